@@ -2,6 +2,9 @@
 """Tests for the client."""
 
 
+import Queue
+import threading
+import time
 
 # Need to import client to add the flags.
 from grr.client import actions
@@ -180,6 +183,58 @@ class BasicContextTests(test_lib.GRRBaseTest):
     for item in queue.Get():
       result.append(item)
     self.assertEqual(result, ["C"] * 10 + ["A", "B"] * 10)
+    self.assertEqual(queue.Size(), 0)
+
+  def testSizeQueuePartialGet(self):
+    queue = comms.SizeQueue(maxsize=10000000)
+    for i in range(10):
+      queue.Put("%d" % i * 10, 1)
+
+    # Items are returned while their total size fits max_size.
+    self.assertEqual(
+        list(queue.Get(max_size=35)), ["0" * 10, "1" * 10, "2" * 10])
+    self.assertEqual(queue.Size(), 70)
+
+    # The first item is returned even if it is larger than max_size.
+    self.assertEqual(list(queue.Get(max_size=5)), ["3" * 10])
+    self.assertEqual(len(list(queue.Get())), 6)
+    self.assertEqual(queue.Size(), 0)
+
+  def testSizeQueueFull(self):
+    queue = comms.SizeQueue(maxsize=10)
+    queue.Put("A" * 10, 1)
+    self.assertTrue(queue.Full())
+
+    with self.assertRaises(Queue.Full):
+      queue.Put("B", 1, block=False)
+    with self.assertRaises(Queue.Full):
+      queue.Put("B", 1, timeout=0.1)
+
+    # High priority items are queued regardless of the size.
+    queue.Put("C", rdf_flows.GrrMessage.Priority.HIGH_PRIORITY, block=False)
+    self.assertEqual(list(queue.Get()), ["C", "A" * 10])
+
+  def testSizeQueueBlockingPut(self):
+    queue = comms.SizeQueue(maxsize=10)
+    queue.Put("A" * 10, 1)
+
+    done = threading.Event()
+
+    def Put():
+      queue.Put("B", 1)
+      done.set()
+
+    thread = threading.Thread(target=Put)
+    thread.start()
+    self.assertFalse(done.wait(0.1))
+
+    # Draining the queue wakes the writer up straight away.
+    start_time = time.time()
+    self.assertEqual(list(queue.Get(max_size=1)), ["A" * 10])
+    self.assertTrue(done.wait(5))
+    self.assertLess(time.time() - start_time, 0.5)
+    thread.join()
+    self.assertEqual(list(queue.Get()), ["B"])
 
 
 def main(argv):
@@ -70,6 +70,8 @@ Examples:
 
 
 import base64
+import heapq
+import itertools
 import os
 
 import pdb
@@ -939,14 +941,21 @@ class SizeQueue(object):
   on. In the client we want to limit the total memory footprint, hence we need
   to use the total size as a measure of how full the queue is.
 
-  TODO(user): this class needs some attention to ensure it is thread safe.
+  Items are returned highest priority first, and in the order they were put on
+  the queue within a priority. All methods are thread safe.
   """
-  total_size = 0
+
+  # Blocked writers wake up this often to heartbeat the nanny.
+  HEARTBEAT_INTERVAL = 1
 
   def __init__(self, maxsize=1024, nanny=None):
-    self.lock = threading.RLock()
+    self.lock = threading.Lock()
+    # Notified whenever items are removed from the queue.
+    self.not_full = threading.Condition(self.lock)
+    # A heap of (-1 * priority, sequence number, item), ordered by priority
+    # first and then by insertion order.
     self.queue = []
-    self._reversed = []
+    self._sequence = itertools.count()
     self.total_size = 0
     self.maxsize = maxsize
     self.nanny = nanny
@@ -965,7 +974,7 @@ class SizeQueue(object):
       item: The item to put - must have a __len__() method.
       priority: The priority of this message.
       block: If True we block indefinitely.
-      timeout: Maximum time we spend waiting on the queue (1 sec resolution).
+      timeout: Maximum time in seconds we spend waiting on the queue.
 
     Raises:
       Queue.Full: if the queue is full and block is False, or
@@ -975,45 +984,62 @@ class SizeQueue(object):
     if isinstance(item, rdfvalue.RDFValue):
       item = item.SerializeToString()
 
-    if priority >= rdf_flows.GrrMessage.Priority.HIGH_PRIORITY:
-      pass  # If high priority is set we dont care about the size of the queue.
+    with self.not_full:
+      # If high priority is set we dont care about the size of the queue.
+      if priority < rdf_flows.GrrMessage.Priority.HIGH_PRIORITY:
+        if not block:
+          if self.total_size >= self.maxsize:
+            raise Queue.Full
 
-    elif not block:
-      if self.total_size >= self.maxsize:
-        raise Queue.Full
-
-    else:
-      count = 0
-      # Wait until the queue has more space. We do not hold the lock here to
-      # ensure that the posting thread can drain this queue while we block here.
-      while self.total_size >= self.maxsize:
-        time.sleep(1)
-        self.nanny.Heartbeat()
-        count += 1
-
-        if timeout and count > timeout:
-          raise Queue.Full
-
-    with self.lock:
-      self.queue.append((-1 * priority, item))
+        else:
+          deadline = timeout and time.time() + timeout
+          # Waiting releases the lock, so the posting thread can drain this
+          # queue while we block here.
+          while self.total_size >= self.maxsize:
+            wait_time = self.HEARTBEAT_INTERVAL
+            if deadline:
+              wait_time = min(wait_time, deadline - time.time())
+              if wait_time <= 0:
+                raise Queue.Full
+
+            self.not_full.wait(wait_time)
+            if self.nanny:
+              self.nanny.Heartbeat()
+
+      heapq.heappush(self.queue, (-1 * priority, next(self._sequence), item))
       self.total_size += len(item)
 
-  def Get(self):
-    """Retrieves the items from the queue."""
-    with self.lock:
-      if self._reversed:
-        # We have leftovers from a partial Get().
-        self._reversed.reverse()
-        self.queue = self._reversed + self.queue
+  def Get(self, max_size=None):
+    """Retrieves the items from the queue.
+
+    Items are removed from the queue as they are yielded, so a partial Get()
+    leaves the remaining items queued.
 
-      self.queue.sort(key=lambda msg: msg[0])  # by priority only.
-      self.queue.reverse()
-      self._reversed, self.queue = self.queue, []
+    Args:
+      max_size: If set, stop before the total size of the returned items
+        exceeds this. The first item is always returned so that items larger
+        than max_size can still be sent.
 
-      while self._reversed:
-        item = self._reversed.pop()[1]
+    Yields:
+      The queued items, highest priority first.
+    """
+    returned_size = 0
+    while True:
+      with self.not_full:
+        if not self.queue:
+          return
+
+        item = self.queue[0][2]
+        if (max_size is not None and returned_size and
+            returned_size + len(item) > max_size):
+          return
+
+        heapq.heappop(self.queue)
         self.total_size -= len(item)
-        yield item
+        returned_size += len(item)
+        self.not_full.notify_all()
+
+      yield item
 
   def Size(self):
     return self.total_size
@@ -1079,22 +1105,17 @@ class GRRThreadedWorker(GRRClientWorker, threading.Thread):
     client connects.
 
     Args:
-       max_size: The size (in bytes) of the returned protobuf will be at most
-       one message length over this size.
+       max_size: The total size (in bytes) of the returned messages will be at
+       most this, unless the first message is larger.
 
     Returns:
        A MessageList protobuf
     """
     queue = rdf_flows.MessageList()
-    length = 0
 
-    for message in self._out_queue.Get():
+    for message in self._out_queue.Get(max_size=max_size):
       queue.job.Append(rdf_flows.GrrMessage.FromSerializedString(message))
       stats.STATS.IncrementCounter("grr_client_sent_messages")
-      length += len(message)
-
-      if length > max_size:
-        break
 
     return queue
 
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""Stress test for the client output queue."""
+
+
+import threading
+import time
+
+
+from grr.client import comms
+from grr.lib import flags
+from grr.lib import test_lib
+from grr.lib.rdfvalues import protodict as rdf_protodict
+
+
+class OutQueueBenchmark(test_lib.MicroBenchmarks):
+  """Replies from client actions passing through the output queue to a POST.
+
+  ACTION_THREADS threads send replies the way client actions do, while a
+  posting thread drains the queue into message lists and serializes them, which
+  is what the HTTP client does before each POST. Each POST then takes
+  POST_LATENCY seconds. The queue only holds a few replies, so the actions
+  block on it most of the time.
+  """
+
+  labels = ["benchmark"]
+  units = "s"
+
+  ACTION_THREADS = 4
+  REPLIES_PER_THREAD = 2000
+  REPLY_SIZE = 10000
+  MAX_OUT_QUEUE = 100000
+  MAX_POST_SIZE = 50000
+  POST_LATENCY = 0.01
+
+  def setUp(self):
+    super(OutQueueBenchmark, self).setUp(["Value"], ["<15"])
+
+  def testActionsToPost(self):
+    """Throughput of replies from client actions to the POST body."""
+    with test_lib.ConfigOverrider({
+        "Client.max_out_queue": self.MAX_OUT_QUEUE
+    }):
+      worker = comms.GRRThreadedWorker(start_worker_thread=False)
+
+    payload = rdf_protodict.DataBlob(data="x" * self.REPLY_SIZE)
+    block_times = []
+    lock = threading.Lock()
+
+    def Action():
+      slowest = 0
+      for i in xrange(self.REPLIES_PER_THREAD):
+        start = time.time()
+        worker.SendReply(payload, session_id="W:benchmark", response_id=i)
+        slowest = max(slowest, time.time() - start)
+      with lock:
+        block_times.append(slowest)
+
+    actions = [
+        threading.Thread(target=Action) for _ in xrange(self.ACTION_THREADS)
+    ]
+
+    start_time = time.time()
+    for action in actions:
+      action.start()
+
+    total = self.ACTION_THREADS * self.REPLIES_PER_THREAD
+    posted = posts = post_bytes = 0
+    while posted < total:
+      message_list = worker.Drain(max_size=self.MAX_POST_SIZE)
+      if not message_list.job:
+        time.sleep(0.001)
+        continue
+      post_bytes += len(message_list.SerializeToString())
+      time.sleep(self.POST_LATENCY)
+      posted += len(message_list.job)
+      posts += 1
+      self.assertLessEqual(
+          sum(len(m.SerializeToString()) for m in message_list.job),
+          self.MAX_POST_SIZE)
+
+    elapsed_time = time.time() - start_time
+    for action in actions:
+      action.join()
+
+    self.AddResult("Replies posted", elapsed_time, total,
+                   "%d/s" % (total / elapsed_time))
+    self.AddResult("POSTs", elapsed_time, posts,
+                   "%.1f MB/s" % (post_bytes / elapsed_time / 1024 / 1024))
+    self.AddResult("Slowest blocked reply", max(block_times), 1, "")
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -13,6 +13,10 @@ config_lib.DEFINE_string("Datastore.implementation", "FakeDataStore",
 config_lib.DEFINE_string("Blobstore.implementation", "MemoryStreamBlobstore",
                          "Blob storage subsystem to use.")
 
+config_lib.DEFINE_integer("Blobstore.known_blobs_cache_size", 100000,
+                          "Number of digests of blobs known to be stored that "
+                          "are remembered, writes of these blobs are skipped.")
+
 DATASTORE_PATHING = [
     r"%{(?P<path>files/hash/generic/sha256/...).*}",
     r"%{(?P<path>files/hash/generic/sha1/...).*}",
@@ -35,6 +39,21 @@ config_lib.DEFINE_string(
     help=("Location of the data store (usually a "
           "filesystem directory)"))
 
+# AFF4 attribute cache.
+config_lib.DEFINE_integer(
+    "AFF4.attribute_cache_max_size",
+    default=0,
+    help=("Maximum number of AFF4 objects whose attributes are kept in the "
+          "process wide read cache used by read only opens. 0 disables the "
+          "cache."))
+
+config_lib.DEFINE_integer(
+    "AFF4.attribute_cache_max_age",
+    default=10,
+    help=("Number of seconds attributes stay in the AFF4 attribute cache. "
+          "Writes from other processes become visible after at most this "
+          "long."))
+
 # SQLite data store.
 config_lib.DEFINE_integer(
     "SqliteDatastore.vacuum_check",
@@ -67,6 +86,19 @@ config_lib.DEFINE_integer(
     help=("Number of file handles kept in the SQLite "
           "data_store cache."))
 
+config_lib.DEFINE_integer(
+    "SqliteDatastore.group_commit_size",
+    default=500,
+    help=("Writes made with sync=False are committed together with later "
+          "writes to the same sqlite file. This many writes are committed "
+          "in a single transaction at most."))
+
+config_lib.DEFINE_float(
+    "SqliteDatastore.group_commit_interval",
+    default=0.5,
+    help=("Maximum time in seconds writes made with sync=False stay "
+          "uncommitted. Other processes only see them once committed."))
+
 # MySQLAdvanced data store.
 config_lib.DEFINE_string("Mysql.host", "localhost",
                          "The MySQL server hostname.")
@@ -154,6 +186,13 @@ config_lib.DEFINE_integer(
     help=("Number of seconds to wait in-between attempts"
           "to reconnect to the database."))
 
+config_lib.DEFINE_integer(
+    "HTTPDataStore.max_pipelined_requests",
+    100,
+    help=("Maximum number of requests sent on a single data server "
+          "connection before their responses are read. Further requests "
+          "wait until responses arrive."))
+
 config_lib.DEFINE_string(
     "CloudBigtable.project_id",
     default=None,
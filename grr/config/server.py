@@ -37,6 +37,25 @@ config_lib.DEFINE_integer("Worker.queue_shards", 5,
                           "Queue notifications will be sharded across "
                           "this number of datastore subjects.")
 
+config_lib.DEFINE_string("Worker.notification_socket_dir", "",
+                         "A directory in which workers bind unix sockets to "
+                         "be woken up when new notifications are written by "
+                         "other processes on this host (e.g. the frontend). "
+                         "When empty, only workers running in the same "
+                         "process as the writer are woken up and all others "
+                         "poll the notification shards.")
+
+config_lib.DEFINE_bool("Worker.lease_queue_shards", False,
+                       "If set, every worker leases a share of the "
+                       "notification shards and only processes notifications "
+                       "from its own shards, so workers don't compete for the "
+                       "same flows.")
+
+config_lib.DEFINE_integer("Worker.queue_shard_lease_time", 60,
+                          "Lease time in seconds for notification shards. "
+                          "Shards of workers which stopped are taken over by "
+                          "other workers after this time.")
+
 config_lib.DEFINE_list("Frontend.well_known_flows", ["TransferStore", "Stats"],
                        "Allow these well known flows to run directly on the "
                        "frontend. Other flows are scheduled as normal.")
@@ -106,6 +125,30 @@ config_lib.DEFINE_integer("Frontend.port_max", None,
                           "use ports between Frontend.bind_port and "
                           "Frontend.port_max.")
 
+config_lib.DEFINE_choice(
+    name="Frontend.server_mode",
+    default="threaded",
+    choices=["threaded", "async"],
+    help="How the frontend serves client connections. threaded uses a thread "
+    "per connection, async multiplexes all connections on an event loop and "
+    "processes complete requests in a pool of Frontend.async_worker_threads "
+    "threads.")
+
+config_lib.DEFINE_integer("Frontend.async_worker_threads", 10,
+                          "Number of threads processing client requests when "
+                          "Frontend.server_mode is async.")
+
+config_lib.DEFINE_integer("Frontend.async_max_request_size", 64 * 1024 * 1024,
+                          "Requests larger than this are answered with 413 "
+                          "and their connection is closed when "
+                          "Frontend.server_mode is async. This must be larger "
+                          "than Client.max_post_size.")
+
+config_lib.DEFINE_integer("Frontend.async_max_backlog", 1000,
+                          "Maximum number of requests waiting for a worker "
+                          "thread when Frontend.server_mode is async. No more "
+                          "requests are read while it is full.")
+
 config_lib.DEFINE_integer("Frontend.max_queue_size", 500,
                           "Maximum number of messages to queue for the client.")
 
@@ -117,12 +160,43 @@ config_lib.DEFINE_integer("Frontend.message_expiry_time", 600,
                           "Maximum time messages remain valid within the "
                           "system.")
 
+config_lib.DEFINE_integer("Frontend.cipher_cache_max_size", 50000,
+                          "Maximum number of verified client session ciphers "
+                          "the frontend keeps. Messages encrypted with a "
+                          "cached cipher need no RSA operations.")
+
+config_lib.DEFINE_integer("Frontend.cipher_cache_max_age", 24 * 60 * 60,
+                          "Maximum time in seconds a verified client session "
+                          "cipher is cached for. Clients reuse their cipher for "
+                          "a day.")
+
 config_lib.DEFINE_string("Frontend.upload_store", "FileUploadFileStore",
                          "The implementation of the upload file store.")
 
 config_lib.DEFINE_string("FileUploadFileStore.root_dir", "/tmp/",
                          "Where to store files uploaded.")
 
+config_lib.DEFINE_integer("FileStore.ingestion_threads", 4,
+                          "Number of threads adding downloaded files to the "
+                          "file store. When 0, files are added by the worker "
+                          "that processes the event.")
+
+config_lib.DEFINE_string("FileStore.hash_index_path", "",
+                         "A file in which the index of hashes known to be in "
+                         "the hash file store is kept between restarts. It "
+                         "can be shared by processes on the same host. When "
+                         "empty, the index is only kept in memory.")
+
+config_lib.DEFINE_integer("FileStore.hash_index_max_pending", 100000,
+                          "Number of hashes added to the hash index which are "
+                          "kept in memory before they are merged into the "
+                          "sorted index.")
+
+config_lib.DEFINE_string("FileStore.nsrl_index_path", "",
+                         "An NSRL index file written by import_nsrl_hashes "
+                         "--nsrl_index. When set, NSRL lookups are served from "
+                         "this file instead of the data store.")
+
 config_lib.DEFINE_bool("Server.initialized", False,
                        "True once config_updater initialize has been "
                        "run at least once.")
@@ -3,11 +3,13 @@
 
 
 
+import collections
 import cStringIO
 import itertools
 import os
 import re
 import sys
+import threading
 import zipfile
 
 
@@ -24,6 +26,76 @@ from grr.lib.rdfvalues import structs as rdf_structs
 from grr.proto import api_utils_pb2
 
 
+class _ThreadedIterator(object):
+  """Runs an iterator on a separate thread.
+
+  Items are buffered until the consumer asks for them. The producer blocks
+  while the buffered items are larger than max_size bytes, as measured by
+  size_fn. An exception raised by the iterator is reraised in the consumer.
+  """
+
+  def __init__(self, iterator, max_size, size_fn=len, name=None):
+    self._iterator = iterator
+    self._max_size = max_size
+    self._size_fn = size_fn
+
+    self._cond = threading.Condition()
+    self._items = collections.deque()
+    self._size = 0
+    self._done = False
+    self._stopped = False
+    self._exc_info = None
+
+    self._thread = threading.Thread(target=self._Run, name=name)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _Run(self):
+    try:
+      for item in self._iterator:
+        size = self._size_fn(item)
+        with self._cond:
+          # A single item larger than max_size is let through on its own.
+          while (self._items and self._size + size > self._max_size and
+                 not self._stopped):
+            self._cond.wait()
+          if self._stopped:
+            break
+          self._items.append((item, size))
+          self._size += size
+          self._cond.notify_all()
+    except Exception:  # pylint: disable=broad-except
+      self._exc_info = sys.exc_info()
+    finally:
+      close = getattr(self._iterator, "close", None)
+      if close is not None:
+        close()
+      with self._cond:
+        self._done = True
+        self._cond.notify_all()
+
+  def __iter__(self):
+    try:
+      while True:
+        with self._cond:
+          while not self._items and not self._done:
+            self._cond.wait()
+          if not self._items:
+            break
+          item, size = self._items.popleft()
+          self._size -= size
+          self._cond.notify_all()
+        yield item
+
+      if self._exc_info:
+        raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+    finally:
+      # Stops the producer if the consumer goes away early.
+      with self._cond:
+        self._stopped = True
+        self._cond.notify_all()
+
+
 class CollectionArchiveGenerator(object):
   """Class that generates downloaded files archive from a collection."""
 
@@ -36,6 +108,11 @@ class CollectionArchiveGenerator(object):
       "# blobs in the data store to archive.\n")
 
   BATCH_SIZE = 1000
+  # Chunks of upcoming files are read ahead of the archive writer while they
+  # fit into this many bytes.
+  PREFETCH_SIZE = 64 * 1024 * 1024
+  # Archive output waiting to be sent, in bytes.
+  OUTPUT_BUFFER_SIZE = 8 * 1024 * 1024
 
   def __init__(self,
                archive_format=ZIP,
@@ -123,18 +200,16 @@ class CollectionArchiveGenerator(object):
         manifest_fd, os.path.join(self.prefix, "MANIFEST"), st=st):
       yield chunk
 
-  def Generate(self, collection, token=None):
-    """Generates archive from a given collection.
-
-    Iterates the collection and generates an archive by yielding contents
-    of every referenced AFF4Stream.
+  def _GenerateArchiveOps(self, collection, token=None):
+    """Reads the collection's files and yields the archive operations.
 
     Args:
       collection: Iterable with items that point to aff4 paths.
       token: User's ACLToken.
 
     Yields:
-      Binary chunks comprising the generated archive.
+      (method name, args) tuples, each describing a call to the archive
+      generator. The file chunks are passed in the args.
     """
     hashes = set()
     for fd_urn_batch in utils.Grouper(
@@ -166,8 +241,7 @@ class CollectionArchiveGenerator(object):
             hashes.add(sha256_hash)
 
           up_prefix = "../" * len(fd.urn.Split())
-          yield self.archive_generator.WriteSymlink(up_prefix + content_path,
-                                                    archive_path)
+          yield "WriteSymlink", (up_prefix + content_path, archive_path)
 
       if fds_to_write:
         prev_fd = None
@@ -180,23 +254,67 @@ class CollectionArchiveGenerator(object):
             continue
 
           if prev_fd != fd:
-            if prev_fd:
-              yield self.archive_generator.WriteFileFooter()
+            if prev_fd is not None:
+              yield "WriteFileFooter", ()
             prev_fd = fd
 
             content_path, st = fds_to_write[fd]
-            yield self.archive_generator.WriteFileHeader(content_path, st=st)
+            yield "WriteFileHeader", (content_path, st)
+
+          yield "WriteFileChunk", (chunk,)
+
+        if prev_fd is not None:
+          yield "WriteFileFooter", ()
 
-          yield self.archive_generator.WriteFileChunk(chunk)
+  @staticmethod
+  def _ArchiveOpSize(op):
+    _, args = op
+    return sum(len(arg) for arg in args if isinstance(arg, basestring))
 
-        if self.archive_generator.is_file_write_in_progress:
-          yield self.archive_generator.WriteFileFooter()
+  def _WriteArchive(self, ops):
+    """Applies the archive operations, yielding the archive's binary chunks."""
+    for method_name, args in ops:
+      if method_name == "WriteFileHeader":
+        content_path, st = args
+        yield self.archive_generator.WriteFileHeader(content_path, st=st)
+      else:
+        yield getattr(self.archive_generator, method_name)(*args)
 
     for chunk in self._WriteDescription():
       yield chunk
 
     yield self.archive_generator.Close()
 
+  def Generate(self, collection, token=None):
+    """Generates archive from a given collection.
+
+    Iterates the collection and generates an archive by yielding contents
+    of every referenced AFF4Stream.
+
+    The work is pipelined: one thread reads the files, streaming the chunks of
+    up to BATCH_SIZE files at a time and keeping up to PREFETCH_SIZE bytes
+    ahead of the archive writer. Another thread compresses and writes the
+    archive while the caller sends out the previous output.
+
+    Args:
+      collection: Iterable with items that point to aff4 paths.
+      token: User's ACLToken.
+
+    Yields:
+      Binary chunks comprising the generated archive.
+    """
+    ops = _ThreadedIterator(
+        self._GenerateArchiveOps(collection, token=token),
+        self.PREFETCH_SIZE,
+        size_fn=self._ArchiveOpSize,
+        name="CollectionArchiveReader")
+    output = _ThreadedIterator(
+        self._WriteArchive(ops),
+        self.OUTPUT_BUFFER_SIZE,
+        name="CollectionArchiveWriter")
+    for chunk in output:
+      yield chunk
+
 
 class ApiDataObjectKeyValuePair(rdf_structs.RDFProtoStruct):
   """Defines a proto for returning key value pairs of data objects."""
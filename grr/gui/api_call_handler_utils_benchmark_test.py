@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""Benchmark for generating file archives from collections."""
+
+
+import hashlib
+import os
+import time
+
+
+from grr.gui import api_call_handler_utils
+from grr.lib import aff4
+from grr.lib import data_store
+from grr.lib import flags
+from grr.lib import test_lib
+from grr.lib import utils
+from grr.lib.aff4_objects import aff4_grr
+from grr.lib.rdfvalues import client as rdf_client
+from grr.lib.rdfvalues import crypto as rdf_crypto
+from grr.lib.rdfvalues import paths as rdf_paths
+
+
+class CollectionArchiveGeneratorBenchmark(test_lib.MicroBenchmarks):
+  """Archives a collection of FILES downloaded files.
+
+  The files are blob images like the ones MultiGetFile writes. Each of them
+  holds FILE_SIZE bytes, half random and half compressible. Every multi
+  subject read from the data store additionally waits DATA_STORE_LATENCY
+  seconds, which is roughly the round trip time to a remote data store.
+  """
+
+  labels = ["benchmark"]
+  units = "s"
+
+  FILES = 10000
+  FILE_SIZE = 8 * 1024
+  DATA_STORE_LATENCY = 0.002
+
+  def setUp(self):
+    super(CollectionArchiveGeneratorBenchmark, self).setUp(["Value"], ["<20"])
+
+  def _CreateFiles(self, client_id):
+    stat_entries = []
+    for i in xrange(self.FILES):
+      content = os.urandom(self.FILE_SIZE / 2) + "%08d" % i * (
+          self.FILE_SIZE / 16)
+      digest = data_store.DB.StoreBlob(content, token=self.token)
+
+      pathspec = rdf_paths.PathSpec(
+          path="files/file%05d" % i, pathtype=rdf_paths.PathSpec.PathType.OS)
+      with aff4.FACTORY.Create(
+          pathspec.AFF4Path(client_id),
+          aff4_grr.VFSBlobImage,
+          token=self.token) as fd:
+        fd.SetChunksize(512 * 1024)
+        fd.AddBlob(digest.decode("hex"), len(content))
+        fd.Set(
+            fd.Schema.HASH,
+            rdf_crypto.Hash(sha256=hashlib.sha256(content).digest()))
+
+      stat_entries.append(rdf_client.StatEntry(pathspec=pathspec))
+    return stat_entries
+
+  def MultiResolvePrefix(self, *args, **kwargs):
+    time.sleep(self.latency)
+    return self.multi_resolve_prefix(*args, **kwargs)
+
+  def testGenerateArchive(self):
+    """Throughput of archiving a collection of FILES files."""
+    client_id = rdf_client.ClientURN("C.1000000000000000")
+    stat_entries = self._CreateFiles(client_id)
+
+    self.multi_resolve_prefix = data_store.DB.MultiResolvePrefix
+    generator_cls = api_call_handler_utils.CollectionArchiveGenerator
+    for latency in [0, self.DATA_STORE_LATENCY]:
+      self.latency = latency
+      with utils.Stubber(data_store.DB, "MultiResolvePrefix",
+                         self.MultiResolvePrefix):
+        for archive_format in [generator_cls.ZIP, generator_cls.TAR_GZ]:
+          generator = generator_cls(
+              archive_format=archive_format,
+              prefix="benchmark",
+              client_id=client_id)
+
+          start_time = time.time()
+          for _ in generator.Generate(stat_entries, token=self.token):
+            pass
+          elapsed_time = time.time() - start_time
+
+          self.assertEqual(generator.archived_files, self.FILES)
+          self.AddResult("%s, %.0fms latency" % (archive_format, latency * 1000),
+                         elapsed_time, self.FILES,
+                         "%d files/s, %.1f MB/s" %
+                         (self.FILES / elapsed_time, self.FILES *
+                          self.FILE_SIZE / elapsed_time / 1024 / 1024))
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -7,6 +7,7 @@
 import hashlib
 import os
 import tarfile
+import threading
 import zipfile
 
 
@@ -17,6 +18,7 @@ from grr.gui import api_call_handler_utils
 from grr.lib import aff4
 from grr.lib import flags
 from grr.lib import test_lib
+from grr.lib import utils
 from grr.lib.aff4_objects import collects
 from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import crypto as rdf_crypto
@@ -283,6 +285,48 @@ class CollectionArchiveGeneratorTest(test_lib.GRRBaseTest):
     })
 
 
+  def testArchivesAllFilesWithTinyReadAheadBudget(self):
+    generator_cls = api_call_handler_utils.CollectionArchiveGenerator
+    with utils.MultiStubber((generator_cls, "BATCH_SIZE", 1),
+                            (generator_cls, "PREFETCH_SIZE", 1),
+                            (generator_cls, "OUTPUT_BUFFER_SIZE", 1)):
+      _, fd_path = self._GenerateArchive(
+          self.stat_entries, archive_format=generator_cls.TAR_GZ)
+
+    with tarfile.open(fd_path) as tar_fd:
+      link1_dest = ("test_prefix/hashes/91e9240f415223982edc345532630710"
+                    "e94a7f52cd5f48f5ee1afc555078f0ab")
+      link2_dest = ("test_prefix/hashes/87298cc2f31fba73181ea2a9e6ef10dc"
+                    "e21ed95e98bdac9c4e1504ea16f486e4")
+      self.assertEqual(tar_fd.extractfile(link1_dest).read(), "hello1")
+      self.assertEqual(tar_fd.extractfile(link2_dest).read(), "hello2")
+
+      manifest_fd = tar_fd.extractfile("test_prefix/MANIFEST")
+      self.assertEqual(yaml.safe_load(manifest_fd.read())["archived_files"], 2)
+
+  def testRaisesErrorsFromReadingTheCollection(self):
+
+    def BrokenCollection():
+      yield self.stat_entries[0]
+      raise RuntimeError("Collection is broken.")
+
+    with self.assertRaises(RuntimeError):
+      self._GenerateArchive(BrokenCollection())
+
+  def testStopsWorkerThreadsWhenConsumerStops(self):
+    archive_generator = api_call_handler_utils.CollectionArchiveGenerator(
+        prefix="test_prefix", client_id=self.client_id)
+    content = archive_generator.Generate(
+        self.stat_entries * 1000, token=self.token)
+    content.next()
+    content.close()
+
+    for thread in threading.enumerate():
+      if thread.name in ("CollectionArchiveReader", "CollectionArchiveWriter"):
+        thread.join(10)
+        self.assertFalse(thread.isAlive())
+
+
 class FilterCollectionTest(test_lib.GRRBaseTest):
   """Test for FilterCollection."""
 
@@ -3,7 +3,6 @@
 
 import functools
 import itertools
-import operator
 import re
 
 import logging
@@ -163,6 +162,24 @@ class ApiHunt(rdf_structs.RDFProtoStruct):
 
     return self
 
+  def InitFromHuntSummary(self, summary):
+    """Initializes the fields shown in hunt listings from a HuntSummary."""
+    self.urn = summary.session_id
+    self.name = summary.hunt_name
+    self.state = summary.state
+    self.crash_limit = summary.crash_limit
+    self.client_limit = summary.client_limit
+    self.client_rate = summary.client_rate
+    self.created = summary.create_time
+    self.expires = summary.expires
+    self.creator = summary.creator
+    self.description = summary.description
+    self.is_robot = summary.creator == "GRRWorker"
+    self.total_cpu_usage = summary.total_cpu_usage
+    self.total_net_usage = summary.total_net_usage
+
+    return self
+
 
 class ApiHuntResult(rdf_structs.RDFProtoStruct):
   """API hunt results object."""
@@ -218,24 +235,27 @@ class ApiListHuntsResult(rdf_structs.RDFProtoStruct):
 
 
 class ApiListHuntsHandler(api_call_handler_base.ApiCallHandler):
-  """Renders list of available hunts."""
+  """Renders list of available hunts.
+
+  Hunts are listed from their summaries in the hunts index, without opening
+  them.
+  """
 
   args_type = ApiListHuntsArgs
   result_type = ApiListHuntsResult
 
-  def _BuildHuntList(self, hunt_list):
-    hunt_list = sorted(
-        hunt_list,
-        reverse=True,
-        key=lambda hunt: hunt.GetRunner().context.create_time)
+  def _BuildHuntList(self, summaries):
+    return [ApiHunt().InitFromHuntSummary(summary) for summary in summaries]
 
-    return [ApiHunt().InitFromAff4Object(hunt_obj) for hunt_obj in hunt_list]
+  def _ParseSummary(self, entry):
+    _, _, value = entry
+    return rdf_hunts.HuntSummary.FromSerializedString(value)
 
-  def _CreatedByFilter(self, username, hunt_obj):
-    return hunt_obj.context.creator == username
+  def _CreatedByFilter(self, username, summary):
+    return summary.creator == username
 
-  def _DescriptionContainsFilter(self, substring, hunt_obj):
-    return substring in hunt_obj.runner_args.description
+  def _DescriptionContainsFilter(self, substring, summary):
+    return substring in summary.description
 
   def _Username(self, username, token):
     if username == "me":
@@ -275,69 +295,51 @@ class ApiListHuntsHandler(api_call_handler_base.ApiCallHandler):
     else:
       return None
 
+  def _GetIndex(self, token):
+    """Returns the hunts index, raising if it misses hunts."""
+    index = implementation.HuntSummaryIndex(token=token)
+    index.CheckComplete()
+    return index
+
   def HandleNonFiltered(self, args, token):
-    fd = aff4.FACTORY.Open("aff4:/hunts", mode="r", token=token)
-    children = list(fd.ListChildren())
-    total_count = len(children)
-    children.sort(key=operator.attrgetter("age"), reverse=True)
+    index = self._GetIndex(token)
+    # Only the summaries of the requested page are read.
+    entries = index.ListHunts()
+    total_count = len(entries)
     if args.count:
-      children = children[args.offset:args.offset + args.count]
+      entries = entries[args.offset:args.offset + args.count]
     else:
-      children = children[args.offset:]
-
-    hunt_list = []
-    for hunt in fd.OpenChildren(children=children):
-      # Legacy hunts may have hunt.context == None: we just want to skip them.
-      if not isinstance(hunt, implementation.GRRHunt) or not hunt.context:
-        continue
-
-      hunt_list.append(hunt)
+      entries = entries[args.offset:]
 
     return ApiListHuntsResult(
-        total_count=total_count, items=self._BuildHuntList(hunt_list))
+        total_count=total_count,
+        items=self._BuildHuntList(
+            self._ParseSummary(entry)
+            for entry in index.ReadSummaries(entries)))
 
   def HandleFiltered(self, filter_func, args, token):
-    fd = aff4.FACTORY.Open("aff4:/hunts", mode="r", token=token)
-    children = list(fd.ListChildren())
-    children.sort(key=operator.attrgetter("age"), reverse=True)
-
     if not args.active_within:
       raise ValueError("active_within filter has to be used when "
                        "any kind of filtering is done (to prevent "
                        "queries of death)")
 
     min_age = rdfvalue.RDFDatetime.Now() - args.active_within
-    active_children = []
-    for child in children:
-      if child.age > min_age:
-        active_children.append(child)
-      else:
-        break
-
+    min_age = min_age.AsMicroSecondsFromEpoch()
     index = 0
-    hunt_list = []
-    active_children_map = {}
-    for hunt in fd.OpenChildren(children=active_children):
-      # Legacy hunts may have hunt.context == None: we just want to skip them.
-      if (not isinstance(hunt, implementation.GRRHunt) or not hunt.context or
-          not filter_func(hunt)):
-        continue
-      active_children_map[hunt.urn] = hunt
-
-    for urn in active_children:
-      try:
-        hunt = active_children_map[urn]
-      except KeyError:
+    summaries = []
+    for entry in self._GetIndex(token).ReadAll(min_create_time=min_age):
+      summary = self._ParseSummary(entry)
+      if not filter_func(summary):
         continue
 
       if index >= args.offset:
-        hunt_list.append(hunt)
+        summaries.append(summary)
 
       index += 1
-      if args.count and len(hunt_list) >= args.count:
+      if args.count and len(summaries) >= args.count:
         break
 
-    return ApiListHuntsResult(items=self._BuildHuntList(hunt_list))
+    return ApiListHuntsResult(items=self._BuildHuntList(summaries))
 
   def Handle(self, args, token=None):
     filter_func = self._BuildFilter(args, token)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""Benchmark for listing hunts."""
+
+
+import time
+
+
+from grr.gui.api_plugins import hunt as hunt_plugin
+from grr.lib import flags
+from grr.lib import maintenance_utils
+from grr.lib import test_lib
+from grr.lib.hunts import implementation
+from grr.lib.hunts import standard_test
+
+
+class ApiListHuntsHandlerBenchmark(test_lib.MicroBenchmarks,
+                                   standard_test.StandardHuntTestMixin):
+  """Lists the newest PAGE_SIZE of HUNTS hunts.
+
+  Adding hunts to the hunts index opens all of them, like every listing did
+  before the index existed.
+  """
+
+  labels = ["benchmark"]
+  units = "s"
+
+  HUNTS = 1000
+  PAGE_SIZE = 50
+
+  def setUp(self):
+    super(ApiListHuntsHandlerBenchmark, self).setUp(["Value"], ["<20"])
+
+  def _List(self, name, args):
+    handler = hunt_plugin.ApiListHuntsHandler()
+    start_time = time.time()
+    result = handler.Handle(args, token=self.token)
+    self.AddResult(name, time.time() - start_time, 1,
+                   "%d hunts" % len(result.items))
+
+  def testListHunts(self):
+    """Time to render a page of the hunts list."""
+    for i in xrange(self.HUNTS):
+      with test_lib.FakeTime(1000 + i):
+        with self.CreateHunt(description="hunt_%d" % i):
+          pass
+
+    index = implementation.HuntSummaryIndex(token=self.token)
+    for hunt_id, _ in index.ListHunts():
+      index.Delete(hunt_id)
+
+    start_time = time.time()
+    maintenance_utils.UpdateHuntSummaryIndex(token=self.token)
+    self.AddResult("Indexing all hunts", time.time() - start_time, 1,
+                   "%d hunts" % self.HUNTS)
+
+    args = hunt_plugin.ApiListHuntsArgs(count=self.PAGE_SIZE)
+    self._List("From the index", args)
+
+    # The hunts were created in 1970.
+    self._List("Filtered, from the index",
+               hunt_plugin.ApiListHuntsArgs(
+                   count=self.PAGE_SIZE,
+                   active_within="30000d",
+                   description_contains="hunt_1"))
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
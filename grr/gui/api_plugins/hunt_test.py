@@ -19,11 +19,13 @@ from grr.lib import action_mocks
 from grr.lib import aff4
 from grr.lib import flags
 from grr.lib import flow
+from grr.lib import maintenance_utils
 from grr.lib import output_plugin
 from grr.lib import rdfvalue
 from grr.lib import test_lib
 from grr.lib import utils
 from grr.lib.aff4_objects import aff4_grr
+from grr.lib.flows.cron import system as cron_system
 from grr.lib.flows.general import file_finder
 from grr.lib.hunts import implementation
 from grr.lib.hunts import standard
@@ -145,6 +147,75 @@ class ApiListHuntsHandlerTest(api_test_lib.ApiCallHandlerTest,
     self.assertEqual(create_times[0], 10 * 60 * 1000000)
     self.assertEqual(create_times[1], 9 * 60 * 1000000)
 
+  def testListsHuntsWithoutOpeningThem(self):
+    for i in range(5):
+      self.CreateHunt(description="hunt_%d" % i)
+
+    with utils.Stubber(aff4.FACTORY, "MultiOpen",
+                       lambda *args, **kwargs: self.fail("Hunts opened.")):
+      result = self.handler.Handle(
+          hunt_plugin.ApiListHuntsArgs(), token=self.token)
+      self.assertEqual(result.total_count, 5)
+
+      result = self.handler.Handle(
+          hunt_plugin.ApiListHuntsArgs(
+              description_contains="hunt_3", active_within="1d"),
+          token=self.token)
+      self.assertEqual([item.description for item in result.items], ["hunt_3"])
+
+  def testOnlyTheSummariesOfThePageAreRead(self):
+    for i in range(5):
+      self.CreateHunt(description="hunt_%d" % i)
+
+    with test_lib.Instrument(implementation.HuntSummaryIndex,
+                             "ReadSummaries") as read:
+      result = self.handler.Handle(
+          hunt_plugin.ApiListHuntsArgs(offset=1, count=2), token=self.token)
+      self.assertEqual(result.total_count, 5)
+      self.assertEqual(len(result.items), 2)
+      self.assertEqual(read.call_count, 1)
+      self.assertEqual(len(read.args[0][1]), 2)
+
+  def testListingFailsWhileHuntsAreMissingFromTheIndex(self):
+    with self.CreateHunt(description="the hunt") as hunt:
+      pass
+
+    index = implementation.HuntSummaryIndex(token=self.token)
+    index.Delete(hunt.urn)
+
+    # Listing hunts does not write to the index.
+    self.assertRaises(
+        implementation.HuntSummaryIndexIncompleteError,
+        self.handler.Handle,
+        hunt_plugin.ApiListHuntsArgs(),
+        token=self.token)
+    self.assertIsNone(index.Read(hunt.urn))
+
+    self.assertEqual(
+        maintenance_utils.UpdateHuntSummaryIndex(token=self.token), 1)
+    self.assertEqual(
+        maintenance_utils.UpdateHuntSummaryIndex(token=self.token), 0)
+
+    # Once all hunts were indexed, the hunts are not listed anymore.
+    with utils.Stubber(aff4.FACTORY, "ListChildren",
+                       lambda *args, **kwargs: self.fail("Hunts listed.")):
+      result = self.handler.Handle(
+          hunt_plugin.ApiListHuntsArgs(), token=self.token)
+    self.assertEqual([item.description for item in result.items], ["the hunt"])
+
+  def testHuntsMissingFromTheIndexAreAddedByTheCronJob(self):
+    with self.CreateHunt(description="the hunt") as hunt:
+      pass
+    implementation.HuntSummaryIndex(token=self.token).Delete(hunt.urn)
+
+    for _ in test_lib.TestFlowHelper(
+        cron_system.UpdateHuntSummaryIndexCronFlow.__name__, token=self.token):
+      pass
+
+    result = self.handler.Handle(
+        hunt_plugin.ApiListHuntsArgs(), token=self.token)
+    self.assertEqual([item.description for item in result.items], ["the hunt"])
+
   def testRaisesIfCreatedByFilterUsedWithoutActiveWithinFilter(self):
     self.assertRaises(
         ValueError,
@@ -273,6 +273,61 @@ def _ValidateAFF4Type(aff4_type):
   return aff4_type
 
 
+class AttributeCache(utils.AgeBasedCache):
+  """A read-through cache of the raw attributes of AFF4 objects.
+
+  Entries are keyed by the object urn and hold a dict mapping the cache
+  invariant (see Factory._MakeCacheInvariant) to the attribute list returned
+  by the data store. Keying by urn means that a write to an object drops all
+  cached variants of it in one go.
+  """
+
+  def __init__(self, max_size=10, max_age=600):
+    super(AttributeCache, self).__init__(max_size=max_size, max_age=max_age)
+    # Readers take a generation before going to the data store and only
+    # populate the cache if the urn was not invalidated in the meantime,
+    # otherwise a concurrent write could be masked by stale data.
+    self.generation = 0
+    self._invalidated_at = {}
+    self._oldest_valid_generation = 0
+
+  def KillObject(self, obj):
+    stats.STATS.IncrementCounter("aff4_cache_evictions")
+
+  @utils.Synchronized
+  def GetValues(self, urn, key):
+    """Returns cached attributes or raises KeyError."""
+    return list(self.Get(urn)[key])
+
+  @utils.Synchronized
+  def PutValues(self, urn, key, values, generation):
+    """Caches attributes read from the data store at the given generation."""
+    if (generation < self._oldest_valid_generation or
+        self._invalidated_at.get(urn, -1) >= generation):
+      return
+
+    try:
+      self.Get(urn)[key] = list(values)
+    except KeyError:
+      self.Put(urn, {key: list(values)})
+
+  @utils.Synchronized
+  def Invalidate(self, urns):
+    """Drops all cached attributes of the given urns."""
+    # Don't let the invalidation log grow unbounded, forgetting it simply
+    # rejects all reads currently in flight.
+    if len(self._invalidated_at) > self._limit:
+      self._invalidated_at = {}
+      self._oldest_valid_generation = self.generation + 1
+
+    for urn in urns:
+      self._invalidated_at[urn] = self.generation
+      if self.Pop(urn) is not None:
+        stats.STATS.IncrementCounter("aff4_cache_invalidations")
+
+    self.generation += 1
+
+
 class Factory(object):
   """A central factory for AFF4 objects."""
 
@@ -284,6 +339,15 @@ class Factory(object):
         max_size=self.intermediate_cache_max_size,
         max_age=self.intermediate_cache_age)
 
+    # The attribute cache is opt-in: it can serve data which was written by
+    # other processes up to max_age seconds ago.
+    self.attribute_cache = None
+    attribute_cache_max_size = config.CONFIG["AFF4.attribute_cache_max_size"]
+    if attribute_cache_max_size > 0:
+      self.attribute_cache = AttributeCache(
+          max_size=attribute_cache_max_size,
+          max_age=config.CONFIG["AFF4.attribute_cache_max_age"])
+
     # Create a token for system level actions. This token is used by other
     # classes such as HashFileStore and NSRLFilestore to create entries under
     # aff4:/files, as well as to create top level paths like aff4:/foreman
@@ -310,16 +374,63 @@ class Factory(object):
 
     raise RuntimeError("Unknown age specification: %s" % age)
 
-  def GetAttributes(self, urns, token=None, age=NEWEST_TIME):
-    """Retrieves all the attributes for all the urns."""
-    urns = set([utils.SmartUnicode(u) for u in urns])
+  def GetAttributes(self,
+                    urns,
+                    token=None,
+                    age=NEWEST_TIME,
+                    use_cache=False,
+                    attributes=None):
+    """Retrieves all the attributes for all the urns.
+
+    Args:
+      urns: The urns to read.
+      token: The token to use.
+      age: The age policy used to read the attributes.
+      use_cache: If True and the attribute cache is enabled, the newest
+          attributes may be served from (and are stored in) the cache. Only
+          callers which do not modify the object should set this.
+      attributes: If set, only these attributes are read. The cache is not
+          used in this case.
+
+    Yields:
+      Tuples of (urn, attributes) for the urns that exist.
+    """
+    cache = self.attribute_cache
+    if not use_cache or age != NEWEST_TIME or attributes is not None:
+      cache = None
+
+    if attributes is None:
+      prefixes = AFF4_PREFIXES
+    else:
+      prefixes = [utils.SmartStr(attribute) for attribute in attributes]
+
+    if cache is None:
+      urns = set([utils.SmartUnicode(u) for u in urns])
+    else:
+      # Normalize the urns so they match the ones invalidated on writes.
+      urns = set([utils.SmartUnicode(rdfvalue.RDFURN(u)) for u in urns])
     to_read = {urn: self._MakeCacheInvariant(urn, token, age) for urn in urns}
 
+    if cache is not None:
+      generation = cache.generation
+      for urn, key in to_read.items():
+        try:
+          values = cache.GetValues(urn, key)
+        except KeyError:
+          stats.STATS.IncrementCounter("aff4_cache_misses")
+          continue
+
+        stats.STATS.IncrementCounter("aff4_cache_hits")
+        del to_read[urn]
+        # Objects which do not exist are cached as well but not reported.
+        if values:
+          yield urn, values
+
     # Urns not present in the cache we need to get from the database.
     if to_read:
       for subject, values in data_store.DB.MultiResolvePrefix(
           to_read,
-          AFF4_PREFIXES,
+          prefixes,
           timestamp=self.ParseAgeSpecification(age),
           token=token,
           limit=None):
@@ -327,7 +438,21 @@ class Factory(object):
         # Ensure the values are sorted.
         values.sort(key=lambda x: x[-1], reverse=True)
 
-        yield utils.SmartUnicode(subject), values
+        subject = utils.SmartUnicode(subject)
+        if cache is not None and subject in to_read:
+          cache.PutValues(subject, to_read.pop(subject), values, generation)
+
+        yield subject, values
+
+      if cache is not None:
+        for urn, key in to_read.iteritems():
+          cache.PutValues(urn, key, [], generation)
+
+  def InvalidateAttributeCache(self, urns):
+    """Drops the cached attributes of the given urns."""
+    if self.attribute_cache is not None:
+      self.attribute_cache.Invalidate(
+          [utils.SmartUnicode(rdfvalue.RDFURN(urn)) for urn in urns])
 
   def SetAttributes(self,
                     urn,
@@ -355,6 +480,9 @@ class Factory(object):
           replace=False,
           sync=sync,
           to_delete=to_delete)
+      # Writes through a mutation pool invalidate the cache when the pool is
+      # flushed.
+      self.InvalidateAttributeCache([urn])
 
     if add_child_index:
       self._UpdateChildIndex(urn, token, mutation_pool=mutation_pool)
@@ -405,6 +533,7 @@ class Factory(object):
           else:
             data_store.DB.MultiSet(
                 dirname, attributes, token=token, replace=True, sync=False)
+            self.InvalidateAttributeCache([dirname])
 
           self.intermediate_cache.Put(urn, 1)
 
@@ -638,6 +767,7 @@ class Factory(object):
     if values:
       data_store.DB.MultiSet(
           new_urn, values, token=token, replace=False, sync=sync)
+      self.InvalidateAttributeCache([new_urn])
 
       self._UpdateChildIndex(new_urn, token)
 
@@ -714,7 +844,9 @@ class Factory(object):
       token = data_store.default_token
 
     if "r" in mode and (local_cache is None or urn not in local_cache):
-      local_cache = dict(self.GetAttributes([urn], age=age, token=token))
+      local_cache = dict(
+          self.GetAttributes(
+              [urn], age=age, token=token, use_cache=mode == "r"))
 
     # Read the row from the table. We know the object already exists if there is
     # some data in the local_cache already for this object.
@@ -767,7 +899,8 @@ class Factory(object):
 
     aff4_type = _ValidateAFF4Type(aff4_type)
 
-    for urn, values in self.GetAttributes(urns, token=token, age=age):
+    for urn, values in self.GetAttributes(
+        urns, token=token, age=age, use_cache=mode == "r"):
       try:
         obj = self.Open(
             urn,
@@ -1196,6 +1329,8 @@ class Factory(object):
   def Flush(self):
     data_store.DB.Flush()
     self.intermediate_cache.Flush()
+    if self.attribute_cache is not None:
+      self.attribute_cache.Flush()
 
   # Well known AFF4 paths.
   def _InitWellKnownPaths(self):
@@ -1737,7 +1872,7 @@ class AFF4Object(object):
       self.synced_attributes = {}
 
       if "r" in mode:
-        if local_cache:
+        if local_cache is not None:
           try:
             for attribute, value, ts in local_cache[utils.SmartUnicode(urn)]:
               self.DecodeValueFromAttribute(attribute, value, ts)
@@ -2728,6 +2863,30 @@ class ChunkCache(utils.FastStore):
     return self.__dict__
 
 
+class ChunkPrefetcher(object):
+  """Fetches chunks of an AFF4ImageBase on a background thread."""
+
+  def __init__(self, fetch_cb, chunks):
+    self.chunks = set(chunks)
+    self.result = {}
+    self.thread = threading.Thread(
+        name="AFF4ImagePrefetch", target=self._Fetch, args=(fetch_cb, chunks))
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _Fetch(self, fetch_cb, chunks):
+    try:
+      self.result = fetch_cb(chunks)
+    except Exception as e:  # pylint: disable=broad-except
+      # The chunks will simply be read again when they are needed.
+      logging.warning("Prefetching chunks failed: %s", e)
+
+  def Wait(self):
+    """Waits for the fetch to finish and returns the chunks read."""
+    self.thread.join()
+    return self.result
+
+
 class AFF4ImageBase(AFF4Stream):
   """An AFF4 Image is stored in segments.
 
@@ -2748,6 +2907,12 @@ class AFF4ImageBase(AFF4Stream):
   # How many chunks should be cached.
   LOOK_AHEAD = 10
 
+  # When the stream is read sequentially, the read ahead window doubles each
+  # time the reader catches up with it, up to this many chunks. The next
+  # window is then fetched in the background while the current one is being
+  # consumed. Setting this to LOOK_AHEAD disables streaming reads.
+  MAX_LOOK_AHEAD = 40
+
   class SchemaCls(AFF4Stream.SchemaCls):
     """The schema for AFF4ImageBase."""
     _CHUNKSIZE = Attribute(
@@ -2827,6 +2992,11 @@ class AFF4ImageBase(AFF4Stream):
     # A cache for segments.
     self.chunk_cache = ChunkCache(self._WriteChunk, 100)
 
+    # State of the sequential read detection.
+    self.look_ahead = self.LOOK_AHEAD
+    self._read_ahead_end = None
+    self._prefetch = None
+
     if "r" in self.mode:
       self.size = int(self.Get(self.Schema.SIZE))
       # pylint: disable=protected-access
@@ -2868,54 +3038,97 @@ class AFF4ImageBase(AFF4Stream):
     self._dirty = True
     self.size = offset
     self.offset = offset
+    self._CollectPrefetchedChunks()
     self.chunk_cache.Flush()
 
   def _ReadChunk(self, chunk):
     self._ReadChunks([chunk])
     return self.chunk_cache.Get(chunk)
 
-  def _ReadChunks(self, chunks):
+  def _FetchChunks(self, chunks):
+    """Reads the given chunks from the data store.
+
+    This does not touch the chunk cache so it is safe to call from a
+    background thread.
+
+    Args:
+      chunks: A list of chunk numbers.
+
+    Returns:
+      A dict mapping chunk numbers to the chunk data.
+    """
     chunk_names = {
         self.urn.Add(self.CHUNK_ID_TEMPLATE % chunk): chunk
         for chunk in chunks
     }
+    result = {}
     for child in FACTORY.MultiOpen(
         chunk_names, mode="rw", token=self.token, age=self.age_policy):
       if isinstance(child, AFF4Stream):
-        fd = StringIO.StringIO(child.read())
-        fd.dirty = False
-        fd.chunk = chunk_names[child.urn]
-        self.chunk_cache.Put(fd.chunk, fd)
+        result[chunk_names[child.urn]] = child.read()
+    return result
+
+  def _ReadChunks(self, chunks):
+    # Chunks are cached as read only strings, _GetChunkForWriting turns them
+    # into file like objects if they are modified.
+    for chunk, data in self._FetchChunks(chunks).iteritems():
+      self.chunk_cache.Put(chunk, data)
 
   def _WriteChunk(self, chunk):
-    if chunk.dirty:
+    if getattr(chunk, "dirty", False):
       chunk_name = self.urn.Add(self.CHUNK_ID_TEMPLATE % chunk.chunk)
       with FACTORY.Create(
           chunk_name, self.STREAM_TYPE, mode="rw", token=self.token) as fd:
         fd.write(chunk.getvalue())
 
+  def _MakeWritableChunk(self, chunk, data=""):
+    fd = StringIO.StringIO(data)
+    fd.chunk = chunk
+    fd.dirty = True
+    self.chunk_cache.Put(chunk, fd)
+    return fd
+
   def _GetChunkForWriting(self, chunk):
     """Opens a chunk for writing, creating a new one if it doesn't exist yet."""
-    try:
-      chunk = self.chunk_cache.Get(chunk)
-      chunk.dirty = True
-      return chunk
-    except KeyError:
-      pass
+    self._CollectPrefetchedChunks()
 
     try:
-      chunk = self._ReadChunk(chunk)
-      chunk.dirty = True
-      return chunk
+      fd = self.chunk_cache.Get(chunk)
     except KeyError:
-      pass
+      try:
+        fd = self._ReadChunk(chunk)
+      except KeyError:
+        return self._MakeWritableChunk(chunk)
+
+    if isinstance(fd, basestring):
+      return self._MakeWritableChunk(chunk, fd)
 
-    fd = StringIO.StringIO()
-    fd.chunk = chunk
     fd.dirty = True
-    self.chunk_cache.Put(chunk, fd)
     return fd
 
+  def _StartPrefetch(self, chunks):
+    """Starts reading the given chunks on a background thread."""
+    self._prefetch = ChunkPrefetcher(self._FetchChunks, chunks)
+
+  def _CollectPrefetchedChunks(self):
+    """Waits for the background read and moves its chunks into the cache."""
+    prefetch = self._prefetch
+    if prefetch is None:
+      return
+
+    self._prefetch = None
+    for chunk, data in prefetch.Wait().iteritems():
+      # Never replace a chunk that was read (or modified) in the meantime.
+      if chunk not in self.chunk_cache:
+        self.chunk_cache.Put(chunk, data)
+
+  def _ChunkRange(self, start, length):
+    """Chunk numbers to read ahead, not going past the end of the stream."""
+    end = start + length
+    if "w" not in self.mode:
+      end = min(end, self.size / self.chunksize + 1)
+    return range(start, max(start + 1, end))
+
   def _GetChunkForReading(self, chunk):
     """Returns the relevant chunk from the datastore and reads ahead."""
     try:
@@ -2926,13 +3139,41 @@ class AFF4ImageBase(AFF4Stream):
     # We don't have this chunk already cached. The most common read
     # access pattern is contiguous reading so since we have to go to
     # the data store already, we read ahead to reduce round trips.
+    prefetched = self._prefetch is not None and chunk in self._prefetch.chunks
+    if prefetched:
+      self._CollectPrefetchedChunks()
+    else:
+      # A pending background read that is not needed anymore.
+      self._CollectPrefetchedChunks()
 
-    missing_chunks = []
-    for chunk_number in range(chunk, chunk + self.LOOK_AHEAD):
-      if chunk_number not in self.chunk_cache:
-        missing_chunks.append(chunk_number)
+      # Reaching the end of the read ahead window means the stream is read
+      # sequentially, anything else looks like random access.
+      if chunk == self._read_ahead_end:
+        self.look_ahead = min(self.look_ahead * 2, self.MAX_LOOK_AHEAD)
+      else:
+        self.look_ahead = self.LOOK_AHEAD
+
+      missing_chunks = [
+          chunk_number
+          for chunk_number in self._ChunkRange(chunk, self.look_ahead)
+          if chunk_number not in self.chunk_cache
+      ]
+      self._ReadChunks(missing_chunks)
+      self._read_ahead_end = chunk + self.look_ahead
+
+    # When streaming, fetch the next window while this one is being consumed.
+    # Streams opened for writing are not prefetched since the background read
+    # could race with local modifications.
+    streaming = self.look_ahead > self.LOOK_AHEAD or prefetched
+    if (streaming and self.MAX_LOOK_AHEAD > self.LOOK_AHEAD and
+        "w" not in self.mode):
+      if prefetched:
+        self.look_ahead = min(self.look_ahead * 2, self.MAX_LOOK_AHEAD)
+      next_chunks = self._ChunkRange(self._read_ahead_end, self.look_ahead)
+      if next_chunks[0] * self.chunksize < self.size:
+        self._StartPrefetch(next_chunks)
+        self._read_ahead_end = next_chunks[-1] + 1
 
-    self._ReadChunks(missing_chunks)
     # This should work now - otherwise we just give up.
     try:
       return self.chunk_cache.Get(chunk)
@@ -2949,7 +3190,7 @@ class AFF4ImageBase(AFF4Stream):
     retries = 0
     while retries < self.NUM_RETRIES:
       fd = self._GetChunkForReading(chunk)
-      if fd:
+      if fd is not None:
         break
       # Arriving here means we know about blobs that cannot be found in the db.
       # The most likely reason is that they have not been synced yet so we
@@ -2961,16 +3202,21 @@ class AFF4ImageBase(AFF4Stream):
     if retries >= self.NUM_RETRIES:
       raise IOError("Chunk not found for reading.")
 
-    fd.seek(chunk_offset)
+    if isinstance(fd, basestring):
+      # Chunks which were only read are plain strings and can be sliced
+      # directly.
+      result = fd[chunk_offset:chunk_offset + available_to_read]
+    else:
+      fd.seek(chunk_offset)
+      result = fd.read(available_to_read)
 
-    result = fd.read(available_to_read)
     self.offset += len(result)
 
     return result
 
   def Read(self, length):
     """Read a block of data from the file."""
-    result = ""
+    result = []
 
     # The total available size in the file
     length = int(length)
@@ -2982,8 +3228,8 @@ class AFF4ImageBase(AFF4Stream):
         break
 
       length -= len(data)
-      result += data
-    return result
+      result.append(data)
+    return "".join(result)
 
   def _WritePartial(self, data):
     """Writes at most one chunk of data."""
@@ -3038,8 +3284,9 @@ class AFF4ImageBase(AFF4Stream):
     return self.content_last
 
   def __getstate__(self):
-    # We can't pickle the callback.
+    # We can't pickle the callback or the prefetching thread.
     if "chunk_cache" in self.__dict__:
+      self._CollectPrefetchedChunks()
       self.chunk_cache.Flush()
       res = self.__dict__.copy()
       del res["chunk_cache"]
@@ -3048,6 +3295,9 @@ class AFF4ImageBase(AFF4Stream):
 
   def __setstate__(self, state):
     self.__dict__ = state
+    self.__dict__.setdefault("look_ahead", self.LOOK_AHEAD)
+    self.__dict__.setdefault("_read_ahead_end", None)
+    self.__dict__.setdefault("_prefetch", None)
     self.chunk_cache = ChunkCache(self._WriteChunk, 100)
 
 
@@ -3077,6 +3327,17 @@ class AFF4InitHook(registry.InitHook):
     # pylint: enable=unused-variable,global-statement,g-import-not-at-top
     stats.STATS.RegisterCounterMetric("aff4_cache_hits")
     stats.STATS.RegisterCounterMetric("aff4_cache_misses")
+    stats.STATS.RegisterCounterMetric("aff4_cache_evictions")
+    stats.STATS.RegisterCounterMetric("aff4_cache_invalidations")
+
+    if _InvalidateAttributeCache not in data_store.mutation_listeners:
+      data_store.mutation_listeners.append(_InvalidateAttributeCache)
+
+
+def _InvalidateAttributeCache(subjects):
+  """Data store mutation listener keeping FACTORY's attribute cache fresh."""
+  if FACTORY is not None:
+    FACTORY.InvalidateAttributeCache(subjects)
 
 
 class AFF4Filter(object):
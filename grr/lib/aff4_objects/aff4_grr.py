@@ -493,25 +493,50 @@ class GRRForeman(aff4.AFF4Object):
       self.Set(self.Schema.RULES, new_rules)
       self.Flush()
 
-  def _CheckIfHuntTaskWasAssigned(self, client_id, hunt_id):
-    """Will return True if hunt's task was assigned to this client before."""
-    for _ in aff4.FACTORY.Stat(
-        [client_id.Add("flows/%s:hunt" % rdfvalue.RDFURN(hunt_id).Basename())],
-        token=self.token):
-      return True
+  # The most recently compiled rules, shared by all foreman instances.
+  _compiled_rules_cache = (None, None)
 
-    return False
+  def _GetCompiledRules(self):
+    """Returns the rules compiled for evaluation, compiling them if needed."""
+    rules = self.Get(self.Schema.RULES)
+    compiled_source, compiled = getattr(self, "_compiled_rules", (None, None))
+    if compiled_source is rules:
+      return compiled
+
+    serialized_rules = rules.SerializeToString() if rules else ""
+    cached_key, compiled = GRRForeman._compiled_rules_cache
+    if cached_key != serialized_rules:
+      compiled = rdf_foreman.CompiledForemanRules(rules or [])
+      GRRForeman._compiled_rules_cache = (serialized_rules, compiled)
+
+    self._compiled_rules = (rules, compiled)
+    return compiled
+
+  def _GetAssignedHunts(self, client_id, rules):
+    """Returns the ids of the hunts of the rules assigned to this client."""
+    hunt_urns = {}
+    for rule in rules:
+      for action in rule.actions:
+        if action.HasField("hunt_id"):
+          hunt_id = rdfvalue.RDFURN(action.hunt_id)
+          urn = client_id.Add("flows/%s:hunt" % hunt_id.Basename())
+          hunt_urns[urn] = hunt_id
 
-  def _EvaluateRules(self, objects, rule, client_id):
-    """Evaluates the rules."""
-    return rule.client_rule_set.Evaluate(objects, client_id)
+    if not hunt_urns:
+      return set()
 
-  def _RunActions(self, rule, client_id):
+    return set(
+        hunt_urns[stat["urn"]]
+        for stat in aff4.FACTORY.Stat(hunt_urns, token=self.token))
+
+  def _RunActions(self, rule, client_id, assigned_hunts):
     """Run all the actions specified in the rule.
 
     Args:
       rule: Rule which actions are to be executed.
       client_id: Id of a client where rule's actions are to be executed.
+      assigned_hunts: A set of the ids of the hunts which were started on this
+          client before. Hunts started here are added to it.
 
     Returns:
       Number of actions started.
@@ -525,7 +550,8 @@ class GRRForeman(aff4.AFF4Object):
         token.username = "Foreman"
 
         if action.HasField("hunt_id"):
-          if self._CheckIfHuntTaskWasAssigned(client_id, action.hunt_id):
+          hunt_id = rdfvalue.RDFURN(action.hunt_id)
+          if hunt_id in assigned_hunts:
             logging.info("Foreman: ignoring hunt %s on client %s: was started "
                          "here before", client_id, action.hunt_id)
           else:
@@ -534,6 +560,7 @@ class GRRForeman(aff4.AFF4Object):
 
             flow_cls = flow.GRRFlow.classes[action.hunt_name]
             flow_cls.StartClients(action.hunt_id, [client_id])
+            assigned_hunts.add(hunt_id)
             actions_count += 1
         else:
           flow.GRRFlow.StartFlow(
@@ -561,57 +588,60 @@ class GRRForeman(aff4.AFF4Object):
     """
     client_id = rdf_client.ClientURN(client_id)
 
-    rules = self.Get(self.Schema.RULES)
+    rules = self._GetCompiledRules()
     if not rules:
       return 0
 
-    client = aff4.FACTORY.Open(client_id, mode="rw", token=self.token)
-    try:
-      last_foreman_run = client.Get(client.Schema.LAST_FOREMAN_TIME) or 0
-    except AttributeError:
+    # The client object is not opened here, the foreman only needs this one
+    # attribute of it.
+    last_foreman_attribute = VFSGRRClient.SchemaCls.LAST_FOREMAN_TIME
+    value, _ = data_store.DB.Resolve(
+        client_id, last_foreman_attribute.predicate, token=self.token)
+    if value is None:
       last_foreman_run = 0
+    else:
+      last_foreman_run = int(
+          last_foreman_attribute.attribute_type.FromDatastoreValue(value))
 
-    latest_rule = max(rule.created for rule in rules)
-
-    if latest_rule <= int(last_foreman_run):
+    latest_rule = rules.latest_rule_time
+    if latest_rule <= last_foreman_run:
       return 0
 
     # Update the latest checked rule on the client.
-    client.Set(client.Schema.LAST_FOREMAN_TIME(latest_rule))
-    client.Close()
+    data_store.DB.Set(
+        client_id,
+        last_foreman_attribute.predicate,
+        last_foreman_attribute.attribute_type(latest_rule),
+        token=self.token)
+
+    now = time.time() * 1e6
+    relevant_rules = [
+        index for index in rules.GetRulesCreatedAfter(last_foreman_run)
+        if rules.rules[index].expires >= now
+    ]
 
     # For efficiency we collect all the objects we want to open first and then
     # open them all in one round trip.
     object_urns = {}
-    relevant_rules = []
-    expired_rules = False
-
-    now = time.time() * 1e6
-
-    for rule in rules:
-      if rule.expires < now:
-        expired_rules = True
-        continue
-      if rule.created <= int(last_foreman_run):
-        continue
-
-      relevant_rules.append(rule)
-
-      for path in rule.client_rule_set.GetPathsToCheck():
-        aff4_object = client_id.Add(path)
-        object_urns[str(aff4_object)] = aff4_object
+    for path in rules.GetPathsToCheck(relevant_rules):
+      aff4_object = client_id.Add(path)
+      object_urns[str(aff4_object)] = aff4_object
 
     # Retrieve all aff4 objects we need.
     objects = {}
-    for fd in aff4.FACTORY.MultiOpen(object_urns, token=self.token):
-      objects[fd.urn] = fd
+    if object_urns:
+      for fd in aff4.FACTORY.MultiOpen(object_urns, token=self.token):
+        objects[fd.urn] = fd
+
+    matching_rules = rules.GetMatchingRules(relevant_rules, objects, client_id)
 
     actions_count = 0
-    for rule in relevant_rules:
-      if self._EvaluateRules(objects, rule, client_id):
-        actions_count += self._RunActions(rule, client_id)
+    if matching_rules:
+      assigned_hunts = self._GetAssignedHunts(client_id, matching_rules)
+      for rule in matching_rules:
+        actions_count += self._RunActions(rule, client_id, assigned_hunts)
 
-    if expired_rules:
+    if rules.earliest_expiry < now:
       self.ExpireRules()
 
     return actions_count
@@ -6,15 +6,22 @@ under aff4:/files to handle new file hash and new file creations.
 """
 
 import hashlib
+import os
+import threading
 
 import logging
 
+from grr import config
 from grr.lib import fingerprint
 from grr.lib import access_control
 from grr.lib import aff4
 from grr.lib import data_store
+from grr.lib import hash_index
+from grr.lib import nsrl_index
 from grr.lib import rdfvalue
 from grr.lib import registry
+from grr.lib import stats
+from grr.lib import utils
 from grr.lib.aff4_objects import aff4_grr
 from grr.lib.rdfvalues import nsrl as rdf_nsrl
 
@@ -188,6 +195,47 @@ class HashFileStore(FileStore):
       "pecoff": ["md5", "sha1"]
   }
 
+  # Process wide index of the sha256 hashes of files known to be in the store.
+  _hash_index = None
+  _hash_index_lock = threading.Lock()
+
+  # The generation of the hash index file which was written for this data
+  # store. A file of any other generation was written before the data store
+  # was wiped or restored and is dropped.
+  HASH_INDEX_GENERATION = "index:hash_index_generation"
+
+  @staticmethod
+  def _WriteHashIndexGeneration(generation):
+    data_store.DB.Set(
+        HashFileStore.PATH,
+        HashFileStore.HASH_INDEX_GENERATION,
+        generation,
+        token=aff4.FACTORY.root_token)
+
+  @staticmethod
+  def GetHashIndex():
+    """Returns the index of sha256 hashes of files known to be in the store."""
+    with HashFileStore._hash_index_lock:
+      if HashFileStore._hash_index is None:
+        generation, _ = data_store.DB.Resolve(
+            HashFileStore.PATH,
+            HashFileStore.HASH_INDEX_GENERATION,
+            token=aff4.FACTORY.root_token)
+        HashFileStore._hash_index = hash_index.HashIndex(
+            path=config.CONFIG["FileStore.hash_index_path"] or None,
+            max_pending=config.CONFIG["FileStore.hash_index_max_pending"],
+            generation=generation or "",
+            compact_callback=HashFileStore._WriteHashIndexGeneration)
+      return HashFileStore._hash_index
+
+  @staticmethod
+  def ResetHashIndex():
+    """Drops the hash index, the next GetHashIndex() call opens it again."""
+    with HashFileStore._hash_index_lock:
+      if HashFileStore._hash_index is not None:
+        HashFileStore._hash_index.Close()
+        HashFileStore._hash_index = None
+
   def AddURN(self, sha256hash, file_urn):
     index_urn = self.PATH.Add("generic/sha256").Add(sha256hash)
     self._AddToIndex(index_urn, file_urn)
@@ -268,6 +316,9 @@ class HashFileStore(FileStore):
     Blobs use the hash in the schema:
     aff4:/files/hash/generic/sha256/[sha256hash]
 
+    Hashes in the hash index are not looked up in the data store. Hashes found
+    in the data store are added to the index.
+
     Args:
       hashes: A list of Hash objects to check.
 
@@ -277,12 +328,32 @@ class HashFileStore(FileStore):
     hash_map = {}
     for hsh in hashes:
       if hsh.HasField("sha256"):
-        # The canonical name of the file is where we store the file hash.
-        hash_map[aff4.ROOT_URN.Add("files/hash/generic/sha256").Add(
-            str(hsh.sha256))] = hsh
-
-    for metadata in aff4.FACTORY.Stat(list(hash_map), token=self.token):
-      yield metadata["urn"], hash_map[metadata["urn"]]
+        hash_map[hsh.sha256.SerializeToString()] = hsh
+
+    index = self.GetHashIndex()
+    known_digests = index.CheckDigests(hash_map)
+    stats.STATS.IncrementCounter(
+        "filestore_hash_index_hits", delta=len(known_digests))
+
+    results = []
+    urns = {}
+    for digest, hsh in hash_map.iteritems():
+      # The canonical name of the file is where we store the file hash.
+      urn = aff4.ROOT_URN.Add("files/hash/generic/sha256").Add(str(hsh.sha256))
+      if digest in known_digests:
+        results.append((urn, hsh))
+      else:
+        urns[urn] = digest
+
+    found_digests = []
+    for metadata in aff4.FACTORY.Stat(list(urns), token=self.token):
+      digest = urns[metadata["urn"]]
+      found_digests.append(digest)
+      results.append((metadata["urn"], hash_map[digest]))
+    index.AddMany(found_digests)
+
+    for urn, hsh in results:
+      yield urn, hsh
 
   def _GetHashers(self, hash_types):
     return [
@@ -291,33 +362,46 @@ class HashFileStore(FileStore):
     ]
 
   def _HashFile(self, fd):
-    """Look for the required hashes in the file."""
+    """Look for the required hashes in the file.
+
+    Hashes which are already set on the file, e.g. the ones the client sent
+    when the file was downloaded, are reused. Only the missing hashes are
+    computed, all of them in a single pass over the file. If nothing is missing
+    only the PE headers are read to find out if the file needs authenticode
+    hashes.
+
+    Args:
+      fd: The file to hash.
+
+    Returns:
+      The Hash object with all the hashes of the file.
+    """
     hashes = fd.Get(fd.Schema.HASH)
-    if hashes:
-      found_all = True
-      for fingerprint_type, hash_types in self.HASH_TYPES.iteritems():
-        for hash_type in hash_types:
-          if fingerprint_type == "pecoff":
-            hash_type = "pecoff_%s" % hash_type
-          if not hashes.HasField(hash_type):
-            found_all = False
-            break
-        if not found_all:
-          break
-      if found_all:
-        return hashes
+    if not hashes:
+      hashes = fd.Schema.HASH()
 
     fingerprinter = fingerprint.Fingerprinter(fd)
     if "generic" in self.HASH_TYPES:
-      hashers = self._GetHashers(self.HASH_TYPES["generic"])
-      fingerprinter.EvalGeneric(hashers=hashers)
+      missing = [
+          hash_type for hash_type in self.HASH_TYPES["generic"]
+          if hasattr(hashlib, hash_type) and not hashes.HasField(hash_type)
+      ]
+      if missing:
+        fingerprinter.EvalGeneric(hashers=self._GetHashers(missing))
     if "pecoff" in self.HASH_TYPES:
-      hashers = self._GetHashers(self.HASH_TYPES["pecoff"])
-      if hashers:
+      hash_types = self.HASH_TYPES["pecoff"]
+      hashers = self._GetHashers(hash_types)
+      if hashers and not all(
+          hashes.HasField("pecoff_%s" % hash_type) for hash_type in hash_types):
         fingerprinter.EvalPecoff(hashers=hashers)
 
-    if not hashes:
-      hashes = fd.Schema.HASH()
+    if not fingerprinter.fingers:
+      stats.STATS.IncrementCounter("filestore_files_not_rehashed")
+      return hashes
+
+    stats.STATS.IncrementCounter("filestore_files_rehashed")
+    stats.STATS.IncrementCounter(
+        "filestore_bytes_rehashed", delta=fingerprinter.filelength)
 
     for result in fingerprinter.HashIt():
       fingerprint_type = result["name"]
@@ -405,6 +489,7 @@ class HashFileStore(FileStore):
         new_fd.Set(new_fd.Schema.STAT(None))
 
     self._AddToIndex(canonical_urn, fd.urn)
+    self.GetHashIndex().Add(hashes.sha256.SerializeToString())
 
     for hash_type, hash_digest in hashes.ListSetFields():
       # Determine fingerprint type.
@@ -557,17 +642,55 @@ class NSRLFile(FileStoreImage):
 
 
 class NSRLFileStore(HashFileStore):
-  """FileStore with NSRL hashes."""
+  """FileStore with NSRL hashes.
+
+  The NSRL is either stored as one NSRLFile object per hash, or, when
+  FileStore.nsrl_index_path is set, read from an index file written by
+  import_nsrl_hashes.
+  """
 
   PATH = rdfvalue.RDFURN("aff4:/files/nsrl")
   PRIORITY = 1
   EXTERNAL = False
 
-  FILE_TYPES = {
-      "M": rdf_nsrl.NSRLInformation.FileType.MALICIOUS_FILE,
-      "S": rdf_nsrl.NSRLInformation.FileType.SPECIAL_FILE,
-      "": rdf_nsrl.NSRLInformation.FileType.NORMAL_FILE
-  }
+  FILE_TYPES = nsrl_index.FILE_TYPES
+
+  _nsrl_index = None
+  _nsrl_index_key = None
+  # Held while the index is used, so it is not closed under its readers.
+  _nsrl_index_lock = threading.RLock()
+
+  @staticmethod
+  def _SetNSRLIndex(index, key):
+    if NSRLFileStore._nsrl_index is not None:
+      NSRLFileStore._nsrl_index.Close()
+    NSRLFileStore._nsrl_index = index
+    NSRLFileStore._nsrl_index_key = key
+
+  @staticmethod
+  def GetNSRLIndex():
+    """Returns the NSRL index file or None if the NSRL is in the data store.
+
+    Callers have to hold _nsrl_index_lock while they use the index.
+    """
+    path = config.CONFIG["FileStore.nsrl_index_path"]
+    if not path:
+      return None
+
+    with NSRLFileStore._nsrl_index_lock:
+      try:
+        # Importing replaces the file, in which case the new one is opened.
+        stat = os.stat(path)
+        key = (path, stat.st_ino, stat.st_mtime)
+        if NSRLFileStore._nsrl_index_key != key:
+          NSRLFileStore._SetNSRLIndex(nsrl_index.NSRLIndex(path), key)
+      except (IOError, OSError) as e:
+        if NSRLFileStore._nsrl_index_key != path:
+          logging.warning("Cannot open NSRL index %s, using the data store: %s",
+                          path, e)
+          NSRLFileStore._SetNSRLIndex(None, path)
+
+      return NSRLFileStore._nsrl_index
 
   def GetChildrenByPriority(self, allow_external=True):
     return
@@ -580,12 +703,39 @@ class NSRLFileStore(HashFileStore):
     return
 
   def NSRLInfoForSHA1s(self, hashes):
+    """Returns a dict mapping the hex SHA-1s in the NSRL to NSRLFile objects."""
+    with self._nsrl_index_lock:
+      index = self.GetNSRLIndex()
+      if index is not None:
+        return self._NSRLInfoFromIndex(index, hashes)
+
     urns = {self.PATH.Add(h): h for h in hashes}
     return {
         urns[obj.urn]: obj
         for obj in aff4.FACTORY.MultiOpen(urns, token=self.token)
     }
 
+  def _NSRLInfoFromIndex(self, index, hashes):
+    infos = index.Lookup(h.decode("hex") for h in hashes)
+
+    result = {}
+    for h in hashes:
+      info = infos.get(h.decode("hex"))
+      if info is None:
+        continue
+
+      # The objects are built from the index, without going to the data store.
+      urn = self.PATH.Add(h)
+      result[h] = NSRLFile(
+          urn,
+          mode="r",
+          token=self.token,
+          local_cache={
+              utils.SmartUnicode(urn): [(NSRLFile.SchemaCls.NSRL.predicate,
+                                         info.SerializeToString(), 0)]
+          })
+    return result
+
   def CheckHashes(self, hashes, unused_external=True):
     """Checks a list of hashes for presence in the store.
 
@@ -599,6 +749,21 @@ class NSRLFileStore(HashFileStore):
     Yields:
       Tuples of (RDFURN, hash object) that exist in the store.
     """
+    with self._nsrl_index_lock:
+      index = self.GetNSRLIndex()
+      if index is not None:
+        hash_map = {}
+        for hsh in hashes:
+          if hsh.HasField("sha1"):
+            hash_map[hsh.sha1.SerializeToString()] = hsh
+        found = index.CheckDigests(hash_map)
+
+    if index is not None:
+      for digest in found:
+        hsh = hash_map[digest]
+        yield self.PATH.Add(str(hsh.sha1)), hsh
+      return
+
     hash_map = {}
     for hsh in hashes:
       if hsh.HasField("sha1"):
@@ -654,8 +819,20 @@ class FileStoreInit(registry.InitHook):
 
   pre = [aff4_grr.GRRAFF4Init]
 
+  def RunOnce(self):
+    """Register the hashing metrics."""
+    # Files added to the store which had to be read again because some of
+    # their hashes were missing, and files for which all hashes were known.
+    stats.STATS.RegisterCounterMetric("filestore_files_rehashed")
+    stats.STATS.RegisterCounterMetric("filestore_files_not_rehashed")
+    stats.STATS.RegisterCounterMetric("filestore_bytes_rehashed", units="BYTES")
+    # Hashes found in the hash index without asking the data store.
+    stats.STATS.RegisterCounterMetric("filestore_hash_index_hits")
+
   def Run(self):
     """Create FileStore and HashFileStore namespaces."""
+    # The namespaces might have been created empty, start over with the index.
+    HashFileStore.ResetHashIndex()
     try:
       filestore = aff4.FACTORY.Create(
           FileStore.PATH, FileStore, mode="rw", token=aff4.FACTORY.root_token)
@@ -8,15 +8,22 @@ import time
 
 from grr.lib import action_mocks
 from grr.lib import aff4
+from grr.lib import data_store
+from grr.lib import events
 from grr.lib import flags
+from grr.lib import nsrl_index
 from grr.lib import rdfvalue
+from grr.lib import stats
 from grr.lib import test_lib
 from grr.lib import utils
 from grr.lib.aff4_objects import aff4_grr
 from grr.lib.aff4_objects import filestore
 from grr.lib.aff4_objects import filestore_test_lib
 from grr.lib.flows.general import file_finder
+from grr.lib.flows.general import transfer
+from grr.lib.rdfvalues import crypto as rdf_crypto
 from grr.lib.rdfvalues import file_finder as rdf_file_finder
+from grr.lib.rdfvalues import flows as rdf_flows
 from grr.lib.rdfvalues import paths as rdf_paths
 
 
@@ -109,6 +116,22 @@ class HashFileStoreTest(test_lib.AFF4ObjectTest):
     client_ids = self.SetupClients(1)
     self.client_id = client_ids[0]
 
+  def tearDown(self):
+    pool = transfer.FileStoreCreateFile._thread_pool
+    if pool is not None:
+      pool.Stop()
+      transfer.FileStoreCreateFile._thread_pool = None
+
+    super(HashFileStoreTest, self).tearDown()
+
+  def _GetPendingFiles(self):
+    values = data_store.DB.MultiResolvePrefix(
+        transfer.FileStoreCreateFile.GetAllPendingShards(),
+        transfer.FileStoreCreateFile.PENDING_PREFIX,
+        token=self.token)
+    return sorted(
+        value for records in dict(values).values() for _, value, _ in records)
+
   def AddFile(self, path):
     """Add file with a subpath (relative to winexec_img.dd) to the store."""
     pathspec = rdf_paths.PathSpec(
@@ -427,6 +450,260 @@ class HashFileStoreTest(test_lib.AFF4ObjectTest):
 
     return res
 
+  def _CreateBlobImage(self, data, hashes=None):
+    urn = self.client_id.Add("fs/os/c/blob_image")
+    with aff4.FACTORY.Create(
+        urn, aff4_grr.VFSBlobImage, mode="w", token=self.token) as fd:
+      fd.SetChunksize(filestore.FileStore.CHUNK_SIZE)
+      fd.AppendContent(StringIO.StringIO(data))
+      if hashes:
+        fd.Set(fd.Schema.HASH, hashes)
+    return urn
+
+  def _AddToHashFileStore(self, urn):
+    fd = aff4.FACTORY.Open(urn, mode="rw", token=self.token)
+    hash_filestore = aff4.FACTORY.Open(
+        filestore.HashFileStore.PATH,
+        filestore.HashFileStore,
+        token=self.token)
+    hash_filestore.AddFile(fd)
+    return fd.Get(fd.Schema.HASH)
+
+  def testFileWithAllHashesIsNotReadAgain(self):
+    data = "client data" * 1000
+    urn = self._CreateBlobImage(
+        data,
+        rdf_crypto.Hash(
+            md5=hashlib.md5(data).digest(),
+            sha1=hashlib.sha1(data).digest(),
+            sha256=hashlib.sha256(data).digest()))
+
+    rehashed = stats.STATS.GetMetricValue("filestore_files_rehashed")
+    not_rehashed = stats.STATS.GetMetricValue("filestore_files_not_rehashed")
+    hashes = self._AddToHashFileStore(urn)
+
+    self.assertEqual(
+        stats.STATS.GetMetricValue("filestore_files_rehashed"), rehashed)
+    self.assertEqual(
+        stats.STATS.GetMetricValue("filestore_files_not_rehashed"),
+        not_rehashed + 1)
+
+    self.assertEqual(hashes.sha256, hashlib.sha256(data).digest())
+    refs = list(
+        filestore.HashFileStore.GetReferencesSHA1(
+            hashlib.sha1(data).hexdigest(), token=self.token))
+    self.assertEqual(refs, [urn])
+
+  def testOnlyMissingHashesAreComputed(self):
+    data = "client data" * 1000
+    # The file store trusts the hashes it finds on the file.
+    client_sha256 = hashlib.sha256("client hash").digest()
+    urn = self._CreateBlobImage(data, rdf_crypto.Hash(sha256=client_sha256))
+
+    rehashed = stats.STATS.GetMetricValue("filestore_files_rehashed")
+    rehashed_bytes = stats.STATS.GetMetricValue("filestore_bytes_rehashed")
+    hashes = self._AddToHashFileStore(urn)
+
+    self.assertEqual(
+        stats.STATS.GetMetricValue("filestore_files_rehashed"), rehashed + 1)
+    self.assertEqual(
+        stats.STATS.GetMetricValue("filestore_bytes_rehashed"),
+        rehashed_bytes + len(data))
+
+    self.assertEqual(hashes.sha256, client_sha256)
+    self.assertEqual(hashes.sha1, hashlib.sha1(data).digest())
+    self.assertEqual(hashes.md5, hashlib.md5(data).digest())
+    self.assertTrue(
+        list(
+            aff4.FACTORY.Stat(
+                filestore.HashFileStore.PATH.Add("generic/sha256").Add(
+                    str(hashes.sha256)),
+                token=self.token)))
+
+  def testCheckHashesUsesHashIndex(self):
+    data = "client data" * 1000
+    hsh = rdf_crypto.Hash(sha256=hashlib.sha256(data).digest())
+    self._AddToHashFileStore(self._CreateBlobImage(data, hsh))
+    unknown_hsh = rdf_crypto.Hash(sha256=hashlib.sha256("unknown").digest())
+
+    hash_filestore = aff4.FACTORY.Open(
+        filestore.HashFileStore.PATH,
+        filestore.HashFileStore,
+        token=self.token)
+    canonical_urn = filestore.HashFileStore.PATH.Add("generic/sha256").Add(
+        str(hsh.sha256))
+
+    hits = stats.STATS.GetMetricValue("filestore_hash_index_hits")
+    stat_urns = []
+    stat = aff4.FACTORY.Stat
+
+    def Stat(urns, token=None):
+      stat_urns.extend(urns)
+      return stat(urns, token=token)
+
+    with utils.Stubber(aff4.FACTORY, "Stat", Stat):
+      results = list(hash_filestore.CheckHashes([hsh, unknown_hsh]))
+
+    self.assertEqual(results, [(canonical_urn, hsh)])
+    self.assertEqual(
+        stats.STATS.GetMetricValue("filestore_hash_index_hits"), hits + 1)
+    # Only the hash which is not in the index is looked up in the data store.
+    self.assertEqual(len(stat_urns), 1)
+    self.assertNotEqual(stat_urns[0], canonical_urn)
+
+  def testHashesFoundInDataStoreAreAddedToHashIndex(self):
+    data = "client data" * 1000
+    hsh = rdf_crypto.Hash(sha256=hashlib.sha256(data).digest())
+    self._AddToHashFileStore(self._CreateBlobImage(data, hsh))
+
+    # Another process added the file.
+    filestore.HashFileStore.ResetHashIndex()
+    hash_index = filestore.HashFileStore.GetHashIndex()
+    self.assertNotIn(hsh.sha256.SerializeToString(), hash_index)
+
+    hash_filestore = aff4.FACTORY.Open(
+        filestore.HashFileStore.PATH,
+        filestore.HashFileStore,
+        token=self.token)
+    self.assertEqual(len(list(hash_filestore.CheckHashes([hsh]))), 1)
+    self.assertIn(hsh.sha256.SerializeToString(), hash_index)
+
+  def testHashIndexFileIsDroppedWhenTheDataStoreIsWiped(self):
+    data = "client data" * 1000
+    hsh = rdf_crypto.Hash(sha256=hashlib.sha256(data).digest())
+    digest = hsh.sha256.SerializeToString()
+    path = os.path.join(self.temp_dir, "hash_index")
+
+    with test_lib.ConfigOverrider({"FileStore.hash_index_path": path}):
+      filestore.HashFileStore.ResetHashIndex()
+      try:
+        self._AddToHashFileStore(self._CreateBlobImage(data, hsh))
+        filestore.HashFileStore.GetHashIndex().Compact()
+
+        # A new process uses the index file written for this data store.
+        filestore.HashFileStore.ResetHashIndex()
+        self.assertIn(digest, filestore.HashFileStore.GetHashIndex())
+
+        canonical_urn = filestore.HashFileStore.PATH.Add(
+            "generic/sha256").Add(str(hsh.sha256))
+        data_store.DB.DeleteSubject(canonical_urn, token=self.token)
+        data_store.DB.DeleteAttributes(
+            filestore.HashFileStore.PATH,
+            [filestore.HashFileStore.HASH_INDEX_GENERATION],
+            token=self.token)
+
+        filestore.HashFileStore.ResetHashIndex()
+        self.assertNotIn(digest, filestore.HashFileStore.GetHashIndex())
+        self.assertFalse(os.path.exists(path))
+
+        hash_filestore = aff4.FACTORY.Open(
+            filestore.HashFileStore.PATH,
+            filestore.HashFileStore,
+            token=self.token)
+        self.assertEqual(list(hash_filestore.CheckHashes([hsh])), [])
+      finally:
+        filestore.HashFileStore.ResetHashIndex()
+
+  def testFilesAreAddedOnIngestionThreadPool(self):
+    data = "client data" * 1000
+    urn = self._CreateBlobImage(
+        data, rdf_crypto.Hash(sha256=hashlib.sha256(data).digest()))
+
+    wait_time = stats.STATS.GetMetricValue("filestore_ingestion_wait_time")
+    with test_lib.ConfigOverrider({"FileStore.ingestion_threads": 2}):
+      events.Events.PublishEvent(
+          "FileStore.AddFileToStore",
+          rdf_flows.GrrMessage(
+              payload=urn,
+              auth_state=rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED),
+          token=self.token)
+      worker = test_lib.MockWorker(token=self.token)
+      worker.Simulate()
+
+    transfer.FileStoreCreateFile.GetThreadPool(2).Join()
+
+    self.assertEqual(
+        stats.STATS.GetMetricValue("filestore_ingestion_wait_time").count,
+        wait_time.count + 1)
+    refs = list(
+        filestore.HashFileStore.GetReferencesSHA256(
+            hashlib.sha256(data).hexdigest(), token=self.token))
+    self.assertEqual(refs, [urn])
+    # The file is not pending anymore.
+    self.assertEqual(self._GetPendingFiles(), [])
+
+  def testFilesStayPendingWhenAddingThemFails(self):
+    urn = self._CreateBlobImage("client data")
+
+    def Fail(unused_self, unused_vfs_urn):
+      raise IOError("Could not open the file.")
+
+    with utils.Stubber(transfer.FileStoreCreateFile, "AddFileToStore", Fail):
+      with test_lib.ConfigOverrider({"FileStore.ingestion_threads": 2}):
+        events.Events.PublishEvent(
+            "FileStore.AddFileToStore",
+            rdf_flows.GrrMessage(
+                payload=urn,
+                auth_state=rdf_flows.GrrMessage.AuthorizationState.
+                AUTHENTICATED),
+            token=self.token)
+        worker = test_lib.MockWorker(token=self.token)
+        worker.Simulate()
+
+      transfer.FileStoreCreateFile.GetThreadPool(2).Join()
+
+    # The file is added again once its lease expired.
+    self.assertEqual(self._GetPendingFiles(), [str(urn)])
+
+  def testIngestionThreadPoolIsResized(self):
+    pool = transfer.FileStoreCreateFile.GetThreadPool(2)
+    self.assertIs(transfer.FileStoreCreateFile.GetThreadPool(2), pool)
+
+    resized = transfer.FileStoreCreateFile.GetThreadPool(3)
+    self.assertIsNot(resized, pool)
+    self.assertEqual(resized.max_threads, 3)
+    self.assertFalse(pool.started)
+
+  def testAbandonedFilesAreAddedAgain(self):
+    data = "client data" * 1000
+    urn = self._CreateBlobImage(
+        data, rdf_crypto.Hash(sha256=hashlib.sha256(data).digest()))
+    recent_urn = urn.Add("recent")
+
+    handler = transfer.FileStoreCreateFile(
+        transfer.FileStoreCreateFile.well_known_session_id,
+        mode="rw",
+        token=self.token)
+    prefix = transfer.FileStoreCreateFile.PENDING_PREFIX
+    lease_time = transfer.FileStoreCreateFile.PENDING_LEASE_TIME
+    # A worker died while these files were pending.
+    with test_lib.FakeTime(1000):
+      data_store.DB.Set(
+          transfer.FileStoreCreateFile.GetPendingShard(urn),
+          prefix + str(urn),
+          urn,
+          token=self.token)
+    with test_lib.FakeTime(1000 + lease_time):
+      data_store.DB.Set(
+          transfer.FileStoreCreateFile.GetPendingShard(recent_urn),
+          prefix + str(recent_urn),
+          recent_urn,
+          token=self.token)
+
+    resumed = []
+    with test_lib.ConfigOverrider({"FileStore.ingestion_threads": 0}):
+      with test_lib.FakeTime(1000 + lease_time + 1):
+        for shard in transfer.FileStoreCreateFile.GetAllPendingShards():
+          resumed.extend(handler.ResumeAbandonedFiles(shard))
+    self.assertEqual(resumed, [urn])
+
+    refs = list(
+        filestore.HashFileStore.GetReferencesSHA256(
+            hashlib.sha256(data).hexdigest(), token=self.token))
+    self.assertEqual(refs, [urn])
+    # Files whose lease did not expire yet are left to their worker.
+    self.assertEqual(self._GetPendingFiles(), [str(recent_urn)])
+
   def _SetupNSRLFiles(self):
     urn1 = self.AddFile("/Ext2IFS_1_10b.exe")
     urn2 = self.AddFile("/idea.dll")
@@ -472,6 +749,77 @@ class HashFileStoreTest(test_lib.AFF4ObjectTest):
     self.assertEqual(info.md5, "bb0a15eefe63fd41f8dc9dee01c5cf9a")
     self.assertEqual(info.file_size, 100)
 
+  def _WriteNSRLIndex(self):
+    path = os.path.join(self.temp_dir, "nsrl_index")
+    writer = nsrl_index.NSRLIndexWriter(path)
+    writer.AddHash("e1f7e62b3909263f3a2518bbae6a9ee36d5b502b",
+                   "bb0a15eefe63fd41f8dc9dee01c5cf9a", 0, "idea.dll", 100, [1],
+                   ["358"], "M")
+    writer.Close()
+    return path
+
+  def testCheckHashesNSRLIndex(self):
+    hashes = [
+        rdf_crypto.Hash(
+            sha1="e1f7e62b3909263f3a2518bbae6a9ee36d5b502b".decode("hex")),
+        rdf_crypto.Hash(sha1=hashlib.sha1("unknown").digest()),
+        rdf_crypto.Hash(sha256=hashlib.sha256("no sha1").digest())
+    ]
+    with test_lib.ConfigOverrider({
+        "FileStore.nsrl_index_path": self._WriteNSRLIndex()
+    }):
+      nsrl_fs = aff4.FACTORY.Open("aff4:/files/nsrl", token=self.token)
+      hits = list(nsrl_fs.CheckHashes(hashes))
+
+    self.assertEqual(hits, [(rdfvalue.RDFURN(
+        "aff4:/files/nsrl/e1f7e62b3909263f3a2518bbae6a9ee36d5b502b"),
+                             hashes[0])])
+
+  def testMissingNSRLIndexFallsBackToDataStore(self):
+    nsrl_fs = self._SetupNSRLFiles()
+    sha1 = "e1f7e62b3909263f3a2518bbae6a9ee36d5b502b"
+    hashes = [rdf_crypto.Hash(sha1=sha1.decode("hex"))]
+    path = os.path.join(self.temp_dir, "missing_nsrl_index")
+    with test_lib.ConfigOverrider({"FileStore.nsrl_index_path": path}):
+      self.assertIsNone(filestore.NSRLFileStore.GetNSRLIndex())
+      self.assertEqual(len(list(nsrl_fs.CheckHashes(hashes))), 1)
+      self.assertIn(sha1, nsrl_fs.NSRLInfoForSHA1s([sha1]))
+
+  def testReplacedNSRLIndexIsClosed(self):
+    path = self._WriteNSRLIndex()
+    with test_lib.ConfigOverrider({"FileStore.nsrl_index_path": path}):
+      index = filestore.NSRLFileStore.GetNSRLIndex()
+      self.assertIs(filestore.NSRLFileStore.GetNSRLIndex(), index)
+
+      os.remove(path)
+      self._WriteNSRLIndex()
+      new_index = filestore.NSRLFileStore.GetNSRLIndex()
+      self.assertIsNot(new_index, index)
+      # The old file is unmapped.
+      with self.assertRaises(ValueError):
+        index.Lookup(["\x00" * 20])
+
+  def testNSRLInfoFromIndex(self):
+    sha1s = [
+        "e1f7e62b3909263f3a2518bbae6a9ee36d5b502b",
+        "0000000000000000000000000000000000000000"
+    ]
+    with test_lib.ConfigOverrider({
+        "FileStore.nsrl_index_path": self._WriteNSRLIndex()
+    }):
+      nsrl_fs = aff4.FACTORY.Open("aff4:/files/nsrl", token=self.token)
+      infos = nsrl_fs.NSRLInfoForSHA1s(sha1s)
+
+    self.assertEqual(list(infos), sha1s[:1])
+    fd = infos[sha1s[0]]
+    self.assertIsInstance(fd, filestore.NSRLFile)
+    self.assertEqual(fd.urn, nsrl_fs.PATH.Add(sha1s[0]))
+    info = fd.Get(fd.Schema.NSRL)
+    self.assertEqual(info.md5, "bb0a15eefe63fd41f8dc9dee01c5cf9a".decode("hex"))
+    self.assertEqual(info.file_size, 100)
+    self.assertEqual(info.file_type,
+                     info.FileType.MALICIOUS_FILE)
+
   def testGetClientsForHashesNSRL(self):
     """Tests GetClientsForHashes for the NSRL filestore.
 
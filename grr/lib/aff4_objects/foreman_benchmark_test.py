@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""Benchmark for the foreman assigning hunts to clients."""
+
+
+import time
+
+
+from grr.lib import aff4
+from grr.lib import flags
+from grr.lib import rdfvalue
+from grr.lib import test_lib
+from grr.lib import utils
+from grr.lib.hunts import standard
+from grr.server import foreman as rdf_foreman
+
+
+class ForemanBenchmark(test_lib.MicroBenchmarks):
+  """Foreman checks of many clients while hunts are being started.
+
+  Every round RULES_PER_ROUND hunts are started, the foreman is reopened the
+  way the Foreman flow does it, and every client checks in twice. The rules mix
+  all the client rule types, most of them only match a few clients.
+  """
+
+  labels = ["benchmark"]
+  units = "s"
+
+  CLIENTS = 1000
+  ROUNDS = 50
+  RULES_PER_ROUND = 4
+
+  def setUp(self):
+    super(ForemanBenchmark, self).setUp(["Value"], ["<20"])
+
+  def _MakeRule(self, number, created):
+    """Returns a hunt rule, the client rules depend on the number."""
+    os_rule = rdf_foreman.ForemanClientRule(
+        rule_type=rdf_foreman.ForemanClientRule.Type.OS,
+        os=rdf_foreman.ForemanOsClientRule(os_windows=True))
+    regex_rule = rdf_foreman.ForemanClientRule(
+        rule_type=rdf_foreman.ForemanClientRule.Type.REGEX,
+        regex=rdf_foreman.ForemanRegexClientRule(
+            attribute_name="Host", attribute_regex="Host-%d$" % (number % 10)))
+    integer_rule = rdf_foreman.ForemanClientRule(
+        rule_type=rdf_foreman.ForemanClientRule.Type.INTEGER,
+        integer=rdf_foreman.ForemanIntegerClientRule(
+            attribute_name="Install",
+            operator=rdf_foreman.ForemanIntegerClientRule.Operator.GREATER_THAN,
+            value=number % 3))
+    label_rule = rdf_foreman.ForemanClientRule(
+        rule_type=rdf_foreman.ForemanClientRule.Type.LABEL,
+        label=rdf_foreman.ForemanLabelClientRule(
+            label_names=["label%d" % (number % 5)]))
+
+    hunt_id = rdfvalue.RDFURN("aff4:/hunts/H:%08X" % number)
+    return rdf_foreman.ForemanRule(
+        created=created,
+        expires=created + rdfvalue.Duration("1w").microseconds,
+        description="Benchmark rule %d" % number,
+        client_rule_set=rdf_foreman.ForemanClientRuleSet(
+            match_mode=rdf_foreman.ForemanClientRuleSet.MatchMode.MATCH_ALL,
+            rules=[os_rule, regex_rule, integer_rule, label_rule]),
+        actions=[
+            rdf_foreman.ForemanRuleAction(
+                hunt_id=hunt_id,
+                hunt_name=standard.SampleHunt.__name__,
+                client_limit=0)
+        ])
+
+  def StartClients(self, hunt_id, client_ids):
+    self.started.append((hunt_id, client_ids))
+
+  def testForemanChecks(self):
+    """Time for 2 * CLIENTS * ROUNDS foreman checks."""
+    client_ids = self.SetupClients(self.CLIENTS, system="Windows")
+    for i, client_id in enumerate(client_ids):
+      with aff4.FACTORY.Open(client_id, mode="rw", token=self.token) as client:
+        client.Set(client.Schema.HOSTNAME("Host-%d" % i))
+        client.Set(client.Schema.INSTALL_DATE(i % 7))
+        client.AddLabels("label%d" % (i % 5), owner="GRR")
+
+    self.started = []
+    with aff4.FACTORY.Open(
+        "aff4:/foreman", mode="rw", token=self.token) as foreman:
+      foreman.Set(foreman.Schema.RULES())
+
+    elapsed_time = 0
+    checks = 0
+    with utils.Stubber(standard.SampleHunt, "StartClients",
+                       self.StartClients):
+      for round_number in xrange(self.ROUNDS):
+        with aff4.FACTORY.Open(
+            "aff4:/foreman", mode="rw", token=self.token) as foreman:
+          rules = foreman.Get(foreman.Schema.RULES)
+          now = rdfvalue.RDFDatetime.Now().AsMicroSecondsFromEpoch()
+          for i in xrange(self.RULES_PER_ROUND):
+            number = round_number * self.RULES_PER_ROUND + i
+            rules.Append(self._MakeRule(number, now))
+          foreman.Set(foreman.Schema.RULES, rules)
+
+        start_time = time.time()
+        foreman = aff4.FACTORY.Open("aff4:/foreman", token=self.token)
+        for client_id in client_ids:
+          foreman.AssignTasksToClient(client_id)
+          # Clients check in more often than hunts are started.
+          foreman.AssignTasksToClient(client_id)
+          checks += 2
+        elapsed_time += time.time() - start_time
+
+    self.AddResult("Foreman checks", elapsed_time, checks,
+                   "%d/s" % (checks / elapsed_time))
+    self.AddResult("Hunts started", elapsed_time, len(self.started), "")
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
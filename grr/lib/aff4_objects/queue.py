@@ -87,7 +87,8 @@ class Queue(aff4.AFF4Object):
                    timeout="30m",
                    start_time=None,
                    record_filter=lambda x: False,
-                   max_filtered=1000):
+                   max_filtered=1000,
+                   max_scanned=None):
     """Returns and claims up to limit unclaimed records for timeout seconds.
 
     Returns a list of records which are now "claimed", a claimed record will
@@ -113,6 +114,8 @@ class Queue(aff4.AFF4Object):
         sequentially without any unfiltered results, we stop looking for
         results.
 
+      max_scanned: The maximum number of records to read, defaults to 4 * limit.
+
     Returns:
       A list (id, record) where record is a self.rdf_type and id is a record
       identifier which can be used to delete or release the record.
@@ -136,7 +139,7 @@ class Queue(aff4.AFF4Object):
 
     for subject, values in data_store.DB.ScanAttributes(
         self.urn.Add("Records"), [self.VALUE_ATTRIBUTE, self.LOCK_ATTRIBUTE],
-        max_records=4 * limit,
+        max_records=max_scanned or 4 * limit,
         after_urn=after_urn,
         token=self.token):
       if self.VALUE_ATTRIBUTE not in values:
@@ -16,6 +16,7 @@ from grr.lib import flags
 from grr.lib import flow
 from grr.lib import queue_manager
 from grr.lib import rdfvalue
+from grr.lib import stats
 from grr.lib import test_lib
 from grr.lib import utils
 from grr.lib.aff4_objects import aff4_grr
@@ -1130,6 +1131,84 @@ class AFF4Tests(test_lib.AFF4ObjectTest):
   def testAFF4UnversionedImage(self):
     self.ExerciseAFF4ImageBase(aff4.AFF4UnversionedImage)
 
+  def _CreateNumberedImage(self, path, chunks, chunksize=10):
+    with aff4.FACTORY.Create(path, aff4.AFF4Image, token=self.token) as fd:
+      fd.SetChunksize(chunksize)
+      for i in range(chunks):
+        fd.Write("Chunk%05d" % i)
+    return "".join("Chunk%05d" % i for i in range(chunks))
+
+  def testAFF4ImageStreamingReadGrowsLookAhead(self):
+    path = "aff4:/C.12345/aff4imagestreaming"
+    expected = self._CreateNumberedImage(path, 500)
+
+    fd = aff4.FACTORY.Open(path, token=self.token)
+    data = []
+    while True:
+      buf = fd.Read(7)
+      if not buf:
+        break
+      data.append(buf)
+
+    self.assertEqual("".join(data), expected)
+    self.assertEqual(fd.look_ahead, fd.MAX_LOOK_AHEAD)
+
+  def testAFF4ImageStreamingReadPrefetchesNextWindow(self):
+    path = "aff4:/C.12345/aff4imagestreaming"
+    expected = self._CreateNumberedImage(path, 500)
+
+    fd = aff4.FACTORY.Open(path, token=self.token)
+    self.assertEqual(fd.Read(fd.LOOK_AHEAD * 10), expected[:100])
+
+    with mock.patch.object(
+        fd, "_FetchChunks", wraps=fd._FetchChunks) as fetch_mock:
+      self.assertEqual(fd.Read(10), expected[100:110])
+
+    # The current window is read synchronously and the next one is prefetched.
+    self.assertIsNotNone(fd._prefetch)
+    self.assertEqual(
+        sorted(fd._prefetch.Wait()), range(30, 30 + fd.look_ahead))
+    self.assertEqual(fetch_mock.call_count, 2)
+
+  def testAFF4ImageRandomAccessResetsLookAhead(self):
+    path = "aff4:/C.12345/aff4imagestreaming"
+    expected = self._CreateNumberedImage(path, 500)
+
+    fd = aff4.FACTORY.Open(path, token=self.token)
+    fd.Read(3000)
+    self.assertGreater(fd.look_ahead, fd.LOOK_AHEAD)
+
+    fd.Seek(4000)
+    self.assertEqual(fd.Read(20), expected[4000:4020])
+    self.assertEqual(fd.look_ahead, fd.LOOK_AHEAD)
+
+    fd.Seek(100)
+    self.assertEqual(fd.Read(20), expected[100:120])
+
+  def testAFF4ImageStreamingReadStopsAtEndOfStream(self):
+    path = "aff4:/C.12345/aff4imagestreaming"
+    expected = self._CreateNumberedImage(path, 25)
+
+    fd = aff4.FACTORY.Open(path, token=self.token)
+    with mock.patch.object(
+        fd, "_FetchChunks", wraps=fd._FetchChunks) as fetch_mock:
+      self.assertEqual(fd.Read(1000), expected)
+
+    for call in fetch_mock.call_args_list:
+      self.assertLessEqual(max(call[0][0]), 25)
+
+  def testAFF4ImageWritesToChunksThatWereRead(self):
+    path = "aff4:/C.12345/aff4imagestreaming"
+    expected = self._CreateNumberedImage(path, 50)
+
+    with aff4.FACTORY.Open(path, mode="rw", token=self.token) as fd:
+      self.assertEqual(fd.Read(30), expected[:30])
+      fd.Seek(12)
+      fd.Write("XX")
+
+    fd = aff4.FACTORY.Open(path, token=self.token)
+    self.assertEqual(fd.Read(500), expected[:12] + "XX" + expected[14:])
+
   def testAFF4ImageSize(self):
     path = "/C.12345/aff4imagesize"
 
@@ -1757,6 +1836,148 @@ class AFF4Tests(test_lib.AFF4ObjectTest):
             self.fail("Class %s used aff4.FACTORY during init: %s" % (cls, e))
 
 
+class AFF4AttributeCacheTest(test_lib.AFF4ObjectTest):
+  """Tests for the Factory's attribute cache."""
+
+  def setUp(self):
+    super(AFF4AttributeCacheTest, self).setUp()
+
+    with test_lib.ConfigOverrider({"AFF4.attribute_cache_max_size": 3}):
+      self.factory = aff4.Factory()
+    self.factory_stubber = utils.Stubber(aff4, "FACTORY", self.factory)
+    self.factory_stubber.Start()
+
+    self.urn = rdfvalue.RDFURN("aff4:/foo/bar")
+    with aff4.FACTORY.Create(
+        self.urn, aff4_type=aff4_standard.VFSDirectory,
+        token=self.token) as fd:
+      fd.Set(fd.Schema.PATHSPEC(path="/old"))
+
+  def tearDown(self):
+    self.factory_stubber.Stop()
+    super(AFF4AttributeCacheTest, self).tearDown()
+
+  def _CountReads(self):
+    return mock.patch.object(
+        data_store.DB,
+        "MultiResolvePrefix",
+        wraps=data_store.DB.MultiResolvePrefix)
+
+  def testCacheIsDisabledByDefault(self):
+    self.assertIsNone(aff4.Factory().attribute_cache)
+
+  def testReadOnlyOpenIsServedFromCache(self):
+    aff4.FACTORY.Open(self.urn, token=self.token)
+
+    with self._CountReads() as read_mock:
+      fd = aff4.FACTORY.Open(self.urn, token=self.token)
+      fds = list(aff4.FACTORY.MultiOpen([self.urn], mode="r", token=self.token))
+
+    self.assertEqual(read_mock.call_count, 0)
+    self.assertEqual(fd.Get(fd.Schema.PATHSPEC).path, "/old")
+    self.assertEqual(fds[0].Get(fds[0].Schema.PATHSPEC).path, "/old")
+
+  def testGetAttributesReadsOnlyRequestedAttributes(self):
+    aff4.FACTORY.Open(self.urn, token=self.token)
+
+    with self._CountReads() as read_mock:
+      result = list(
+          aff4.FACTORY.GetAttributes(
+              [self.urn],
+              attributes=[aff4_standard.VFSDirectory.SchemaCls.TYPE],
+              use_cache=True,
+              token=self.token))
+
+    self.assertEqual(read_mock.call_count, 1)
+    self.assertEqual(len(result), 1)
+    self.assertEqual(
+        set(attribute for attribute, _, _ in result[0][1]), set(["aff4:type"]))
+
+  def testReadWriteOpenBypassesCache(self):
+    aff4.FACTORY.Open(self.urn, token=self.token)
+
+    with self._CountReads() as read_mock:
+      aff4.FACTORY.Open(self.urn, mode="rw", token=self.token)
+      aff4.FACTORY.Open(self.urn, age=aff4.ALL_TIMES, token=self.token)
+
+    self.assertEqual(read_mock.call_count, 2)
+
+  def testNonExistingObjectsAreCached(self):
+    urn = rdfvalue.RDFURN("aff4:/does/not/exist")
+    aff4.FACTORY.Open(urn, token=self.token)
+
+    with self._CountReads() as read_mock:
+      fd = aff4.FACTORY.Open(urn, token=self.token)
+      fds = aff4.FACTORY.MultiOpen([urn], mode="r", token=self.token)
+      self.assertEqual(list(fds), [])
+
+    self.assertEqual(read_mock.call_count, 0)
+    self.assertFalse(fd.Get(fd.Schema.TYPE))
+
+  def testWriteAttributesInvalidatesCache(self):
+    aff4.FACTORY.Open(self.urn, token=self.token)
+
+    with aff4.FACTORY.Open(self.urn, mode="rw", token=self.token) as fd:
+      fd.Set(fd.Schema.PATHSPEC(path="/new"))
+
+    fd = aff4.FACTORY.Open(self.urn, token=self.token)
+    self.assertEqual(fd.Get(fd.Schema.PATHSPEC).path, "/new")
+
+  def testMutationPoolInvalidatesCacheOnFlush(self):
+    with data_store.DB.GetMutationPool(token=self.token) as pool:
+      with aff4.FACTORY.Create(
+          self.urn,
+          aff4_type=aff4_standard.VFSDirectory,
+          mutation_pool=pool,
+          token=self.token) as fd:
+        fd.Set(fd.Schema.PATHSPEC(path="/new"))
+
+      # The write is still sitting in the pool, this fills the cache with the
+      # old data.
+      fd = aff4.FACTORY.Open(self.urn, token=self.token)
+      self.assertEqual(fd.Get(fd.Schema.PATHSPEC).path, "/old")
+
+    fd = aff4.FACTORY.Open(self.urn, token=self.token)
+    self.assertEqual(fd.Get(fd.Schema.PATHSPEC).path, "/new")
+
+  def testDeleteInvalidatesCache(self):
+    aff4.FACTORY.Open(self.urn, token=self.token)
+    aff4.FACTORY.Delete(self.urn, token=self.token)
+
+    fd = aff4.FACTORY.Open(self.urn, token=self.token)
+    self.assertFalse(fd.Get(fd.Schema.PATHSPEC))
+
+  def testConcurrentWriteIsNotMaskedByStaleRead(self):
+    generation = aff4.FACTORY.attribute_cache.generation
+    aff4.FACTORY.InvalidateAttributeCache([self.urn])
+
+    key = aff4.FACTORY._MakeCacheInvariant(self.urn, self.token,
+                                           aff4.NEWEST_TIME)
+    aff4.FACTORY.attribute_cache.PutValues(
+        utils.SmartUnicode(self.urn), key, [("aff4:type", "Stale", 0)],
+        generation)
+
+    with self.assertRaises(KeyError):
+      aff4.FACTORY.attribute_cache.GetValues(
+          utils.SmartUnicode(self.urn), key)
+
+  def testCountersAreUpdated(self):
+    hits = stats.STATS.GetMetricValue("aff4_cache_hits")
+    misses = stats.STATS.GetMetricValue("aff4_cache_misses")
+    evictions = stats.STATS.GetMetricValue("aff4_cache_evictions")
+
+    aff4.FACTORY.Open(self.urn, token=self.token)
+    aff4.FACTORY.Open(self.urn, token=self.token)
+    for i in range(4):
+      aff4.FACTORY.Open("aff4:/other/%d" % i, token=self.token)
+
+    self.assertEqual(stats.STATS.GetMetricValue("aff4_cache_hits"), hits + 1)
+    self.assertEqual(
+        stats.STATS.GetMetricValue("aff4_cache_misses"), misses + 5)
+    self.assertEqual(
+        stats.STATS.GetMetricValue("aff4_cache_evictions"), evictions + 2)
+
+
 class AFF4SymlinkTestSubject(aff4.AFF4Volume):
   """A test subject for AFF4SymlinkTest."""
 
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""Benchmark for client index lookups."""
+
+
+import time
+
+
+from grr.lib import aff4
+from grr.lib import client_index
+from grr.lib import flags
+from grr.lib import test_lib
+from grr.lib.aff4_objects import aff4_grr
+
+
+class ClientIndexBenchmark(test_lib.MicroBenchmarks):
+  """Searches for clients in an index of many synthetic clients.
+
+  The queries combine keywords with posting lists of very different sizes,
+  from a single client to all of them.
+  """
+
+  labels = ["benchmark"]
+  units = "s"
+
+  CLIENTS = 200000
+  REPEATS = 10
+
+  QUERIES = [
+      ["host:host-123456"],
+      ["label:label42"],
+      ["label:label42", "windows"],
+      ["label:label42", "host:host"],
+      ["label:dept3", "linux"],
+      ["windows"],
+  ]
+
+  SYSTEMS = ["Windows", "Linux", "Darwin"]
+
+  def setUp(self):
+    super(ClientIndexBenchmark, self).setUp(["Clients"], ["<10"])
+
+  def _AddClients(self, index):
+    for i in xrange(self.CLIENTS):
+      client = aff4.FACTORY.Create(
+          "C.%016X" % i, aff4_grr.VFSGRRClient, mode="rw", token=self.token)
+      client.Set(client.Schema.HOSTNAME("host-%d" % i))
+      client.Set(client.Schema.SYSTEM(self.SYSTEMS[i % len(self.SYSTEMS)]))
+      client.Set(client.Schema.CLIENT_INFO(
+          labels=["label%d" % (i % 1000), "dept%d" % (i % 10)]))
+      index.AddClient(client)
+
+  def testLookupClients(self):
+    """Time to look up clients in an index of CLIENTS clients."""
+    index = client_index.CreateClientIndex(token=self.token)
+
+    start_time = time.time()
+    self._AddClients(index)
+    self.AddResult("AddClient", time.time() - start_time, self.CLIENTS, "")
+
+    for query in self.QUERIES:
+      start_time = time.time()
+      for _ in xrange(self.REPEATS):
+        results = index.LookupClients(query)
+      self.AddResult(" ".join(query),
+                     time.time() - start_time, self.REPEATS, len(results))
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
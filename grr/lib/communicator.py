@@ -28,7 +28,8 @@ class CommunicatorInit(registry.InitHook):
     stats.STATS.RegisterCounterMetric("grr_decryption_error")
     stats.STATS.RegisterCounterMetric("grr_authenticated_messages")
     stats.STATS.RegisterCounterMetric("grr_unauthenticated_messages")
-    stats.STATS.RegisterCounterMetric("grr_rsa_operations")
+    stats.STATS.RegisterCounterMetric(
+        "grr_rsa_operations", fields=[("type", str)])
 
     stats.STATS.RegisterCounterMetric(
         "grr_encrypted_cipher_cache", fields=[("type", str)])
@@ -88,7 +89,7 @@ class Cipher(object):
     self.cipher_metadata.signature = self.private_key.Sign(serialized_cipher)
 
     # Now encrypt the cipher.
-    stats.STATS.IncrementCounter("grr_rsa_operations")
+    stats.STATS.IncrementCounter("grr_rsa_operations", fields=["performed"])
     self.encrypted_cipher = remote_public_key.Encrypt(serialized_cipher)
 
     # Encrypt the metadata block symmetrically.
@@ -135,6 +136,7 @@ class ReceivedCipher(Cipher):
 
     try:
       # The encrypted_cipher contains the session key, iv and hmac_key.
+      stats.STATS.IncrementCounter("grr_rsa_operations", fields=["performed"])
       self.serialized_cipher = private_key.Decrypt(
           response_comms.encrypted_cipher)
 
@@ -250,7 +252,7 @@ class ReceivedCipher(Cipher):
     """
     if self.cipher_metadata.signature and remote_public_key:
 
-      stats.STATS.IncrementCounter("grr_rsa_operations")
+      stats.STATS.IncrementCounter("grr_rsa_operations", fields=["performed"])
       remote_public_key.Verify(self.serialized_cipher,
                                self.cipher_metadata.signature)
       return True
@@ -273,7 +275,7 @@ class Communicator(object):
     self.server_cipher_age = rdfvalue.RDFDatetime().FromSecondsFromEpoch(0)
 
     # A cache for encrypted ciphers
-    self.encrypted_cipher_cache = utils.FastStore(max_size=50000)
+    self.encrypted_cipher_cache = utils.ShardedFastStore(max_size=50000)
 
   def EncodeMessageList(self, message_list, signed_message_list):
     """Encode the MessageList into the signed_message_list rdfvalue."""
@@ -454,6 +456,9 @@ class Communicator(object):
       cipher = self.encrypted_cipher_cache.Get(response_comms.encrypted_cipher)
       stats.STATS.IncrementCounter(
           "grr_encrypted_cipher_cache", fields=["hits"])
+      # The cached cipher saves decrypting and verifying it again.
+      stats.STATS.IncrementCounter(
+          "grr_rsa_operations", delta=2, fields=["cached"])
 
       # Even though we have seen this encrypted cipher already, we should still
       # make sure that all the other fields are sane and verify the HMAC.
@@ -473,7 +478,9 @@ class Communicator(object):
       try:
         remote_public_key = self._GetRemotePublicKey(source)
         if cipher.VerifyCipherSignature(remote_public_key):
-          # At this point we know this cipher is legit, we can cache it.
+          # At this point we know this cipher is legit, we can cache it. The
+          # cache should not keep the whole first request alive though.
+          cipher.response_comms = None
           self.encrypted_cipher_cache.Put(response_comms.encrypted_cipher,
                                           cipher)
           cipher_verified = True
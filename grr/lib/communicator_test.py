@@ -135,6 +135,54 @@ class ClientCommsTest(test_lib.GRRBaseTest):
       self.assertEqual(decoded_messages[i].auth_state,
                        rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED)
 
+  def _GetRSAOperations(self):
+    return (stats.STATS.GetMetricValue(
+        "grr_rsa_operations", fields=["performed"]),
+            stats.STATS.GetMetricValue("grr_rsa_operations",
+                                       fields=["cached"]))
+
+  def testCachedCipherSkipsRSAOperations(self):
+    """Repeated messages with the same cipher need no RSA operations."""
+    self.MakeClientAFF4Record()
+
+    self.ClientServerCommunicate()
+    performed, cached = self._GetRSAOperations()
+
+    for _ in range(3):
+      decoded_messages = self.ClientServerCommunicate()
+      self.assertEqual(decoded_messages[0].auth_state,
+                       rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED)
+
+    # Decrypting and verifying the cipher was skipped for every message.
+    self.assertEqual(self._GetRSAOperations(), (performed, cached + 6))
+
+    # The cache does not hold on to the first request.
+    cipher = list(self.server_communicator.encrypted_cipher_cache)[0][1]
+    self.assertIsNone(cipher[1].response_comms)
+
+  def testCachedCipherExpires(self):
+    with test_lib.ConfigOverrider({"Frontend.cipher_cache_max_age": 60}):
+      self.server_communicator = front_end.ServerCommunicator(
+          certificate=self.server_certificate,
+          private_key=self.server_private_key,
+          token=self.token)
+
+    self.MakeClientAFF4Record()
+
+    now = time.time()
+    with test_lib.FakeTime(now):
+      self.ClientServerCommunicate()
+      performed, cached = self._GetRSAOperations()
+
+    with test_lib.FakeTime(now + 30):
+      self.ClientServerCommunicate()
+      self.assertEqual(self._GetRSAOperations(), (performed, cached + 2))
+
+    # The client still uses the same cipher but the server verifies it again.
+    with test_lib.FakeTime(now + 120):
+      self.ClientServerCommunicate()
+      self.assertEqual(self._GetRSAOperations(), (performed + 2, cached + 2))
+
   def testClientPingAndClockIsUpdated(self):
     """Check PING and CLOCK are updated, simulate bad client clock."""
     new_client = self.MakeClientAFF4Record()
@@ -37,6 +37,7 @@ able to filter it directly).
 
 import abc
 import atexit
+import hashlib
 import sys
 import time
 
@@ -79,6 +80,16 @@ class DBSubjectLockError(Error):
 # This token will be used by default if no token was provided.
 default_token = None
 
+# Callables which get notified with the subjects modified each time a
+# MutationPool is flushed. In-process caches layered above the data store use
+# this to drop entries that became stale.
+mutation_listeners = []
+
+# Callables which get called with the queue shard each time notifications are
+# written to it. Workers use this to wake up as soon as there is work instead
+# of polling the notification shards.
+notification_listeners = []
+
 
 def GetDefaultToken(token):
   """Returns the provided token or the default token.
@@ -118,6 +129,7 @@ class MutationPool(object):
     self.delete_attributes_requests = []
 
     self.new_notifications = []
+    self.collection_index_requests = {}
 
   def DeleteSubjects(self, subjects):
     self.delete_subject_requests.extend(subjects)
@@ -166,18 +178,51 @@ class MutationPool(object):
           token=self.token,
           sync=False)
 
+    # Records have to be written before they are marked as pending, so that
+    # readers never find markers of records which don't exist.
+    for (collection_cls, collection_urn), record_ids in sorted(
+        self.collection_index_requests.iteritems(), key=lambda x: x[0][1]):
+      DB.MultiSet(
+          collection_urn,
+          dict((collection_cls.INDEX_PENDING_TEMPLATE % record_id, ["1"])
+               for record_id in record_ids),
+          token=self.token,
+          sync=False)
+
     if (self.delete_subject_requests or self.delete_attributes_requests or
-        self.set_requests):
+        self.set_requests or self.collection_index_requests):
       DB.Flush()
 
+    self._NotifyMutationListeners()
+
     for queue, notifications in self.new_notifications:
       DB.CreateNotifications(queue, notifications, token=self.token)
     self.new_notifications = []
 
+    # One index update per collection for all the records of this flush.
+    for (collection_cls, collection_urn), _ in sorted(
+        self.collection_index_requests.iteritems(), key=lambda x: x[0][1]):
+      collection_cls.FlushPendingRecords(collection_urn, token=self.token)
+    self.collection_index_requests = {}
+
     self.delete_subject_requests = []
     self.set_requests = []
     self.delete_attributes_requests = []
 
+  def _NotifyMutationListeners(self):
+    """Tells the registered listeners which subjects were modified."""
+    if not mutation_listeners:
+      return
+
+    subjects = set(self.delete_subject_requests)
+    subjects.update(req[0] for req in self.delete_attributes_requests)
+    subjects.update(req[0] for req in self.set_requests)
+    if not subjects:
+      return
+
+    for listener in mutation_listeners:
+      listener(subjects)
+
   def __enter__(self):
     return self
 
@@ -192,6 +237,21 @@ class MutationPool(object):
   def CreateNotifications(self, queue, notifications):
     self.new_notifications.append((queue, notifications))
 
+  # Collection index handling
+  def CollectionAddToIndex(self, collection_cls, collection_urn, record_id):
+    """Adds a record of an IndexedSequentialCollection to its index on Flush.
+
+    The markers of a collection are written with a single MultiSet after the
+    records, and the index is updated once per collection.
+
+    Args:
+      collection_cls: The IndexedSequentialCollection subclass.
+      collection_urn: The urn of the collection.
+      record_id: The (timestamp, suffix) pair of the record.
+    """
+    key = (collection_cls, utils.SmartStr(collection_urn))
+    self.collection_index_requests.setdefault(key, []).append(record_id)
+
 
 class DataStore(object):
   """Abstract database access."""
@@ -236,6 +296,11 @@ class DataStore(object):
       raise RuntimeError("No blob store %s found." % blobstore_name)
 
     self.blobstore = cls()
+    # Digests of blobs that are known to be in the blob store. Blobs are
+    # content addressed so a blob that was stored once never needs to be
+    # written again.
+    self.known_blobs = utils.ShardedFastStore(
+        max_size=config.CONFIG["Blobstore.known_blobs_cache_size"])
 
   def InitializeMonitorThread(self):
     """Start the thread that registers the size of the DataStore."""
@@ -629,6 +694,47 @@ class DataStore(object):
       ts, v = r[attribute]
       yield (s, ts, v)
 
+  def ScanAttributeBatches(self,
+                           subject_prefix,
+                           attribute,
+                           after_urn=None,
+                           max_records=None,
+                           batch_size=1000,
+                           token=None):
+    """Scans the newest values of an attribute, a page of rows at a time.
+
+    This is the bulk version of ScanAttribute. Values are returned as stored,
+    without decoding them according to the attribute type, and data stores
+    which can fetch a whole page in one query override this.
+
+    Args:
+      subject_prefix: Subject beginning with this prefix can be scanned. Must
+        be an aff4 object and a directory - "/" will be appended if necessary.
+        User must have read and query permissions on this directory.
+
+      attribute: The attribute name to scan.
+
+      after_urn: If set, only scan records which come after this urn.
+
+      max_records: The maximum number of records to scan.
+
+      batch_size: The maximum number of records in each batch.
+
+      token: The security token to authenticate with.
+
+    Yields: Lists of up to batch_size (subject, timestamp, value) tuples, in
+      lexicographic order of subjects.
+
+    """
+    for batch in utils.Grouper(
+        self.ScanAttribute(
+            subject_prefix,
+            attribute,
+            after_urn=after_urn,
+            max_records=max_records,
+            token=token), batch_size):
+      yield batch
+
   def ReadBlob(self, identifier, token=None):
     return self.ReadBlobs([identifier], token=token).values()[0]
 
@@ -636,21 +742,63 @@ class DataStore(object):
     return self.blobstore.ReadBlobs(identifiers, token=token)
 
   def StoreBlob(self, content, token=None):
-    return self.blobstore.StoreBlob(content, token=token)
+    return self.StoreBlobs([content], token=token)[0]
+
+  def _IsKnownBlob(self, identifier):
+    try:
+      return self.known_blobs.Get(identifier)
+    except KeyError:
+      return False
 
   def StoreBlobs(self, contents, token=None):
-    return self.blobstore.StoreBlobs(contents, token=token)
+    """Stores blobs, skipping the ones known to be in the blob store."""
+    contents_by_digest = {}
+    new_contents = []
+    for content in contents:
+      digest = hashlib.sha256(content).hexdigest()
+      if digest in contents_by_digest or self._IsKnownBlob(digest):
+        stats.STATS.IncrementCounter("blob_store_writes_saved")
+        stats.STATS.IncrementCounter(
+            "blob_store_bytes_saved", delta=len(content))
+      else:
+        new_contents.append(content)
+      contents_by_digest[digest] = content
+
+    if new_contents:
+      self.blobstore.StoreBlobs(new_contents, token=token)
+
+    for digest in contents_by_digest:
+      self.known_blobs.Put(digest, True)
+    return contents_by_digest.keys()
 
   def BlobExists(self, identifier, token=None):
     return self.BlobsExist([identifier], token=token).values()[0]
 
   def BlobsExist(self, identifiers, token=None):
-    return self.blobstore.BlobsExist(identifiers, token=token)
+    """Checks blob existence, only asking the blob store for unknown blobs."""
+    result = {}
+    unknown = []
+    for identifier in identifiers:
+      if self._IsKnownBlob(identifier):
+        result[identifier] = True
+      else:
+        unknown.append(identifier)
+
+    if unknown:
+      for identifier, exists in self.blobstore.BlobsExist(
+          unknown, token=token).iteritems():
+        if exists:
+          self.known_blobs.Put(identifier, True)
+        result[identifier] = exists
+
+    return result
 
   def DeleteBlob(self, identifier, token=None):
     return self.DeleteBlobs([identifier], token=token)
 
   def DeleteBlobs(self, identifiers, token=None):
+    for identifier in identifiers:
+      self.known_blobs.ExpireObject(identifier)
     return self.blobstore.DeleteBlobs(identifiers, token=token)
 
   def GetMutationPool(self, token=None):
@@ -664,6 +812,9 @@ class DataStore(object):
       ]
     self.MultiSet(queue_shard, values, replace=False, sync=True, token=token)
 
+    for listener in notification_listeners:
+      listener(queue_shard)
+
   def DeleteNotifications(self,
                           queue_shards,
                           session_ids,
@@ -1130,3 +1281,6 @@ class DataStoreInit(registry.InitHook):
     """Initialize some Varz."""
     stats.STATS.RegisterCounterMetric("grr_commit_failure")
     stats.STATS.RegisterCounterMetric("datastore_retries")
+    stats.STATS.RegisterCounterMetric("blob_store_writes_saved")
+    stats.STATS.RegisterCounterMetric(
+        "blob_store_bytes_saved", units="BYTES")
@@ -28,8 +28,10 @@ from grr.lib import flow
 from grr.lib import queue_manager
 from grr.lib import rdfvalue
 from grr.lib import sequential_collection
+from grr.lib import stats
 from grr.lib import test_lib
 from grr.lib import threadpool
+from grr.lib import utils
 from grr.lib import worker
 from grr.lib.aff4_objects import aff4_grr
 from grr.lib.aff4_objects import standard
@@ -44,6 +46,11 @@ class StringSequentialCollection(
   RDF_TYPE = rdfvalue.RDFString
 
 
+class UnindexedStringSequentialCollection(
+    sequential_collection.SequentialCollection):
+  RDF_TYPE = rdfvalue.RDFString
+
+
 def DeletionTest(f):
   """This indicates a test that uses deletion."""
 
@@ -332,6 +339,40 @@ class _DataStoreTest(test_lib.GRRBaseTest):
         token=self.token)
     self.assertListEqual(values, [("aff4:stored", "4", 3000)])
 
+  def testMultiSetKeepsAllVersionsWhenReplacing(self):
+    for sync in [True, False]:
+      attribute = "aff4:replaced_%s" % sync
+      data_store.DB.MultiSet(
+          self.test_row, {attribute: [("1", 1000), ("2", 2000)]},
+          replace=True,
+          sync=sync,
+          token=self.token)
+      data_store.DB.Flush()
+
+      values = data_store.DB.ResolvePrefix(
+          self.test_row,
+          attribute,
+          timestamp=data_store.DB.ALL_TIMESTAMPS,
+          token=self.token)
+      self.assertListEqual(values, [(attribute, "2", 2000),
+                                    (attribute, "1", 1000)])
+
+      # A later MultiSet replaces all of them.
+      data_store.DB.MultiSet(
+          self.test_row, {attribute: [("3", 3000), ("4", 4000)]},
+          replace=True,
+          sync=sync,
+          token=self.token)
+      data_store.DB.Flush()
+
+      values = data_store.DB.ResolvePrefix(
+          self.test_row,
+          attribute,
+          timestamp=data_store.DB.ALL_TIMESTAMPS,
+          token=self.token)
+      self.assertListEqual(values, [(attribute, "4", 4000),
+                                    (attribute, "3", 3000)])
+
   @DeletionTest
   def testDeleteAttributes(self):
     """Test we can delete an attribute."""
@@ -912,6 +953,65 @@ class _DataStoreTest(test_lib.GRRBaseTest):
     ]
     self.assertEqual(sorted(values), ["h1", "h2", "h3", "h4", "h5", "h6", "h7"])
 
+  def testScanAttributeBatches(self):
+    for i in range(10):
+      data_store.DB.Set(
+          "aff4:/B/%d" % i,
+          "aff4:foo",
+          "B %d old value" % i,
+          timestamp=1900,
+          token=self.token)
+      data_store.DB.Set(
+          "aff4:/B/%d" % i,
+          "aff4:foo",
+          "B %d value" % i,
+          timestamp=2000,
+          token=self.token,
+          replace=False)
+    data_store.DB.Set(
+        "aff4:/B/1.1", "aff4:foo2", "B 1.1 other value", token=self.token)
+    data_store.DB.Set(
+        "aff4:/A", "aff4:foo", "A value", timestamp=3000, token=self.token)
+    data_store.DB.Set(
+        "aff4:/C/1", "aff4:foo", "C value", timestamp=3000, token=self.token)
+
+    batches = list(
+        data_store.DB.ScanAttributeBatches(
+            "aff4:/B", "aff4:foo", batch_size=4, token=self.token))
+    self.assertEqual([len(b) for b in batches], [4, 4, 2])
+    self.assertEqual([r[0] for b in batches for r in b],
+                     ["aff4:/B/%d" % i for i in range(10)])
+    self.assertEqual([(r[1], r[2]) for b in batches for r in b],
+                     [(2000, "B %d value" % i) for i in range(10)])
+
+    batches = list(
+        data_store.DB.ScanAttributeBatches(
+            "aff4:/B",
+            "aff4:foo",
+            after_urn="aff4:/B/2",
+            max_records=5,
+            batch_size=2,
+            token=self.token))
+    self.assertEqual([[r[2] for r in b] for b in batches],
+                     [["B 3 value", "B 4 value"], ["B 5 value", "B 6 value"],
+                      ["B 7 value"]])
+
+    # Subjects stored in different places are returned in order.
+    results = [
+        r[0]
+        for b in data_store.DB.ScanAttributeBatches(
+            "aff4:/", "aff4:foo", batch_size=3, token=self.token)
+        for r in b
+    ]
+    self.assertEqual(results, ["aff4:/A"] + ["aff4:/B/%d" % i
+                                             for i in range(10)] +
+                     ["aff4:/C/1"])
+
+    self.assertEqual(
+        list(
+            data_store.DB.ScanAttributeBatches(
+                "aff4:/D", "aff4:foo", token=self.token)), [])
+
   def testScanAttributes(self):
     for i in range(0, 7):
       data_store.DB.Set(
@@ -1465,6 +1565,30 @@ class _DataStoreTest(test_lib.GRRBaseTest):
     self.assertFalse(data_store.DB.BlobExists(identifier, token=self.token))
     self.assertEqual(data_store.DB.ReadBlob(identifier, token=self.token), None)
 
+  def testKnownBlobsAreNotWrittenAgain(self):
+    data = "randomdata" * 50
+    identifier = data_store.DB.StoreBlob(data, token=self.token)
+
+    prev_writes_saved = stats.STATS.GetMetricValue("blob_store_writes_saved")
+    prev_bytes_saved = stats.STATS.GetMetricValue("blob_store_bytes_saved")
+
+    blobstore = data_store.DB.blobstore
+    with mock.patch.object(blobstore, "StoreBlobs") as store_blobs:
+      with mock.patch.object(blobstore, "BlobsExist") as blobs_exist:
+        self.assertEqual(
+            data_store.DB.StoreBlobs([data, data], token=self.token),
+            [identifier])
+        self.assertTrue(data_store.DB.BlobExists(identifier, token=self.token))
+
+    self.assertFalse(store_blobs.called)
+    self.assertFalse(blobs_exist.called)
+    self.assertEqual(
+        stats.STATS.GetMetricValue("blob_store_writes_saved"),
+        prev_writes_saved + 2)
+    self.assertEqual(
+        stats.STATS.GetMetricValue("blob_store_bytes_saved"),
+        prev_bytes_saved + 2 * len(data))
+
   def testAFF4BlobImage(self):
     # 500k
     data = "randomdata" * 50 * 1024
@@ -2439,10 +2563,6 @@ class DataStoreBenchmarks(test_lib.MicroBenchmarks):
   READ_COUNT = 50
   BIG_READ_SIZE = 25
 
-  # The sequential collection index is only computed for records 5m old, so we
-  # write records this far in the past in order to force index creation.
-  INDEX_DELAY = rdfvalue.Duration("10m")
-
   @test_lib.SetLabel("benchmark")
   def testCollections(self):
 
@@ -2452,17 +2572,13 @@ class DataStoreBenchmarks(test_lib.MicroBenchmarks):
     # Populate and exercise an indexed sequential collection.
     #
 
-    indexed_collection = aff4.FACTORY.Create(
-        "aff4:/test_seq_collection",
-        StringSequentialCollection,
-        mode="rw",
-        token=self.token)
+    indexed_collection = StringSequentialCollection(
+        rdfvalue.RDFURN("aff4:/test_seq_collection"), token=self.token)
 
     start_time = time.time()
     for _ in range(self.RECORDS):
       indexed_collection.Add(
-          rdfvalue.RDFString(self._GenerateRandomString(self.RECORD_SIZE)),
-          timestamp=rdfvalue.RDFDatetime.Now() - self.INDEX_DELAY)
+          rdfvalue.RDFString(self._GenerateRandomString(self.RECORD_SIZE)))
     elapsed_time = time.time() - start_time
     self.AddResult("Seq. Coll. Add (size %d)" % self.RECORD_SIZE, elapsed_time,
                    self.RECORDS)
@@ -2499,6 +2615,142 @@ class DataStoreBenchmarks(test_lib.MicroBenchmarks):
     elapsed_time = time.time() - start_time
     self.AddResult("Seq. Coll. full sequential read", elapsed_time, 1)
 
+  # Size of the collection iterated over by testCollectionFullScan, like the
+  # result collection of a large hunt.
+  FULL_SCAN_RECORDS = 1000000
+
+  @test_lib.SetLabel("benchmark")
+  def testCollectionFullScan(self):
+    """Iterating over a whole collection, a record or a batch at a time."""
+    collection = StringSequentialCollection(
+        rdfvalue.RDFURN("aff4:/test_full_scan"), token=self.token)
+    value = rdfvalue.RDFString("x" * 100)
+
+    with data_store.DB.GetMutationPool(token=self.token) as pool:
+      for i in xrange(self.FULL_SCAN_RECORDS):
+        collection.StaticAdd(
+            collection.collection_id,
+            self.token,
+            value,
+            timestamp=i + 1,
+            suffix=1,
+            mutation_pool=pool)
+        if pool.Size() > 10000:
+          pool.Flush()
+
+    # This is how SequentialCollection.Scan used to read collections.
+    start_time = time.time()
+    count = 0
+    for _, timestamp, serialized in data_store.DB.ScanAttribute(
+        collection.collection_id.Add("Results"),
+        collection.ATTRIBUTE,
+        token=self.token):
+      rdf_value = collection.RDF_TYPE.FromSerializedString(serialized)
+      rdf_value.age = timestamp
+      count += 1
+    self.AddResult("ScanAttribute, one record at a time",
+                   time.time() - start_time, count)
+    self.assertEqual(count, self.FULL_SCAN_RECORDS)
+
+    start_time = time.time()
+    count = 0
+    for _ in collection.Scan():
+      count += 1
+    self.AddResult("Scan", time.time() - start_time, count)
+    self.assertEqual(count, self.FULL_SCAN_RECORDS)
+
+    start_time = time.time()
+    count = 0
+    for batch in collection.ScanBatches():
+      count += len(batch)
+    self.AddResult("ScanBatches", time.time() - start_time, count)
+    self.assertEqual(count, self.FULL_SCAN_RECORDS)
+
+    start_time = time.time()
+    count = 0
+    for batch in collection.ScanBatches(decode=False):
+      count += len(batch)
+    self.AddResult("ScanBatches, not decoded", time.time() - start_time, count)
+    self.assertEqual(count, self.FULL_SCAN_RECORDS)
+
+  # Number of records in the collections read by testCollectionIndex.
+  INDEX_RECORDS = 100000
+  INDEX_READ_COUNT = 20
+
+  @test_lib.SetLabel("benchmark")
+  def testCollectionIndex(self):
+    """Lengths and reads at an offset with and without the collection index."""
+    value = rdfvalue.RDFString("x" * 100)
+
+    for name, collection_cls in (("indexed", StringSequentialCollection),
+                                 ("unindexed",
+                                  UnindexedStringSequentialCollection)):
+      urn = rdfvalue.RDFURN("aff4:/test_%s" % name)
+      start_time = time.time()
+      with data_store.DB.GetMutationPool(token=self.token) as pool:
+        for i in xrange(self.INDEX_RECORDS):
+          collection_cls.StaticAdd(
+              urn,
+              self.token,
+              value,
+              timestamp=i + 1,
+              suffix=1,
+              mutation_pool=pool)
+          if pool.Size() > 10000:
+            pool.Flush()
+      self.AddResult("Add, %s" % name, time.time() - start_time,
+                     self.INDEX_RECORDS)
+
+      # Collections without an index are read by scanning them.
+      collection = StringSequentialCollection(urn, token=self.token)
+
+      start_time = time.time()
+      self.assertEqual(len(collection), self.INDEX_RECORDS)
+      self.AddResult("Length, %s" % name, time.time() - start_time, 1)
+
+      rand = random.Random(42)
+      start_time = time.time()
+      for _ in xrange(self.INDEX_READ_COUNT):
+        offset = rand.randint(0, self.INDEX_RECORDS - 1)
+        self.assertEqual(collection[offset].age.AsMicroSecondsFromEpoch(),
+                         offset + 1)
+      self.AddResult("Read at random offsets, %s" % name,
+                     time.time() - start_time, self.INDEX_READ_COUNT)
+
+  # Size of the image streamed by testAFF4ImageStreaming.
+  IMAGE_CHUNKS = 512
+  IMAGE_READ_SIZE = 1024 * 1024
+
+  @test_lib.SetLabel("benchmark")
+  def testAFF4ImageStreaming(self):
+    """Sequential AFF4Image reads with a fixed and an adaptive read ahead."""
+    urn = rdfvalue.RDFURN("aff4:/test_image")
+    chunk = os.urandom(aff4.AFF4Image.chunksize)
+    with aff4.FACTORY.Create(urn, aff4.AFF4Image, token=self.token) as fd:
+      for _ in xrange(self.IMAGE_CHUNKS):
+        fd.Write(chunk)
+    data_store.DB.Flush()
+
+    size_mb = float(self.IMAGE_CHUNKS * len(chunk)) / (1024 * 1024)
+
+    def StreamImage():
+      fd = aff4.FACTORY.Open(urn, token=self.token)
+      start_time = time.time()
+      while fd.Read(self.IMAGE_READ_SIZE):
+        pass
+      return time.time() - start_time
+
+    # Pinning the window to LOOK_AHEAD gives the fixed synchronous read ahead.
+    with utils.Stubber(aff4.AFF4ImageBase, "MAX_LOOK_AHEAD",
+                       aff4.AFF4ImageBase.LOOK_AHEAD):
+      elapsed_time = StreamImage()
+    self.AddResult("AFF4Image fixed read ahead (%.1f MB/s)" %
+                   (size_mb / elapsed_time), elapsed_time, 1)
+
+    elapsed_time = StreamImage()
+    self.AddResult("AFF4Image streaming read ahead (%.1f MB/s)" %
+                   (size_mb / elapsed_time), elapsed_time, 1)
+
   @test_lib.SetLabel("benchmark")
   def testSimulateFlows(self):
     self.flow_ids = []
@@ -85,6 +85,7 @@ class FakeDataStore(data_store.DataStore):
   @utils.Synchronized
   def Clear(self):
     self.subjects = {}
+    self.known_blobs.Flush()
 
   def DBSubjectLock(self, subject, lease_time=None, token=None):
     return FakeDBSubjectLock(self, subject, lease_time=lease_time, token=token)
@@ -133,7 +134,8 @@ class FakeDataStore(data_store.DataStore):
       self.DeleteAttributes(subject, to_delete, token=token)
 
     for k, seq in values.items():
-      for v in seq:
+      # Replacing drops the old versions, all of the new ones are kept.
+      for i, v in enumerate(seq):
         if isinstance(v, (list, tuple)):
           v, element_timestamp = v
         else:
@@ -145,7 +147,7 @@ class FakeDataStore(data_store.DataStore):
             v,
             timestamp=element_timestamp,
             token=token,
-            replace=replace,
+            replace=replace and i == 0,
             sync=sync)
 
   @utils.Synchronized
@@ -162,6 +164,7 @@ class FakeDataStore(data_store.DataStore):
       raise ValueError(
           "String passed to DeleteAttributes (non string iterable expected).")
 
+    attributes = set(attributes)
     subject = utils.SmartUnicode(subject)
     try:
       record = self.subjects[subject]
@@ -222,6 +225,38 @@ class FakeDataStore(data_store.DataStore):
         return_count += 1
         yield (s, results)
 
+  def ScanAttributeBatches(self,
+                           subject_prefix,
+                           attribute,
+                           after_urn=None,
+                           max_records=None,
+                           batch_size=1000,
+                           token=None):
+    subject_prefix = self._CleanSubjectPrefix(subject_prefix)
+    after_urn = utils.SmartUnicode(after_urn or "")
+    attribute = utils.SmartUnicode(attribute)
+
+    with self.lock:
+      subjects = sorted(s for s in self.subjects
+                        if s.startswith(subject_prefix) and s > after_urn)
+
+    batch = []
+    return_count = 0
+    for s in subjects:
+      attribute_list = self.subjects.get(s, {}).get(attribute)
+      if not attribute_list:
+        continue
+      value, timestamp = attribute_list[-1]
+      batch.append((s, timestamp, value))
+      return_count += 1
+      if len(batch) >= batch_size:
+        yield batch
+        batch = []
+      if max_records and return_count >= max_records:
+        break
+    if batch:
+      yield batch
+
   @utils.Synchronized
   def ResolveMulti(self,
                    subject,
@@ -252,21 +287,19 @@ class FakeDataStore(data_store.DataStore):
     # are lists of timestamped data.
     results = {}
     for attribute in attributes:
-      for attr, values in record.iteritems():
-        if attr == attribute:
-          for value, ts in values:
-            results_list = results.setdefault(attribute, [])
-            # If we are always after the latest ts we clear older ones.
-            if (results_list and timestamp == self.NEWEST_TIMESTAMP and
-                results_list[0][1] < ts):
-              results_list = []
-              results[attribute] = results_list
-
-            # Timestamp outside the range, drop it.
-            elif ts < start or ts > end:
-              continue
+      for value, ts in record.get(attribute, ()):
+        results_list = results.setdefault(attribute, [])
+        # If we are always after the latest ts we clear older ones.
+        if (results_list and timestamp == self.NEWEST_TIMESTAMP and
+            results_list[0][1] < ts):
+          results_list = []
+          results[attribute] = results_list
+
+        # Timestamp outside the range, drop it.
+        elif ts < start or ts > end:
+          continue
 
-            results_list.append((attribute, ts, value))
+        results_list.append((attribute, ts, value))
 
     # Return the results in the same order they requested.
     remaining_limit = limit
@@ -4,7 +4,9 @@
 
 import base64
 import binascii
+import collections
 import httplib
+import itertools
 import random
 import re
 import socket
@@ -61,66 +63,158 @@ class HTTPDataStoreError(Error):
 
 
 class DataServerConnection(object):
-  """Represents one connection to a data server."""
+  """Represents one connection to a data server.
+
+  Requests are pipelined: every request is tagged with a request id and sent
+  right away, and a reader thread hands the responses to the callers waiting
+  for them. Many threads can share a connection and a single thread can have
+  requests outstanding on several data servers at once.
+
+  When the connection is lost, the server may or may not have applied the
+  requests which were sent but not answered yet. Of those, only reads are
+  replayed after reconnecting, the others fail. Requests which were never
+  completely sent are sent again.
+
+  self.lock protects the state of the connection and is never held while
+  talking to the server. Writing to the socket and reconnecting are serialized
+  by self.send_lock, so the reader thread can always drain the responses.
+  """
+
+  # Commands which can be sent again without changing their outcome.
+  REPLAYABLE_COMMANDS = frozenset([
+      rdf_data_server.DataStoreCommand.Command.RESOLVE_MULTI,
+      rdf_data_server.DataStoreCommand.Command.MULTI_RESOLVE_PREFIX,
+      rdf_data_server.DataStoreCommand.Command.SCAN_ATTRIBUTES,
+  ])
 
   def __init__(self, server):
     self.conn = None
     self.sock = None
+    self.reader_sock = None
     self.lock = threading.Lock()
+    self.send_lock = threading.RLock()
+    self.request_sent = threading.Condition(self.lock)
+    self.response_arrived = threading.Condition(self.lock)
     self.server = server
-    # Mark pending requests and subjects that are scheduled to change on
-    # the database.
-    self.requests = []
+    # Serialized requests which were not answered yet, by request id in the
+    # order they were sent.
+    self.requests = collections.OrderedDict()
+    # Ids of the pending requests which were sent on the current connection.
+    self.sent = set()
+    # Ids of the pending requests which are replayed after reconnecting.
+    self.replayable = set()
+    # Ids of the requests somebody waits for and their responses.
+    self.awaited = set()
+    self.responses = {}
+    # Failed responses to requests nobody waits for. Raised by Sync().
+    self.failed_responses = []
+    self.next_request_id = 1
+    # Responses up to this request id are read with the replay timeout.
+    self.replayed_until = 0
+    # Incremented on every reconnection.
+    self.generation = 0
+    self.error = None
+    self.closed = False
     self._DoConnection()
 
+    self.reader = threading.Thread(
+        target=self._ReadResponses,
+        name="DataServerReader_%s:%d" % (self.Address(), self.Port()))
+    self.reader.daemon = True
+    self.reader.start()
+
   def Address(self):
     return self.server.Address()
 
   def Port(self):
     return self.server.Port()
 
-  def _ReadExactly(self, n):
+  def _ReadExactly(self, sock, n):
     ret = ""
     left = n
     while left:
-      data = self.sock.recv(left)
+      data = sock.recv(left)
       if not data:
         raise IOError("Expected %d bytes, got EOF after %d" % (n, len(ret)))
       ret += data
       left = n - len(ret)
     return ret
 
-  def _ReadReply(self):
+  def _ReadReply(self, sock):
     try:
-      replylen_str = self._ReadExactly(sutils.SIZE_PACKER.size)
+      replylen_str = self._ReadExactly(sock, sutils.SIZE_PACKER.size)
       replylen = sutils.SIZE_PACKER.unpack(replylen_str)[0]
-      reply = self._ReadExactly(replylen)
-      response = rdf_data_store.DataStoreResponse.FromSerializedString(reply)
-      CheckResponseStatus(response)
-      return response
+      reply = self._ReadExactly(sock, replylen)
+      return rdf_data_store.DataStoreResponse.FromSerializedString(reply)
     except (socket.error, socket.timeout, IOError) as e:
       logging.warning("Cannot read reply from server %s:%d : %s",
                       self.Address(), self.Port(), e)
       return None
 
-  def _Sync(self):
-    """Read responses from the pending requests."""
-    self.sock.settimeout(config.CONFIG["HTTPDataStore.read_timeout"])
-    while self.requests:
-      response = self._ReadReply()
-      if not response:
-        # Could not read response. Let's exit and force a reconnection
-        # followed by a replay.
-        # TODO(user): Maybe we need to assign an unique ID for each
-        # request so that the server knows which ones were already applied.
-        return False
-      self.requests.pop()
-    return True
+  def _ReadResponses(self):
+    """Reads the responses to the pending requests as they arrive."""
+    try:
+      while True:
+        with self.lock:
+          while not self.sent and not self.closed:
+            self.request_sent.wait()
+          if self.closed:
+            return
+          sock = self.reader_sock
+          generation = self.generation
+          if min(self.sent) <= self.replayed_until:
+            timeout = config.CONFIG["HTTPDataStore.replay_timeout"]
+          else:
+            timeout = config.CONFIG["HTTPDataStore.read_timeout"]
+
+        sock.settimeout(timeout)
+        response = self._ReadReply(sock)
+
+        if response is None:
+          with self.lock:
+            if self.closed:
+              return
+          # Unless somebody reconnected in the meantime, we reconnect and
+          # replay the pending reads.
+          self._RedoConnection(generation)
+          continue
 
-  def _SendRequest(self, command):
-    request_str = command.SerializeToString()
+        with self.lock:
+          if self.closed:
+            return
+          self._DeliverResponse(response)
+    except Exception as e:  # pylint: disable=broad-except
+      with self.lock:
+        if not self.error:
+          logging.exception("Connection to %s:%d failed", self.Address(),
+                            self.Port())
+          self.error = HTTPDataStoreError(
+              "Connection to %s:%d failed: %s" % (self.Address(), self.Port(),
+                                                  e))
+        self.response_arrived.notify_all()
+
+  def _DeliverResponse(self, response):
+    """Hands a response to whoever waits for it."""
+    request_id = response.request_id
+    if request_id not in self.sent:
+      if request_id:
+        logging.warning("Dropping response to unknown request %d from %s:%d",
+                        request_id, self.Address(), self.Port())
+        return
+      # Data servers which don't echo request ids answer in order.
+      request_id = min(self.sent)
+
+    del self.requests[request_id]
+    self.sent.discard(request_id)
+    self.replayable.discard(request_id)
+    if request_id in self.awaited:
+      self.responses[request_id] = response
+    elif response.status != rdf_data_store.DataStoreResponse.Status.OK:
+      self.failed_responses.append(response)
+    self.response_arrived.notify_all()
+
+  def _SendRequest(self, request_str):
     request_body = sutils.SIZE_PACKER.pack(len(request_str)) + request_str
-    self.sock.settimeout(config.CONFIG["HTTPDataStore.send_timeout"])
     try:
       self.sock.sendall(request_body)
       return True
@@ -133,14 +227,23 @@ class DataServerConnection(object):
     """Reconnect to the data server."""
     try:
       if self.sock:
-        self.sock.close()
+        # Wakes up the reader thread.
+        self.sock.shutdown(socket.SHUT_RDWR)
     except socket.error:
       pass
+    for sock in (self.sock, self.reader_sock):
+      try:
+        if sock:
+          sock.close()
+      except socket.error:
+        pass
     try:
       if self.conn:
         self.conn.close()
     except httplib.HTTPException:
       pass
+    with self.lock:
+      self.generation += 1
     try:
       self.conn = httplib.HTTPConnection(self.Address(), self.Port())
       username = config.CONFIG.Get("HTTPDataStore.username")
@@ -168,11 +271,16 @@ class DataServerConnection(object):
       # Confirm handshake.
       self.sock.setblocking(1)
       self.sock.settimeout(config.CONFIG["HTTPDataStore.login_timeout"])
-      ack = self._ReadExactly(3)
+      ack = self._ReadExactly(self.sock, 3)
       if ack == "IP\n":
         raise HTTPDataStoreError("Invalid data server username/password.")
       if ack != "OK\n":
         return False
+      self.sock.settimeout(config.CONFIG["HTTPDataStore.send_timeout"])
+      # The reader thread uses a duplicate of the socket so it can have its
+      # own timeout.
+      self.reader_sock = socket.fromfd(self.sock.fileno(), self.sock.family,
+                                       self.sock.type)
       logging.info("Connected to data server %s:%d", self.Address(),
                    self.Port())
       return True
@@ -186,29 +294,56 @@ class DataServerConnection(object):
       return False
     return False
 
+  def _ForgetSentRequests(self):
+    """Fails the sent requests which must not be sent twice.
+
+    Requests which were sent on a lost connection may have been applied. Reads
+    and the requests which were never completely sent are kept to be sent on
+    the next connection.
+    """
+    with self.lock:
+      for request_id in sorted(self.sent - self.replayable):
+        del self.requests[request_id]
+        response = rdf_data_store.DataStoreResponse(
+            request_id=request_id,
+            status=rdf_data_store.DataStoreResponse.Status.DATA_STORE_ERROR,
+            status_desc=("Connection to %s:%d was lost, the request may or "
+                         "may not have been applied." % (self.Address(),
+                                                         self.Port())))
+        if request_id in self.awaited:
+          self.responses[request_id] = response
+        else:
+          self.failed_responses.append(response)
+
+      self.sent.clear()
+      self.response_arrived.notify_all()
+
+  def _MarkSent(self, request_id):
+    with self.lock:
+      # The response may have been delivered already.
+      if request_id in self.requests:
+        self.sent.add(request_id)
+        self.request_sent.notify()
+
   def _ReplaySync(self):
-    """Send all the requests again."""
-    if self.requests:
-      logging.info("Replaying the failed requests")
-    while self.requests:
-      req = self.requests[-1]
-      if not self._SendRequest(req):
-        return False
-      self.sock.settimeout(config.CONFIG["HTTPDataStore.replay_timeout"])
-      response = self._ReadReply()
-      if not response:
-        # Could not read response. Let's exit and force a reconnection
-        # followed by a replay.
-        # TODO(user): Maybe we need to assign an unique ID for each
-        # request so that the server knows which ones were already applied.
+    """Send all the pending requests again."""
+    with self.lock:
+      pending = self.requests.items()
+      if pending:
+        logging.info("Replaying %d failed requests", len(pending))
+        self.replayed_until = pending[-1][0]
+
+    for request_id, request_str in pending:
+      if not self._SendRequest(request_str):
         return False
-      self.requests.pop()
+      self._MarkSent(request_id)
     return True
 
   def _DoConnection(self):
     """Cleanups the current connection and creates another one."""
     started = time.time()
     while True:
+      self._ForgetSentRequests()
       if self._Reconnect() and self._ReplaySync():
         break
       else:
@@ -221,53 +356,125 @@ class DataServerConnection(object):
         raise HTTPDataStoreError("Could not connect to %s:%d. Giving up." %
                                  (self.Address(), self.Port()))
 
-  def _RedoConnection(self):
-    logging.warning("Attempt to reconnect with %s:%d",
-                    self.Address(), self.Port())
-    self._DoConnection()
+  def _RedoConnection(self, generation):
+    """Reconnects, unless the connection of generation was already replaced."""
+    with self.send_lock:
+      with self.lock:
+        if generation != self.generation:
+          return
+
+      logging.warning("Attempt to reconnect with %s:%d",
+                      self.Address(), self.Port())
+      try:
+        self._DoConnection()
+      except HTTPDataStoreError as e:
+        with self.lock:
+          self.error = e
+          self.response_arrived.notify_all()
+        raise
+
+  def SendRequest(self, command, wait_for_response=True):
+    """Sends a request to the data server without waiting for the response.
+
+    Args:
+      command: The rdf_data_server.DataStoreCommand to send.
+      wait_for_response: If False, the response is discarded unless it
+          reports an error, which is then raised by Sync().
+
+    Returns:
+      The request id to pass to WaitForResponse().
+    """
+    request_str = command.SerializeToString()
+    max_pipelined = config.CONFIG["HTTPDataStore.max_pipelined_requests"]
+
+    with self.lock:
+      while len(self.requests) >= max_pipelined and not self.error:
+        self.response_arrived.wait()
+
+    # Requests are registered and sent in the same order, servers which don't
+    # echo request ids answer them in that order.
+    with self.send_lock:
+      with self.lock:
+        if self.error:
+          raise self.error
+
+        request_id = self.next_request_id
+        self.next_request_id += 1
+        # Appending the serialized request_id field sets it on the command.
+        request_str += rdf_data_server.DataStoreCommand(
+            request_id=request_id).SerializeToString()
+        self.requests[request_id] = request_str
+        if command.command in self.REPLAYABLE_COMMANDS:
+          self.replayable.add(request_id)
+        if wait_for_response:
+          self.awaited.add(request_id)
+        generation = self.generation
+
+      if self._SendRequest(request_str):
+        self._MarkSent(request_id)
+      else:
+        # The request did not reach the server, it is sent again after
+        # reconnecting.
+        self._RedoConnection(generation)
+
+    return request_id
+
+  def WaitForResponse(self, request_id):
+    """Waits for the response to a request sent with SendRequest()."""
+    with self.lock:
+      try:
+        while request_id not in self.responses:
+          if self.error:
+            raise self.error
+          self.response_arrived.wait()
+        response = self.responses.pop(request_id)
+      finally:
+        self.awaited.discard(request_id)
+
+    return CheckResponseStatus(response)
+
+  def DiscardResponse(self, request_id):
+    """Drops the response to a request nobody will wait for anymore."""
+    with self.lock:
+      self.awaited.discard(request_id)
+      self.responses.pop(request_id, None)
 
-  @utils.Synchronized
   def MakeRequestAndContinue(self, command, unused_subject):
     """Make request but do not sync with the data server."""
-    while not self._SendRequest(command):
-      self._RedoConnection()
-    self.requests.insert(0, command)
+    self.SendRequest(command, wait_for_response=False)
     return None
 
-  @utils.Synchronized
   def SyncAndMakeRequest(self, command):
     """Make a request to the data server and return the response."""
-    if not self._Sync():
-      # Must reconnect and resend requests.
-      self._RedoConnection()
-    # At this point, we have a synchronized connection.
-    while not self._SendRequest(command):
-      self._RedoConnection()
-    self.sock.settimeout(config.CONFIG["HTTPDataStore.read_timeout"])
-    response = self._ReadReply()
-    if not response:
-      # Must reconnect and resend the request.
-      while True:
-        self._RedoConnection()
-        if not self._SendRequest(command):
-          continue
-        response = self._ReadReply()
-        if response:
-          break
-    return response
+    return self.WaitForResponse(self.SendRequest(command))
 
-  @utils.Synchronized
   def Sync(self):
-    if self._Sync():
-      return True
-    self._RedoConnection()
-    return self._Sync()
+    """Waits until all the pending requests are answered."""
+    with self.lock:
+      while self.requests and not self.error:
+        self.response_arrived.wait()
+      if self.error:
+        raise self.error
+      failed, self.failed_responses = self.failed_responses, []
+
+    for response in failed:
+      CheckResponseStatus(response)
+    return True
 
   def NumPendingRequests(self):
     return len(self.requests)
 
   def Close(self):
-    self.conn.close()
+    with self.lock:
+      self.closed = True
+      self.request_sent.notify_all()
+      self.response_arrived.notify_all()
+      try:
+        self.sock.shutdown(socket.SHUT_RDWR)
+      except socket.error:
+        pass
+      self.reader_sock.close()
+      self.conn.close()
 
 
 class DataServer(object):
@@ -523,10 +730,37 @@ class HTTPDataStore(data_store.DataStore):
     else:
       return server.MakeRequestAndContinue(cmd, subject)
 
+  def _SendRequests(self, commands):
+    """Sends (connection, command) pairs and returns the request ids."""
+    pending = []
+    try:
+      for server, cmd in commands:
+        pending.append((server, server.SendRequest(cmd)))
+    except Exception:
+      for server, request_id in pending:
+        server.DiscardResponse(request_id)
+      raise
+    return pending
+
+  def _GatherResponses(self, pending):
+    """Yields the responses to a list of (connection, request id) pairs."""
+    pending = collections.deque(pending)
+    try:
+      while pending:
+        server, request_id = pending.popleft()
+        yield server.WaitForResponse(request_id)
+    finally:
+      # The caller might not consume all the responses.
+      for server, request_id in pending:
+        server.DiscardResponse(request_id)
+
   def _MakeRequestsForPrefix(self, prefix, typ, request):
     cmd = rdf_data_server.DataStoreCommand(command=typ, request=request)
-    for server in self.GetServersForPrefix(prefix):
-      yield server.SyncAndMakeRequest(cmd)
+    # Send the request to all the servers before reading any response so
+    # they all work on it at the same time.
+    pending = self._SendRequests(
+        (server, cmd) for server in self.GetServersForPrefix(prefix))
+    return self._GatherResponses(pending)
 
   def DeleteAttributes(self,
                        subject,
@@ -603,18 +837,29 @@ class HTTPDataStore(data_store.DataStore):
                          token=None):
     """MultiResolvePrefix."""
     typ = rdf_data_server.DataStoreCommand.Command.MULTI_RESOLVE_PREFIX
+    # All the subjects are requested up front so the data servers resolve
+    # them in parallel. Each request is limited to the overall limit and the
+    # results are truncated below.
+    subjects = list(subjects)
+
+    def Commands():
+      for subject in subjects:
+        request = self._MakeRequest(
+            [subject],
+            attribute_prefix,
+            timestamp=timestamp,
+            token=token,
+            limit=limit)
+        cmd = rdf_data_server.DataStoreCommand(command=typ, request=request)
+        # Connections are picked as the requests are sent so the requests are
+        # spread over the connection pool.
+        yield self.GetServer(subject), cmd
+
+    responses = self._GatherResponses(self._SendRequests(Commands()))
+
     results = {}
     remaining_limit = limit
-    for subject in subjects:
-      request = self._MakeRequest(
-          [subject],
-          attribute_prefix,
-          timestamp=timestamp,
-          token=token,
-          limit=remaining_limit)
-
-      response = self._MakeSyncRequest(request, typ)
-
+    for subject, response in itertools.izip(subjects, responses):
       if response.results:
         result_set = response.results[0]
         values = [(pred, self._Decode(value), ts)
@@ -1,12 +1,27 @@
 #!/usr/bin/env python
 """Benchmark tests for HTTP datastore."""
 
+
+import threading
+import time
+
+
+from grr.lib import data_store
 from grr.lib import data_store_test
 from grr.lib import flags
 from grr.lib import test_lib
+from grr.lib.data_stores import http_data_store
 from grr.lib.data_stores import http_data_store_test
 
 
+def setUpModule():
+  http_data_store_test.SetupDataStore()
+
+
+def tearDownModule():
+  http_data_store_test.tearDownModule()
+
+
 class HTTPDataStoreBenchmarks(http_data_store_test.HTTPDataStoreMixin,
                               data_store_test.DataStoreBenchmarks):
   """Benchmark the HTTP remote data store abstraction."""
@@ -17,6 +32,95 @@ class HTTPDataStoreCSVBenchmarks(http_data_store_test.HTTPDataStoreMixin,
   """Benchmark the HTTP remote data store."""
 
 
+class HTTPDataStorePipeliningBenchmark(http_data_store_test.HTTPDataStoreMixin,
+                                       test_lib.MicroBenchmarks):
+  """Round trips to local data servers with and without pipelining."""
+
+  labels = ["benchmark"]
+  units = "ms"
+
+  SUBJECTS = 200
+  ATTRIBUTES = 5
+  THREADS = 10
+  REQUESTS_PER_THREAD = 100
+
+  def setUp(self):
+    super(HTTPDataStorePipeliningBenchmark, self).setUp(["Requests/s"],
+                                                        ["<20"])
+    self.subjects = ["aff4:/C.%016X/bench/%d" % (i, i)
+                     for i in range(self.SUBJECTS)]
+    for subject in self.subjects:
+      data_store.DB.MultiSet(
+          subject, {
+              "metadata:attr%d" % i: ["value %d of %s" % (i, subject)]
+              for i in range(self.ATTRIBUTES)
+          },
+          token=self.token)
+
+  def _Record(self, name, time_taken, requests):
+    self.AddResult(name, time_taken / requests, requests,
+                   "%.1f" % (requests / time_taken))
+
+  def testMultiResolvePrefix(self):
+    """Resolving many subjects spread over both data servers."""
+    start = time.time()
+    for subject in self.subjects:
+      list(
+          data_store.DB.MultiResolvePrefix(
+              [subject], "metadata:", token=self.token))
+    self._Record("One subject per call", time.time() - start, self.SUBJECTS)
+
+    start = time.time()
+    results = list(
+        data_store.DB.MultiResolvePrefix(
+            self.subjects, "metadata:", token=self.token))
+    self._Record("All subjects pipelined", time.time() - start, self.SUBJECTS)
+    self.assertEqual(len(results), self.SUBJECTS)
+
+  def testScanAttributes(self):
+    """Scanning a prefix held by both data servers."""
+    repeats = 20
+    start = time.time()
+    for _ in range(repeats):
+      results = list(
+          data_store.DB.ScanAttributes(
+              "aff4:/", ["metadata:attr0"], token=self.token))
+    self._Record("ScanAttributes on all servers", time.time() - start,
+                 repeats)
+    self.assertGreaterEqual(len(results), self.SUBJECTS)
+
+  def _Resolve(self, db, offset):
+    for i in range(self.REQUESTS_PER_THREAD):
+      subject = self.subjects[(offset + i) % self.SUBJECTS]
+      db.ResolveMulti(subject, ["metadata:attr0"], token=self.token)
+
+  def testConcurrentRequests(self):
+    """Threads sharing the connections to the data servers."""
+    for connections in [1, 5]:
+      with test_lib.ConfigOverrider({
+          "Dataserver.max_connections": connections
+      }):
+        db = http_data_store.HTTPDataStore()
+
+      threads = [
+          threading.Thread(target=self._Resolve, args=(db, i * 17))
+          for i in range(self.THREADS)
+      ]
+      try:
+        start = time.time()
+        for thread in threads:
+          thread.start()
+        for thread in threads:
+          thread.join()
+        time_taken = time.time() - start
+      finally:
+        db.CloseConnections()
+
+      self._Record("%d threads, %d connection(s) per server" %
+                   (self.THREADS, connections), time_taken,
+                   self.THREADS * self.REQUESTS_PER_THREAD)
+
+
 def main(args):
   test_lib.main(args)
 
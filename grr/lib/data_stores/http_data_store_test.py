@@ -8,6 +8,7 @@ import shutil
 import socket
 import tempfile
 import threading
+import time
 import unittest
 
 
@@ -24,6 +25,8 @@ from grr.lib import utils
 
 from grr.lib.data_stores import http_data_store
 from grr.lib.data_stores import sqlite_data_store
+from grr.lib.rdfvalues import data_server as rdf_data_server
+from grr.lib.rdfvalues import data_store as rdf_data_store
 
 from grr.server.data_server import data_server
 
@@ -162,8 +165,8 @@ def tearDownModule():
 
 class HTTPDataStoreMixin(object):
 
-  def setUp(self):
-    super(HTTPDataStoreMixin, self).setUp()
+  def setUp(self, *args):
+    super(HTTPDataStoreMixin, self).setUp(*args)
     # These tests change the config so we preserve state.
     self.config_stubber = test_lib.PreserveConfig()
     self.config_stubber.Start()
@@ -204,6 +207,179 @@ class HTTPDataStoreTest(HTTPDataStoreMixin, data_store_test._DataStoreTest):
     # This just makes sure the datastore can actually initialize.
     pass
 
+  def testPipelinedResponsesAreMatchedToRequests(self):
+    subjects = ["aff4:/row:%s" % i for i in range(10)]
+    for subject in subjects:
+      data_store.DB.Set(subject, "metadata:predicate", subject,
+                        token=self.token)
+
+    connection = data_store.DB.GetServer(subjects[0])
+    typ = rdf_data_server.DataStoreCommand.Command.RESOLVE_MULTI
+    request_ids = []
+    for subject in subjects:
+      request = data_store.DB._MakeRequest(
+          [subject], ["metadata:predicate"], token=self.token)
+      request_ids.append(
+          connection.SendRequest(
+              rdf_data_server.DataStoreCommand(command=typ, request=request)))
+
+    # All the requests are sent before any response is read.
+    self.assertEqual(len(set(request_ids)), len(subjects))
+    for subject, request_id in reversed(zip(subjects, request_ids)):
+      response = connection.WaitForResponse(request_id)
+      self.assertEqual(response.request_id, request_id)
+      self.assertEqual(response.results[0].subject, subject)
+
+    self.assertEqual(connection.NumPendingRequests(), 0)
+    self.assertEqual(connection.responses, {})
+
+  def _SendOnceWithLostConnection(self, connection, command, **kwargs):
+    send_request = connection._SendRequest
+    sends = []
+
+    def FailFirstSend(request_str):
+      sends.append(request_str)
+      if len(sends) == 1:
+        return False
+      return send_request(request_str)
+
+    with utils.Stubber(connection, "_SendRequest", FailFirstSend):
+      return connection.SendRequest(command, **kwargs)
+
+  def testReadsAreReplayedAfterReconnecting(self):
+    subject = "aff4:/row:replayed"
+    data_store.DB.Set(subject, "metadata:predicate", "value", token=self.token)
+
+    connection = data_store.DB.GetServer(subject)
+    request = data_store.DB._MakeRequest(
+        [subject], ["metadata:predicate"], token=self.token)
+    request_id = self._SendOnceWithLostConnection(
+        connection,
+        rdf_data_server.DataStoreCommand(
+            command=rdf_data_server.DataStoreCommand.Command.RESOLVE_MULTI,
+            request=request))
+
+    response = connection.WaitForResponse(request_id)
+    self.assertEqual(response.results[0].subject, subject)
+
+  def _MakeSetCommand(self, subject, value):
+    request = data_store.DB._MakeRequest([subject], [], token=self.token)
+    new_value = request.values.Append(
+        attribute=u"metadata:predicate",
+        option=rdf_data_store.DataStoreValue.Option.REPLACE)
+    new_value.timestamp = data_store.DB.TimestampSpecFromTimestamp(
+        int(time.time() * 1e6))
+    new_value.value.SetValue(value)
+    return rdf_data_server.DataStoreCommand(
+        command=rdf_data_server.DataStoreCommand.Command.MULTI_SET,
+        request=request)
+
+  def testWritesWhichWereNotSentAreSentAfterReconnecting(self):
+    subject = "aff4:/row:resent"
+    connection = data_store.DB.GetServer(subject)
+
+    request_id = self._SendOnceWithLostConnection(
+        connection, self._MakeSetCommand(subject, "value"))
+    connection.WaitForResponse(request_id)
+
+    self._SendOnceWithLostConnection(
+        connection,
+        self._MakeSetCommand(subject, "other value"),
+        wait_for_response=False)
+    connection.Sync()
+    self.assertEqual(connection.NumPendingRequests(), 0)
+
+    self.assertEqual(
+        data_store.DB.Resolve(subject, "metadata:predicate",
+                              token=self.token)[0], "other value")
+
+  def testWritesFailWhenTheReplyIsLost(self):
+    subject = "aff4:/row:not_replayed"
+    connection = data_store.DB.GetServer(subject)
+    command = self._MakeSetCommand(subject, "value")
+
+    read_reply = connection._ReadReply
+    lost = []
+
+    def LoseFirstReply(sock):
+      reply = read_reply(sock)
+      if not lost:
+        lost.append(reply)
+        return None
+      return reply
+
+    with utils.Stubber(connection, "_ReadReply", LoseFirstReply):
+      request_id = connection.SendRequest(command)
+      self.assertRaises(data_store.Error, connection.WaitForResponse,
+                        request_id)
+
+      del lost[:]
+      connection.SendRequest(command, wait_for_response=False)
+      self.assertRaises(data_store.Error, connection.Sync)
+      self.assertEqual(connection.NumPendingRequests(), 0)
+
+    # The connection is still usable.
+    data_store.DB.Set(subject, "metadata:predicate", "value", token=self.token)
+    self.assertEqual(
+        data_store.DB.Resolve(subject, "metadata:predicate",
+                              token=self.token)[0], "value")
+
+  def testReadsAreReplayedWhenTheReplyIsLost(self):
+    subject = "aff4:/row:reply_lost"
+    data_store.DB.Set(subject, "metadata:predicate", "value", token=self.token)
+
+    connection = data_store.DB.GetServer(subject)
+    request = data_store.DB._MakeRequest(
+        [subject], ["metadata:predicate"], token=self.token)
+    read_reply = connection._ReadReply
+    lost = []
+
+    def LoseFirstReply(sock):
+      reply = read_reply(sock)
+      if not lost:
+        lost.append(reply)
+        return None
+      return reply
+
+    with utils.Stubber(connection, "_ReadReply", LoseFirstReply):
+      request_id = connection.SendRequest(
+          rdf_data_server.DataStoreCommand(
+              command=rdf_data_server.DataStoreCommand.Command.RESOLVE_MULTI,
+              request=request))
+      response = connection.WaitForResponse(request_id)
+
+    self.assertEqual(response.results[0].subject, subject)
+
+  def testLockIsNotHeldWhileSending(self):
+    subject = "aff4:/row:blocked"
+    connection = data_store.DB.GetServer(subject)
+    send_request = connection._SendRequest
+    sending = threading.Event()
+    release = threading.Event()
+
+    def BlockingSend(request_str):
+      sending.set()
+      release.wait(10)
+      return send_request(request_str)
+
+    with utils.Stubber(connection, "_SendRequest", BlockingSend):
+      sender = threading.Thread(
+          target=connection.SendRequest,
+          args=(self._MakeSetCommand(subject, "value"),),
+          kwargs=dict(wait_for_response=False))
+      sender.start()
+      try:
+        self.assertTrue(sending.wait(10))
+        # Other threads can still use the connection state.
+        self.assertTrue(connection.lock.acquire(False))
+        connection.lock.release()
+      finally:
+        release.set()
+        sender.join()
+
+    connection.Sync()
+    self.assertEqual(connection.NumPendingRequests(), 0)
+
 
 def main(args):
   test_lib.main(args)
@@ -152,6 +152,10 @@ class MySQLAdvancedDataStore(data_store.DataStore):
 
   POOL = None
 
+  # Maximum number of attributes replaced by a single DELETE. Subjects are not
+  # split, so a subject with more attributes gets a DELETE of its own.
+  REPLACE_BATCH_SIZE = 1000
+
   def __init__(self):
     self.database_name = config.CONFIG["Mysql.database_name"]
     # Use the global connection pool.
@@ -377,6 +381,63 @@ class MySQLAdvancedDataStore(data_store.DataStore):
       if max_records and result_count >= max_records:
         return
 
+  def _ScanAttributeBatch(self, subject_prefix, attribute, after_urn, limit):
+    """Reads the newest values of attribute for a page of subjects."""
+    query = """
+    SELECT page.subject, aff4.timestamp, aff4.value
+      FROM aff4
+      JOIN (
+            SELECT subjects.hash, subjects.subject, MAX(timestamp) timestamp
+            FROM aff4
+            JOIN subjects ON aff4.subject_hash=subjects.hash
+            WHERE aff4.attribute_hash=unhex(md5(%s))
+                  AND subjects.subject like %s
+                  AND subjects.subject > %s
+            GROUP BY subjects.hash, subjects.subject
+            ORDER BY subjects.subject
+            LIMIT %s
+            ) page ON aff4.subject_hash=page.hash
+                  AND aff4.timestamp=page.timestamp
+      WHERE aff4.attribute_hash=unhex(md5(%s))
+      ORDER BY page.subject
+    """
+    args = [attribute, subject_prefix + "%", after_urn, limit, attribute]
+    results, _ = self.ExecuteQuery(query, args)
+
+    batch = []
+    for row in results:
+      # Several values written with the same timestamp, keep one of them.
+      if batch and batch[-1][0] == row["subject"]:
+        continue
+      batch.append((row["subject"], row["timestamp"], row["value"]))
+    return batch
+
+  def ScanAttributeBatches(self,
+                           subject_prefix,
+                           attribute,
+                           after_urn=None,
+                           max_records=None,
+                           batch_size=1000,
+                           token=None):
+    subject_prefix = self._CleanSubjectPrefix(subject_prefix)
+    after_urn = self._CleanAfterURN(after_urn, subject_prefix) or ""
+
+    while True:
+      limit = batch_size
+      if max_records:
+        limit = min(limit, max_records)
+      batch = self._ScanAttributeBatch(subject_prefix, attribute, after_urn,
+                                       limit)
+      if batch:
+        yield batch
+      if len(batch) < limit:
+        return
+      if max_records:
+        max_records -= len(batch)
+        if not max_records:
+          return
+      after_urn = utils.SmartStr(batch[-1][0])
+
   def MultiSet(self,
                subject,
                values,
@@ -396,6 +457,8 @@ class MySQLAdvancedDataStore(data_store.DataStore):
 
     # Build a document for each unique timestamp.
     for attribute, sequence in values.items():
+      attribute = utils.SmartUnicode(attribute)
+      versions = []
       for value in sequence:
 
         if isinstance(value, tuple):
@@ -409,21 +472,22 @@ class MySQLAdvancedDataStore(data_store.DataStore):
         if entry_timestamp is not None:
           entry_timestamp = int(entry_timestamp)
 
-        attribute = utils.SmartUnicode(attribute)
-        data = self._Encode(value)
+        versions.append([self._Encode(value), entry_timestamp])
 
-        # Replacing means to delete all versions of the attribute first.
-        if replace or attribute in to_delete:
-          existing = self._CountExistingRows(subject, attribute)
-          if existing:
-            to_replace.append([subject, attribute, data, entry_timestamp])
-          else:
-            to_insert.append([subject, attribute, data, entry_timestamp])
-          if attribute in to_delete:
-            to_delete.remove(attribute)
+      if not versions:
+        continue
 
-        else:
-          to_insert.append([subject, attribute, data, entry_timestamp])
+      # Replacing means to delete all versions of the attribute first. The
+      # deletes for all the replaced attributes are done in a single
+      # statement, deleting versions which don't exist is a no-op.
+      if replace or attribute in to_delete:
+        to_replace.append([subject, attribute, versions])
+        to_delete.discard(attribute)
+
+      else:
+        to_insert.extend(
+            [subject, attribute, data, entry_timestamp]
+            for data, entry_timestamp in versions)
 
     if to_delete:
       self.DeleteAttributes(subject, to_delete, token=token)
@@ -443,14 +507,6 @@ class MySQLAdvancedDataStore(data_store.DataStore):
         with self.buffer_lock:
           self.to_insert.extend(to_insert)
 
-  def _CountExistingRows(self, subject, attribute):
-    query = ("SELECT count(*) AS total FROM aff4 "
-             "WHERE subject_hash=unhex(md5(%s)) "
-             "AND attribute_hash=unhex(md5(%s))")
-    args = [subject, attribute]
-    result, _ = self.ExecuteQuery(query, args)
-    return int(result[0]["total"])
-
   @utils.Synchronized
   def Flush(self):
     # TODO(user): There is a race condition here. The locking only
@@ -482,22 +538,54 @@ class MySQLAdvancedDataStore(data_store.DataStore):
       self._ExecuteTransaction(transaction)
 
   def _BuildReplaces(self, values):
-    transaction = []
+    """Build the queries replacing all versions of the given attributes.
+
+    Args:
+      values: A list of [subject, attribute, versions] lists, versions being
+          the [data, timestamp] pairs written by one MultiSet. The versions of
+          the last MultiSet for each subject and attribute are all kept.
+
+    Returns:
+      DELETEs for batches of subjects with up to REPLACE_BATCH_SIZE attributes
+      between them, followed by the inserts.
+    """
     updates = {}
     to_insert = []
 
-    for (subject, attribute, data, timestamp) in values:
-      updates.setdefault(subject, {})[attribute] = [data, timestamp]
+    for (subject, attribute, versions) in values:
+      updates.setdefault(subject, {})[attribute] = versions
 
-    for subject in updates:
-      for attribute in updates[subject]:
-        data = updates[subject][attribute][0]
-        timestamp = updates[subject][attribute][1]
-        to_insert.append([subject, attribute, data, timestamp])
-        delete_q = self._BuildDelete(subject, attribute)[0]
-        transaction.append(delete_q)
-    transaction.extend(self._BuildInserts(to_insert))
-    return transaction
+    queries = []
+    criteria = []
+    args = []
+    batch_size = 0
+    for subject, attributes in sorted(updates.iteritems()):
+      criteria.append("(subject_hash=unhex(md5(%%s)) AND attribute_hash IN "
+                      "(%s))" % ", ".join(["unhex(md5(%s))"] * len(attributes)))
+      args.append(subject)
+      for attribute, versions in attributes.iteritems():
+        args.append(attribute)
+        to_insert.extend(
+            [subject, attribute, data, timestamp]
+            for data, timestamp in versions)
+
+      batch_size += len(attributes)
+      if batch_size >= self.REPLACE_BATCH_SIZE:
+        queries.append(self._BuildReplaceDelete(criteria, args))
+        criteria = []
+        args = []
+        batch_size = 0
+
+    if criteria:
+      queries.append(self._BuildReplaceDelete(criteria, args))
+
+    return queries + self._BuildInserts(to_insert)
+
+  def _BuildReplaceDelete(self, criteria, args):
+    return {
+        "query": "DELETE aff4 FROM aff4 WHERE " + " OR ".join(criteria),
+        "args": args
+    }
 
   def _BuildInserts(self, values):
     subjects_q = {}
@@ -515,16 +603,16 @@ class MySQLAdvancedDataStore(data_store.DataStore):
     aff4_q["args"] = []
 
     seen = {}
-    seen["subjects"] = []
-    seen["attributes"] = []
+    seen["subjects"] = set()
+    seen["attributes"] = set()
 
     for (subject, attribute, value, timestamp) in values:
       if subject not in seen["subjects"]:
         subjects_q["args"].extend([subject, subject])
-        seen["subjects"].append(subject)
+        seen["subjects"].add(subject)
       if attribute not in seen["attributes"]:
         attributes_q["args"].extend([attribute, attribute])
-        seen["attributes"].append(attribute)
+        seen["attributes"].add(attribute)
       aff4_q["args"].extend([subject, attribute, timestamp, timestamp, value])
 
     subjects_q["query"] += ", ".join(["(unhex(md5(%s)), %s)"] *
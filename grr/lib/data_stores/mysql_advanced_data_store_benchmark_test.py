@@ -2,9 +2,16 @@
 """Benchmark tests for MySQL advanced data store."""
 
 
+import time
+
+
+from MySQLdb import cursors
+
+from grr.lib import data_store
 from grr.lib import data_store_test
 from grr.lib import flags
 from grr.lib import test_lib
+from grr.lib import utils
 from grr.lib.data_stores import mysql_advanced_data_store_test
 
 
@@ -20,6 +27,65 @@ class MysqlAdvancedDataStoreCSVBenchmarks(
   """Benchmark the mysql data store abstraction."""
 
 
+class MysqlAdvancedMultiSetBenchmarks(
+    mysql_advanced_data_store_test.MysqlAdvancedTestMixin,
+    test_lib.MicroBenchmarks):
+  """Queries sent to the server per MultiSet and rows written per second."""
+
+  labels = ["benchmark"]
+  units = "ms"
+
+  SUBJECTS = 100
+  ATTRIBUTES = 20
+
+  def setUp(self):
+    super(MysqlAdvancedMultiSetBenchmarks, self).setUp(
+        ["Queries/MultiSet", "Rows/s"], ["<20", "<20"])
+    self.InitDatastore()
+
+    self.queries = 0
+    execute = cursors.DictCursor.execute
+
+    def CountingExecute(cursor, query, args=None):
+      self.queries += 1
+      return execute(cursor, query, args)
+
+    self.execute_stubber = utils.Stubber(cursors.DictCursor, "execute",
+                                         CountingExecute)
+    self.execute_stubber.Start()
+
+  def tearDown(self):
+    self.execute_stubber.Stop()
+    super(MysqlAdvancedMultiSetBenchmarks, self).tearDown()
+    self.DestroyDatastore()
+
+  def _MultiSet(self, name, sync):
+    values = {
+        "metadata:attribute%d" % i: ["value %d" % i]
+        for i in range(self.ATTRIBUTES)
+    }
+
+    self.queries = 0
+    start = time.time()
+    for i in range(self.SUBJECTS):
+      data_store.DB.MultiSet(
+          "aff4:/benchmark/subject%d" % i, values, sync=sync, token=self.token)
+    if not sync:
+      data_store.DB.Flush()
+    time_taken = time.time() - start
+
+    rows = self.SUBJECTS * self.ATTRIBUTES
+    self.AddResult(name, time_taken / self.SUBJECTS, self.SUBJECTS,
+                   "%.1f" % (float(self.queries) / self.SUBJECTS),
+                   "%.1f" % (rows / time_taken))
+
+  def testMultiSet(self):
+    """MultiSet of new and existing attributes with replace=True."""
+    self._MultiSet("New attributes", True)
+    self._MultiSet("Replacing attributes", True)
+    self._MultiSet("Replacing attributes, sync=False", False)
+
+
 def main(args):
   test_lib.main(args)
 
@@ -10,6 +10,7 @@ from grr.lib import data_store
 from grr.lib import data_store_test
 from grr.lib import flags
 from grr.lib import test_lib
+from grr.lib import utils
 from grr.lib.data_stores import mysql_advanced_data_store
 
 
@@ -62,6 +63,32 @@ class MysqlAdvancedDataStoreTest(MysqlAdvancedTestMixin,
     else:
       super(MysqlAdvancedDataStoreTest, self).testMultiSet()
 
+  def testReplacesAreDeletedInBatches(self):
+    subjects = ["aff4:/row:%d" % i for i in range(10)]
+    for subject in subjects:
+      data_store.DB.MultiSet(
+          subject, {"metadata:predicate": ["old"]}, token=self.token)
+
+    with utils.Stubber(data_store.DB, "REPLACE_BATCH_SIZE", 3):
+      queries = data_store.DB._BuildReplaces(
+          [[subject, u"metadata:predicate", [["new", 1000]]]
+           for subject in subjects])
+      self.assertEqual(
+          len([q for q in queries if q["query"].startswith("DELETE")]), 4)
+
+      for subject in subjects:
+        data_store.DB.MultiSet(
+            subject, {"metadata:predicate": [("new", 1000)]},
+            sync=False,
+            token=self.token)
+      data_store.DB.Flush()
+
+    for subject in subjects:
+      self.assertEqual(
+          data_store.DB.ResolvePrefix(
+              subject, "metadata:predicate", token=self.token),
+          [("metadata:predicate", "new", 1000)])
+
 
 def main(args):
   test_lib.main(args)
@@ -6,12 +6,13 @@ SQLite database files are created by taking the root of each AFF4 object.
 
 
 
+import heapq
 import itertools
 import os
+import random
 import re
 import stat
 import tempfile
-import thread
 import threading
 import time
 
@@ -22,6 +23,8 @@ import logging
 from grr import config
 from grr.lib import aff4
 from grr.lib import data_store
+from grr.lib import registry
+from grr.lib import stats
 from grr.lib import utils
 from grr.lib.data_stores import common
 
@@ -263,6 +266,13 @@ class SqliteConnection(object):
     self.Execute("PRAGMA cache_size = 10000")
     self.lock = threading.RLock()
     self.dirty = False
+    # Writes which are left for a later group commit, see DeferCommit().
+    self.deferred_writes = 0
+    self.first_deferred_write = None
+    self.commit_deferred = False
+    self.group_commit_size = config.CONFIG["SqliteDatastore.group_commit_size"]
+    self.group_commit_interval = config.CONFIG[
+        "SqliteDatastore.group_commit_interval"]
     # Counter for vacuuming purposes.
     self.deleted = 0
     self.next_vacuum_check = config.CONFIG["SqliteDatastore.vacuum_check"]
@@ -291,6 +301,29 @@ class SqliteConnection(object):
     else:
       return None, None
 
+  @utils.Synchronized
+  def AcquireLock(self, subject, expires, token):
+    """Locks a subject unless it holds a lock which has not expired yet.
+
+    Checking and taking the lock is a single statement so that it is atomic
+    even when several processes share the database file.
+
+    Args:
+      subject: The subject to lock.
+      expires: The expiration time of the new lock in microseconds.
+      token: An integer identifying the lock owner.
+
+    Returns:
+      True if the lock was taken.
+    """
+    subject = utils.SmartStr(subject)
+    query = """INSERT OR REPLACE INTO lock
+               SELECT ?, ?, ? WHERE NOT EXISTS (
+                 SELECT 1 FROM lock WHERE subject = ? AND expires > ?)"""
+    args = (subject, expires, token, subject, int(time.time() * 1e6))
+    self.dirty = True
+    return self.Execute(query, args).rowcount == 1
+
   @utils.Synchronized
   def SetLock(self, subject, expires, token):
     """Locks a subject."""
@@ -301,11 +334,15 @@ class SqliteConnection(object):
     self.dirty = True
 
   @utils.Synchronized
-  def RemoveLock(self, subject):
-    """Removes the lock from a subject."""
+  def RemoveLock(self, subject, token=None):
+    """Removes the lock from a subject, if given only the one held by token."""
     subject = utils.SmartStr(subject)
-    query = "DELETE FROM lock WHERE subject = ?"
-    args = (subject,)
+    if token is None:
+      query = "DELETE FROM lock WHERE subject = ?"
+      args = (subject,)
+    else:
+      query = "DELETE FROM lock WHERE subject = ? AND token = ?"
+      args = (subject, token)
     self.Execute(query, args)
     self.dirty = True
 
@@ -464,6 +501,31 @@ class SqliteConnection(object):
     for r in cursor:
       yield r
 
+  @utils.Synchronized
+  def ScanAttributeBatch(self, subject_prefix, attribute, after_urn, limit):
+    """Returns the newest values of attribute for a page of subjects.
+
+    Args:
+     subject_prefix: Returns records for subjects which begin with
+       subject_prefix.
+     attribute: The attribute of interest.
+     after_urn: Only subjects which come after this are returned.
+     limit: The maximum number of records to return.
+
+    Returns:
+     A list of (subject, timestamp, value) records ordered by subject.
+    """
+    # SQLite takes the value from the row holding the MAX(timestamp).
+    query = """SELECT subject, MAX(timestamp), value FROM tbl
+               WHERE subject LIKE ? AND subject > ? AND predicate = ?
+               GROUP BY subject
+               ORDER BY subject
+               LIMIT ?"""
+    args = (utils.SmartStr(subject_prefix) + "%", utils.SmartStr(after_urn),
+            utils.SmartStr(attribute), limit)
+    return [(subject, timestamp, str(value))
+            for subject, timestamp, value in self.Execute(query, args)]
+
   @utils.Synchronized
   def DeleteAttribute(self, subject, attribute):
     """Deletes all values for the given subject/attribute."""
@@ -520,10 +582,44 @@ class SqliteConnection(object):
     return self
 
   def __exit__(self, exc_type, exc_value, traceback):
-    if self.dirty:
-      self.Flush()
+    try:
+      if self.dirty and not self.commit_deferred:
+        self.Flush()
+    finally:
+      self.commit_deferred = False
+      self.lock.release()
+
+  def DeferCommit(self):
+    """Leaves the changes made while holding the connection uncommitted.
+
+    The changes are committed in one transaction together with later writes
+    once enough writes were deferred, the oldest deferred write is too old
+    or Commit() is called.
+
+    Returns:
+      True if the commit was deferred, False if the changes are committed
+      when the connection is released.
+    """
+    if not self.dirty:
+      return False
+
+    now = time.time()
+    if self.first_deferred_write is None:
+      self.first_deferred_write = now
+    self.deferred_writes += 1
+    if (self.deferred_writes >= self.group_commit_size or
+        now - self.first_deferred_write >= self.group_commit_interval):
+      return False
+
     self.dirty = False
-    self.lock.release()
+    self.commit_deferred = True
+    return True
+
+  @utils.Synchronized
+  def Commit(self):
+    """Commits the deferred writes, if any."""
+    if self.dirty or self.deferred_writes:
+      self.Flush()
 
   @utils.Synchronized
   def Flush(self):
@@ -531,9 +627,13 @@ class SqliteConnection(object):
     if self.conn:
       try:
         self.conn.commit()
+        stats.STATS.IncrementCounter("sqlite_datastore_commits")
       except sqlite3.OperationalError:
         # Transaction not active.
         pass
+    self.dirty = False
+    self.deferred_writes = 0
+    self.first_deferred_write = None
 
     if self.deleted >= self.next_vacuum_check:
       if self._NeedsVacuum() and not self._HasRecentVacuum():
@@ -597,7 +697,7 @@ class SqliteConnection(object):
   @utils.Synchronized
   def Close(self):
     """Flush and close connection."""
-    if self.dirty:
+    if self.dirty or self.deferred_writes:
       self.Flush()
     self.cursor.close()
     self.conn.close()
@@ -613,6 +713,10 @@ class SqliteDataStore(data_store.DataStore):
 
   def __init__(self, path=None):
     self._CalculateAttributeStorageTypes()
+    # Connections holding writes made with sync=False which are not
+    # committed yet.
+    self.uncommitted = set()
+    self.uncommitted_lock = threading.Lock()
     super(SqliteDataStore, self).__init__()
     self.cache = SqliteConnectionCache(
         config.CONFIG["SqliteDatastore.connection_cache_size"], path)
@@ -650,6 +754,29 @@ class SqliteDataStore(data_store.DataStore):
     else:
       return value
 
+  def _StartWrite(self, subject, sync):
+    """Returns the connection to write subject to.
+
+    Writes with sync=True are barriers: all the writes made with sync=False
+    before are committed first.
+
+    Args:
+      subject: The subject to write.
+      sync: Whether the write has to be committed before returning.
+
+    Returns:
+      The SqliteConnection for the subject.
+    """
+    if sync and self.uncommitted:
+      self.Flush()
+    return self.cache.Get(subject)
+
+  def _FinishWrite(self, sqlite_connection, sync):
+    """Called with the connection held after making changes to it."""
+    if not sync and sqlite_connection.DeferCommit():
+      with self.uncommitted_lock:
+        self.uncommitted.add(sqlite_connection)
+
   def MultiSet(self,
                subject,
                values,
@@ -659,14 +786,12 @@ class SqliteDataStore(data_store.DataStore):
                to_delete=None,
                token=None):
     """Set multiple values at once."""
-    # All operations are synchronized.
-    _ = sync
     if timestamp is None or timestamp == self.NEWEST_TIMESTAMP:
       timestamp = time.time() * 1000000
 
     to_delete = set(to_delete or [])
 
-    with self.cache.Get(subject) as sqlite_connection:
+    with self._StartWrite(subject, sync) as sqlite_connection:
       if replace:
         to_delete.update(values.keys())
 
@@ -688,6 +813,8 @@ class SqliteDataStore(data_store.DataStore):
           sqlite_connection.SetAttribute(subject, attribute, value,
                                          element_timestamp)
 
+      self._FinishWrite(sqlite_connection, sync)
+
   def DeleteAttributes(self,
                        subject,
                        attributes,
@@ -696,13 +823,11 @@ class SqliteDataStore(data_store.DataStore):
                        sync=True,
                        token=None):
     """Remove some attributes from a subject."""
-    _ = sync
-
     if isinstance(attributes, basestring):
       raise ValueError(
           "String passed to DeleteAttributes (non string iterable expected).")
 
-    with self.cache.Get(subject) as sqlite_connection:
+    with self._StartWrite(subject, sync) as sqlite_connection:
       if start is None and end is None:
         # This is done when we delete all attributes at once without
         # caring about timestamps.
@@ -716,11 +841,12 @@ class SqliteDataStore(data_store.DataStore):
         for attribute in list(attributes):
           sqlite_connection.DeleteAttributeRange(subject, attribute, start, end)
 
-  def DeleteSubject(self, subject, sync=False, token=None):
-    _ = sync
+      self._FinishWrite(sqlite_connection, sync)
 
-    with self.cache.Get(subject) as sqlite_connection:
+  def DeleteSubject(self, subject, sync=False, token=None):
+    with self._StartWrite(subject, sync) as sqlite_connection:
       sqlite_connection.DeleteSubject(subject)
+      self._FinishWrite(sqlite_connection, sync)
 
   def MultiResolvePrefix(self,
                          subjects,
@@ -878,6 +1004,57 @@ class SqliteDataStore(data_store.DataStore):
         sorted(raw_results, key=lambda x: x[0]), max_records):
       yield r
 
+  def _ScanConnection(self, sqlite_connection, subject_prefix, attribute,
+                      after_urn, max_records, batch_size):
+    """Yields the pages of a scan over a single database file."""
+    after_urn = after_urn or ""
+    while True:
+      limit = batch_size
+      if max_records:
+        limit = min(limit, max_records)
+      batch = sqlite_connection.ScanAttributeBatch(subject_prefix, attribute,
+                                                   after_urn, limit)
+      if batch:
+        yield batch
+      if len(batch) < limit:
+        return
+      if max_records:
+        max_records -= len(batch)
+        if not max_records:
+          return
+      after_urn = batch[-1][0]
+
+  def ScanAttributeBatches(self,
+                           subject_prefix,
+                           attribute,
+                           after_urn=None,
+                           max_records=None,
+                           batch_size=1000,
+                           token=None):
+    subject_prefix = self._CleanSubjectPrefix(subject_prefix)
+    after_urn = self._CleanAfterURN(after_urn, subject_prefix)
+
+    connections = list(self.cache.GetPrefix(subject_prefix))
+    if len(connections) == 1:
+      for batch in self._ScanConnection(connections[0], subject_prefix,
+                                        attribute, after_urn, max_records,
+                                        batch_size):
+        yield batch
+      return
+
+    # Subjects are spread over several files, each of them is scanned in order
+    # and the records are merged.
+    records = heapq.merge(*[
+        itertools.chain.from_iterable(
+            self._ScanConnection(sqlite_connection, subject_prefix, attribute,
+                                 after_urn, max_records, batch_size))
+        for sqlite_connection in connections
+    ])
+    if max_records:
+      records = itertools.islice(records, max_records)
+    for batch in utils.Grouper(records, batch_size):
+      yield batch
+
   def ResolveMulti(self,
                    subject,
                    attributes,
@@ -939,7 +1116,13 @@ class SqliteDataStore(data_store.DataStore):
     return self.cache.RootPath()
 
   def Flush(self):
-    pass
+    """Commits the writes made with sync=False."""
+    with self.uncommitted_lock:
+      uncommitted = self.uncommitted
+      self.uncommitted = set()
+
+    for sqlite_connection in uncommitted:
+      sqlite_connection.Commit()
 
   def ChangeLocation(self, location):
     self.cache.ChangePath(location)
@@ -949,6 +1132,12 @@ class SqliteDataStore(data_store.DataStore):
         self, subject, lease_time=lease_time, token=token)
 
 
+class SqliteDataStoreInit(registry.InitHook):
+
+  def RunOnce(self):
+    stats.STATS.RegisterCounterMetric("sqlite_datastore_commits")
+
+
 class SqliteDBSubjectLock(data_store.DBSubjectLock):
   """The SQLite data store transaction object.
 
@@ -965,33 +1154,17 @@ class SqliteDBSubjectLock(data_store.DBSubjectLock):
   locked = False
 
   def _Acquire(self, lease_time):
-    self.lock_token = thread.get_ident()
-    sqlite_connection = self.store.cache.Get(self.subject)
-
-    # We first check if there is a lock on the subject.
-    # Next we set our lease time and lock_token as identification.
-    with sqlite_connection:
-      locked_until, stored_token = sqlite_connection.GetLock(self.subject)
+    # Thread ids are not unique across processes sharing the database so the
+    # lock token is random.
+    self.lock_token = random.getrandbits(62)
+    self.expires = int((time.time() + lease_time) * 1e6)
 
-      # This is currently locked by another thread.
-      if locked_until and (time.time() * 1e6) < float(locked_until):
+    with self.store.cache.Get(self.subject) as sqlite_connection:
+      if not sqlite_connection.AcquireLock(self.subject, self.expires,
+                                           self.lock_token):
         raise data_store.DBSubjectLockError(
             "Subject %s is locked" % self.subject)
 
-      # Subject is not locked, we take a lease on it.
-      self.expires = int((time.time() + lease_time) * 1e6)
-      sqlite_connection.SetLock(self.subject, self.expires, self.lock_token)
-
-    # TODO(user): This shouldn't really be necessary, and seems fragile. We
-    # should be able to use an UPDATE WHERE lock_expiration < now inside a
-    # transaction and check that we changed one row.
-    # Check if the lock stuck. If the stored token is not ours
-    # then probably someone was able to grab it before us.
-    locked_until, stored_token = sqlite_connection.GetLock(self.subject)
-    if stored_token != self.lock_token:
-      raise data_store.DBSubjectLockError(
-          "Unable to lock subject %s" % self.subject)
-
     self.locked = True
 
   def UpdateLease(self, duration):
@@ -1002,5 +1175,5 @@ class SqliteDBSubjectLock(data_store.DBSubjectLock):
   def Release(self):
     if self.locked:
       with self.store.cache.Get(self.subject) as sqlite_connection:
-        sqlite_connection.RemoveLock(self.subject)
+        sqlite_connection.RemoveLock(self.subject, token=self.lock_token)
         self.locked = False
@@ -2,8 +2,13 @@
 """Benchmark tests for sqlite datastore."""
 
 
+import time
+
+
+from grr.lib import data_store
 from grr.lib import data_store_test
 from grr.lib import flags
+from grr.lib import stats
 from grr.lib import test_lib
 
 from grr.lib.data_stores import sqlite_data_store_test
@@ -19,6 +24,53 @@ class SqliteDataStoreCSVBenchmarks(sqlite_data_store_test.SqliteTestMixin,
   """Benchmark the SQLite data store abstraction."""
 
 
+class SqliteGroupCommitBenchmarks(sqlite_data_store_test.SqliteTestMixin,
+                                  test_lib.MicroBenchmarks):
+  """Small writes spread over many client databases, like a hunt fan-out."""
+
+  labels = ["benchmark"]
+  units = "ms"
+
+  CLIENTS = 50
+  WRITES = 5000
+
+  def setUp(self):
+    super(SqliteGroupCommitBenchmarks, self).setUp(
+        ["Writes/s", "Commits/s", "Commits/write"], ["<20", "<20", "<20"])
+    self.InitDatastore()
+    # Commits are only made by the writes under test.
+    data_store.DB.flusher_thread.Stop()
+
+  def tearDown(self):
+    super(SqliteGroupCommitBenchmarks, self).tearDown()
+    self.DestroyDatastore()
+
+  def _Write(self, name, sync):
+    commits = stats.STATS.GetMetricValue("sqlite_datastore_commits")
+
+    start = time.time()
+    for i in range(self.WRITES):
+      subject = "aff4:/C.%016X/flows/W:%d" % (i % self.CLIENTS, i)
+      data_store.DB.MultiSet(
+          subject, {"aff4:size": [i],
+                    "aff4:type": ["HuntResult"]},
+          sync=sync,
+          token=self.token)
+    data_store.DB.Flush()
+    time_taken = time.time() - start
+
+    commits = stats.STATS.GetMetricValue("sqlite_datastore_commits") - commits
+    self.AddResult(name, time_taken / self.WRITES, self.WRITES,
+                   "%.1f" % (self.WRITES / time_taken),
+                   "%.1f" % (commits / time_taken),
+                   "%.3f" % (float(commits) / self.WRITES))
+
+  def testMultiSet(self):
+    """MultiSet of two attributes on many subjects in many databases."""
+    self._Write("sync=True", True)
+    self._Write("sync=False (group commit)", False)
+
+
 def main(args):
   test_lib.main(args)
 
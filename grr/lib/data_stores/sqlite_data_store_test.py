@@ -2,12 +2,14 @@
 """Tests the SQLite data store."""
 
 import shutil
+import sqlite3
 
 
 from grr.lib import access_control
 from grr.lib import data_store
 from grr.lib import data_store_test
 from grr.lib import flags
+from grr.lib import stats
 from grr.lib import test_lib
 from grr.lib import utils
 
@@ -36,6 +38,7 @@ class SqliteTestMixin(object):
 
   def DestroyDatastore(self):
     try:
+      data_store.DB.Flush()
       data_store.DB.cache.Flush()
     except AttributeError:
       pass
@@ -49,6 +52,63 @@ class SqliteTestMixin(object):
 class SqliteDataStoreTest(SqliteTestMixin, data_store_test._DataStoreTest):
   """Test the sqlite data store."""
 
+  def _StopFlusherThread(self):
+    # The flusher thread would commit the writes at random times.
+    data_store.DB.flusher_thread.Stop()
+
+  def _CountCommittedRows(self, subject):
+    # A separate connection only sees committed rows.
+    filename = data_store.DB.cache.Get(subject).Filename()
+    conn = sqlite3.connect(filename)
+    try:
+      return conn.execute("SELECT COUNT(*) FROM tbl WHERE subject = ?",
+                          (subject,)).fetchone()[0]
+    finally:
+      conn.close()
+
+  def testUnsyncedWritesAreCommittedTogether(self):
+    self._StopFlusherThread()
+    subjects = ["aff4:/C.0000000000000001/file%d" % i for i in range(10)]
+    commits = stats.STATS.GetMetricValue("sqlite_datastore_commits")
+
+    for subject in subjects:
+      data_store.DB.Set(
+          subject, "aff4:size", 1, sync=False, token=self.token)
+      # Writes are visible in this process right away.
+      self.assertEqual(
+          data_store.DB.Resolve(subject, "aff4:size", token=self.token)[0], 1)
+
+    self.assertEqual(self._CountCommittedRows(subjects[0]), 0)
+
+    data_store.DB.Flush()
+    for subject in subjects:
+      self.assertEqual(self._CountCommittedRows(subject), 1)
+    self.assertEqual(
+        stats.STATS.GetMetricValue("sqlite_datastore_commits") - commits, 1)
+
+  def testSyncedWritesCommitEarlierWrites(self):
+    self._StopFlusherThread()
+    unsynced = "aff4:/C.0000000000000001/unsynced"
+    synced = "aff4:/C.0000000000000002/synced"
+
+    data_store.DB.Set(unsynced, "aff4:size", 1, sync=False, token=self.token)
+    self.assertEqual(self._CountCommittedRows(unsynced), 0)
+
+    data_store.DB.Set(synced, "aff4:size", 1, sync=True, token=self.token)
+    self.assertEqual(self._CountCommittedRows(unsynced), 1)
+    self.assertEqual(self._CountCommittedRows(synced), 1)
+
+  def testGroupCommitSize(self):
+    self._StopFlusherThread()
+    subject = "aff4:/C.0000000000000001/file"
+    with test_lib.ConfigOverrider({"SqliteDatastore.group_commit_size": 3}):
+      data_store.DB.cache.Flush()
+      for i in range(3):
+        data_store.DB.Set(
+            subject, "aff4:size", i, replace=False, sync=False,
+            token=self.token)
+        self.assertEqual(self._CountCommittedRows(subject), 0 if i < 2 else 3)
+
 
 def main(args):
   test_lib.main(args)
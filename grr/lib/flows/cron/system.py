@@ -3,6 +3,8 @@
 
 
 import bisect
+import Queue
+import threading
 import time
 
 import logging
@@ -92,13 +94,24 @@ class _ActiveCounter(object):
 
 
 class AbstractClientStatsCronFlow(cronjobs.SystemCronFlow):
-  """A cron job which opens every client in the system.
+  """A cron job which reads every client in the system.
 
   We feed all the client objects to the AbstractClientStatsCollector instances.
+  The clients are found through the client index and only CLIENT_ATTRIBUTES
+  are read, in batches. Contiguous ranges of client ids are read in parallel.
   """
 
   CLIENT_STATS_URN = rdfvalue.RDFURN("aff4:/stats/ClientFleetStats")
 
+  # The client attributes which ProcessClient uses.
+  CLIENT_ATTRIBUTES = []
+
+  # Clients are read in batches of this size.
+  CLIENT_BATCH_SIZE = 1000
+
+  # The number of client id ranges which are read in parallel.
+  CLIENT_READ_THREADS = 4
+
   def BeginProcessing(self):
     pass
 
@@ -124,6 +137,79 @@ class AbstractClientStatsCronFlow(cronjobs.SystemCronFlow):
           token=self.token)
     return self.stats[label]
 
+  def _ReadClients(self, client_urns):
+    """Returns the clients, with only the attributes we need read."""
+    attributes = set(self.CLIENT_ATTRIBUTES)
+    attributes.add(aff4_grr.VFSGRRClient.SchemaCls.TYPE)
+    attributes.add(aff4_grr.VFSGRRClient.SchemaCls.LABELS)
+
+    clients = []
+    for urn, values in aff4.FACTORY.GetAttributes(
+        client_urns, attributes=attributes, token=self.token):
+      try:
+        client = aff4.FACTORY.Open(
+            urn, mode="r", local_cache={urn: values}, token=self.token)
+      except IOError:
+        continue
+
+      if isinstance(client, aff4_grr.VFSGRRClient):
+        clients.append(client)
+
+    return clients
+
+  def _IterateClients(self):
+    """Yields all the clients, reading them in parallel in the background."""
+    client_urns = sorted(export_utils.GetAllClients(token=self.token))
+    logging.debug("Found %d clients.", len(client_urns))
+    if not client_urns:
+      return
+
+    range_size = ((len(client_urns) + self.CLIENT_READ_THREADS - 1) //
+                  self.CLIENT_READ_THREADS)
+    batches = Queue.Queue(maxsize=2 * self.CLIENT_READ_THREADS)
+    stop = threading.Event()
+
+    def ReadClientRange(urns):
+      try:
+        for urn_batch in utils.Grouper(urns, self.CLIENT_BATCH_SIZE):
+          if stop.is_set():
+            return
+          batches.put(self._ReadClients(urn_batch))
+      except Exception as e:  # pylint: disable=broad-except
+        batches.put(e)
+      finally:
+        batches.put(None)
+
+    readers = []
+    for start in xrange(0, len(client_urns), range_size):
+      reader = threading.Thread(
+          name="ClientStatsReader",
+          target=ReadClientRange,
+          args=(client_urns[start:start + range_size],))
+      reader.daemon = True
+      reader.start()
+      readers.append(reader)
+
+    try:
+      running = len(readers)
+      while running:
+        batch = batches.get()
+        if batch is None:
+          running -= 1
+        elif isinstance(batch, Exception):
+          raise batch
+        else:
+          for client in batch:
+            yield client
+    finally:
+      stop.set()
+      # Unblock readers waiting for room in the queue.
+      while any(reader.is_alive() for reader in readers):
+        try:
+          batches.get(timeout=0.1)
+        except Queue.Empty:
+          pass
+
   @flow.StateHandler()
   def Start(self):
     """Retrieve all the clients for the AbstractClientStatsCollectors."""
@@ -133,19 +219,14 @@ class AbstractClientStatsCronFlow(cronjobs.SystemCronFlow):
 
       self.BeginProcessing()
 
-      root = aff4.FACTORY.Open(aff4.ROOT_URN, token=self.token)
-      children_urns = list(root.ListChildren())
-      logging.debug("Found %d children.", len(children_urns))
-
       processed_count = 0
-      for child in aff4.FACTORY.MultiOpen(
-          children_urns, mode="r", token=self.token, age=aff4.NEWEST_TIME):
-        if isinstance(child, aff4_grr.VFSGRRClient):
-          self.ProcessClient(child)
-          processed_count += 1
+      for client in self._IterateClients():
+        self.ProcessClient(client)
+        processed_count += 1
 
-        # This flow is not dead: we don't want to run out of lease time.
-        self.HeartBeat()
+        if processed_count % self.CLIENT_BATCH_SIZE == 0:
+          # This flow is not dead: we don't want to run out of lease time.
+          self.HeartBeat()
 
       self.FinishProcessing()
       for fd in self.stats.values():
@@ -163,6 +244,11 @@ class GRRVersionBreakDown(AbstractClientStatsCronFlow):
 
   frequency = rdfvalue.Duration("4h")
 
+  CLIENT_ATTRIBUTES = [
+      aff4_grr.VFSGRRClient.SchemaCls.PING,
+      aff4_grr.VFSGRRClient.SchemaCls.CLIENT_INFO
+  ]
+
   def BeginProcessing(self):
     self.counter = _ActiveCounter(
         aff4_stats.ClientFleetStats.SchemaCls.GRRVERSION_HISTOGRAM)
@@ -187,6 +273,12 @@ class GRRVersionBreakDown(AbstractClientStatsCronFlow):
 class OSBreakDown(AbstractClientStatsCronFlow):
   """Records relative ratios of OS versions in 7 day actives."""
 
+  CLIENT_ATTRIBUTES = [
+      aff4_grr.VFSGRRClient.SchemaCls.PING,
+      aff4_grr.VFSGRRClient.SchemaCls.SYSTEM,
+      aff4_grr.VFSGRRClient.SchemaCls.UNAME
+  ]
+
   def BeginProcessing(self):
     self.counters = [
         _ActiveCounter(aff4_stats.ClientFleetStats.SchemaCls.OS_HISTOGRAM),
@@ -221,6 +313,8 @@ class LastAccessStats(AbstractClientStatsCronFlow):
   # The number of clients fall into these bins (number of hours ago)
   _bins = [1, 2, 3, 7, 14, 30, 60]
 
+  CLIENT_ATTRIBUTES = [aff4_grr.VFSGRRClient.SchemaCls.PING]
+
   def _ValuesForLabel(self, label):
     if label not in self.values:
       self.values[label] = [0] * len(self._bins)
@@ -329,6 +423,21 @@ class PurgeClientStats(cronjobs.SystemCronFlow):
       self.HeartBeat()
 
 
+class UpdateHuntSummaryIndexCronFlow(cronjobs.SystemCronFlow):
+  """Adds hunts created by older GRR versions to the hunt summary index."""
+
+  frequency = rdfvalue.Duration("1d")
+  # Runs right after an upgrade, hunts are not listed until they are indexed.
+  start_time_randomization = False
+
+  @flow.StateHandler()
+  def Start(self):
+    added = hunts_implementation.HuntSummaryIndex(
+        token=self.token).AddUnindexedHunts(heartbeat=self.HeartBeat)
+    if added:
+      self.Log("Added %d hunts to the hunt summary index.", added)
+
+
 class EndToEndTests(cronjobs.SystemCronFlow):
   """Runs end-to-end tests on designated clients.
 
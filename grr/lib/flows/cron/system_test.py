@@ -179,6 +179,17 @@ class SystemCronFlowTest(test_lib.FlowTestsBaseclass):
     # All our clients appeared at the same time but this label is only half.
     self._CheckAccessStats("Label2", count=10L)
 
+  def testClientStatsReadInSmallBatchesAndManyRanges(self):
+    with utils.MultiStubber(
+        (system.AbstractClientStatsCronFlow, "CLIENT_BATCH_SIZE", 3),
+        (system.AbstractClientStatsCronFlow, "CLIENT_READ_THREADS", 7)):
+      for _ in test_lib.TestFlowHelper(
+          system.LastAccessStats.__name__, token=self.token):
+        pass
+
+    self._CheckAccessStats("All", count=20L)
+    self._CheckAccessStats("Label1", count=10L)
+
   def testPurgeClientStats(self):
     max_age = system.PurgeClientStats.MAX_AGE
 
@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 """These flows are designed for high performance transfers."""
 
+import random
+import threading
+import time
 import zlib
 
 import logging
@@ -12,7 +15,11 @@ from grr.lib import data_store
 from grr.lib import file_store
 from grr.lib import flow
 from grr.lib import rdfvalue
+from grr.lib import registry
 from grr.lib import server_stubs
+from grr.lib import stats
+from grr.lib import threadpool
+from grr.lib import utils
 from grr.lib.aff4_objects import aff4_grr
 from grr.lib.aff4_objects import collects
 from grr.lib.aff4_objects import filestore
@@ -609,6 +616,9 @@ class MultiGetFileMixin(object):
 
         if existing_blobs[hash_response.data.encode("hex")]:
           # If we have the data we may call our state directly.
+          stats.STATS.IncrementCounter("blob_uploads_saved")
+          stats.STATS.IncrementCounter(
+              "blob_upload_bytes_saved", delta=hash_response.length)
           self.CallState(
               [hash_response],
               next_state="WriteBuffer",
@@ -661,6 +671,8 @@ class MultiGetFileMixin(object):
           fd.Set(fd.Schema.STAT(stat_entry))
           fd.Set(fd.Schema.PATHSPEC(stat_entry.pathspec))
           fd.Set(fd.Schema.CONTENT_LAST(rdfvalue.RDFDatetime().Now()))
+          # The file store reuses these instead of hashing the file again.
+          fd.Set(fd.Schema.HASH, file_tracker["hash_obj"])
 
           for digest, length in file_tracker["blobs"]:
             fd.AddBlob(digest, length)
@@ -794,8 +806,18 @@ class FileStoreCreateFile(flow.EventListener):
   store. Files are deduplicated and stored centrally.
 
   This event listener will be fired when a new file is downloaded through
-  e.g. the GetFile flow. We then recalculate the file's hashes and store it in
-  the data store under a canonical URN.
+  e.g. the GetFile flow. We then calculate the file's missing hashes and store
+  it in the data store under a canonical URN.
+
+  Hashing large files takes a while so files are added on a dedicated thread
+  pool, the worker only waits when all the pool's threads are busy and its
+  queue is full.
+
+  Every file handed to the pool is recorded in the data store until it was
+  added. The records are spread over PENDING_SHARDS rows and every worker
+  checks one of them per PENDING_CHECK_INTERVAL. Files left behind by a worker
+  which died, or whose ingestion failed, are added again by the next worker
+  which sees them once PENDING_LEASE_TIME has passed.
   """
 
   EVENTS = ["FileStore.AddFileToStore"]
@@ -804,12 +826,121 @@ class FileStoreCreateFile(flow.EventListener):
 
   CHUNK_SIZE = 512 * 1024
 
+  THREAD_POOL_NAME = "FileStoreIngestion"
+
+  PENDING_URN = rdfvalue.RDFURN("aff4:/filestore_ingestion")
+  PENDING_PREFIX = "index:pending:"
+  PENDING_SHARDS = 16
+  # Seconds after which a pending file is considered abandoned.
+  PENDING_LEASE_TIME = 3600
+  # Seconds between two checks of a pending shard for abandoned files.
+  PENDING_CHECK_INTERVAL = 60
+
+  _thread_pool = None
+  _thread_pool_lock = threading.Lock()
+  _last_pending_check = 0
+
+  @classmethod
+  def GetPendingShard(cls, vfs_urn):
+    """Returns the row the pending record of vfs_urn is written to."""
+    shard = zlib.crc32(utils.SmartStr(vfs_urn)) % cls.PENDING_SHARDS
+    return cls.PENDING_URN.Add(str(shard))
+
+  @classmethod
+  def GetAllPendingShards(cls):
+    return [cls.PENDING_URN.Add(str(i)) for i in range(cls.PENDING_SHARDS)]
+
+  @classmethod
+  def GetThreadPool(cls, threads):
+    """Returns the running ingestion pool, with the given number of threads."""
+    with cls._thread_pool_lock:
+      pool = cls._thread_pool
+      if pool is None or pool.max_threads != threads:
+        if pool is not None:
+          # FileStore.ingestion_threads was changed, the files already queued
+          # are added before the pool is replaced.
+          pool.Stop()
+
+        pool = threadpool.ThreadPool(
+            cls.THREAD_POOL_NAME, min_threads=threads, max_threads=threads)
+        pool.Start()
+        cls._thread_pool = pool
+
+      return pool
+
   @flow.EventHandler()
   def ProcessMessage(self, message=None, event=None):
     """Process the new file and add to the file store."""
     _ = event
     vfs_urn = message.payload
 
+    threads = config.CONFIG["FileStore.ingestion_threads"]
+    if not threads:
+      self.AddFileToStore(vfs_urn)
+      return
+
+    data_store.DB.Set(
+        self.GetPendingShard(vfs_urn),
+        self.PENDING_PREFIX + utils.SmartStr(vfs_urn),
+        vfs_urn,
+        token=self.token)
+    self._Schedule(self.GetThreadPool(threads), vfs_urn)
+
+    if time.time() - self._last_pending_check > self.PENDING_CHECK_INTERVAL:
+      FileStoreCreateFile._last_pending_check = time.time()
+      # Workers pick shards at random so they don't all check the same ones.
+      self.ResumeAbandonedFiles(random.choice(self.GetAllPendingShards()))
+
+  def ResumeAbandonedFiles(self, shard):
+    """Adds the pending files of a shard whose lease expired to the file store.
+
+    Args:
+      shard: The pending shard to check, from GetAllPendingShards().
+
+    Returns:
+      The urns of the files which were scheduled again.
+    """
+    threads = config.CONFIG["FileStore.ingestion_threads"]
+    cutoff = (time.time() - self.PENDING_LEASE_TIME) * 1e6
+
+    abandoned = []
+    for attribute, value, timestamp in data_store.DB.ResolvePrefix(
+        shard, self.PENDING_PREFIX, token=self.token):
+      if timestamp < cutoff:
+        abandoned.append((attribute, rdfvalue.RDFURN(value)))
+
+    for attribute, vfs_urn in abandoned:
+      logging.info("Adding abandoned file %s to the file store.", vfs_urn)
+      # Renewing the lease keeps other workers from adding it as well.
+      data_store.DB.Set(shard, attribute, vfs_urn, token=self.token)
+      if threads:
+        self._Schedule(self.GetThreadPool(threads), vfs_urn)
+      else:
+        self._AddPendingFileToStore(vfs_urn)
+
+    return [vfs_urn for _, vfs_urn in abandoned]
+
+  def _Schedule(self, pool, vfs_urn):
+    start_time = time.time()
+    pool.AddTask(
+        target=self._AddPendingFileToStore,
+        args=(vfs_urn,),
+        name="AddFileToStore %s" % vfs_urn,
+        blocking=True,
+        inline=False)
+    stats.STATS.RecordEvent("filestore_ingestion_wait_time",
+                            time.time() - start_time)
+
+  def _AddPendingFileToStore(self, vfs_urn):
+    # If adding the file fails, it stays pending and is retried once its
+    # lease expired.
+    self.AddFileToStore(vfs_urn)
+    data_store.DB.DeleteAttributes(
+        self.GetPendingShard(vfs_urn),
+        [self.PENDING_PREFIX + utils.SmartStr(vfs_urn)],
+        token=self.token)
+
+  def AddFileToStore(self, vfs_urn):
     vfs_fd = aff4.FACTORY.Open(vfs_urn, mode="rw", token=self.token)
     filestore_fd = aff4.FACTORY.Create(
         filestore.FileStore.PATH,
@@ -892,6 +1023,19 @@ class GetMBR(flow.GRRFlow):
       self.SendReply(rdfvalue.RDFBytes(mbr_data))
 
 
+class TransferInit(registry.InitHook):
+  """Init handler to define blob transfer and file store ingestion metrics."""
+
+  def RunOnce(self):
+    # Blobs the clients did not have to upload because they were already in
+    # the blob store when their hashes were checked.
+    stats.STATS.RegisterCounterMetric("blob_uploads_saved")
+    stats.STATS.RegisterCounterMetric("blob_upload_bytes_saved", units="BYTES")
+    # Time the worker is blocked because the file store ingestion pool is full.
+    stats.STATS.RegisterEventMetric(
+        "filestore_ingestion_wait_time", units="SECONDS")
+
+
 class TransferStore(flow.WellKnownFlow):
   """Store a buffer into a determined location."""
   well_known_session_id = rdfvalue.SessionID(flow_name="TransferStore")
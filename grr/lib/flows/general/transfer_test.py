@@ -14,6 +14,7 @@ from grr.lib import constants
 from grr.lib import file_store
 from grr.lib import flags
 from grr.lib import flow
+from grr.lib import stats
 from grr.lib import test_lib
 from grr.lib import utils
 
@@ -395,6 +396,7 @@ class TestTransfer(test_lib.FlowTestsBaseclass):
     # there should only be a single TransferBuffer call.
     args = transfer.MultiGetFileArgs(
         pathspecs=pathspecs, maximum_pending_files=1)
+    prev_uploads_saved = stats.STATS.GetMetricValue("blob_uploads_saved")
     for _ in test_lib.TestFlowHelper(
         transfer.MultiGetFile.__name__,
         client_mock,
@@ -404,6 +406,40 @@ class TestTransfer(test_lib.FlowTestsBaseclass):
       pass
 
     self.assertEqual(client_mock.action_counts["TransferBuffer"], 1)
+    # Every other hashed chunk was found in the blob store.
+    self.assertEqual(
+        stats.STATS.GetMetricValue("blob_uploads_saved") - prev_uploads_saved,
+        client_mock.action_counts["HashBuffer"] - 1)
+
+  def testMultiGetFileReusesClientHashesInFileStore(self):
+    client_mock = action_mocks.MultiGetFileClientMock()
+    path = os.path.join(self.temp_dir, "hashed_by_client.txt")
+    data = "Hello client" * 100
+    with open(path, "wb") as fd:
+      fd.write(data)
+    pathspec = rdf_paths.PathSpec(
+        pathtype=rdf_paths.PathSpec.PathType.OS, path=path)
+
+    args = transfer.MultiGetFileArgs(pathspecs=[pathspec])
+    not_rehashed = stats.STATS.GetMetricValue("filestore_files_not_rehashed")
+    for _ in test_lib.TestFlowHelper(
+        transfer.MultiGetFile.__name__,
+        client_mock,
+        token=self.token,
+        client_id=self.client_id,
+        args=args):
+      pass
+
+    fd = aff4.FACTORY.Open(pathspec.AFF4Path(self.client_id), token=self.token)
+    fd_hash = fd.Get(fd.Schema.HASH)
+    self.assertEqual(fd_hash.md5, hashlib.md5(data).digest())
+    self.assertEqual(fd_hash.sha1, hashlib.sha1(data).digest())
+    self.assertEqual(fd_hash.sha256, hashlib.sha256(data).digest())
+
+    # Adding the file to the file store did not read it again.
+    self.assertEqual(
+        stats.STATS.GetMetricValue("filestore_files_not_rehashed"),
+        not_rehashed + 1)
 
   def testMultiGetFileSetsFileHashAttributeWhenMultipleChunksDownloaded(self):
     client_mock = action_mocks.MultiGetFileClientMock()
@@ -37,7 +37,12 @@ class ServerCommunicator(communicator.Communicator):
     self.token = token
     super(ServerCommunicator, self).__init__(
         certificate=certificate, private_key=private_key)
-    self.pub_key_cache = utils.FastStore(max_size=50000)
+    self.pub_key_cache = utils.ShardedFastStore(max_size=50000)
+    # Verified client ciphers, clients reuse them for many polls so this saves
+    # most of the RSA operations.
+    self.encrypted_cipher_cache = utils.ShardedAgeBasedCache(
+        max_size=config.CONFIG["Frontend.cipher_cache_max_size"],
+        max_age=config.CONFIG["Frontend.cipher_cache_max_age"])
     # Our common name as an RDFURN.
     self.common_name = rdfvalue.RDFURN(self.certificate.GetCN())
 
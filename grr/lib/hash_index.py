@@ -0,0 +1,472 @@
+#!/usr/bin/env python
+"""Compact indexes to check large numbers of hashes for existence.
+
+A HashIndex keeps fixed size prefixes of hash digests in a sorted array which
+can live in a memory mapped file, new digests are kept in memory until there
+are enough of them to merge them into the array. A Bloom filter in front of
+both answers most lookups of unknown digests without searching the array.
+
+Index files have a header, the sorted keys and the bits of a Bloom filter
+holding all the keys:
+  MAGIC | prefix size | key count | filter capacity | filter size |
+  generation | keys | bits
+
+Every file is written with a new random generation, which its users can
+record elsewhere to tell whether a file is the one they expect.
+"""
+
+import heapq
+import math
+import mmap
+import os
+import struct
+import threading
+
+import logging
+
+
+class Error(Exception):
+  pass
+
+
+class IndexFileError(Error):
+  """Raised when an index file is corrupt or was written differently."""
+
+
+class BloomFilter(object):
+  """A Bloom filter for keys which are cryptographic hash digests.
+
+  The keys are already uniformly distributed so the NUM_HASHES bit positions
+  are taken from the first 16 bytes of the key instead of hashing it again.
+  """
+
+  NUM_HASHES = 4
+  POSITIONS = struct.Struct("<4I")
+
+  def __init__(self, capacity, error_rate=0.01, size=None, bits=None):
+    """Constructor.
+
+    Args:
+      capacity: The number of keys the filter is sized for. Adding more keys
+        than that raises the false positive rate.
+      error_rate: The false positive rate when the filter holds capacity keys.
+      size: The number of bits, computed from capacity and error_rate if not
+        given.
+      bits: A bytearray with the bits of an existing filter of this size.
+    """
+    self.capacity = max(capacity, 1)
+    if size is None:
+      # The optimal size for a fixed number of hash functions.
+      bits_per_key = -self.NUM_HASHES / math.log(
+          1 - error_rate**(1.0 / self.NUM_HASHES))
+      size = min(int(self.capacity * bits_per_key) + 1, 2**32)
+    self.size = size
+
+    if bits is None:
+      bits = bytearray((size + 7) // 8)
+    self.bits = bits
+
+  def _Positions(self, key):
+    if len(key) < 16:
+      key = key.ljust(16, "\x00")
+    size = self.size
+    return [value % size for value in self.POSITIONS.unpack_from(key)]
+
+  def Add(self, key):
+    bits = self.bits
+    for position in self._Positions(key):
+      bits[position >> 3] |= 1 << (position & 7)
+
+  def __contains__(self, key):
+    bits = self.bits
+    for position in self._Positions(key):
+      if not bits[position >> 3] & (1 << (position & 7)):
+        return False
+    return True
+
+
+class SortedPrefixArray(object):
+  """An immutable sorted array of fixed size keys.
+
+  The keys are stored back to back in a string or a memory mapped file. Since
+  they are hash digests they are uniformly distributed, so lookups interpolate
+  the position of a key from its value and only touch a few keys.
+
+  Every key can be followed by a fixed size payload, in which case the keys are
+  record_size bytes apart.
+  """
+
+  VALUE = struct.Struct(">Q")
+  MAX_INTERPOLATIONS = 8
+
+  def __init__(self,
+               data="",
+               prefix_size=16,
+               offset=0,
+               length=None,
+               record_size=None):
+    if prefix_size < self.VALUE.size:
+      raise ValueError("Keys need at least %d bytes." % self.VALUE.size)
+    if record_size is None:
+      record_size = prefix_size
+    if record_size < prefix_size:
+      raise ValueError("Records can not be shorter than their keys.")
+
+    self.data = data
+    self.prefix_size = prefix_size
+    self.record_size = record_size
+    self.offset = offset
+    if length is None:
+      if (len(data) - offset) % record_size:
+        raise IndexFileError("Array size is not a multiple of the record size.")
+      length = (len(data) - offset) // record_size
+    self.length = length
+
+  def Close(self):
+    if isinstance(self.data, mmap.mmap):
+      self.data.close()
+
+  def __len__(self):
+    return self.length
+
+  def __getitem__(self, index):
+    start = self.offset + index * self.record_size
+    return self.data[start:start + self.prefix_size]
+
+  def Payload(self, index):
+    """Returns the bytes stored after the key at index."""
+    start = self.offset + index * self.record_size
+    return self.data[start + self.prefix_size:start + self.record_size]
+
+  def __iter__(self):
+    for i in xrange(self.length):
+      yield self[i]
+
+  def _Value(self, index):
+    return self.VALUE.unpack_from(self.data,
+                                  self.offset + index * self.record_size)[0]
+
+  def Find(self, key, lo=0):
+    """Returns the index of the first key not less than key, starting at lo."""
+    hi = self.length
+    value = self.VALUE.unpack_from(key)[0]
+
+    # Keys in [lo, hi) have values in [low_value, high_value).
+    low_value = self._Value(lo - 1) if lo else 0
+    high_value = 2**64
+    for _ in xrange(self.MAX_INTERPOLATIONS):
+      if hi - lo <= 4:
+        break
+
+      mid = lo + (value - low_value) * (hi - lo) // (high_value - low_value)
+      mid = min(max(mid, lo), hi - 1)
+      mid_value = self._Value(mid)
+      if mid_value < value:
+        lo = mid + 1
+        low_value = mid_value
+      elif mid_value > value:
+        hi = mid
+        high_value = mid_value
+      else:
+        # The keys are unique, so everything before an equal key is smaller.
+        if self[mid] == key:
+          return mid
+        break
+
+    data = self.data
+    offset = self.offset
+    prefix_size = self.prefix_size
+    record_size = self.record_size
+    while lo < hi:
+      mid = (lo + hi) // 2
+      start = offset + mid * record_size
+      if data[start:start + prefix_size] < key:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def __contains__(self, key):
+    index = self.Find(key)
+    return index < self.length and self[index] == key
+
+  def Merge(self, keys):
+    """Yields the keys of this array and the sorted keys, without duplicates."""
+    previous = None
+    for key in heapq.merge(iter(self), keys):
+      if key != previous:
+        yield key
+        previous = key
+
+
+MAGIC = "GRRHIDX2"
+GENERATION_SIZE = 16
+HEADER = struct.Struct("<8sIQQQ%ds" % GENERATION_SIZE)
+
+
+def NewGeneration():
+  return os.urandom(GENERATION_SIZE // 2).encode("hex")
+
+
+def WriteIndexFile(path,
+                   keys,
+                   prefix_size,
+                   capacity,
+                   error_rate=0.01,
+                   generation=""):
+  """Writes sorted, unique keys and a Bloom filter holding them to a file.
+
+  The file is written next to its final location and then renamed, so readers
+  never see a partially written index.
+
+  Args:
+    path: The index file to write.
+    keys: An iterable of sorted, unique keys of prefix_size bytes.
+    prefix_size: The size of the keys.
+    capacity: The Bloom filter capacity, at least the number of keys.
+    error_rate: The Bloom filter false positive rate at capacity.
+    generation: Identifies this version of the file, at most GENERATION_SIZE
+      characters.
+
+  Returns:
+    The number of keys written.
+  """
+  bloom_filter = BloomFilter(capacity, error_rate=error_rate)
+  tmp_path = "%s.%d.tmp" % (path, os.getpid())
+  count = 0
+  with open(tmp_path, "wb") as fd:
+    fd.seek(HEADER.size)
+    for key in keys:
+      fd.write(key)
+      bloom_filter.Add(key)
+      count += 1
+    fd.write(bloom_filter.bits)
+
+    fd.seek(0)
+    fd.write(
+        HEADER.pack(MAGIC, prefix_size, count, bloom_filter.capacity,
+                    bloom_filter.size, generation))
+  os.rename(tmp_path, path)
+  return count
+
+
+def ReadIndexFile(path, prefix_size):
+  """Maps an index file into memory.
+
+  Args:
+    path: An index file written by WriteIndexFile.
+    prefix_size: The expected size of the keys.
+
+  Returns:
+    A (SortedPrefixArray, BloomFilter, generation) tuple.
+
+  Raises:
+    IndexFileError: If the file is not an index file with keys of prefix_size
+    bytes.
+  """
+  with open(path, "rb") as fd:
+    header = fd.read(HEADER.size)
+    if len(header) != HEADER.size:
+      raise IndexFileError("Index file %s is truncated." % path)
+
+    (magic, file_prefix_size, count, capacity, size,
+     generation) = HEADER.unpack(header)
+    if magic != MAGIC:
+      raise IndexFileError("%s is not an index file." % path)
+    if file_prefix_size != prefix_size:
+      raise IndexFileError("Index file %s has %d byte prefixes, expected %d." %
+                           (path, file_prefix_size, prefix_size))
+
+    bits_offset = HEADER.size + count * prefix_size
+    bits_size = (size + 7) // 8
+    if os.fstat(fd.fileno()).st_size != bits_offset + bits_size:
+      raise IndexFileError("Index file %s has the wrong size." % path)
+
+    # The mapping stays valid when the file is closed or replaced.
+    data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+  array = SortedPrefixArray(
+      data, prefix_size=prefix_size, offset=HEADER.size, length=count)
+  bloom_filter = BloomFilter(
+      capacity,
+      size=size,
+      bits=bytearray(data[bits_offset:bits_offset + bits_size]))
+  return array, bloom_filter, generation.rstrip("\x00")
+
+
+class HashIndex(object):
+  """An index of hash digests which answers bulk membership queries.
+
+  Only the first prefix_size bytes of every digest are stored, so with the
+  default 16 byte prefixes a digest which was never added is reported as
+  present with a probability of about n / 2^128.
+
+  New digests are collected in memory and merged into the sorted array once
+  there are more than max_pending of them and more than an eighth of the
+  array, so the cost of merging per added digest does not grow with the index.
+  When the index has a path the array is written to that file, which is picked
+  up again when the index is recreated. Several processes can use the same
+  file, the last one to merge wins, so the index is a cache and must never be
+  the only record of a digest.
+
+  Whoever keeps the digests elsewhere can tie the file to that record: every
+  merge writes the file with a new generation and passes it to
+  compact_callback, and a file which does not have the expected generation is
+  deleted instead of being used.
+
+  This class is thread safe.
+  """
+
+  def __init__(self,
+               path=None,
+               prefix_size=16,
+               max_pending=100000,
+               error_rate=0.01,
+               generation=None,
+               compact_callback=None):
+    """Constructor.
+
+    Args:
+      path: The index file, if the index should outlive the process.
+      prefix_size: The number of bytes of every digest which are kept.
+      max_pending: The minimum number of digests kept in memory before they
+        are merged into the sorted array.
+      error_rate: The false positive rate of the Bloom filter.
+      generation: If not None, an existing index file is only used if it was
+        written with this generation.
+      compact_callback: Called with the generation of the index file every
+        time the file is written.
+    """
+    self.path = path
+    self.prefix_size = prefix_size
+    self.max_pending = max_pending
+    self.error_rate = error_rate
+    self.compact_callback = compact_callback
+    self.lock = threading.RLock()
+    self.pending = set()
+
+    self.array = None
+    if path and os.path.exists(path):
+      self.array, self.bloom_filter, file_generation = ReadIndexFile(
+          path, prefix_size)
+      if generation is not None and file_generation != generation:
+        logging.warning(
+            "Hash index %s was written for generation %r, expected %r. "
+            "Starting with an empty index.", path, file_generation, generation)
+        self.array.Close()
+        self.array = None
+        try:
+          os.remove(path)
+        except OSError:
+          pass
+
+    if self.array is None:
+      self.array = SortedPrefixArray(prefix_size=prefix_size)
+      self.bloom_filter = BloomFilter(
+          self._MaxPending(), error_rate=error_rate)
+
+  def _MaxPending(self):
+    return max(self.max_pending, len(self.array) // 8)
+
+  def __len__(self):
+    with self.lock:
+      return len(self.array) + len(self.pending)
+
+  def Add(self, digest):
+    self.AddMany([digest])
+
+  def AddMany(self, digests):
+    """Adds digests to the index."""
+    with self.lock:
+      for digest in digests:
+        key = digest[:self.prefix_size]
+        if key in self.bloom_filter and (key in self.pending or
+                                         key in self.array):
+          continue
+
+        self.pending.add(key)
+        self.bloom_filter.Add(key)
+
+      if len(self.pending) > self._MaxPending():
+        self.Compact()
+
+  def Compact(self):
+    """Merges the digests kept in memory into the sorted array."""
+    with self.lock:
+      if not self.pending:
+        return
+
+      keys = self.array.Merge(sorted(self.pending))
+      count = len(self.array) + len(self.pending)
+      # Leave room for the digests added until the next merge.
+      capacity = count + max(self.max_pending, count // 8)
+
+      if self.path:
+        WriteIndexFile(
+            self.path,
+            keys,
+            self.prefix_size,
+            capacity,
+            error_rate=self.error_rate,
+            generation=NewGeneration())
+        array, bloom_filter, generation = ReadIndexFile(
+            self.path, self.prefix_size)
+      else:
+        bloom_filter = BloomFilter(capacity, error_rate=self.error_rate)
+        data = []
+        for key in keys:
+          data.append(key)
+          bloom_filter.Add(key)
+        array = SortedPrefixArray("".join(data), prefix_size=self.prefix_size)
+
+      self.array.Close()
+      self.array = array
+      self.bloom_filter = bloom_filter
+      self.pending = set()
+
+      if self.path and self.compact_callback:
+        self.compact_callback(generation)
+
+  def __contains__(self, digest):
+    return bool(self.CheckDigests([digest]))
+
+  def CheckDigests(self, digests):
+    """Checks many digests for presence in the index.
+
+    The digests are looked up in sorted order so every search in the array
+    starts where the previous one ended.
+
+    Args:
+      digests: An iterable of digests.
+
+    Returns:
+      The set of digests which are in the index.
+    """
+    found = set()
+    with self.lock:
+      bloom_filter = self.bloom_filter
+      candidates = []
+      for digest in set(digests):
+        key = digest[:self.prefix_size]
+        if key not in bloom_filter:
+          continue
+        if key in self.pending:
+          found.add(digest)
+        else:
+          candidates.append((key, digest))
+
+      candidates.sort()
+      array = self.array
+      lo = 0
+      for key, digest in candidates:
+        lo = array.Find(key, lo)
+        if lo == len(array):
+          break
+        if array[lo] == key:
+          found.add(digest)
+
+    return found
+
+  def Close(self):
+    with self.lock:
+      self.array.Close()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""Benchmark for bulk hash lookups in the hash index."""
+
+
+import hashlib
+import os
+import time
+
+
+from grr.lib import flags
+from grr.lib import hash_index
+from grr.lib import test_lib
+
+
+class HashIndexBenchmark(test_lib.MicroBenchmarks):
+  """Checks batches of hashes against an index of DIGESTS digests.
+
+  Half of every batch is in the index, like the hashes of common files a hunt
+  collects from many clients.
+  """
+
+  labels = ["benchmark"]
+  units = "s"
+
+  DIGESTS = 1000000
+  BATCH_SIZE = 100000
+
+  def setUp(self):
+    super(HashIndexBenchmark, self).setUp(["Value"], ["<20"])
+
+  def _Digest(self, number):
+    return hashlib.sha256(str(number)).digest()
+
+  def testCheckDigests(self):
+    """Lookups of BATCH_SIZE hashes at a time."""
+    path = os.path.join(self.temp_dir, "hash_index")
+    index = hash_index.HashIndex(path=path, max_pending=self.BATCH_SIZE)
+
+    start_time = time.time()
+    for start in xrange(0, self.DIGESTS, self.BATCH_SIZE):
+      index.AddMany(
+          self._Digest(i) for i in xrange(start, start + self.BATCH_SIZE))
+    self.AddResult("AddMany", time.time() - start_time, self.DIGESTS, "")
+
+    start_time = time.time()
+    index = hash_index.HashIndex(path=path, max_pending=self.BATCH_SIZE)
+    self.AddResult("Open", time.time() - start_time, 1, "")
+
+    first = self.DIGESTS - self.BATCH_SIZE / 2
+    batch = [self._Digest(first + i) for i in xrange(self.BATCH_SIZE)]
+    start_time = time.time()
+    found = index.CheckDigests(batch)
+    elapsed_time = time.time() - start_time
+    self.assertEqual(len(found), self.BATCH_SIZE / 2)
+    self.AddResult("CheckDigests", elapsed_time, self.BATCH_SIZE,
+                   "%d/s" % (self.BATCH_SIZE / elapsed_time))
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
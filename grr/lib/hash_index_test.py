@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+"""Tests for grr.lib.hash_index."""
+
+
+import hashlib
+import os
+
+
+from grr.lib import flags
+from grr.lib import hash_index
+from grr.lib import test_lib
+
+
+def Digest(number):
+  return hashlib.sha256(str(number)).digest()
+
+
+class BloomFilterTest(test_lib.GRRBaseTest):
+
+  def testAddedKeysArePresent(self):
+    bloom_filter = hash_index.BloomFilter(1000)
+    for i in xrange(1000):
+      bloom_filter.Add(Digest(i))
+
+    for i in xrange(1000):
+      self.assertIn(Digest(i), bloom_filter)
+
+  def testFalsePositiveRate(self):
+    bloom_filter = hash_index.BloomFilter(1000, error_rate=0.01)
+    for i in xrange(1000):
+      bloom_filter.Add(Digest(i))
+
+    false_positives = sum(
+        Digest(i) in bloom_filter for i in xrange(1000, 11000))
+    self.assertLess(false_positives, 200)
+
+
+class SortedPrefixArrayTest(test_lib.GRRBaseTest):
+
+  def testFind(self):
+    keys = [Digest(i) for i in xrange(1000)]
+    keys.sort()
+    array = hash_index.SortedPrefixArray("".join(keys), prefix_size=32)
+    self.assertEqual(len(array), 1000)
+    self.assertEqual(list(array), keys)
+
+    for i, key in enumerate(keys):
+      self.assertEqual(array.Find(key), i)
+      self.assertEqual(array.Find(key, lo=i), i)
+      self.assertIn(key, array)
+
+    self.assertEqual(array.Find("\x00" * 32), 0)
+    self.assertEqual(array.Find("\xff" * 32), 1000)
+    self.assertNotIn(Digest(1000), array)
+
+  def testFindWithEqualValues(self):
+    # Keys which only differ after the bytes used to interpolate.
+    keys = ["a" * 8 + "%08d" % i for i in xrange(100)]
+    array = hash_index.SortedPrefixArray("".join(keys), prefix_size=16)
+    for i, key in enumerate(keys):
+      self.assertEqual(array.Find(key), i)
+    self.assertEqual(array.Find("a" * 16), 100)
+
+  def testRecordsWithPayloads(self):
+    keys = sorted(Digest(i)[:16] for i in xrange(100))
+    array = hash_index.SortedPrefixArray(
+        "".join(key + "%04d" % i for i, key in enumerate(keys)),
+        prefix_size=16,
+        record_size=20)
+    self.assertEqual(len(array), 100)
+    self.assertEqual(list(array), keys)
+    for i, key in enumerate(keys):
+      self.assertEqual(array.Find(key), i)
+      self.assertEqual(array.Payload(i), "%04d" % i)
+
+  def testMerge(self):
+    array = hash_index.SortedPrefixArray("bbbbbbbbdddddddd", prefix_size=8)
+    self.assertEqual(
+        list(array.Merge(["aaaaaaaa", "bbbbbbbb", "cccccccc"])),
+        ["aaaaaaaa", "bbbbbbbb", "cccccccc", "dddddddd"])
+
+
+class IndexFileTest(test_lib.GRRBaseTest):
+
+  def testWriteAndReadIndexFile(self):
+    path = os.path.join(self.temp_dir, "index")
+    keys = sorted(Digest(i)[:16] for i in xrange(100))
+    self.assertEqual(hash_index.WriteIndexFile(path, keys, 16, 100), 100)
+
+    array, bloom_filter, _ = hash_index.ReadIndexFile(path, 16)
+    self.assertEqual(list(array), keys)
+    for key in keys:
+      self.assertIn(key, bloom_filter)
+    array.Close()
+
+    hash_index.WriteIndexFile(path, [], 16, 100, generation="abc")
+    array, _, generation = hash_index.ReadIndexFile(path, 16)
+    self.assertEqual(len(array), 0)
+    self.assertEqual(generation, "abc")
+
+  def testReadIndexFileRaisesOnBadFiles(self):
+    path = os.path.join(self.temp_dir, "index")
+    hash_index.WriteIndexFile(path, [Digest(0)[:16]], 16, 10)
+    with self.assertRaises(hash_index.IndexFileError):
+      hash_index.ReadIndexFile(path, 20)
+
+    with open(path, "ab") as fd:
+      fd.write("x")
+    with self.assertRaises(hash_index.IndexFileError):
+      hash_index.ReadIndexFile(path, 16)
+
+    with open(path, "wb") as fd:
+      fd.write("not an index file, but long enough for a header")
+    with self.assertRaises(hash_index.IndexFileError):
+      hash_index.ReadIndexFile(path, 16)
+
+
+class HashIndexTest(test_lib.GRRBaseTest):
+
+  def testCheckDigests(self):
+    index = hash_index.HashIndex(max_pending=10)
+    index.AddMany(Digest(i) for i in xrange(0, 100, 2))
+    # The digests were merged into the sorted array.
+    self.assertEqual(len(index.pending), 0)
+    self.assertEqual(len(index), 50)
+
+    index.Add(Digest(1))
+    self.assertEqual(len(index.pending), 1)
+
+    found = index.CheckDigests(Digest(i) for i in xrange(100))
+    self.assertEqual(found, set(Digest(i) for i in range(0, 100, 2) + [1]))
+    self.assertIn(Digest(4), index)
+    self.assertNotIn(Digest(5), index)
+
+  def testAddingDigestsTwiceDoesNotGrowTheIndex(self):
+    index = hash_index.HashIndex(max_pending=10)
+    for _ in xrange(3):
+      index.AddMany(Digest(i) for i in xrange(25))
+    self.assertEqual(len(index), 25)
+
+    index.Compact()
+    self.assertEqual(len(index), 25)
+    self.assertEqual(len(index.array), 25)
+
+  def testIndexIsKeptInFile(self):
+    path = os.path.join(self.temp_dir, "hash_index")
+    index = hash_index.HashIndex(path=path, max_pending=10)
+    index.AddMany(Digest(i) for i in xrange(15))
+    index.Compact()
+    index.Close()
+
+    index = hash_index.HashIndex(path=path, max_pending=10)
+    self.assertEqual(len(index), 15)
+    self.assertEqual(
+        index.CheckDigests(Digest(i) for i in xrange(30)),
+        set(Digest(i) for i in xrange(15)))
+
+    # Digests which were not merged yet are not in the file.
+    index.Add(Digest(15))
+    index = hash_index.HashIndex(path=path, max_pending=10)
+    self.assertNotIn(Digest(15), index)
+
+  def testIndexFileOfAnotherGenerationIsDropped(self):
+    path = os.path.join(self.temp_dir, "hash_index")
+    generations = []
+    index = hash_index.HashIndex(
+        path=path, max_pending=10, compact_callback=generations.append)
+    index.AddMany(Digest(i) for i in xrange(15))
+    index.Compact()
+    index.Close()
+    self.assertEqual(len(generations), 1)
+
+    index = hash_index.HashIndex(
+        path=path, max_pending=10, generation=generations[0])
+    self.assertEqual(len(index), 15)
+    index.Close()
+
+    index = hash_index.HashIndex(
+        path=path, max_pending=10, generation="other")
+    self.assertEqual(len(index), 0)
+    self.assertFalse(os.path.exists(path))
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -409,6 +409,36 @@ class HuntTest(test_lib.FlowTestsBaseclass):
       # before.
       self.assertEqual(num_tasks, 0)
 
+  def testForemanPicksUpChangedRules(self):
+    """Checks that rules added after the foreman compiled its rules are used."""
+    client_rule_set = rdf_foreman.ForemanClientRuleSet(rules=[
+        rdf_foreman.ForemanClientRule(
+            rule_type=rdf_foreman.ForemanClientRule.Type.REGEX,
+            regex=rdf_foreman.ForemanRegexClientRule(
+                attribute_name="GRR client", attribute_regex="GRR"))
+    ])
+
+    hunt_ids = []
+    with utils.Stubber(standard.SampleHunt, "StartClients", self.Callback):
+      self.called = []
+
+      for _ in range(2):
+        with implementation.GRRHunt.StartHunt(
+            hunt_name=standard.SampleHunt.__name__,
+            client_rule_set=client_rule_set,
+            client_rate=0,
+            token=self.token) as hunt:
+          hunt.GetRunner().Start()
+          hunt_ids.append(hunt.urn)
+
+        foreman = aff4.FACTORY.Open(
+            "aff4:/foreman", mode="rw", token=self.token)
+        self.assertEqual(foreman.AssignTasksToClient(self.client_id), 1)
+        # The rules did not change, nothing new is assigned.
+        self.assertEqual(foreman.AssignTasksToClient(self.client_id), 0)
+
+    self.assertEqual([hunt_id for hunt_id, _ in self.called], hunt_ids)
+
   def testClientLimit(self):
     """This tests that we can limit hunts to a number of clients."""
 
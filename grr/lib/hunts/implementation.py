@@ -6,6 +6,7 @@ of clients, managing these flows, collecting and presenting the combined results
 of all these flows.
 """
 
+import operator
 import threading
 import traceback
 
@@ -41,6 +42,10 @@ class HuntRunnerError(Exception):
   """Raised when there is an error during state transitions."""
 
 
+class HuntSummaryIndexIncompleteError(Exception):
+  """Raised when hunts written by older versions are not indexed yet."""
+
+
 class HuntResultsMetadata(aff4.AFF4Object):
   """Metadata AFF4 object used by CronHuntOutputFlow."""
 
@@ -67,6 +72,210 @@ class HuntResultsMetadata(aff4.AFF4Object):
         versioned=False)
 
 
+class HuntSummaryIndex(object):
+  """An index of the summaries of all hunts.
+
+  The summaries are kept as attributes of aff4:/hunts, so hunts can be listed
+  with a single data store query instead of opening every hunt. Every summary
+  is stored with the creation time of its hunt as timestamp, so hunts can be
+  sorted and filtered by age without parsing the summaries.
+
+  All summaries live on the same row, so a summary is only rewritten when
+  something shown in the listing changed: any of its fields, or one of its
+  counters by more than COUNTER_CHANGE_RATIO.
+
+  Every hunt also has a small marker with the same timestamp, so a page of
+  hunts is found without reading all the summaries. Hunts created by older
+  versions are added by the UpdateHuntSummaryIndexCronFlow, which sets
+  COMPLETE_ATTRIBUTE once they all are.
+  """
+
+  HUNTS_URN = rdfvalue.RDFURN("aff4:/hunts")
+  PREFIX = "index:hunt_summary:"
+  CREATED_PREFIX = "index:hunt_created:"
+  COMPLETE_ATTRIBUTE = "index:hunt_summary_complete"
+
+  # Upper bound for the creation times of hunts read by ReadAll.
+  MAX_TIMESTAMP = (2**63) - 1
+
+  COUNTERS = ["client_count", "results_count", "total_cpu_usage",
+              "total_net_usage"]
+  COUNTER_CHANGE_RATIO = 0.1
+
+  def __init__(self, token=None):
+    self.token = token
+
+  def IsOutdated(self, written, current):
+    """Checks if the written summary of a hunt needs to be replaced.
+
+    Args:
+      written: The HuntSummary last written to the index or None.
+      current: The current HuntSummary of the hunt.
+
+    Returns:
+      True if the current summary should be written to the index.
+    """
+    if written is None:
+      return True
+
+    for counter in self.COUNTERS:
+      old_value = getattr(written, counter)
+      if abs(getattr(current, counter) - old_value) > (
+          old_value * self.COUNTER_CHANGE_RATIO):
+        return True
+
+    # Counters which changed less than the ratio are ignored.
+    written = written.Copy()
+    current = current.Copy()
+    for summary in written, current:
+      for counter in self.COUNTERS:
+        setattr(summary, counter, 0)
+    return written != current
+
+  def Write(self, summary):
+    hunt_id = summary.session_id.Basename()
+    data_store.DB.MultiSet(
+        self.HUNTS_URN, {
+            self.PREFIX + hunt_id: [summary],
+            self.CREATED_PREFIX + hunt_id: ["1"]
+        },
+        timestamp=summary.create_time.AsMicroSecondsFromEpoch(),
+        token=self.token,
+        sync=False)
+
+  def Delete(self, hunt_urn):
+    hunt_id = rdfvalue.RDFURN(hunt_urn).Basename()
+    data_store.DB.DeleteAttributes(
+        self.HUNTS_URN, [self.PREFIX + hunt_id, self.CREATED_PREFIX + hunt_id],
+        token=self.token,
+        sync=False)
+
+  def Read(self, hunt_urn):
+    """Returns the HuntSummary of a hunt or None if it is not in the index."""
+    value, _ = data_store.DB.Resolve(
+        self.HUNTS_URN,
+        self.PREFIX + rdfvalue.RDFURN(hunt_urn).Basename(),
+        token=self.token)
+    if value is None:
+      return None
+    return rdf_hunts.HuntSummary.FromSerializedString(value)
+
+  def ListHunts(self):
+    """Lists the ids of all hunts in the index, newest first.
+
+    Returns:
+      A list of (hunt id, creation time in microseconds) tuples.
+    """
+    entries = [(attribute[len(self.CREATED_PREFIX):], timestamp)
+               for attribute, _, timestamp in data_store.DB.ResolvePrefix(
+                   self.HUNTS_URN, self.CREATED_PREFIX, token=self.token)]
+    entries.sort(key=operator.itemgetter(1), reverse=True)
+    return entries
+
+  def ReadSummaries(self, entries):
+    """Reads the summaries of some of the hunts listed by ListHunts.
+
+    Args:
+      entries: (hunt id, creation time) tuples.
+
+    Returns:
+      A list of (hunt id, creation time in microseconds, serialized
+      HuntSummary) tuples in the same order. Hunts without a summary are
+      skipped.
+    """
+    values = dict((attribute[len(self.PREFIX):], value)
+                  for attribute, value, _ in data_store.DB.ResolveMulti(
+                      self.HUNTS_URN,
+                      [self.PREFIX + hunt_id for hunt_id, _ in entries],
+                      token=self.token))
+    return [(hunt_id, create_time, values[hunt_id])
+            for hunt_id, create_time in entries if hunt_id in values]
+
+  def ReadAll(self, min_create_time=0):
+    """Reads the summaries of the hunts created after a time, newest first.
+
+    Args:
+      min_create_time: Only hunts created after this time in microseconds are
+          read.
+
+    Returns:
+      A list of (hunt id, creation time in microseconds, serialized
+      HuntSummary) tuples.
+    """
+    entries = []
+    for attribute, value, timestamp in data_store.DB.ResolvePrefix(
+        self.HUNTS_URN,
+        self.PREFIX,
+        timestamp=(min_create_time + 1, self.MAX_TIMESTAMP),
+        token=self.token):
+      entries.append((attribute[len(self.PREFIX):], timestamp, value))
+
+    entries.sort(key=operator.itemgetter(1), reverse=True)
+    return entries
+
+  def IsComplete(self):
+    value, _ = data_store.DB.Resolve(
+        self.HUNTS_URN, self.COMPLETE_ATTRIBUTE, token=self.token)
+    return value is not None
+
+  def MarkComplete(self):
+    data_store.DB.Set(
+        self.HUNTS_URN, self.COMPLETE_ATTRIBUTE, "1", token=self.token)
+
+  def ListUnindexedHunts(self):
+    """Returns the urns of the hunts which are not in the index."""
+    indexed = set(hunt_id for hunt_id, _ in self.ListHunts())
+    return [
+        urn
+        for urn in aff4.FACTORY.ListChildren(self.HUNTS_URN, token=self.token)
+        if urn.Basename() not in indexed
+    ]
+
+  def AddUnindexedHunts(self, heartbeat=None):
+    """Adds the hunts written by older GRR versions to the index.
+
+    Args:
+      heartbeat: Called after each batch of hunts, if given.
+
+    Returns:
+      The number of hunts which were added.
+    """
+    unindexed = self.ListUnindexedHunts()
+    added = 0
+    for batch in utils.Grouper(unindexed, 1000):
+      for hunt in aff4.FACTORY.MultiOpen(batch, token=self.token):
+        # Legacy hunts may have hunt.context == None: we just want to skip
+        # them.
+        if not isinstance(hunt, GRRHunt) or not hunt.context:
+          continue
+
+        self.Write(hunt.GetSummary())
+        added += 1
+
+      data_store.DB.Flush()
+      if heartbeat:
+        heartbeat()
+
+    self.MarkComplete()
+    return added
+
+  def CheckComplete(self):
+    """Raises if there are hunts which are not in the index yet.
+
+    Raises:
+      HuntSummaryIndexIncompleteError: If some hunts are not indexed.
+    """
+    if self.IsComplete():
+      return
+
+    unindexed = self.ListUnindexedHunts()
+    if unindexed:
+      raise HuntSummaryIndexIncompleteError(
+          "%d hunts are not in the hunt index yet. They are added by the "
+          "UpdateHuntSummaryIndexCronFlow cron job, or by running "
+          "\"config_updater update_hunt_summary_index\"." % len(unindexed))
+
+
 class HuntRunner(object):
   """The runner for hunts.
 
@@ -896,6 +1105,13 @@ class GRRHunt(flow.FlowBase):
         creates_new_object_version=False,
         default="PAUSED")
 
+    HUNT_SUMMARY = aff4.Attribute(
+        "aff4:hunt_summary",
+        rdf_hunts.HuntSummary,
+        "The summary last written to the hunts index.",
+        versioned=False,
+        creates_new_object_version=False)
+
   args_type = None
 
   def Initialize(self):
@@ -1103,6 +1319,8 @@ class GRRHunt(flow.FlowBase):
   def OnDelete(self, deletion_pool=None):
     super(GRRHunt, self).OnDelete(deletion_pool=deletion_pool)
 
+    HuntSummaryIndex(token=self.token).Delete(self.urn)
+
     # Delete all the symlinks in the clients namespace that point to the flows
     # initiated by this hunt.
     children_urns = deletion_pool.ListChildren(self.urn)
@@ -1258,16 +1476,26 @@ class GRRHunt(flow.FlowBase):
             for response in responses
         ]
 
-        for msg in msgs:
-          hunts_results.HuntResultCollection.StaticAdd(
-              self.results_collection_urn, self.token, msg)
-
-        for msg in msgs:
-          multi_type_collection.MultiTypeCollection.StaticAdd(
-              self.multi_type_output_urn, self.token, msg)
+        # Using a pool indexes the results once per collection, instead of
+        # once per result.
+        with data_store.DB.GetMutationPool(token=self.token) as pool:
+          for msg in msgs:
+            hunts_results.HuntResultCollection.StaticAdd(
+                self.results_collection_urn,
+                self.token,
+                msg,
+                mutation_pool=pool)
+
+          for msg in msgs:
+            multi_type_collection.MultiTypeCollection.StaticAdd(
+                self.multi_type_output_urn,
+                self.token,
+                msg,
+                mutation_pool=pool)
 
         if responses:
           self.RegisterClientWithResults(client_id)
+        self.context.results_count += len(msgs)
 
         # Update stats.
         stats.STATS.IncrementCounter("hunt_results_added", delta=len(msgs))
@@ -1505,12 +1733,54 @@ class GRRHunt(flow.FlowBase):
     if self.context is None:
       raise IOError("Trying to write a hunt without context: %s." % self.urn)
 
+  def GetSummary(self):
+    """Returns what is shown about this hunt in hunt listings."""
+    # New hunts are not opened for reading, they have no clients yet.
+    client_count = 0
+    if "r" in self.mode:
+      client_count = int(self.Get(self.Schema.CLIENT_COUNT, 0))
+
+    summary = rdf_hunts.HuntSummary(
+        session_id=self.urn,
+        hunt_name=self.runner_args.hunt_name,
+        state=str(self.Get(self.Schema.STATE)),
+        creator=self.context.creator,
+        description=self.runner_args.description,
+        create_time=self.context.create_time,
+        expires=self.context.expires,
+        crash_limit=self.runner_args.crash_limit,
+        client_limit=self.runner_args.client_limit,
+        client_count=client_count,
+        results_count=self.context.results_count)
+
+    # Fields which are not set on the hunt are left unset, so they have the
+    # same defaults when the hunt is shown from its summary.
+    if self.runner_args.HasField("client_rate"):
+      summary.client_rate = self.runner_args.client_rate
+    usage_stats = self.context.usage_stats
+    if usage_stats.user_cpu_stats.HasField("sum"):
+      summary.total_cpu_usage = usage_stats.user_cpu_stats.sum
+    if usage_stats.network_bytes_sent_stats.HasField("sum"):
+      summary.total_net_usage = usage_stats.network_bytes_sent_stats.sum
+
+    return summary
+
   def WriteState(self):
     if "w" in self.mode:
       self._ValidateState()
       self.Set(self.Schema.HUNT_ARGS(self.args))
       self.Set(self.Schema.HUNT_CONTEXT(self.context))
       self.Set(self.Schema.HUNT_RUNNER_ARGS(self.runner_args))
+      # Every change of the hunt is written through here, so this keeps the
+      # summary in the hunts index up to date.
+      summary = self.GetSummary()
+      written = None
+      if "r" in self.mode:
+        written = self.Get(self.Schema.HUNT_SUMMARY)
+      index = HuntSummaryIndex(token=self.token)
+      if index.IsOutdated(written, summary):
+        index.Write(summary)
+        self.Set(self.Schema.HUNT_SUMMARY(summary))
 
 
 class HuntInitHook(registry.InitHook):
@@ -9,6 +9,7 @@ from grr.lib import flow
 from grr.lib import output_plugin
 from grr.lib import rdfvalue
 from grr.lib import stats
+from grr.lib import threadpool
 from grr.lib import utils
 
 from grr.lib.aff4_objects import cronjobs
@@ -52,6 +53,14 @@ class ProcessHuntResultCollectionsCronFlow(cronjobs.SystemCronFlow):
 
   The ProcessHuntResultCollectionsCronFlow reads hunt results stored in
   HuntResultCollections and feeds runs output plugins on them.
+
+  Results are processed in work units of one batch of a single hunt. Every
+  round claims work units for up to MAX_PARALLEL_HUNTS hunts that were not
+  served yet in the current cycle and processes them in parallel, so a hunt
+  with a burst of results gets one batch per cycle like every other hunt. After
+  each batch the plugin states and the number of processed results are written
+  before the batch's notifications are deleted, so an interrupted run resumes
+  from the last processed batch.
   """
 
   frequency = rdfvalue.Duration("5m")
@@ -61,6 +70,11 @@ class ProcessHuntResultCollectionsCronFlow(cronjobs.SystemCronFlow):
   args_type = ProcessHuntResultCollectionsCronFlowArgs
 
   DEFAULT_BATCH_SIZE = 5000
+  MAX_PARALLEL_HUNTS = 4
+  # How far to look past the notifications of hunts that were already served
+  # for the results of other hunts.
+  MAX_SCANNED_NOTIFICATIONS = 100000
+  THREAD_POOL_NAME = "HuntResultsProcessing"
 
   def CheckIfRunningTooLong(self):
     if self.args.max_running_time:
@@ -104,8 +118,6 @@ class ProcessHuntResultCollectionsCronFlow(cronjobs.SystemCronFlow):
       except Exception as e:  # pylint: disable=broad-except
         logging.exception("Error processing hunt results: hunt %s, "
                           "plugin %s", hunt_urn, utils.SmartStr(plugin))
-        self.Log("Error processing hunt results (hunt %s, "
-                 "plugin %s): %s" % (hunt_urn, utils.SmartStr(plugin), e))
         stats.STATS.IncrementCounter(
             "hunt_output_plugin_errors", fields=[plugin_def.plugin_name])
 
@@ -122,64 +134,116 @@ class ProcessHuntResultCollectionsCronFlow(cronjobs.SystemCronFlow):
         implementation.GRRHunt.PluginErrorCollectionForHID(
             hunt_urn, token=self.token).Add(plugin_status)
 
-  def ProcessOneHunt(self, exceptions_by_hunt):
-    """Reads results for one hunt and process them."""
-    hunt_results_urn, results = (
-        hunts_results.HuntResultQueue.ClaimNotificationsForCollection(
-            start_time=self.args.start_processing_time,
-            token=self.token,
-            lease_time=self.lifetime))
-    logging.debug("Found %d results for hunt %s", len(results),
-                  hunt_results_urn)
-    if not results:
-      return 0
+  def ClaimWorkUnits(self, served_collections):
+    """Claims one batch of results for each of several hunts.
 
-    hunt_urn = rdfvalue.RDFURN(hunt_results_urn.Dirname())
+    Args:
+      served_collections: Result collections that already got a batch in the
+        current cycle, they are skipped.
+
+    Returns:
+      A list of (hunt results urn, notifications) pairs, one for every hunt.
+    """
     batch_size = self.args.batch_size or self.DEFAULT_BATCH_SIZE
+    excluded_collections = set(served_collections)
+    work_units = []
+    while len(work_units) < self.MAX_PARALLEL_HUNTS:
+      hunt_results_urn, results = (
+          hunts_results.HuntResultQueue.ClaimNotificationsForCollection(
+              start_time=self.args.start_processing_time,
+              token=self.token,
+              lease_time=self.lifetime,
+              excluded_collections=excluded_collections,
+              limit=batch_size,
+              max_filtered=0,
+              max_scanned=self.MAX_SCANNED_NOTIFICATIONS))
+      if not results:
+        break
+
+      logging.debug("Found %d results for hunt %s", len(results),
+                    hunt_results_urn)
+      work_units.append((hunt_results_urn, results))
+      excluded_collections.add(hunt_results_urn)
+
+    return work_units
+
+  def ProcessWorkUnit(self, work_unit, errors):
+    """Runs the output plugins of a hunt on one batch of its results.
+
+    This is called from the thread pool, errors are collected in the errors list
+    as (hunt urn, plugin descriptor, exception) tuples.
+
+    Args:
+      work_unit: A (hunt results urn, notifications) pair.
+      errors: A list to append plugin errors to.
+    """
+    hunt_results_urn, results = work_unit
+    hunt_urn = rdfvalue.RDFURN(hunt_results_urn.Dirname())
     metadata_urn = hunt_urn.Add("ResultsMetadata")
-    exceptions_by_plugin = {}
-    num_processed_for_hunt = 0
     collection_obj = implementation.GRRHunt.ResultCollectionForHID(
         hunt_urn, token=self.token)
+    exceptions_by_plugin = {}
     try:
       with aff4.FACTORY.OpenWithLock(
           metadata_urn, lease_time=600, token=self.token) as metadata_obj:
         all_plugins, used_plugins = self.LoadPlugins(metadata_obj)
         num_processed = int(
             metadata_obj.Get(metadata_obj.Schema.NUM_PROCESSED_RESULTS))
-        for batch in utils.Grouper(results, batch_size):
-          results = list(
-              collection_obj.MultiResolve([(ts, suffix)
-                                           for (_, ts, suffix) in batch]))
-          self.RunPlugins(hunt_urn, used_plugins, results, exceptions_by_plugin)
-
-          hunts_results.HuntResultQueue.DeleteNotifications(
-              [record_id for (record_id, _, _) in batch], token=self.token)
-          num_processed += len(batch)
-          num_processed_for_hunt += len(batch)
-          self.HeartBeat()
-          metadata_obj.Set(
-              metadata_obj.Schema.NUM_PROCESSED_RESULTS(num_processed))
-          metadata_obj.UpdateLease(600)
-          if self.CheckIfRunningTooLong():
-            logging.warning("Run too long, stopping.")
-            break
 
+        values = list(
+            collection_obj.MultiResolve([(ts, suffix)
+                                         for (_, ts, suffix) in results]))
+        self.RunPlugins(hunt_urn, used_plugins, values, exceptions_by_plugin)
+
+        # The checkpoint is written when the lock is released, before the
+        # notifications are deleted. If we die in between the batch is
+        # processed again once the claims expire but it is never lost.
         metadata_obj.Set(metadata_obj.Schema.OUTPUT_PLUGINS(all_plugins))
         metadata_obj.Set(
-            metadata_obj.Schema.NUM_PROCESSED_RESULTS(num_processed))
+            metadata_obj.Schema.NUM_PROCESSED_RESULTS(
+                num_processed + len(results)))
     except aff4.LockError:
       logging.warn("ProcessHuntResultCollectionsCronFlow: "
                    "Could not get lock on hunt metadata %s.", metadata_urn)
-      return 0
-
-    if exceptions_by_plugin:
-      for plugin, exceptions in exceptions_by_plugin.items():
-        exceptions_by_hunt.setdefault(hunt_urn, {}).setdefault(
-            plugin, []).extend(exceptions)
-
-    logging.debug("Processed %d results.", num_processed_for_hunt)
-    return len(results)
+      return
+
+    hunts_results.HuntResultQueue.DeleteNotifications(
+        [record_id for (record_id, _, _) in results], token=self.token)
+
+    now = rdfvalue.RDFDatetime.Now().AsMicroSecondsFromEpoch()
+    oldest = min(ts for (_, ts, _) in results).AsMicroSecondsFromEpoch()
+    for plugin_def, _ in used_plugins:
+      stats.STATS.SetGaugeValue(
+          "hunt_results_processing_lag", (now - oldest) / 1e6,
+          fields=[hunt_urn.Basename(), plugin_def.plugin_name])
+
+    for plugin_def, exceptions in exceptions_by_plugin.items():
+      for e in exceptions:
+        errors.append((hunt_urn, plugin_def, e))
+
+    logging.debug("Processed %d results for hunt %s.", len(results), hunt_urn)
+
+  def ProcessWorkUnits(self, work_units, exceptions_by_hunt):
+    """Processes the work units in parallel."""
+    errors = []
+    if len(work_units) == 1:
+      self.ProcessWorkUnit(work_units[0], errors)
+    else:
+      pool = threadpool.ThreadPool.Factory(self.THREAD_POOL_NAME,
+                                           self.MAX_PARALLEL_HUNTS)
+      pool.Start()
+      for work_unit in work_units:
+        pool.AddTask(
+            target=self.ProcessWorkUnit,
+            args=(work_unit, errors),
+            name=self.THREAD_POOL_NAME)
+      pool.Join()
+
+    for hunt_urn, plugin_def, e in errors:
+      self.Log("Error processing hunt results (hunt %s, "
+               "plugin %s): %s" % (hunt_urn, plugin_def.plugin_name, e))
+      exceptions_by_hunt.setdefault(hunt_urn, {}).setdefault(plugin_def,
+                                                              []).append(e)
 
   @flow.StateHandler()
   def Start(self):
@@ -190,11 +254,20 @@ class ProcessHuntResultCollectionsCronFlow(cronjobs.SystemCronFlow):
       self.args.max_running_time = rdfvalue.Duration("%ds" % int(
           ProcessHuntResultCollectionsCronFlow.lifetime.seconds * 0.6))
 
+    served_collections = set()
     while not self.CheckIfRunningTooLong():
-      count = self.ProcessOneHunt(exceptions_by_hunt)
-      if not count:
+      work_units = self.ClaimWorkUnits(served_collections)
+      if not work_units and served_collections:
+        # Every hunt with pending results got a batch, start the next cycle.
+        served_collections = set()
+        work_units = self.ClaimWorkUnits(served_collections)
+      if not work_units:
         break
 
+      served_collections.update(urn for urn, _ in work_units)
+      self.ProcessWorkUnits(work_units, exceptions_by_hunt)
+      self.HeartBeat()
+
     if exceptions_by_hunt:
       e = ResultsProcessingError()
       for hunt_urn, exceptions_by_plugin in exceptions_by_hunt.items():
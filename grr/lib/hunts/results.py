@@ -32,7 +32,11 @@ class HuntResultQueue(aff4_queue.Queue):
                                       token=None,
                                       start_time=None,
                                       lease_time=200,
-                                      collection=None):
+                                      collection=None,
+                                      excluded_collections=None,
+                                      limit=100000,
+                                      max_filtered=1000,
+                                      max_scanned=None):
     """Return unclaimed hunt result notifications for collection.
 
     Args:
@@ -47,6 +51,18 @@ class HuntResultQueue(aff4_queue.Queue):
       collection: The urn of the collection to find notifications for. If unset,
         the earliest (unclaimed) notification will determine the collection.
 
+      excluded_collections: A set of collection urns. Notifications for these
+        collections are skipped when the collection is picked from the earliest
+        notification.
+
+      limit: The maximum number of notifications to claim.
+
+      max_filtered: Stop looking for notifications after this many notifications
+        for other collections were skipped in a row.
+
+      max_scanned: The maximum number of notifications to read, defaults to
+        4 * limit.
+
     Returns:
       A pair (collection, results) where collection is the collection that
       notifications were retrieved for and results is a list of tuples (id,
@@ -58,15 +74,18 @@ class HuntResultQueue(aff4_queue.Queue):
 
     class CollectionFilter(object):
 
-      def __init__(self, collection):
+      def __init__(self, collection, excluded_collections):
         self.collection = collection
+        self.excluded_collections = excluded_collections or set()
 
       def FilterRecord(self, notification):
         if self.collection is None:
+          if notification.result_collection_urn in self.excluded_collections:
+            return True
           self.collection = notification.result_collection_urn
         return self.collection != notification.result_collection_urn
 
-    f = CollectionFilter(collection)
+    f = CollectionFilter(collection, excluded_collections)
     results = []
     with aff4.FACTORY.OpenWithLock(
         RESULT_NOTIFICATION_QUEUE,
@@ -80,7 +99,9 @@ class HuntResultQueue(aff4_queue.Queue):
           record_filter=f.FilterRecord,
           start_time=start_time,
           timeout=lease_time,
-          limit=100000):
+          limit=limit,
+          max_filtered=max_filtered,
+          max_scanned=max_scanned):
         results.append((record_id, value.timestamp, value.suffix))
     return (f.collection, results)
 
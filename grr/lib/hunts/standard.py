@@ -528,5 +528,11 @@ class StandardHuntInitHook(registry.InitHook):
         "hunt_output_plugin_errors", fields=[("plugin", str)])
     stats.STATS.RegisterCounterMetric(
         "hunt_results_ran_through_plugin", fields=[("plugin", str)])
+    stats.STATS.RegisterGaugeMetric(
+        "hunt_results_processing_lag",
+        float,
+        fields=[("hunt", str), ("plugin", str)],
+        docstring="Age of the oldest result in the last processed batch.",
+        units="SECONDS")
     stats.STATS.RegisterCounterMetric("hunt_results_compacted")
     stats.STATS.RegisterCounterMetric("hunt_results_compaction_locking_errors")
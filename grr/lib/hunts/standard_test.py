@@ -25,6 +25,7 @@ from grr.lib.flows.general import administrative
 from grr.lib.flows.general import transfer
 from grr.lib.hunts import implementation
 from grr.lib.hunts import process_results
+from grr.lib.hunts import results as hunts_results
 from grr.lib.hunts import standard
 from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import flows as rdf_flows
@@ -68,6 +69,14 @@ class StatefulDummyHuntOutputPlugin(output_plugin.OutputPlugin):
     self.state.index += 1
 
 
+class HuntOrderDummyHuntOutputPlugin(output_plugin.OutputPlugin):
+  """Records the result collections whose batches were processed, in order."""
+  hunts = []
+
+  def ProcessResponses(self, unused_responses):
+    HuntOrderDummyHuntOutputPlugin.hunts.append(self.state.source_urn)
+
+
 class LongRunningDummyHuntOutputPlugin(output_plugin.OutputPlugin):
   num_calls = 0
 
@@ -226,6 +235,7 @@ class StandardHuntTest(test_lib.FlowTestsBaseclass, StandardHuntTestMixin):
     DummyHuntOutputPlugin.num_calls = 0
     DummyHuntOutputPlugin.num_responses = 0
     StatefulDummyHuntOutputPlugin.data = []
+    HuntOrderDummyHuntOutputPlugin.hunts = []
     LongRunningDummyHuntOutputPlugin.num_calls = 0
 
     with test_lib.FakeTime(0):
@@ -365,6 +375,60 @@ class StandardHuntTest(test_lib.FlowTestsBaseclass, StandardHuntTestMixin):
       self.assertListEqual(per_type_collection.ListStoredTypes(),
                            [rdf_client.StatEntry.__name__])
 
+  def testHuntSummaryIsKeptUpToDate(self):
+    index = implementation.HuntSummaryIndex(token=self.token)
+    with self.CreateHunt(description="the hunt") as hunt:
+      pass
+
+    summary = index.Read(hunt.urn)
+    self.assertEqual(summary.state, "PAUSED")
+    self.assertEqual(summary.description, "the hunt")
+    self.assertEqual(summary.creator, self.token.username)
+    self.assertEqual(summary.create_time, hunt.context.create_time)
+
+    with aff4.FACTORY.Open(hunt.urn, mode="rw", token=self.token) as hunt_obj:
+      hunt_obj.Run()
+    self.assertEqual(index.Read(hunt.urn).state, "STARTED")
+
+    self.AssignTasksToClients()
+    self.RunHunt()
+    summary = index.Read(hunt.urn)
+    self.assertEqual(summary.client_count, 10)
+    # Half of the clients have a file to return.
+    self.assertEqual(summary.results_count, 5)
+
+    self.StopHunt(hunt.urn)
+    self.assertEqual(index.Read(hunt.urn).state, "STOPPED")
+
+    aff4.FACTORY.Delete(hunt.urn, token=self.token)
+    self.assertIsNone(index.Read(hunt.urn))
+
+  def testHuntSummaryIsOnlyWrittenWhenItChanges(self):
+    index = implementation.HuntSummaryIndex(token=self.token)
+    with self.CreateHunt(description="the hunt") as hunt:
+      pass
+
+    with test_lib.Instrument(implementation.HuntSummaryIndex,
+                             "Write") as write:
+      with aff4.FACTORY.Open(hunt.urn, mode="rw", token=self.token) as hunt_obj:
+        hunt_obj.context.results_count = 100
+      self.assertEqual(write.call_count, 1)
+
+      # Counters which changed by less than COUNTER_CHANGE_RATIO do not
+      # rewrite the summary.
+      with aff4.FACTORY.Open(hunt.urn, mode="rw", token=self.token) as hunt_obj:
+        hunt_obj.context.results_count = 105
+      self.assertEqual(write.call_count, 1)
+      self.assertEqual(index.Read(hunt.urn).results_count, 100)
+
+      with aff4.FACTORY.Open(hunt.urn, mode="rw", token=self.token) as hunt_obj:
+        hunt_obj.runner_args.description = "renamed"
+      self.assertEqual(write.call_count, 2)
+
+    summary = index.Read(hunt.urn)
+    self.assertEqual(summary.description, "renamed")
+    self.assertEqual(summary.results_count, 105)
+
   def testHuntWithoutForemanRules(self):
     """Check no foreman rules are created if we pass add_foreman_rules=False."""
     hunt_urn = self.StartHunt(add_foreman_rules=False)
@@ -754,6 +818,69 @@ class StandardHuntTest(test_lib.FlowTestsBaseclass, StandardHuntTestMixin):
     self.assertEqual(DummyHuntOutputPlugin.num_calls, 1)
     self.assertListEqual(StatefulDummyHuntOutputPlugin.data, [0])
 
+  def testHuntWithManyResultsDoesNotStarveOtherHunts(self):
+    plugin_descriptor = output_plugin.OutputPluginDescriptor(
+        plugin_name="HuntOrderDummyHuntOutputPlugin")
+    busy_hunt_urn = self.StartHunt(output_plugins=[plugin_descriptor])
+    self.AssignTasksToClients()
+    self.RunHunt(failrate=-1)
+
+    # The results of the second hunt arrive after all the busy hunt results.
+    hunt_urn = self.StartHunt(output_plugins=[plugin_descriptor])
+    self.AssignTasksToClients(self.client_ids[:2])
+    self.RunHunt(failrate=-1)
+
+    with utils.Stubber(process_results.ProcessHuntResultCollectionsCronFlow,
+                       "MAX_PARALLEL_HUNTS", 1):
+      self.ProcessHuntOutputPlugins(batch_size=2)
+
+    self.maxDiff = None
+    busy_results_urn = busy_hunt_urn.Add("Results")
+    self.assertEqual(HuntOrderDummyHuntOutputPlugin.hunts,
+                     [busy_results_urn, hunt_urn.Add("Results")] +
+                     [busy_results_urn] * 4)
+
+  def testProcessingLagIsReportedPerHuntAndPlugin(self):
+    hunt_urn = self.StartHunt(output_plugins=[
+        output_plugin.OutputPluginDescriptor(
+            plugin_name="DummyHuntOutputPlugin")
+    ])
+    self.AssignTasksToClients()
+    self.RunHunt(failrate=-1)
+
+    with test_lib.FakeTime(rdfvalue.RDFDatetime.Now() +
+                           rdfvalue.Duration("2h")):
+      self.ProcessHuntOutputPlugins()
+
+    lag = stats.STATS.GetMetricValue(
+        "hunt_results_processing_lag",
+        fields=[hunt_urn.Basename(), "DummyHuntOutputPlugin"])
+    self.assertGreater(lag, 3600)
+
+  def testProcessedResultsAreCheckpointedBeforeNotificationsAreDeleted(self):
+    self.StartHunt(output_plugins=[
+        output_plugin.OutputPluginDescriptor(
+            plugin_name="DummyHuntOutputPlugin")
+    ])
+    self.AssignTasksToClients()
+    self.RunHunt(failrate=-1)
+
+    # The run dies after the first batch was processed but before its
+    # notifications were deleted.
+    with mock.patch.object(
+        hunts_results.HuntResultQueue,
+        "DeleteNotifications",
+        side_effect=RuntimeError("Lost the worker.")):
+      with self.assertRaises(RuntimeError):
+        self.ProcessHuntOutputPlugins(batch_size=4)
+    self.assertEqual(DummyHuntOutputPlugin.num_responses, 4)
+
+    # Once the claims expire, processing resumes and nothing is lost.
+    with test_lib.FakeTime(rdfvalue.RDFDatetime.Now() +
+                           rdfvalue.Duration("1d")):
+      self.ProcessHuntOutputPlugins(batch_size=4)
+    self.assertEqual(DummyHuntOutputPlugin.num_responses, 14)
+
   def testProcessHuntResultCollectionsCronFlowAbortsIfRunningTooLong(self):
     self.assertEqual(LongRunningDummyHuntOutputPlugin.num_calls, 0)
 
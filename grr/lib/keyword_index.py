@@ -7,9 +7,20 @@ possible to search for those names which match all keywords.
 """
 
 
+import random
+
+
 from grr.lib import aff4
 from grr.lib import data_store
 from grr.lib import rdfvalue
+from grr.lib import utils
+
+
+# The most recently read small posting lists, keyed by keyword urn. Each entry
+# holds the keyword's update marker at the time the list was read and is only
+# used while the marker in the data store is unchanged. Only lists of up to
+# POSTING_LIST_PROBE_SIZE entries are cached, which bounds the cache size.
+POSTING_LIST_CACHE = utils.FastStore(max_size=100)
 
 
 class AFF4KeywordIndex(aff4.AFF4Object):
@@ -19,37 +30,189 @@ class AFF4KeywordIndex(aff4.AFF4Object):
   INDEX_PREFIX_LEN = len(INDEX_PREFIX)
   INDEX_COLUMN_FORMAT = INDEX_PREFIX + "%s"
 
+  # Changes with every update of a keyword's posting list.
+  UPDATE_MARKER_ATTRIBUTE = "kw_meta:update"
+
   # The lowest and highest legal timestamps.
   FIRST_TIMESTAMP = 0
   LAST_TIMESTAMP = (2**63) - 2  # maxint64 - 1
 
+  # Lookup reads at most this many entries of a posting list before deciding it
+  # is large. Lists which fit are read completely.
+  POSTING_LIST_PROBE_SIZE = 1000
+
+  # Once the candidate names are down to this many, the large posting lists
+  # are probed for the candidates instead of being read.
+  MAX_POINT_LOOKUPS = 1000
+
   def _KeywordToURN(self, keyword):
     return self.urn.Add(keyword)
 
-  def Lookup(self, keywords, **kwargs):
+  def _NewUpdateMarker(self):
+    return "%016x" % random.getrandbits(64)
+
+  def _ReadUpdateMarkers(self, keyword_urns):
+    """Returns a dict mapping keyword urns to their current update markers."""
+    keyword_urns = {utils.SmartStr(urn): urn for urn in keyword_urns}
+    markers = {}
+    for subject, values in data_store.DB.MultiResolvePrefix(
+        keyword_urns.keys(),
+        self.UPDATE_MARKER_ATTRIBUTE,
+        timestamp=data_store.DB.NEWEST_TIMESTAMP,
+        token=self.token):
+      for _, value, ts in values:
+        markers[keyword_urns[utils.SmartStr(subject)]] = (value, ts)
+    return markers
+
+  def _ReadPostingList(self, keyword_urn, marker, limit=None):
+    """Reads a posting list with all its timestamps.
+
+    Args:
+      keyword_urn: The urn of the keyword.
+      marker: The update marker of the keyword, None if it has none.
+      limit: If set, gives up on lists with more than this many entries.
+
+    Returns:
+      A dict mapping each name to a list of its timestamps, or None if the
+      posting list has more than limit entries.
+    """
+    key = utils.SmartStr(keyword_urn)
+    if marker is not None:
+      try:
+        cached_marker, posting_list = POSTING_LIST_CACHE.Get(key)
+        # A cached None means the list was too large for a limited read.
+        if cached_marker == marker and (posting_list is not None or limit):
+          return posting_list
+      except KeyError:
+        pass
+
+    values = data_store.DB.ResolvePrefix(
+        keyword_urn,
+        self.INDEX_PREFIX,
+        timestamp=(self.FIRST_TIMESTAMP, self.LAST_TIMESTAMP + 1),
+        limit=limit + 1 if limit else None,
+        token=self.token)
+    if limit and len(values) > limit:
+      if marker is not None:
+        POSTING_LIST_CACHE.Put(key, (marker, None))
+      return None
+
+    posting_list = {}
+    for column, _, ts in values:
+      posting_list.setdefault(column[self.INDEX_PREFIX_LEN:], []).append(ts)
+
+    if marker is not None and len(values) <= self.POSTING_LIST_PROBE_SIZE:
+      POSTING_LIST_CACHE.Put(key, (marker, posting_list))
+
+    return posting_list
+
+  def _FilterPostingList(self, posting_list, start_time, end_time):
+    """Returns a dict mapping names to their latest timestamp in range."""
+    result = {}
+    for name, timestamps in posting_list.iteritems():
+      in_range = [ts for ts in timestamps if start_time <= ts <= end_time]
+      if in_range:
+        result[name] = max(in_range)
+    return result
+
+  def _ProbePostingList(self, keyword_urn, names, start_time, end_time):
+    """Returns a dict mapping the names which are in the list to timestamps."""
+    columns = [self.INDEX_COLUMN_FORMAT % name for name in names]
+    result = {}
+    for column, _, ts in data_store.DB.ResolveMulti(
+        keyword_urn,
+        columns,
+        timestamp=(start_time, end_time),
+        token=self.token):
+      name = column[self.INDEX_PREFIX_LEN:]
+      result[name] = max(result.get(name, -1), ts)
+    return result
+
+  def Lookup(self,
+             keywords,
+             start_time=FIRST_TIMESTAMP,
+             end_time=LAST_TIMESTAMP,
+             last_seen_map=None):
     """Finds objects associated with keywords.
 
-    Find the names related to all keywords.
+    Find the names related to all keywords. The posting lists are intersected
+    smallest first: lists of up to POSTING_LIST_PROBE_SIZE entries are read
+    completely, the larger ones are then only probed for the remaining names.
+    The small lists are cached until the keyword is updated.
 
     Args:
       keywords: A collection of keywords that we are interested in.
-      **kwargs: Additional arguments to be passed to the underlying call to
-        ReadPostingLists
+      start_time: Only considers keywords added at or after this point in time.
+      end_time: Only considers keywords at or before this point in time.
+      last_seen_map: If present, is treated as a dict and populated to map pairs
+        (keyword, name) to the timestamp of the latest connection found, for
+        the names returned.
     Returns:
       A set of potentially relevant names.
 
     """
+    keyword_urns = {}
+    for kw in keywords:
+      keyword_urns[kw] = self._KeywordToURN(kw)
+    if not keyword_urns:
+      return set()
 
-    posting_lists = self.ReadPostingLists(keywords, **kwargs)
+    # Same range as ReadPostingLists.
+    end_time += 1
+    markers = self._ReadUpdateMarkers(keyword_urns.values())
 
-    results = posting_lists.values()
-    relevant_set = results[0]
+    small_lists = {}
+    large_keywords = []
+    for kw, keyword_urn in keyword_urns.iteritems():
+      posting_list = self._ReadPostingList(
+          keyword_urn,
+          markers.get(keyword_urn),
+          limit=self.POSTING_LIST_PROBE_SIZE)
+      if posting_list is None:
+        large_keywords.append(kw)
+      else:
+        small_lists[kw] = self._FilterPostingList(posting_list, start_time,
+                                                  end_time)
 
-    for hits in results:
-      relevant_set &= hits
+    if not small_lists:
+      # Only large lists, one of them has to be read.
+      kw = large_keywords.pop()
+      posting_list = self._ReadPostingList(keyword_urns[kw],
+                                           markers.get(keyword_urns[kw]))
+      small_lists[kw] = self._FilterPostingList(posting_list, start_time,
+                                                end_time)
+
+    hits = {}
+    relevant_set = None
+    for kw in sorted(small_lists, key=lambda kw: len(small_lists[kw])):
+      hits[kw] = small_lists[kw]
+      if relevant_set is None:
+        relevant_set = set(hits[kw])
+      else:
+        relevant_set.intersection_update(hits[kw])
+
+      if not relevant_set:
+        return set()
+
+    for kw in large_keywords:
+      keyword_urn = keyword_urns[kw]
+      if len(relevant_set) <= self.MAX_POINT_LOOKUPS:
+        hits[kw] = self._ProbePostingList(keyword_urn, relevant_set,
+                                          start_time, end_time)
+      else:
+        hits[kw] = self._FilterPostingList(
+            self._ReadPostingList(keyword_urn, markers.get(keyword_urn)),
+            start_time, end_time)
+      relevant_set.intersection_update(hits[kw])
 
       if not relevant_set:
-        return relevant_set
+        return set()
+
+    if last_seen_map is not None:
+      for kw, timestamps in hits.iteritems():
+        for name in relevant_set:
+          last_seen_map[(kw, name)] = max(
+              last_seen_map.get((kw, name), -1), timestamps[name])
 
     return relevant_set
 
@@ -108,25 +271,35 @@ class AFF4KeywordIndex(aff4.AFF4Object):
     """
     if timestamp is None:
       timestamp = rdfvalue.RDFDatetime.Now().AsMicroSecondsFromEpoch()
+    marker = self._NewUpdateMarker()
     if sync:
       with data_store.DB.GetMutationPool(token=self.token) as mutation_pool:
         for keyword in set(keywords):
+          keyword_urn = self._KeywordToURN(keyword)
           mutation_pool.Set(
-              self._KeywordToURN(keyword),
+              keyword_urn,
               self.INDEX_COLUMN_FORMAT % name,
               "",
               timestamp=timestamp,
               **kwargs)
+          mutation_pool.Set(keyword_urn, self.UPDATE_MARKER_ATTRIBUTE, marker)
     else:
       for keyword in set(keywords):
+        keyword_urn = self._KeywordToURN(keyword)
         data_store.DB.Set(
-            self._KeywordToURN(keyword),
+            keyword_urn,
             self.INDEX_COLUMN_FORMAT % name,
             "",
             token=self.token,
             sync=False,
             timestamp=timestamp,
             **kwargs)
+        data_store.DB.Set(
+            keyword_urn,
+            self.UPDATE_MARKER_ATTRIBUTE,
+            marker,
+            token=self.token,
+            sync=False)
 
   def RemoveKeywordsForName(self, name, keywords, sync=True):
     """Removes keywords for a name.
@@ -136,14 +309,24 @@ class AFF4KeywordIndex(aff4.AFF4Object):
       keywords: A collection of keywords.
       sync: Sync to data store immediately.
     """
+    marker = self._NewUpdateMarker()
     if sync:
       with data_store.DB.GetMutationPool(token=self.token) as mutation_pool:
         for keyword in set(keywords):
-          mutation_pool.DeleteAttributes(
-              self._KeywordToURN(keyword), [self.INDEX_COLUMN_FORMAT % name])
+          keyword_urn = self._KeywordToURN(keyword)
+          mutation_pool.DeleteAttributes(keyword_urn,
+                                         [self.INDEX_COLUMN_FORMAT % name])
+          mutation_pool.Set(keyword_urn, self.UPDATE_MARKER_ATTRIBUTE, marker)
     else:
       for keyword in set(keywords):
+        keyword_urn = self._KeywordToURN(keyword)
         data_store.DB.DeleteAttributes(
-            self._KeywordToURN(keyword), [self.INDEX_COLUMN_FORMAT % name],
+            keyword_urn, [self.INDEX_COLUMN_FORMAT % name],
+            token=self.token,
+            sync=False)
+        data_store.DB.Set(
+            keyword_urn,
+            self.UPDATE_MARKER_ATTRIBUTE,
+            marker,
             token=self.token,
             sync=False)
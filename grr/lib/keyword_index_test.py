@@ -3,9 +3,11 @@
 
 
 from grr.lib import aff4
+from grr.lib import data_store
 from grr.lib import flags
 from grr.lib import keyword_index
 from grr.lib import test_lib
+from grr.lib import utils
 
 
 class KeywordIndexTest(test_lib.AFF4ObjectTest):
@@ -90,6 +92,84 @@ class KeywordIndexTest(test_lib.AFF4ObjectTest):
     self.assertEqual(2004 * 1000000, ls_map[("popular_keyword1", "C.000000")])
     self.assertEqual(1009 * 1000000, ls_map[("popular_keyword2", "C.000000")])
 
+  def testKeywordIndexLargePostingLists(self):
+    index = aff4.FACTORY.Create(
+        "aff4:/index3/",
+        aff4_type=keyword_index.AFF4KeywordIndex,
+        mode="rw",
+        token=self.token)
+    index.POSTING_LIST_PROBE_SIZE = 10
+    index.MAX_POINT_LOOKUPS = 20
+
+    for i in range(100):
+      keywords = ["common"]
+      if i % 2:
+        keywords.append("odd")
+      if i % 25 == 0:
+        keywords.append("rare")
+      with test_lib.FakeTime(1000 + i):
+        index.AddKeywordsForName("C.%X" % i, keywords, sync=self.sync)
+
+    self.assertEqual(len(index.Lookup(["common"])), 100)
+    self.assertEqual(len(index.Lookup(["common", "odd"])), 50)
+    self.assertEqual(
+        index.Lookup(["common", "odd", "rare"]), set(["C.19", "C.4B"]))
+    self.assertEqual(
+        index.Lookup(["rare", "common"], start_time=1050 * 1000000),
+        set(["C.32", "C.4B"]))
+
+    ls_map = {}
+    index.Lookup(["common", "rare"], last_seen_map=ls_map)
+    self.assertEqual(1075 * 1000000, ls_map[("common", "C.4B")])
+    self.assertEqual(1075 * 1000000, ls_map[("rare", "C.4B")])
+
+  def testKeywordIndexSeesUpdatesOfCachedLists(self):
+    index = aff4.FACTORY.Create(
+        "aff4:/index4/",
+        aff4_type=keyword_index.AFF4KeywordIndex,
+        mode="rw",
+        token=self.token)
+    index.POSTING_LIST_PROBE_SIZE = 10
+
+    for i in range(20):
+      index.AddKeywordsForName("C.%X" % i, ["popular_keyword1"], sync=self.sync)
+    self.assertEqual(len(index.Lookup(["popular_keyword1"])), 20)
+    self.assertEqual(len(index.Lookup(["popular_keyword1"])), 20)
+
+    index.AddKeywordsForName("C.100", ["popular_keyword1"], sync=self.sync)
+    self.assertEqual(len(index.Lookup(["popular_keyword1"])), 21)
+
+    index.RemoveKeywordsForName("C.0", ["popular_keyword1"], sync=self.sync)
+    index.RemoveKeywordsForName("C.1", ["popular_keyword1"], sync=self.sync)
+    self.assertEqual(len(index.Lookup(["popular_keyword1"])), 19)
+
+  def testKeywordIndexOnlyCachesSmallLists(self):
+    index = aff4.FACTORY.Create(
+        "aff4:/index5/",
+        aff4_type=keyword_index.AFF4KeywordIndex,
+        mode="rw",
+        token=self.token)
+    index.POSTING_LIST_PROBE_SIZE = 10
+
+    for i in range(20):
+      keywords = ["large"]
+      if i < 5:
+        keywords.append("small")
+      index.AddKeywordsForName("C.%X" % i, keywords, sync=self.sync)
+
+    with test_lib.Instrument(data_store.DB, "MultiResolvePrefix") as markers:
+      self.assertEqual(len(index.Lookup(["large"])), 20)
+      self.assertEqual(len(index.Lookup(["small", "large"])), 5)
+      # The update markers of all keywords are read at once.
+      self.assertEqual(markers.call_count, 2)
+
+    _, small_list = keyword_index.POSTING_LIST_CACHE.Get(
+        utils.SmartStr(index.urn.Add("small")))
+    self.assertEqual(len(small_list), 5)
+    _, large_list = keyword_index.POSTING_LIST_CACHE.Get(
+        utils.SmartStr(index.urn.Add("large")))
+    self.assertIsNone(large_list)
+
 
 class AsyncKeywordIndexTest(KeywordIndexTest):
 
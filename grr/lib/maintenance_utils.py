@@ -19,10 +19,13 @@ from grr.lib import access_control
 from grr.lib import aff4
 from grr.lib import data_store
 from grr.lib import events
+from grr.lib import rdfvalue
+from grr.lib import sequential_collection
 from grr.lib import utils
 from grr.lib.aff4_objects import collects
 from grr.lib.aff4_objects import users
 from grr.lib.builders import signing
+from grr.lib.hunts import implementation
 from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import crypto as rdf_crypto
 
@@ -449,3 +452,67 @@ def DeleteUser(username, token=None):
       events.AuditEvent(
           user=token.username, action="USER_DELETE", urn=user_urn),
       token=token)
+
+
+def _HuntCollectionURNs(hunt_urn, token=None):
+  """Returns the urns of the indexed collections of a hunt."""
+  hunt_cls = implementation.GRRHunt
+  urns = [
+      hunt_urn.Add(name)
+      for name in ("Results", "Logs", "Crashes", "ErrorClients",
+                   "OutputPluginsStatus", "OutputPluginsErrors",
+                   "ClientsWithResults", "AllClients", "CompletedClients")
+  ]
+  typed_results = hunt_cls.TypedResultCollectionForHID(hunt_urn, token=token)
+  for stored_type in typed_results.ListStoredTypes():
+    urns.append(typed_results.collection_id.Add(stored_type))
+  return urns
+
+
+def UpdateCollectionIndexes(collection_urns=None, all_hunts=False, token=None):
+  """Creates the indexes of collections written by older GRR versions.
+
+  Args:
+    collection_urns: Urns of IndexedSequentialCollections to update.
+    all_hunts: If set, the collections of all hunts are updated as well.
+    token: The database access token to use.
+
+  Returns:
+    The number of records which were added to indexes.
+  """
+  token = data_store.GetDefaultToken(token)
+  urns = [rdfvalue.RDFURN(urn) for urn in collection_urns or []]
+  if all_hunts:
+    hunts_root = aff4.FACTORY.Open("aff4:/hunts", token=token)
+    for hunt_urn in hunts_root.ListChildren():
+      urns.extend(_HuntCollectionURNs(hunt_urn, token=token))
+
+  total = 0
+  for urn in urns:
+    # Updating the index only needs the record ids, not the records, so the
+    # base class works for collections of any type.
+    collection = sequential_collection.IndexedSequentialCollection(
+        urn, token=token)
+    added = collection.UpdateIndex()
+    if added:
+      EPrint("Indexed %d records of %s." % (added, urn))
+    total += added
+
+  EPrint("Updated the indexes of %d collections, %d records were added." %
+         (len(urns), total))
+  return total
+
+
+def UpdateHuntSummaryIndex(token=None):
+  """Adds hunts written by older GRR versions to the hunt summary index.
+
+  Args:
+    token: The database access token to use.
+
+  Returns:
+    The number of hunts which were added to the index.
+  """
+  token = data_store.GetDefaultToken(token)
+  added = implementation.HuntSummaryIndex(token=token).AddUnindexedHunts()
+  EPrint("Added %d hunts to the hunt summary index." % added)
+  return added
@@ -217,6 +217,13 @@ class MultiTypeCollection(object):
     mutation_pool = data_store.DB.GetMutationPool(self.token)
     with mutation_pool:
       mutation_pool.DeleteSubject(self.collection_id)
+      # The sub-collection subjects hold the sub-collection indexes.
+      for stored_type in self.ListStoredTypes():
+        sub_collection_urn = self.collection_id.Add(stored_type)
+        mutation_pool.DeleteSubject(sub_collection_urn)
+        mutation_pool.DeleteSubject(
+            sequential_collection.GrrMessageCollection.IndexedRecordsURN(
+                sub_collection_urn))
       for urn, _, _ in data_store.DB.ScanAttribute(
           self.collection_id,
           sequential_collection.SequentialCollection.ATTRIBUTE,
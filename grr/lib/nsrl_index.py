@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+"""A memory mapped index of the NSRL reference data set.
+
+An NSRL index file holds one entry per SHA-1 digest in the data set, sorted
+by digest, followed by the NSRLInformation records the entries point to:
+  MAGIC | entry count | records offset | entries | records
+
+Every entry is the binary SHA-1 digest and the big endian offset of its record
+from the start of the records. Every record is the little endian size of a
+serialized NSRLInformation protobuf followed by the protobuf. The SHA-1 digest
+is left out of the records since the entries already hold it.
+
+Lookups are searches in the memory mapped entries, so an index of the full data
+set can be opened instantly and needs no data store.
+"""
+
+import heapq
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+
+from grr.lib import hash_index
+from grr.lib.rdfvalues import nsrl as rdf_nsrl
+
+
+MAGIC = "GRRNSRL1"
+HEADER = struct.Struct("<8sQQ")
+
+SHA1_SIZE = 20
+RECORD_OFFSET = struct.Struct(">Q")
+ENTRY_SIZE = SHA1_SIZE + RECORD_OFFSET.size
+RECORD_SIZE = struct.Struct("<I")
+
+FILE_TYPES = {
+    "M": rdf_nsrl.NSRLInformation.FileType.MALICIOUS_FILE,
+    "S": rdf_nsrl.NSRLInformation.FileType.SPECIAL_FILE,
+    "": rdf_nsrl.NSRLInformation.FileType.NORMAL_FILE
+}
+
+
+class NSRLIndexWriter(object):
+  """Writes an NSRL index file from records in any order.
+
+  Records are streamed to a temporary file as they are added and only their
+  entries are sorted, max_entries at a time. The sorted runs are merged when
+  the index is written, so memory use does not grow with the data set. When a
+  digest is added more than once the last record wins.
+  """
+
+  def __init__(self, path, max_entries=1000000):
+    """Constructor.
+
+    Args:
+      path: The index file to write.
+      max_entries: The number of entries sorted in memory at a time.
+    """
+    self.path = path
+    self.max_entries = max_entries
+    self.tmp_dir = os.path.dirname(os.path.abspath(path))
+
+    self.records = tempfile.TemporaryFile(dir=self.tmp_dir)
+    self.records_size = 0
+    self.entries = []
+    self.runs = []
+
+  def AddHash(self, sha1, md5, crc, file_name, file_size, product_code_list,
+              op_system_code_list, special_code):
+    """Adds a file from the NSRL hash database.
+
+    This takes the same arguments as NSRLFileStore.AddHash so both can be fed
+    by the same import code.
+
+    Args:
+      sha1: SHA1 digest as a hex encoded string.
+      md5: MD5 digest as a hex encoded string.
+      crc: File CRC as an integer.
+      file_name: Filename.
+      file_size: Size of file.
+      product_code_list: List of products this file is part of.
+      op_system_code_list: List of operating systems this file is part of.
+      special_code: Special code (malicious/special/normal file).
+    """
+    self.AddRecord(sha1.decode("hex"),
+                   rdf_nsrl.NSRLInformation(
+                       md5=md5.decode("hex"),
+                       crc32=crc,
+                       file_name=file_name,
+                       file_size=file_size,
+                       product_code=product_code_list,
+                       op_system_code=op_system_code_list,
+                       file_type=FILE_TYPES.get(special_code, FILE_TYPES[""])))
+
+  def AddRecord(self, sha1, info):
+    """Adds the NSRLInformation for a binary SHA-1 digest.
+
+    Args:
+      sha1: The binary SHA-1 digest.
+      info: The NSRLInformation, its sha1 field is not needed.
+    """
+    if len(sha1) != SHA1_SIZE:
+      raise ValueError("Invalid SHA-1 digest: %r" % sha1)
+
+    data = info.SerializeToString()
+    self.entries.append(sha1 + RECORD_OFFSET.pack(self.records_size))
+    self.records.write(RECORD_SIZE.pack(len(data)))
+    self.records.write(data)
+    self.records_size += RECORD_SIZE.size + len(data)
+
+    if len(self.entries) >= self.max_entries:
+      self._WriteRun()
+
+  def _WriteRun(self):
+    self.entries.sort()
+    run = tempfile.TemporaryFile(dir=self.tmp_dir)
+    run.write("".join(self.entries))
+    run.seek(0)
+    self.runs.append(run)
+    self.entries = []
+
+  def _ReadRun(self, run):
+    while True:
+      entries = run.read(ENTRY_SIZE * 4096)
+      for i in xrange(0, len(entries), ENTRY_SIZE):
+        yield entries[i:i + ENTRY_SIZE]
+      if len(entries) < ENTRY_SIZE * 4096:
+        return
+
+  def _SortedEntries(self):
+    """Yields the entries in order, only the last one for every digest."""
+    self.entries.sort()
+    runs = [self._ReadRun(run) for run in self.runs]
+    runs.append(iter(self.entries))
+
+    # Offsets are big endian, so the last record of a digest sorts last.
+    previous = None
+    for entry in heapq.merge(*runs):
+      if previous is not None and previous[:SHA1_SIZE] != entry[:SHA1_SIZE]:
+        yield previous
+      previous = entry
+    if previous is not None:
+      yield previous
+
+  def Close(self):
+    """Writes the index file.
+
+    The file is written next to its final location and then renamed, so readers
+    never see a partially written index.
+
+    Returns:
+      The number of digests in the index.
+    """
+    tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+    count = 0
+    with open(tmp_path, "wb") as fd:
+      fd.seek(HEADER.size)
+      for entry in self._SortedEntries():
+        fd.write(entry)
+        count += 1
+
+      records_offset = fd.tell()
+      self.records.seek(0)
+      shutil.copyfileobj(self.records, fd, 1024 * 1024)
+
+      fd.seek(0)
+      fd.write(HEADER.pack(MAGIC, count, records_offset))
+    os.rename(tmp_path, self.path)
+
+    self.records.close()
+    for run in self.runs:
+      run.close()
+    return count
+
+
+class NSRLIndex(object):
+  """A read only NSRL index file."""
+
+  def __init__(self, path):
+    """Maps an NSRL index file into memory.
+
+    Args:
+      path: An index file written by NSRLIndexWriter.
+
+    Raises:
+      hash_index.IndexFileError: If the file is not an NSRL index file.
+    """
+    self.path = path
+    with open(path, "rb") as fd:
+      header = fd.read(HEADER.size)
+      if len(header) != HEADER.size:
+        raise hash_index.IndexFileError("Index file %s is truncated." % path)
+
+      magic, count, records_offset = HEADER.unpack(header)
+      if magic != MAGIC:
+        raise hash_index.IndexFileError("%s is not an NSRL index file." % path)
+      if (records_offset != HEADER.size + count * ENTRY_SIZE or
+          os.fstat(fd.fileno()).st_size < records_offset):
+        raise hash_index.IndexFileError(
+            "Index file %s has the wrong size." % path)
+
+      # The mapping stays valid when the file is closed or replaced.
+      self.data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+    self.records_offset = records_offset
+    self.array = hash_index.SortedPrefixArray(
+        self.data,
+        prefix_size=SHA1_SIZE,
+        offset=HEADER.size,
+        length=count,
+        record_size=ENTRY_SIZE)
+
+  def __len__(self):
+    return len(self.array)
+
+  def _Find(self, digests):
+    """Yields (digest, entry index) for the digests in the index."""
+    array = self.array
+    length = len(array)
+    lo = 0
+    # Sorted lookups start where the previous one ended.
+    for digest in sorted(set(digests)):
+      lo = array.Find(digest, lo)
+      if lo == length:
+        return
+      if array[lo] == digest:
+        yield digest, lo
+
+  def CheckDigests(self, digests):
+    """Returns the set of binary SHA-1 digests which are in the index."""
+    return set(digest for digest, _ in self._Find(digests))
+
+  def Lookup(self, digests):
+    """Looks up the NSRL information for binary SHA-1 digests.
+
+    Args:
+      digests: An iterable of binary SHA-1 digests.
+
+    Returns:
+      A dict mapping the digests in the index to their NSRLInformation.
+    """
+    result = {}
+    for digest, index in self._Find(digests):
+      offset = (self.records_offset +
+                RECORD_OFFSET.unpack(self.array.Payload(index))[0])
+      size = RECORD_SIZE.unpack_from(self.data, offset)[0]
+      offset += RECORD_SIZE.size
+      info = rdf_nsrl.NSRLInformation.FromSerializedString(
+          self.data[offset:offset + size])
+      info.sha1 = digest
+      result[digest] = info
+    return result
+
+  def Close(self):
+    self.data.close()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""Benchmark for the NSRL index against NSRL hashes in the data store."""
+
+
+import hashlib
+import os
+import time
+
+
+from grr.lib import aff4
+from grr.lib import data_store
+from grr.lib import flags
+from grr.lib import nsrl_index
+from grr.lib import test_lib
+from grr.lib import utils
+from grr.lib.aff4_objects import filestore
+from grr.lib.rdfvalues import crypto as rdf_crypto
+from grr.tools import import_nsrl_hashes
+
+
+class NSRLIndexBenchmark(test_lib.MicroBenchmarks):
+  """Imports FILES NSRL records and looks up BATCH_SIZE hashes.
+
+  Half of the hashes looked up are in the NSRL. The data store size is the
+  size of the rows the fake data store holds for the NSRL, real data stores
+  add their own overhead.
+  """
+
+  labels = ["benchmark"]
+  units = "s"
+
+  FILES = 20000
+  BATCH_SIZE = 10000
+
+  def setUp(self):
+    super(NSRLIndexBenchmark, self).setUp(["Value"], ["<25"])
+
+  def _SHA1(self, number):
+    return hashlib.sha1(str(number)).hexdigest()
+
+  def _WriteNSRLFile(self, path):
+    with open(path, "wb") as fd:
+      fd.write("\"SHA-1\",\"MD5\",\"CRC32\",\"FileName\",\"FileSize\","
+               "\"ProductCode\",\"OpSystemCode\",\"SpecialCode\"\n")
+      for i in xrange(self.FILES):
+        # Every file is part of two products, like many files in the RDS.
+        for product_code in [i % 1000, 1000 + i % 7]:
+          fd.write("\"%s\",\"%s\",\"%08X\",\"file%d.dll\",%d,%d,\"358\",\"\"\n" %
+                   (self._SHA1(i).upper(), hashlib.md5(str(i)).hexdigest(),
+                    i, i, i * 100, product_code))
+
+  def _DataStoreSize(self):
+    size = 0
+    prefix = utils.SmartUnicode(filestore.NSRLFileStore.PATH)
+    for subject, attributes in data_store.DB.subjects.iteritems():
+      if not subject.startswith(prefix):
+        continue
+      for attribute, values in attributes.iteritems():
+        for value, _ in values:
+          size += len(subject) + len(attribute) + len(utils.SmartStr(value))
+    return size
+
+  def _CheckHashes(self, name, nsrl_fs):
+    hashes = [
+        rdf_crypto.Hash(sha1=self._SHA1(self.FILES - self.BATCH_SIZE / 2 + i)
+                        .decode("hex")) for i in xrange(self.BATCH_SIZE)
+    ]
+    start_time = time.time()
+    hits = list(nsrl_fs.CheckHashes(hashes))
+    elapsed_time = time.time() - start_time
+    self.assertEqual(len(hits), self.BATCH_SIZE / 2)
+    self.AddResult("%s: CheckHashes" % name, elapsed_time, self.BATCH_SIZE,
+                   "%d/s" % (self.BATCH_SIZE / elapsed_time))
+
+    sha1s = [self._SHA1(i) for i in xrange(0, self.FILES, 20)]
+    start_time = time.time()
+    infos = nsrl_fs.NSRLInfoForSHA1s(sha1s)
+    elapsed_time = time.time() - start_time
+    self.assertEqual(len(infos), len(sha1s))
+    self.AddResult("%s: NSRLInfoForSHA1s" % name, elapsed_time, len(sha1s),
+                   "%d/s" % (len(sha1s) / elapsed_time))
+
+  def testNSRLLookups(self):
+    """Import time, size and lookup rate of both NSRL backends."""
+    nsrl_path = os.path.join(self.temp_dir, "NSRLFile.txt")
+    self._WriteNSRLFile(nsrl_path)
+
+    with aff4.FACTORY.Create(
+        filestore.NSRLFileStore.PATH,
+        filestore.NSRLFileStore,
+        mode="rw",
+        token=self.token) as nsrl_fs:
+      start_time = time.time()
+      import_nsrl_hashes.ImportFile(nsrl_fs, nsrl_path, None)
+      data_store.DB.Flush()
+      self.AddResult("data store: import", time.time() - start_time,
+                     self.FILES, "%d bytes" % self._DataStoreSize())
+      self._CheckHashes("data store", nsrl_fs)
+
+    index_path = os.path.join(self.temp_dir, "nsrl_index")
+    start_time = time.time()
+    writer = nsrl_index.NSRLIndexWriter(index_path)
+    import_nsrl_hashes.ImportFile(writer, nsrl_path, None)
+    writer.Close()
+    self.AddResult("index: import", time.time() - start_time, self.FILES,
+                   "%d bytes" % os.path.getsize(index_path))
+
+    with test_lib.ConfigOverrider({"FileStore.nsrl_index_path": index_path}):
+      nsrl_fs = aff4.FACTORY.Open(
+          filestore.NSRLFileStore.PATH, token=self.token)
+      self._CheckHashes("index", nsrl_fs)
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""Tests for grr.lib.nsrl_index."""
+
+
+import hashlib
+import os
+
+
+from grr.lib import flags
+from grr.lib import hash_index
+from grr.lib import nsrl_index
+from grr.lib import test_lib
+from grr.lib.rdfvalues import nsrl as rdf_nsrl
+
+
+def SHA1(number):
+  return hashlib.sha1(str(number)).hexdigest()
+
+
+class NSRLIndexTest(test_lib.GRRBaseTest):
+
+  def setUp(self):
+    super(NSRLIndexTest, self).setUp()
+    self.path = os.path.join(self.temp_dir, "nsrl_index")
+
+  def _AddHash(self, writer, number, file_name=None, special_code=""):
+    writer.AddHash(
+        SHA1(number),
+        hashlib.md5(str(number)).hexdigest(), number, file_name or
+        "file%d.dll" % number, number * 10, [number, 1], ["358"], special_code)
+
+  def testLookup(self):
+    # Add the hashes out of order and sort them in several runs.
+    writer = nsrl_index.NSRLIndexWriter(self.path, max_entries=7)
+    for i in reversed(xrange(0, 100, 2)):
+      self._AddHash(writer, i, special_code="M" if i == 4 else "")
+    self.assertEqual(writer.Close(), 50)
+
+    index = nsrl_index.NSRLIndex(self.path)
+    self.assertEqual(len(index), 50)
+
+    digests = [SHA1(i).decode("hex") for i in xrange(100)]
+    self.assertEqual(
+        index.CheckDigests(digests), set(digests[i] for i in xrange(0, 100, 2)))
+
+    infos = index.Lookup(digests[:6])
+    self.assertEqual(sorted(infos), sorted(digests[0:6:2]))
+    info = infos[digests[4]]
+    self.assertEqual(info.sha1, digests[4])
+    self.assertEqual(info.md5, hashlib.md5("4").digest())
+    self.assertEqual(info.crc32, 4)
+    self.assertEqual(info.file_name, "file4.dll")
+    self.assertEqual(info.file_size, 40)
+    self.assertEqual(list(info.product_code), [4, 1])
+    self.assertEqual(list(info.op_system_code), ["358"])
+    self.assertEqual(info.file_type,
+                     rdf_nsrl.NSRLInformation.FileType.MALICIOUS_FILE)
+    self.assertEqual(infos[digests[2]].file_type,
+                     rdf_nsrl.NSRLInformation.FileType.NORMAL_FILE)
+    index.Close()
+
+  def testLastRecordForADigestWins(self):
+    writer = nsrl_index.NSRLIndexWriter(self.path, max_entries=2)
+    for name in ["first", "second", "third"]:
+      self._AddHash(writer, 1, file_name=name)
+      self._AddHash(writer, 2)
+    self.assertEqual(writer.Close(), 2)
+
+    index = nsrl_index.NSRLIndex(self.path)
+    digest = SHA1(1).decode("hex")
+    self.assertEqual(index.Lookup([digest])[digest].file_name, "third")
+
+  def testEmptyIndex(self):
+    self.assertEqual(nsrl_index.NSRLIndexWriter(self.path).Close(), 0)
+
+    index = nsrl_index.NSRLIndex(self.path)
+    self.assertEqual(len(index), 0)
+    self.assertEqual(index.Lookup([SHA1(0).decode("hex")]), {})
+
+  def testOpeningBadFilesRaises(self):
+    with open(self.path, "wb") as fd:
+      fd.write("not an NSRL index file")
+    with self.assertRaises(hash_index.IndexFileError):
+      nsrl_index.NSRLIndex(self.path)
+
+    writer = nsrl_index.NSRLIndexWriter(self.path)
+    self._AddHash(writer, 0)
+    writer.Close()
+    with open(self.path, "r+b") as fd:
+      fd.truncate(nsrl_index.HEADER.size + 10)
+    with self.assertRaises(hash_index.IndexFileError):
+      nsrl_index.NSRLIndex(self.path)
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -2,10 +2,14 @@
 """This is the manager for the various queues."""
 
 import collections
+import errno
 import os
 import random
 import socket
+import threading
 import time
+import weakref
+import zlib
 
 import logging
 
@@ -119,6 +123,7 @@ class QueueManager(object):
     self.frozen_timestamp = None
 
     self.num_notification_shards = config.CONFIG["Worker.queue_shards"]
+    self.lease_queue_shards = config.CONFIG["Worker.lease_queue_shards"]
 
   def GetNotificationShard(self, queue):
     queue_name = str(queue)
@@ -126,6 +131,15 @@ class QueueManager(object):
     QueueManager.notification_shard_counters[queue_name] += 1
     notification_shard_index = (QueueManager.notification_shard_counters[
         queue_name] % self.num_notification_shards)
+    return self._GetNotificationShardByIndex(queue, notification_shard_index)
+
+  def GetNotificationShardForSession(self, queue, session_id):
+    """Returns the shard all notifications for session_id are written to."""
+    notification_shard_index = (zlib.crc32(utils.SmartStr(session_id)) %
+                                self.num_notification_shards)
+    return self._GetNotificationShardByIndex(queue, notification_shard_index)
+
+  def _GetNotificationShardByIndex(self, queue, notification_shard_index):
     if notification_shard_index > 0:
       return queue.Add(str(notification_shard_index))
     else:
@@ -482,8 +496,22 @@ class QueueManager(object):
     Returns:
       dict of notifications objects keyed by priority.
     """
+    return self.GetNotificationsByPriorityForShards(
+        queue, self.GetAllNotificationShards(queue))
+
+  def GetNotificationsByPriorityForShards(self, queue, queue_shards):
+    """Same as GetNotificationsByPriority but for the given shards.
+
+    Used by the worker to rescan only the shards it was notified about.
+
+    Args:
+      queue: usually rdfvalue.RDFURN("aff4:/W")
+      queue_shards: An iterable of shard urns of this queue.
+    Returns:
+      dict of notifications objects keyed by priority.
+    """
     output_dict = {}
-    for queue_shard in self.GetAllNotificationShards(queue):
+    for queue_shard in queue_shards:
       self._GetUnsortedNotifications(
           queue_shard, notifications_by_session_id=output_dict)
 
@@ -592,8 +620,23 @@ class QueueManager(object):
 
       notification_list.append(notification)
 
-    mutation_pool.CreateNotifications(
-        self.GetNotificationShard(queue), notification_list)
+    if not self.lease_queue_shards:
+      mutation_pool.CreateNotifications(
+          self.GetNotificationShard(queue), notification_list)
+      return
+
+    # Workers only look at the shards they lease, so all notifications of a
+    # flow have to end up in the same shard for just one worker to see them.
+    notifications_by_shard = {}
+    for notification in notification_list:
+      queue_shard = self.GetNotificationShardForSession(
+          queue, notification.session_id)
+      notifications_by_shard.setdefault(utils.SmartStr(queue_shard),
+                                        []).append(notification)
+
+    for queue_shard, shard_notifications in notifications_by_shard.iteritems():
+      mutation_pool.CreateNotifications(
+          rdfvalue.RDFURN(queue_shard), shard_notifications)
 
   def DeleteNotification(self, session_id, start=None, end=None):
     self.DeleteNotifications([session_id], start=start, end=end)
@@ -774,6 +817,341 @@ class WellKnownQueueManager(QueueManager):
       yield response
 
 
+class NotificationWaiter(object):
+  """Collects the notified shards of a set of queue shards.
+
+  Obtained from QueueNotifier.Register(). A worker waits on this object
+  instead of sleeping between polls of the data store.
+  """
+
+  def __init__(self, notifier, queue_shards):
+    self.notifier = notifier
+    self.queue_shards = set(utils.SmartStr(shard) for shard in queue_shards)
+    self.pending = set()
+    self.woken = False
+
+  def Wake(self):
+    """Makes a pending or the next Wait() return immediately."""
+    with self.notifier.condition:
+      self.woken = True
+      self.notifier.condition.notify_all()
+
+  def Wait(self, timeout):
+    """Waits until any of our shards is notified or the timeout passes.
+
+    Args:
+      timeout: The maximum time to wait in seconds.
+
+    Returns:
+      True if there are notified shards or we were woken up.
+    """
+    with self.notifier.condition:
+      if not (self.pending or self.woken):
+        self.notifier.condition.wait(timeout)
+
+      return bool(self.pending or self.woken)
+
+  def PopShards(self):
+    """Returns the shards notified since the last call as urn strings."""
+    with self.notifier.condition:
+      shards, self.pending = self.pending, set()
+      self.woken = False
+
+    return shards
+
+
+class LocalNotificationChannel(object):
+  """Sends notified queue shards to workers in other processes on this host.
+
+  Every listening process binds a unix datagram socket in socket_dir. Sending
+  is a single non blocking datagram per listener so writers are never held up
+  by slow or dead workers. A lost datagram only delays the notification until
+  the worker polls the shard again.
+  """
+
+  SOCKET_SUFFIX = ".sock"
+
+  # How often the list of listening sockets is read from socket_dir.
+  REFRESH_INTERVAL = 5
+
+  def __init__(self, socket_dir):
+    self.socket_dir = socket_dir
+    self.socket_path = None
+    self.receiver = None
+    self.closed = False
+
+    self.sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    self.sender.setblocking(False)
+
+    self.lock = threading.Lock()
+    self.peers = []
+    self.last_refresh = 0
+
+  def _GetPeers(self):
+    with self.lock:
+      now = time.time()
+      if now - self.last_refresh > self.REFRESH_INTERVAL:
+        try:
+          names = os.listdir(self.socket_dir)
+        except OSError:
+          names = []
+
+        paths = [os.path.join(self.socket_dir, name) for name in names
+                 if name.endswith(self.SOCKET_SUFFIX)]
+        self.peers = [path for path in paths if path != self.socket_path]
+        self.last_refresh = now
+
+      return list(self.peers)
+
+  def _RemovePeer(self, path):
+    with self.lock:
+      if path in self.peers:
+        self.peers.remove(path)
+
+    try:
+      os.unlink(path)
+    except OSError:
+      pass
+
+  def Send(self, queue_shard):
+    data = utils.SmartStr(queue_shard)
+    for path in self._GetPeers():
+      try:
+        self.sender.sendto(data, path)
+      except socket.error as e:
+        if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+          # The listener went away without removing its socket.
+          self._RemovePeer(path)
+        # On EAGAIN the listener is not keeping up and has plenty of
+        # notifications queued already so dropping this one is fine.
+
+  def Listen(self, callback):
+    """Binds our socket and calls callback(queue_shard) for received shards."""
+    if self.receiver is not None:
+      return
+
+    if not os.path.isdir(self.socket_dir):
+      os.makedirs(self.socket_dir)
+
+    self.socket_path = os.path.join(
+        self.socket_dir, "%d.%x%s" % (os.getpid(), random.getrandbits(32),
+                                      self.SOCKET_SUFFIX))
+    self.receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    self.receiver.bind(self.socket_path)
+
+    thread = threading.Thread(
+        target=self._Receive, args=(callback,), name="NotificationChannel")
+    thread.daemon = True
+    thread.start()
+
+  def _Receive(self, callback):
+    while not self.closed:
+      try:
+        data = self.receiver.recv(4096)
+      except socket.error as e:
+        if e.errno == errno.EINTR:
+          continue
+        return
+
+      if data:
+        callback(data)
+
+  def Close(self):
+    self.closed = True
+
+    if self.receiver is not None:
+      # Wake up the receiving thread so it notices we are closed.
+      try:
+        self.sender.sendto("", self.socket_path)
+      except socket.error:
+        pass
+
+      try:
+        os.unlink(self.socket_path)
+      except OSError:
+        pass
+      self.receiver.close()
+
+    self.sender.close()
+
+
+class QueueNotifier(object):
+  """Wakes up workers when notifications are written to their queue shards.
+
+  Workers in the same process as the writer (e.g. a frontend running a worker)
+  are woken up directly. When a channel is configured, workers in other local
+  processes are reached through it.
+  """
+
+  def __init__(self, channel=None):
+    self.condition = threading.Condition()
+    self.waiters = weakref.WeakSet()
+    self.channel = channel
+
+  def Register(self, queue_shards):
+    """Returns a NotificationWaiter for the given shards."""
+    waiter = NotificationWaiter(self, queue_shards)
+    with self.condition:
+      self.waiters.add(waiter)
+
+    return waiter
+
+  def Listen(self):
+    """Starts receiving notifications from other processes."""
+    if self.channel is not None:
+      self.channel.Listen(lambda shard: self.Notify(shard, broadcast=False))
+
+  def Notify(self, queue_shard, broadcast=True):
+    """Called each time notifications are written to queue_shard."""
+    queue_shard = utils.SmartStr(queue_shard)
+
+    with self.condition:
+      woken = False
+      for waiter in self.waiters:
+        if queue_shard in waiter.queue_shards:
+          waiter.pending.add(queue_shard)
+          woken = True
+
+      if woken:
+        self.condition.notify_all()
+
+    if broadcast and self.channel is not None:
+      self.channel.Send(queue_shard)
+
+
+NOTIFIER = QueueNotifier()
+
+
+class QueueShardLeases(object):
+  """Leases a fair share of the notification shards of some queues.
+
+  A worker only processes notifications from the shards it holds a
+  DBSubjectLock on, so workers no longer race each other for the same flows.
+  Workers announce themselves with a heartbeat attribute on each queue's
+  membership subject and aim to hold ceil(shards / live workers) shards of
+  every queue. Rebalance() has to be called well within the lease time, it
+  renews our leases and releases or takes shards when workers join or leave.
+  """
+
+  MEMBER_PREDICATE_PREFIX = "worker:"
+
+  def __init__(self,
+               queues,
+               lease_time=60,
+               worker_id=None,
+               store=None,
+               token=None):
+    self.lease_time = lease_time
+    self.token = token
+    self.store = store or data_store.DB
+
+    if worker_id is None:
+      worker_id = "%s:%d:%x" % (socket.gethostname(), os.getpid(),
+                                random.getrandbits(32))
+    self.worker_id = worker_id
+
+    manager = QueueManager(store=self.store, token=token)
+    self.shards = dict((queue, manager.GetAllNotificationShards(queue))
+                       for queue in queues)
+
+    # Held shard leases keyed by the shard urn string.
+    self.leases = {}
+
+  def _GetMembersSubject(self, queue):
+    return queue.Add("workers")
+
+  def _Heartbeat(self, queue, now):
+    """Announces us as a member of queue and returns the number of members."""
+    subject = self._GetMembersSubject(queue)
+    self.store.Set(
+        subject,
+        self.MEMBER_PREDICATE_PREFIX + self.worker_id,
+        str(now + int(self.lease_time * 1e6)),
+        token=self.token)
+
+    members = 0
+    stale = []
+    for predicate, expires, _ in self.store.ResolvePrefix(
+        subject,
+        self.MEMBER_PREDICATE_PREFIX,
+        timestamp=self.store.NEWEST_TIMESTAMP,
+        token=self.token):
+      if int(expires) > now:
+        members += 1
+      else:
+        stale.append(predicate)
+
+    if stale:
+      self.store.DeleteAttributes(subject, stale, token=self.token)
+
+    return max(members, 1)
+
+  def Rebalance(self):
+    """Renews our leases and takes or gives up shards to hold a fair share."""
+    now = int(time.time() * 1e6)
+
+    for queue, shards in self.shards.iteritems():
+      target = -(-len(shards) // self._Heartbeat(queue, now))
+
+      held = []
+      for shard in shards:
+        lease = self.leases.get(utils.SmartStr(shard))
+        if lease is None:
+          continue
+
+        if lease.CheckLease() <= 0:
+          # We did not renew this lease in time so another worker might have
+          # taken the shard already. We must not touch its lock.
+          lease.locked = False
+          del self.leases[utils.SmartStr(shard)]
+          continue
+
+        lease.UpdateLease(self.lease_time)
+        held.append(shard)
+
+      while len(held) > target:
+        self.leases.pop(utils.SmartStr(held.pop())).Release()
+
+      # Start at a different shard for every worker to avoid all of them
+      # trying to lock the same shards first.
+      start = hash(self.worker_id) % len(shards)
+      for shard in shards[start:] + shards[:start]:
+        if len(held) >= target:
+          break
+
+        if utils.SmartStr(shard) in self.leases:
+          continue
+
+        try:
+          self.leases[utils.SmartStr(shard)] = self.store.DBSubjectLock(
+              shard, lease_time=self.lease_time, token=self.token)
+          held.append(shard)
+        except data_store.DBSubjectLockError:
+          pass
+
+  def GetShards(self, queue):
+    """Returns the shards of queue we currently hold a lease on."""
+    return [
+        shard for shard in self.shards.get(queue, [])
+        if utils.SmartStr(shard) in self.leases
+    ]
+
+  def Holds(self, queue_shard):
+    return utils.SmartStr(queue_shard) in self.leases
+
+  def Release(self):
+    """Gives up all our leases and our membership."""
+    for lease in self.leases.values():
+      lease.Release()
+    self.leases = {}
+
+    for queue in self.shards:
+      self.store.DeleteAttributes(
+          self._GetMembersSubject(queue),
+          [self.MEMBER_PREDICATE_PREFIX + self.worker_id],
+          token=self.token)
+
+
 class QueueManagerInit(registry.InitHook):
   """Registers vars used by the QueueManager."""
 
@@ -785,3 +1163,10 @@ class QueueManagerInit(registry.InitHook):
         "notification_queue_count",
         int,
         fields=[("queue_name", str), ("priority", str)])
+
+    socket_dir = config.CONFIG["Worker.notification_socket_dir"]
+    if socket_dir and NOTIFIER.channel is None:
+      NOTIFIER.channel = LocalNotificationChannel(socket_dir)
+
+    if NOTIFIER.Notify not in data_store.notification_listeners:
+      data_store.notification_listeners.append(NOTIFIER.Notify)
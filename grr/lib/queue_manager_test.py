@@ -2,6 +2,9 @@
 """Tests the queue manager."""
 
 
+import os
+import socket
+import threading
 import time
 import mock
 
@@ -12,6 +15,7 @@ from grr.lib import queues
 from grr.lib import rdfvalue
 from grr.lib import stats
 from grr.lib import test_lib
+from grr.lib import utils
 from grr.lib.rdfvalues import flows as rdf_flows
 
 # pylint: mode=test
@@ -579,6 +583,136 @@ class MultiShardedQueueManagerTest(QueueManagerTest):
           notifications = manager.GetNotifications(queues.HUNTS)
           self.assertEqual(len(notifications), 0)
 
+  def testNotifiedShardsWakeUpWaiter(self):
+    manager = queue_manager.QueueManager(token=self.token)
+    notifier = queue_manager.QueueNotifier()
+    waiter = notifier.Register(manager.GetAllNotificationShards(queues.HUNTS))
+
+    with utils.Stubber(data_store, "notification_listeners", [notifier.Notify]):
+      session_id = rdfvalue.SessionID(
+          base="aff4:/hunts", queue=queues.HUNTS, flow_name="42")
+      manager.QueueNotification(session_id=session_id)
+      manager.Flush()
+
+    self.assertTrue(waiter.Wait(0))
+    notified_shards = waiter.PopShards()
+    self.assertEqual(len(notified_shards), 1)
+
+    # Only the notified shard holds the notification.
+    notifications_by_priority = manager.GetNotificationsByPriorityForShards(
+        queues.HUNTS, [rdfvalue.RDFURN(shard) for shard in notified_shards])
+    self.assertEqual(
+        [n.session_id for n in notifications_by_priority.values()[0]],
+        [session_id])
+
+    # Shards are only reported once and other queues don't wake us up.
+    self.assertFalse(waiter.Wait(0))
+    notifier.Notify(queues.FLOWS)
+    self.assertFalse(waiter.Wait(0))
+    self.assertEqual(waiter.PopShards(), set())
+
+  def testLocalNotificationChannel(self):
+    notified = []
+    event = threading.Event()
+
+    def Callback(queue_shard):
+      notified.append(queue_shard)
+      event.set()
+
+    listener = queue_manager.LocalNotificationChannel(self.temp_dir)
+    sender = queue_manager.LocalNotificationChannel(self.temp_dir)
+    try:
+      listener.Listen(Callback)
+
+      sender.Send(queues.HUNTS.Add("1"))
+      event.wait(10)
+      self.assertEqual(notified, [str(queues.HUNTS.Add("1"))])
+    finally:
+      listener.Close()
+
+    # Sockets of listeners that went away are cleaned up by the senders.
+    sender.last_refresh = 0
+    stale_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    stale_path = os.path.join(self.temp_dir, "stale.sock")
+    stale_socket.bind(stale_path)
+    stale_socket.close()
+
+    sender.Send(queues.HUNTS)
+    sender.Close()
+    self.assertFalse(os.path.exists(stale_path))
+
+  def testNotificationsOfASessionShareAShardWhenLeasing(self):
+    with test_lib.ConfigOverrider({"Worker.lease_queue_shards": True}):
+      manager = queue_manager.QueueManager(token=self.token)
+      session_id = rdfvalue.SessionID(
+          base="aff4:/hunts", queue=queues.HUNTS, flow_name="42")
+      for i in range(manager.num_notification_shards):
+        manager.QueueNotification(
+            session_id=session_id,
+            timestamp=rdfvalue.RDFDatetime().FromSecondsFromEpoch(1000 + i))
+        manager.Flush()
+
+      shard = manager.GetNotificationShardForSession(queues.HUNTS, session_id)
+      notifications = manager.GetNotificationsByPriorityForShards(
+          queues.HUNTS, [shard])
+      self.assertEqual(len(notifications.values()[0]), 1)
+
+      other_shards = [
+          s for s in manager.GetAllNotificationShards(queues.HUNTS)
+          if s != shard
+      ]
+      self.assertEqual(
+          manager.GetNotificationsByPriorityForShards(queues.HUNTS,
+                                                      other_shards), {})
+
+  def testShardLeasesAreBalancedBetweenWorkers(self):
+    with test_lib.FakeTime(1000):
+      leases_a = queue_manager.QueueShardLeases(
+          [queues.HUNTS], lease_time=60, worker_id="a", token=self.token)
+      leases_a.Rebalance()
+      self.assertEqual(len(leases_a.GetShards(queues.HUNTS)), 2)
+
+      # A new worker can't get a shard until the other one gives one up.
+      leases_b = queue_manager.QueueShardLeases(
+          [queues.HUNTS], lease_time=60, worker_id="b", token=self.token)
+      leases_b.Rebalance()
+      self.assertEqual(leases_b.GetShards(queues.HUNTS), [])
+
+      leases_a.Rebalance()
+      leases_b.Rebalance()
+      shards_a = leases_a.GetShards(queues.HUNTS)
+      shards_b = leases_b.GetShards(queues.HUNTS)
+      self.assertEqual(len(shards_a), 1)
+      self.assertEqual(len(shards_b), 1)
+      self.assertNotEqual(shards_a, shards_b)
+      self.assertTrue(leases_b.Holds(shards_b[0]))
+      self.assertFalse(leases_b.Holds(shards_a[0]))
+
+      # When a worker leaves, the remaining one takes over its shards.
+      leases_b.Release()
+      leases_a.Rebalance()
+      self.assertEqual(len(leases_a.GetShards(queues.HUNTS)), 2)
+
+  def testShardLeasesOfDeadWorkersExpire(self):
+    with test_lib.FakeTime(1000):
+      leases_a = queue_manager.QueueShardLeases(
+          [queues.HUNTS], lease_time=60, worker_id="a", token=self.token)
+      leases_a.Rebalance()
+
+      leases_b = queue_manager.QueueShardLeases(
+          [queues.HUNTS], lease_time=60, worker_id="b", token=self.token)
+      leases_b.Rebalance()
+      self.assertEqual(leases_b.GetShards(queues.HUNTS), [])
+
+    # Worker a stopped renewing its leases.
+    with test_lib.FakeTime(1061):
+      leases_b.Rebalance()
+      self.assertEqual(len(leases_b.GetShards(queues.HUNTS)), 2)
+
+      # Worker a notices it lost its leases.
+      leases_a.Rebalance()
+      self.assertEqual(leases_a.GetShards(queues.HUNTS), [])
+
 
 def main(argv):
   test_lib.main(argv)
@@ -3,10 +3,17 @@
 
 
 
+import time
+
+
+from grr.lib import aff4
+from grr.lib import client_fixture
 from grr.lib import flags
 from grr.lib import test_lib
 from grr.lib import type_info
+from grr.lib import utils
 from grr.lib.rdfvalues import client as rdf_client
+from grr.lib.rdfvalues import flows as rdf_flows
 from grr.lib.rdfvalues import structs as rdf_structs
 from grr.proto import jobs_pb2
 from grr.proto import knowledge_base_pb2
@@ -340,6 +347,94 @@ class RDFValueBenchmark(test_lib.AverageMicroBenchmarks):
     self.TimeIt(ProtoDecodeEncode)
 
 
+class ClientFixtureBenchmark(test_lib.MicroBenchmarks):
+  """Parsing and re-serializing message lists of real client data."""
+
+  labels = ["benchmark"]
+
+  REPEATS = 100
+
+  def setUp(self):
+    super(ClientFixtureBenchmark, self).setUp(["Messages"], ["<20"])
+
+    # All the protobufs in the client fixture, sent as client responses.
+    args = dict(client_id="C.1000000000000000", age=0)
+    message_list = rdf_flows.MessageList()
+    for _, (_, attributes) in client_fixture.VFS:
+      for attribute_name, value in attributes.items():
+        attribute = aff4.Attribute.PREDICATES[attribute_name]
+        if (isinstance(value, basestring) and aff4.issubclass(
+            attribute.attribute_type, rdf_structs.RDFProtoStruct)):
+          payload = attribute.attribute_type.FromTextFormat(
+              utils.SmartStr(value % args))
+          message_list.job.Append(
+              session_id="aff4:/flows/W:1234", name=attribute_name,
+              payload=payload)
+
+    self.message_count = len(message_list)
+    self.data = message_list.SerializeToString()
+
+  def _TimeIt(self, name, callback):
+    start = time.time()
+    for _ in xrange(self.REPEATS):
+      callback()
+
+    self.AddResult(name, (time.time() - start) / self.REPEATS, self.REPEATS,
+                   self.message_count)
+
+  def testParseAndSerialize(self):
+    """Decoding and encoding a MessageList of StatEntry and other responses."""
+
+    def Parse():
+      rdf_flows.MessageList.FromSerializedString(self.data)
+
+    def ParseAndSerialize():
+      message_list = rdf_flows.MessageList.FromSerializedString(self.data)
+      message_list.SerializeToString()
+
+    def ParseReadOneAndSerialize():
+      message_list = rdf_flows.MessageList.FromSerializedString(self.data)
+      _ = message_list.job[0].payload
+      message_list.SerializeToString()
+
+    def ParseReadAllAndSerialize():
+      message_list = rdf_flows.MessageList.FromSerializedString(self.data)
+      for message in message_list.job:
+        _ = message.session_id
+      message_list.SerializeToString()
+
+    def ParseReadAllPayloads():
+      message_list = rdf_flows.MessageList.FromSerializedString(self.data)
+      for message in message_list.job:
+        _ = message.payload
+
+    self._TimeIt("Parse", Parse)
+    self._TimeIt("Parse and serialize", ParseAndSerialize)
+    self._TimeIt("Parse, read one, serialize", ParseReadOneAndSerialize)
+    self._TimeIt("Parse, read all, serialize", ParseReadAllAndSerialize)
+    self._TimeIt("Parse, decode all payloads", ParseReadAllPayloads)
+
+  def testReceiveMessages(self):
+    """Serializing messages of a MessageList the way the frontend does."""
+
+    authenticated = rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED
+
+    def SerializeMessages():
+      message_list = rdf_flows.MessageList.FromSerializedString(self.data)
+      for message in message_list.job:
+        message.SerializeToString()
+
+    def ReceiveMessages():
+      message_list = rdf_flows.MessageList.FromSerializedString(self.data)
+      for message in message_list.job:
+        message.auth_state = authenticated
+        message.source = "C.1000000000000000"
+        message.SerializeToString()
+
+    self._TimeIt("Serialize all", SerializeMessages)
+    self._TimeIt("Authenticate and serialize all", ReceiveMessages)
+
+
 def main(argv):
   # Run the full test suite
   test_lib.GrrTestProgram(argv=argv)
@@ -533,6 +533,119 @@ class ForemanIntegerClientRuleTest(test_base.RDFValueTestCase):
             client_id))
 
 
+class CompiledForemanRulesTest(test_lib.GRRBaseTest):
+  """Tests for the compiled foreman rules."""
+
+  def _MakeRule(self, created, match_mode, client_rules):
+    return rdf_foreman.ForemanRule(
+        created=created,
+        expires=created + 1000,
+        description="rule created at %d" % created,
+        client_rule_set=rdf_foreman.ForemanClientRuleSet(
+            match_mode=match_mode, rules=client_rules))
+
+  def _OsRule(self, **kwargs):
+    return rdf_foreman.ForemanClientRule(
+        rule_type=rdf_foreman.ForemanClientRule.Type.OS,
+        os=rdf_foreman.ForemanOsClientRule(**kwargs))
+
+  def _LabelRule(self, label):
+    return rdf_foreman.ForemanClientRule(
+        rule_type=rdf_foreman.ForemanClientRule.Type.LABEL,
+        label=rdf_foreman.ForemanLabelClientRule(label_names=[label]))
+
+  def testGetRulesCreatedAfterReturnsOnlyNewerRules(self):
+    match_any = rdf_foreman.ForemanClientRuleSet.MatchMode.MATCH_ANY
+    rules = rdf_foreman.CompiledForemanRules([
+        self._MakeRule(300, match_any, []),
+        self._MakeRule(100, match_any, []),
+        self._MakeRule(200, match_any, [])
+    ])
+
+    self.assertEqual(rules.latest_rule_time, 300)
+    self.assertEqual(rules.earliest_expiry, 1100)
+    self.assertEqual([rules.rules[i].created
+                      for i in rules.GetRulesCreatedAfter(0)], [100, 200, 300])
+    self.assertEqual([rules.rules[i].created
+                      for i in rules.GetRulesCreatedAfter(200)], [300])
+    self.assertEqual(list(rules.GetRulesCreatedAfter(300)), [])
+
+  def testEvaluatesRulesSharingClientRules(self):
+    match_all = rdf_foreman.ForemanClientRuleSet.MatchMode.MATCH_ALL
+    match_any = rdf_foreman.ForemanClientRuleSet.MatchMode.MATCH_ANY
+    linux = self._OsRule(os_linux=True)
+    darwin = self._OsRule(os_darwin=True)
+    rules = rdf_foreman.CompiledForemanRules([
+        self._MakeRule(100, match_all, [linux, self._LabelRule("foo")]),
+        self._MakeRule(200, match_any, [darwin, linux]),
+        self._MakeRule(300, match_all, [linux]),
+        self._MakeRule(400, match_all, [darwin])
+    ])
+
+    client_id, = self.SetupClients(nr_clients=1, system="Linux")
+    indexes = rules.GetRulesCreatedAfter(0)
+    objects = CollectAff4Objects(
+        rules.GetPathsToCheck(indexes), client_id, self.token)
+
+    matching = rules.GetMatchingRules(indexes, objects, client_id)
+    self.assertEqual([rule.created for rule in matching], [200, 300])
+
+  def testOnlyRulesMatchingTheClientOsAndLabelsAreEvaluated(self):
+    match_all = rdf_foreman.ForemanClientRuleSet.MatchMode.MATCH_ALL
+    match_any = rdf_foreman.ForemanClientRuleSet.MatchMode.MATCH_ANY
+    linux = self._OsRule(os_linux=True)
+    windows = self._OsRule(os_windows=True)
+
+    def HostRule(created):
+      return rdf_foreman.ForemanClientRule(
+          rule_type=rdf_foreman.ForemanClientRule.Type.REGEX,
+          regex=rdf_foreman.ForemanRegexClientRule(
+              attribute_name="Host", attribute_regex=".{0,%d}" % created))
+
+    rules = rdf_foreman.CompiledForemanRules([
+        self._MakeRule(100, match_all, [HostRule(100), windows]),
+        self._MakeRule(200, match_all, [HostRule(200), self._LabelRule("foo")]),
+        self._MakeRule(300, match_all, [HostRule(300), self._LabelRule("bar")]),
+        self._MakeRule(400, match_any, [HostRule(400), windows]),
+        self._MakeRule(500, match_all, [HostRule(500), linux]),
+        self._MakeRule(600, match_all, [])
+    ])
+
+    client_id, = self.SetupClients(nr_clients=1, system="Linux")
+    with aff4.FACTORY.Open(client_id, mode="rw", token=self.token) as client:
+      client.AddLabels("foo", owner="GRR")
+
+    indexes = rules.GetRulesCreatedAfter(0)
+    objects = CollectAff4Objects(
+        rules.GetPathsToCheck(indexes), client_id, self.token)
+
+    with test_lib.Instrument(rdf_foreman.ForemanClientValues, "Get") as get:
+      matching = rules.GetMatchingRules(indexes, objects, client_id)
+
+    self.assertEqual([rule.created for rule in matching], [200, 400, 500, 600])
+    # The rules requiring Windows or the label "bar" are not evaluated.
+    self.assertEqual(
+        len([args for args in get.args if args[1:] == ("/", "Host")]), 3)
+
+  def testClientValuesAreReadOnce(self):
+    client_id, = self.SetupClients(nr_clients=1, system="Linux")
+    objects = CollectAff4Objects(["/"], client_id, self.token)
+    values = rdf_foreman.ForemanClientValues(objects, client_id)
+
+    self.assertEqual(values.Get("/", "System"), "Linux")
+    # Changing the object doesn't change the value already read.
+    fd = objects[client_id]
+    fd.Set(fd.Schema.SYSTEM("Windows"))
+    self.assertEqual(values.Get("/", "System"), "Linux")
+
+    self.assertIs(
+        values.Get("/does/not/exist", "System"),
+        rdf_foreman.ForemanClientValues.MISSING)
+    self.assertIs(
+        values.Get("/", "NoSuchAttribute"),
+        rdf_foreman.ForemanClientValues.MISSING)
+
+
 def main(argv):
   # Run the full test suite
   test_lib.GrrTestProgram(argv=argv)
@@ -32,6 +32,14 @@ class HuntContext(rdf_structs.RDFProtoStruct):
   ]
 
 
+class HuntSummary(rdf_structs.RDFProtoStruct):
+  protobuf = flows_pb2.HuntSummary
+  rdf_deps = [
+      rdfvalue.RDFDatetime,
+      rdfvalue.SessionID,
+  ]
+
+
 class HuntRunnerArgs(rdf_structs.RDFProtoStruct):
   """Hunt runner arguments definition."""
 
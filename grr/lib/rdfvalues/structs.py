@@ -62,6 +62,11 @@ ORD_MAP_AND_0X80 = dict((chr(x), x & 0x80) for x in range(0, 256))
 ORD_MAP_AND_0X7F = dict((chr(x), x & 0x7F) for x in range(0, 256))
 
 
+# Total number of bytes of parsed structs which were serialized by writing back
+# the bytes they were parsed from, instead of encoding their fields again.
+PASSTHROUGH_BYTES = 0
+
+
 # This function is HOT.
 def ReadTag(buf, pos):
   """Read a tag from the buffer, and return a (tag_bytes, new_pos) tuple."""
@@ -208,19 +213,75 @@ def SerializeEntries(entries):
 
 
 def ReadIntoObject(buff, index, value_obj, length=0):
-  """Reads all tags until the next end group and store in the value_obj."""
+  """Reads all tags until the next end group and store in the value_obj.
+
+  This makes a single pass over the buffer. Fields are stored in their wire
+  format and only decoded when they are accessed. Repeated fields are not split
+  into their elements here at all: we just record the offsets of their entries
+  and store them as a single wire format string, which is split into elements
+  when the field is first accessed, or written back as is if it never is.
+
+  Args:
+    buff: The buffer to parse.
+    index: The position to start parsing.
+    value_obj: The RDFStruct to read the fields into.
+    length: Optional position to parse until.
+  """
   raw_data = value_obj.GetRawData()
+  type_infos_by_encoded_tag = value_obj.type_infos_by_encoded_tag
   count = 0
 
-  # Split the buffer into tags and wire_format representations, then collect
-  # these into the raw data cache.
-  for (encoded_tag, encoded_length, encoded_field) in SplitBuffer(
-      buff, index=index, length=length):
+  # The buffer can be written back as it is unless we merge into existing data.
+  keep_serialized = not raw_data and index == 0 and length in (0, len(buff))
+
+  # Maps repeated field descriptors to [start, end] offsets of their entries.
+  repeated_fields = {}
+
+  buffer_len = length or len(buff)
+  while index < buffer_len:
+    entry_start = index
+
+    # data_index is the index where the data begins (i.e. after the tag).
+    encoded_tag, data_index = ReadTag(buff, index)
+
+    tag_type = ORD_MAP[encoded_tag[0]] & TAG_TYPE_MASK
+    if tag_type == WIRETYPE_LENGTH_DELIMITED:
+      data_length, data_start = VarintReader(buff, data_index)
+      index = data_start + data_length
+
+    elif tag_type == WIRETYPE_VARINT:
+      data_start = data_index
+      _, index = VarintReader(buff, data_index)
+
+    elif tag_type == WIRETYPE_FIXED64:
+      data_start = data_index
+      index = data_index + 8
+
+    elif tag_type == WIRETYPE_FIXED32:
+      data_start = data_index
+      index = data_index + 4
+
+    else:
+      raise rdfvalue.DecodeError("Unexpected Tag.")
+
+    type_info_obj = type_infos_by_encoded_tag.get(encoded_tag)
+
+    # Repeated fields are handled especially. Entries of a repeated field are
+    # usually adjacent so we only need to extend the last range.
+    if type_info_obj.__class__ is ProtoList:
+      ranges = repeated_fields.get(type_info_obj)
+      if ranges is None:
+        repeated_fields[type_info_obj] = [[entry_start, index]]
+      elif ranges[-1][1] == entry_start:
+        ranges[-1][1] = index
+      else:
+        ranges.append([entry_start, index])
 
-    type_info_obj = value_obj.type_infos_by_encoded_tag.get(encoded_tag)
+      continue
 
     # Internal format to store parsed fields.
-    wire_format = (encoded_tag, encoded_length, encoded_field)
+    wire_format = (encoded_tag, buff[data_index:data_start],
+                   buff[data_start:index])
 
     # If the tag is not found we need to skip it. Skipped fields are
     # inaccessible to this actual object, because they have no type info
@@ -241,16 +302,29 @@ def ReadIntoObject(buff, index, value_obj, length=0):
 
       count += 1
 
-    # Repeated fields are handled especially.
-    elif type_info_obj.__class__ is ProtoList:
-      value_obj.Get(type_info_obj.name).wrapped_list.append((None, wire_format))
-
     else:
       # Set the python_format as None so it gets converted lazily on access.
       raw_data[type_info_obj.name] = (None, wire_format, type_info_obj)
 
+  for type_info_obj, ranges in repeated_fields.iteritems():
+    entries = "".join(buff[start:end] for start, end in ranges)
+
+    if type_info_obj.name in raw_data:
+      # We are merging into an existing list so it must be materialized.
+      repeated_field = value_obj.Get(type_info_obj.name)
+      for wire_format in SplitBuffer(entries):
+        repeated_field.wrapped_list.append((None, wire_format))
+      repeated_field.dirty = True
+
+    else:
+      # This is the wire format ProtoList.ConvertFromWireFormat() expects.
+      raw_data[type_info_obj.name] = (None, ("", "", entries), type_info_obj)
+
   value_obj.SetRawData(raw_data)
 
+  if keep_serialized:
+    value_obj.SetSerialized(buff)
+
 
 # pylint: disable=invalid-name
 if _semantic:
@@ -854,11 +928,17 @@ class ProtoEmbedded(ProtoType):
     result = self.type()
     ReadIntoObject(value[2], 0, result)
 
+    # The freshly decoded protobuf is identical to its wire format. Unless it
+    # is modified, it can be written back without serializing it again.
+    result.dirty = False
+
     return result
 
   def ConvertToWireFormat(self, value):
     """Encode the nested protobuf into wire format."""
-    output = SerializeEntries(value.GetRawData().itervalues())
+    # Some structs override SerializeToString() with a different
+    # representation, but nested structs are always encoded as protobufs.
+    output = RDFStruct.SerializeToString(value)
     return (self.encoded_tag, VarintEncode(len(output)), output)
 
   def LateBind(self, target=None):
@@ -1094,9 +1174,11 @@ class RepeatedFieldHelper(object):
     if self.dirty:
       return True
 
-    # If any of the items is dirty we are also dirty.
-    for item in self.wrapped_list:
-      if self.type_descriptor.IsDirty(item[0]):
+    # If any of the items is dirty we are also dirty. Items which were never
+    # decoded can not have been modified.
+    for python_format, _ in self.wrapped_list:
+      if (python_format is not None and
+          self.type_descriptor.IsDirty(python_format)):
         self.dirty = True
         return True
 
@@ -1125,12 +1207,14 @@ class RepeatedFieldHelper(object):
                                        type(rdf_value), e))
 
     self.wrapped_list.append((rdf_value, wire_format))
+    self.dirty = True
 
     return rdf_value
 
   def Pop(self, item):
     result = self[item]
     self.wrapped_list.pop(item)
+    self.dirty = True
     return result
 
   def Extend(self, iterable):
@@ -1247,7 +1331,9 @@ class ProtoList(ProtoType):
     return result
 
   def ConvertFromWireFormat(self, value, container=None):
-    result = RepeatedFieldHelper(type_descriptor=self.delegate)
+    """Splits the serialized entries into a list of lazy elements."""
+    result = RepeatedFieldHelper(
+        type_descriptor=self.delegate, container=container)
     for wire_format in SplitBuffer(value[2]):
       result.wrapped_list.append((None, wire_format))
 
@@ -1545,6 +1631,13 @@ class RDFStruct(rdfvalue.RDFValue):
   # Stores the raw data here.
   _data = None
 
+  # The serialized form this struct was parsed from, as long as none of the
+  # parsed fields were modified, the names of the parsed fields which were
+  # decoded and the names of the fields which were added since.
+  _serialized = None
+  _decoded_fields = ()
+  _added_fields = ()
+
   # A list of fields which will be removed from this class's type descriptor
   # set.
   suppressions = []
@@ -1601,6 +1694,8 @@ class RDFStruct(rdfvalue.RDFValue):
   def Clear(self):
     """Clear all the fields."""
     self._data = {}
+    self._serialized = None
+    self.dirty = True
 
   def HasField(self, field_name):
     """Checks if the field exists."""
@@ -1671,10 +1766,44 @@ class RDFStruct(rdfvalue.RDFValue):
 
   def SetRawData(self, data):
     self._data = data
+    self._serialized = None
     self.dirty = True
 
+  def SetSerialized(self, serialized):
+    """Records the serialized form matching the current raw data.
+
+    As long as the parsed fields are not modified, SerializeToString() writes
+    these bytes back as they are and only encodes the fields added since.
+
+    Args:
+      serialized: The string the current raw data was parsed from.
+    """
+    self._serialized = serialized
+    self._decoded_fields = []
+    self._added_fields = ()
+
   def SerializeToString(self):
-    return SerializeEntries(self._data.itervalues())
+    data = self.GetRawData()
+    serialized = self._serialized
+    if serialized is None:
+      return SerializeEntries(data.itervalues())
+
+    # Only decoded fields can have been modified in place.
+    for name in self._decoded_fields:
+      python_format, _, type_descriptor = data[name]
+      if type_descriptor.IsDirty(python_format):
+        self._serialized = None
+        return SerializeEntries(data.itervalues())
+
+    global PASSTHROUGH_BYTES  # pylint: disable=global-statement
+    PASSTHROUGH_BYTES += len(serialized)
+
+    added_fields = self._added_fields
+    if not added_fields:
+      return serialized
+
+    return serialized + SerializeEntries(
+        data[name] for name in added_fields if name in data)
 
   def ParseFromString(self, string):
     ReadIntoObject(string, 0, self)
@@ -1728,6 +1857,15 @@ class RDFStruct(rdfvalue.RDFValue):
   def _Set(self, value, type_descriptor):
     """Validate the value and set the attribute with it."""
     attr = type_descriptor.name
+
+    # Fields which were not parsed can be encoded after the parsed ones, all
+    # others invalidate the serialized form.
+    if self._serialized is not None and attr not in self._added_fields:
+      if attr in self._data:
+        self._serialized = None
+      elif value is not None:
+        self._added_fields += (attr,)
+
     # A value of None means we clear the field.
     if value is None:
       self._data.pop(attr, None)
@@ -1783,6 +1921,9 @@ class RDFStruct(rdfvalue.RDFValue):
 
       self._data[attr] = (python_format, wire_format, type_descriptor)
 
+      if self._serialized is not None:
+        self._decoded_fields.append(attr)
+
     return python_format
 
   def GetPrimitive(self, attr):
@@ -1832,6 +1973,7 @@ class RDFStruct(rdfvalue.RDFValue):
 
     value = type_info_obj.primitive_desc.ConvertToWireFormat(value)
     self._data[attr] = (None, value, type_info_obj)
+    self._serialized = None
 
     # Make sure to invalidate our parent's cache if needed.
     self.dirty = True
@@ -2234,3 +2376,20 @@ class SemanticDescriptor(RDFProtoStruct):
 class AnyValue(RDFProtoStruct):
   """Protobuf with arbitrary serialized proto and its type."""
   protobuf = any_pb2.Any
+
+
+class StructsInit(registry.InitHook):
+
+  def RunOnce(self):
+    """Registers the stats of this module."""
+    # The stats module depends on this one.
+    # pylint: disable=g-import-not-at-top
+    from grr.lib import stats
+    # pylint: enable=g-import-not-at-top
+
+    # Bytes of parsed structs which were serialized again without encoding
+    # their fields. This only ever increases, but a counter would have to be
+    # incremented for every serialized struct.
+    stats.STATS.RegisterGaugeMetric("grr_rdfstruct_passthrough_bytes", int)
+    stats.STATS.SetGaugeCallback("grr_rdfstruct_passthrough_bytes",
+                                 lambda: PASSTHROUGH_BYTES)
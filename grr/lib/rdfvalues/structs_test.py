@@ -457,6 +457,89 @@ class RDFStructsTest(test_base.RDFValueTestCase):
     # old result instead.
     self.assertTrue("booo" in path.SerializeToString())
 
+  def testRepeatedFieldsAreDecodedOnAccess(self):
+    tested = TestStruct(foobar="hello")
+    for i in range(5):
+      tested.repeat_nested.Append(foobar="Nest%s" % i)
+
+    serialized = tested.SerializeToString()
+    tested = TestStruct.FromSerializedString(serialized)
+
+    # The repeated field is kept in its wire format until it is accessed.
+    python_format, _, _ = tested.GetRawData()["repeat_nested"]
+    self.assertIsNone(python_format)
+    self.assertEqual(tested.SerializeToString(), serialized)
+
+    self.assertEqual(len(tested.repeat_nested), 5)
+    self.assertEqual(tested.repeat_nested[3].foobar, "Nest3")
+
+    # Reading the elements does not change the serialized form.
+    self.assertEqual(tested.SerializeToString(), serialized)
+
+    # But modifying them does.
+    tested.repeat_nested[3].foobar = "booo"
+    tested.repeat_nested.Append(foobar="Nest5")
+    tested = TestStruct.FromSerializedString(tested.SerializeToString())
+    self.assertEqual([x.foobar for x in tested.repeat_nested],
+                     ["Nest0", "Nest1", "Nest2", "booo", "Nest4", "Nest5"])
+
+  def testUnmodifiedEmbeddedStructsAreNotSerializedAgain(self):
+    tested = TestStruct(foobar="hello")
+    tested.nested.foobar = "goodbye"
+    tested.nested.repeated = ["a", "b"]
+
+    tested = TestStruct.FromSerializedString(tested.SerializeToString())
+    self.assertEqual(tested.nested.foobar, "goodbye")
+    self.assertEqual(list(tested.nested.repeated), ["a", "b"])
+
+    nested_type_info = tested.type_infos["nested"]
+    self.assertFalse(nested_type_info.IsDirty(tested.nested))
+
+    tested.nested.repeated.Append("c")
+    self.assertTrue(nested_type_info.IsDirty(tested.nested))
+
+    tested = TestStruct.FromSerializedString(tested.SerializeToString())
+    self.assertEqual(list(tested.nested.repeated), ["a", "b", "c"])
+
+  def testUnmodifiedStructsAreWrittenBackAsParsed(self):
+    tested = TestStruct(foobar="hello", int=10)
+    tested.nested.foobar = "goodbye"
+    tested.repeat_nested.Append(foobar="Nest")
+
+    # Make sure a field encoded differently than we would do it is preserved.
+    serialized = tested.SerializeToString() + TestStruct(
+        int=10).SerializeToString()
+
+    passthrough_bytes = structs.PASSTHROUGH_BYTES
+    tested = TestStruct.FromSerializedString(serialized)
+    self.assertEqual(tested.nested.foobar, "goodbye")
+    self.assertEqual(tested.SerializeToString(), serialized)
+    self.assertEqual(structs.PASSTHROUGH_BYTES - passthrough_bytes,
+                     len(serialized))
+
+    # New fields are encoded after the parsed ones.
+    tested.float = 2.5
+    tested.repeated.Append("new")
+    self.assertTrue(tested.SerializeToString().startswith(serialized))
+
+    tested = TestStruct.FromSerializedString(tested.SerializeToString())
+    self.assertEqual(tested.float, 2.5)
+    self.assertEqual(list(tested.repeated), ["new"])
+    self.assertEqual(tested.nested.foobar, "goodbye")
+
+    # Changing parsed fields invalidates the serialized form.
+    for modify in (lambda x: setattr(x, "int", 1),
+                   lambda x: setattr(x, "foobar", None),
+                   lambda x: setattr(x.nested, "foobar", "changed"),
+                   lambda x: x.repeat_nested.Append(foobar="Nest2")):
+      tested = TestStruct.FromSerializedString(serialized)
+      modify(tested)
+      self.assertNotEqual(tested.SerializeToString(), serialized)
+
+      new_tested = TestStruct.FromSerializedString(
+          tested.SerializeToString())
+      self.assertEqual(new_tested, tested)
+
   def testWireFormatAccess(self):
 
     m = rdf_flows.SignedMessageList()
@@ -3,14 +3,14 @@
 """
 
 import collections
+import itertools
 import random
-import threading
-import time
+import struct
+
+import logging
 
-from grr.lib import access_control
 from grr.lib import data_store
 from grr.lib import rdfvalue
-from grr.lib import registry
 from grr.lib import utils
 
 from grr.lib.rdfvalues import flows as rdf_flows
@@ -165,13 +165,29 @@ class SequentialCollection(object):
         suffix=suffix,
         **kwargs)
 
-  def Scan(self, after_timestamp=None, include_suffix=False, max_records=None):
-    """Scans for stored records.
-
-    Scans through the collection, returning stored values ordered by timestamp.
+  def _DecodeValue(self, value, timestamp):
+    """Turns a stored record into the value returned by Scan."""
+    # Passing the age in saves creating a default RDFDatetime for each record,
+    # it is converted when it is first accessed.
+    rdf_value = self.RDF_TYPE(age=timestamp)
+    rdf_value.ParseFromString(value)
+    return rdf_value
+
+  def ScanBatches(self,
+                  batch_size=1000,
+                  after_timestamp=None,
+                  include_suffix=False,
+                  max_records=None,
+                  decode=True):
+    """Scans for stored records, a batch at a time.
+
+    Each batch is read from the data store in a single request, which makes
+    this much faster than Scan for iterating over large collections.
 
     Args:
 
+      batch_size: The maximum number of records in each batch.
+
       after_timestamp: If set, only returns values recorded after timestamp.
 
       include_suffix: If true, the timestamps returned are pairs of the form
@@ -181,9 +197,12 @@ class SequentialCollection(object):
       max_records: The maximum number of records to return. Defaults to
         unlimited.
 
+      decode: If false, the serialized records are returned instead of the
+        rdf values so that callers can decode them lazily, or not at all.
+
     Yields:
-      Pairs (timestamp, rdf_value), indicating that rdf_value was stored at
-      timestamp.
+      Lists of pairs (timestamp, rdf_value), indicating that rdf_value was
+      stored at timestamp.
 
     """
     after_urn = None
@@ -196,18 +215,51 @@ class SequentialCollection(object):
       after_urn = utils.SmartStr(
           self._MakeURN(self.collection_id, after_timestamp, suffix=suffix))
 
-    for subject, timestamp, value in data_store.DB.ScanAttribute(
+    for records in data_store.DB.ScanAttributeBatches(
         self.collection_id.Add("Results"),
         self.ATTRIBUTE,
         after_urn=after_urn,
         max_records=max_records,
+        batch_size=batch_size,
         token=self.token):
-      rdf_value = self.RDF_TYPE.FromSerializedString(value)
-      rdf_value.age = timestamp
       if include_suffix:
-        yield (self._ParseURN(subject), rdf_value)
+        keys = [self._ParseURN(subject) for subject, _, _ in records]
+      else:
+        keys = [timestamp for _, timestamp, _ in records]
+
+      if decode:
+        yield [(key, self._DecodeValue(value, timestamp))
+               for key, (_, timestamp, value) in zip(keys, records)]
       else:
-        yield (timestamp, rdf_value)
+        yield [(key, value) for key, (_, _, value) in zip(keys, records)]
+
+  def Scan(self, after_timestamp=None, include_suffix=False, max_records=None):
+    """Scans for stored records.
+
+    Scans through the collection, returning stored values ordered by timestamp.
+
+    Args:
+
+      after_timestamp: If set, only returns values recorded after timestamp.
+
+      include_suffix: If true, the timestamps returned are pairs of the form
+        (micros_since_epoc, suffix) where suffix is a 24 bit random refinement
+        to avoid collisions. Otherwise only micros_since_epoc is returned.
+
+      max_records: The maximum number of records to return. Defaults to
+        unlimited.
+
+    Yields:
+      Pairs (timestamp, rdf_value), indicating that rdf_value was stored at
+      timestamp.
+
+    """
+    for batch in self.ScanBatches(
+        after_timestamp=after_timestamp,
+        include_suffix=include_suffix,
+        max_records=max_records):
+      for item in batch:
+        yield item
 
   def MultiResolve(self, timestamps):
     """Lookup multiple values by (timestamp, suffix) pairs."""
@@ -230,201 +282,487 @@ class SequentialCollection(object):
   def Delete(self):
     pool = data_store.DB.GetMutationPool(self.token)
     with pool:
-      for subject, _, _ in data_store.DB.ScanAttribute(
+      for batch in data_store.DB.ScanAttributeBatches(
           self.collection_id.Add("Results"), self.ATTRIBUTE, token=self.token):
-        pool.DeleteSubject(subject)
+        for subject, _, _ in batch:
+          pool.DeleteSubject(subject)
         if pool.Size() > 50000:
           pool.Flush()
 
 
-class BackgroundIndexUpdater(object):
-  """Updates IndexedSequentialCollection objects in the background."""
-  INDEX_DELAY = 240
+class Error(Exception):
+  """Base class for errors of this module."""
 
-  exit_now = False
 
-  def __init__(self):
-    self.to_process = collections.deque()
-    self.cv = threading.Condition()
+class MissingRecordError(Error):
+  """Raised when a record which is in the index can't be read."""
 
-  def ExitNow(self):
-    with self.cv:
-      self.exit_now = True
-      self.to_process.append(None)
-      self.cv.notify()
 
-  def AddIndexToUpdate(self, collection_cls, index_urn):
-    with self.cv:
-      self.to_process.append((collection_cls, index_urn,
-                              time.time() + self.INDEX_DELAY))
-      self.cv.notify()
+class IndexedSequentialCollection(SequentialCollection):
+  """An indexed sequential collection of RDFValues.
 
-  def ProcessCollection(self, collection_cls, collection_id, token):
-    collection_cls(collection_id, token=token).UpdateIndex()
+  Adds an index to SequentialCollection, making it efficient to find the number
+  of records present, and to find a particular record number.
 
-  def UpdateLoop(self):
-    token = access_control.ACLToken(
-        username="Background Index Updater", reason="Updating An Index")
-    while not self.exit_now:
-      with self.cv:
-        while not self.to_process:
-          self.cv.wait()
-        next_update = self.to_process.popleft()
-        if next_update is None:
-          return
+  Every record written gets a pending marker on the collection subject. The
+  writer then appends all the pending records of the collection to the index,
+  removing their markers in the same write. A MutationPool does this once per
+  collection when it is flushed, so a batch of records costs one index update.
+  Markers left behind by a writer which failed to lock the index or died are
+  indexed by the next writer of the collection. Readers number the indexed
+  records first and the pending ones after them, in timestamp order, so
+  records are visible as soon as they are written. The index is append only,
+  so the record number of an indexed record never changes.
+
+  IMPLEMENTATION NOTE: The index is kept in attributes of the collection_id
+  subject:
+
+    INDEX_COUNT_ATTRIBUTE holds the number of records in the index.
+
+    INDEX_BLOCK_TEMPLATE % b holds the (timestamp, suffix) pairs of the records
+    numbered b * INDEX_BLOCK_SIZE to (b + 1) * INDEX_BLOCK_SIZE - 1, packed with
+    INDEX_KEY_FORMAT.
+
+    INDEX_PENDING_TEMPLATE % (timestamp, suffix) marks a record which is not
+    in the index yet.
+
+  INDEX_RECORD_TEMPLATE % (timestamp, suffix) holds the number of a record.
+  This makes adding a record to the index idempotent. There is one of these
+  per record, so they are kept on the INDEX_RECORDS_SUBJECT child of
+  collection_id, which keeps the collection_id subject small for readers.
+
+  The index is only written while holding a DBSubjectLock on collection_id.
+  Collections written before the index existed have no INDEX_COUNT_ATTRIBUTE
+  and are read by scanning them. The first update indexes up to
+  INDEX_EXISTING_RECORDS_LIMIT records of such a collection, larger ones are
+  marked with INDEX_NEEDS_UPDATE_ATTRIBUTE and left to UpdateIndex.
+  """
 
-      now = time.time()
-      next_cls = next_update[0]
-      next_urn = next_update[1]
-      next_time = next_update[2]
-      while now < next_time:
-        time.sleep(next_time - now)
-        now = time.time()
+  INDEX_COUNT_ATTRIBUTE = "index:count"
+  INDEX_BLOCK_TEMPLATE = "index:block_%08x"
+  INDEX_RECORD_TEMPLATE = "index:record_%016x.%06x"
+  INDEX_RECORDS_SUBJECT = "IndexedRecords"
+  INDEX_PENDING_PREFIX = "index:pending_"
+  INDEX_PENDING_TEMPLATE = INDEX_PENDING_PREFIX + "%016x.%06x"
+  INDEX_NEEDS_UPDATE_ATTRIBUTE = "index:needs_update"
 
-      self.ProcessCollection(next_cls, next_urn, token)
+  # The sparse index which was written by older versions.
+  LEGACY_INDEX_ATTRIBUTE_PREFIX = "index:sc_"
 
+  INDEX_BLOCK_SIZE = 1024
+  INDEX_KEY_FORMAT = ">QI"
+  INDEX_KEY_SIZE = struct.calcsize(INDEX_KEY_FORMAT)
 
-BACKGROUND_INDEX_UPDATER = BackgroundIndexUpdater()
+  # An update which finds no index indexes up to this many existing records
+  # (normally the records just written to a new collection). Larger
+  # collections are left to UpdateIndex.
+  INDEX_EXISTING_RECORDS_LIMIT = 10000
 
+  # Lease time and retry behavior for the index lock, in seconds.
+  INDEX_LOCK_LEASE = 10
+  INDEX_LOCK_RETRY_INTERVAL = 0.05
+  INDEX_LOCK_TIMEOUT = 10
 
-class UpdaterStartHook(registry.InitHook):
+  # Records are read in batches growing up to this size, so that reading a few
+  # records at an offset is cheap and reading many is efficient.
+  MAX_READ_BATCH_SIZE = 1024
 
-  def RunOnce(self):
-    t = threading.Thread(
-        None,
-        BACKGROUND_INDEX_UPDATER.UpdateLoop,
-        name="SequentialCollectionIndexUpdater")
-    t.daemon = True
-    t.start()
+  @classmethod
+  def _ReadIndexState(cls, collection_id, token=None):
+    """Reads the state of the index of a collection.
 
+    Args:
+      collection_id: The urn of the collection.
+      token: The database access token to read with.
 
-class IndexedSequentialCollection(SequentialCollection):
-  """An indexed sequential collection of RDFValues.
+    Returns:
+      A tuple (count, pending, needs_update) of the number of indexed records
+      or None if the collection has no index, the sorted (timestamp, suffix)
+      pairs of the pending records and whether the collection was marked as
+      too large to be indexed without UpdateIndex.
+    """
+    count = None
+    pending = []
+    needs_update = False
+    for attribute, value, _ in data_store.DB.ResolvePrefix(
+        collection_id, [
+            cls.INDEX_COUNT_ATTRIBUTE, cls.INDEX_NEEDS_UPDATE_ATTRIBUTE,
+            cls.INDEX_PENDING_PREFIX
+        ],
+        token=token):
+      if attribute == cls.INDEX_COUNT_ATTRIBUTE:
+        count = int(value, 16)
+      elif attribute == cls.INDEX_NEEDS_UPDATE_ATTRIBUTE:
+        needs_update = True
+      else:
+        timestamp, suffix = attribute[len(cls.INDEX_PENDING_PREFIX):].split(".")
+        pending.append((int(timestamp, 16), int(suffix, 16)))
 
-  Adds an index to SequentialCollection, making it efficient to find the number
-  of records present, and to find a particular record number.
+    pending.sort()
+    return count, pending, needs_update
 
-  IMPLEMENTATION NOTE: The index is created lazily, and for records older than
-    INDEX_WRITE_DELAY.
-  """
+  @classmethod
+  def IndexedRecordsURN(cls, collection_id):
+    """Returns the subject holding the record numbers of the index."""
+    return rdfvalue.RDFURN(collection_id).Add(cls.INDEX_RECORDS_SUBJECT)
 
-  # How many records between index entries. Subclasses may change this.  The
-  # full index must fit comfortably in RAM, default is meant to be reasonable
-  # for collections of up to ~1b small records. (Assumes we can have ~1m index
-  # points in ram, and that reading 1k records is reasonably fast.)
+  @classmethod
+  def _ReadIndexBlock(cls, collection_id, block, token=None):
+    """Returns the (timestamp, suffix) pairs stored in an index block."""
+    value, _ = data_store.DB.Resolve(
+        collection_id, cls.INDEX_BLOCK_TEMPLATE % block, token=token)
+    if not value:
+      return []
+    flat = struct.unpack(">" + cls.INDEX_KEY_FORMAT[1:] *
+                         (len(value) // cls.INDEX_KEY_SIZE), value)
+    return zip(flat[::2], flat[1::2])
 
-  INDEX_SPACING = 1024
+  @classmethod
+  def _ScanExistingRecords(cls, collection_id, first_new_id, token=None):
+    """Returns the ids of the records older than first_new_id.
 
-  # An attribute name of the form "index:sc_<i>" at timestamp <t> indicates that
-  # the item with record number i was stored at timestamp t. The timestamp
-  # suffix is stored as the value.
+    Args:
+      collection_id: The urn of the collection.
+      first_new_id: The (timestamp, suffix) pair of the first record to index.
+      token: The database access token to read with.
 
-  INDEX_ATTRIBUTE_PREFIX = "index:sc_"
+    Returns:
+      The sorted (timestamp, suffix) pairs, or None if there are more than
+      INDEX_EXISTING_RECORDS_LIMIT of them.
+    """
+    existing_ids = []
+    for batch in cls(collection_id, token=token).ScanBatches(
+        include_suffix=True,
+        max_records=cls.INDEX_EXISTING_RECORDS_LIMIT + 1,
+        decode=False):
+      existing_ids.extend(
+          record_id for record_id, _ in batch if record_id < first_new_id)
+      if batch[-1][0] >= first_new_id:
+        break
+
+    if len(existing_ids) > cls.INDEX_EXISTING_RECORDS_LIMIT:
+      return None
+    return existing_ids
 
-  # The time to wait before creating an index for a record - hacky defense
-  # against the correct index changing due to a late write.
+  @classmethod
+  def AppendToIndex(cls,
+                    collection_id,
+                    record_ids=None,
+                    token=None,
+                    index_existing_records=True):
+    """Appends records to the index of a collection.
 
-  INDEX_WRITE_DELAY = rdfvalue.Duration("3m")
+    The pending markers of the records are removed in the same write.
 
-  def __init__(self, *args, **kwargs):
-    super(IndexedSequentialCollection, self).__init__(*args, **kwargs)
-    self._index = None
+    Args:
+      collection_id: The urn of the collection.
 
-  def _ReadIndex(self):
-    if self._index:
-      return
-    self._index = {0: (0, 0)}
-    self._max_indexed = 0
-    for (attr, value, ts) in data_store.DB.ResolvePrefix(
-        self.collection_id, self.INDEX_ATTRIBUTE_PREFIX, token=self.token):
-      i = int(attr[len(self.INDEX_ATTRIBUTE_PREFIX):], 16)
-      self._index[i] = (ts, int(value, 16))
-      self._max_indexed = max(i, self._max_indexed)
-
-  def _MaybeWriteIndex(self, i, ts, mutation_pool):
-    """Write index marker i."""
-    if i > self._max_indexed and i % self.INDEX_SPACING == 0:
-      # We only write the index if the timestamp is more than 5 minutes in the
-      # past: hacky defense against a late write changing the count.
-      if ts[0] < (rdfvalue.RDFDatetime.Now() -
-                  self.INDEX_WRITE_DELAY).AsMicroSecondsFromEpoch():
-        # We may be used in contexts were we don't have write access, so simply
-        # give up in that case. TODO(user): Remove this when the ACL
-        # system allows.
-        try:
-          mutation_pool.Set(
-              self.collection_id,
-              self.INDEX_ATTRIBUTE_PREFIX + "%08x" % i,
-              "%06x" % ts[1],
-              timestamp=ts[0],
-              replace=True)
-          self._index[i] = ts
-          self._max_indexed = max(i, self._max_indexed)
-        except access_control.UnauthorizedAccess:
-          pass
-
-  def _IndexedScan(self, i, max_records=None):
-    """Scan records starting with index i."""
-    self._ReadIndex()
-
-    # The record number that we will read next.
-    idx = 0
-    # The timestamp that we will start reading from.
-    start_ts = 0
-    if i >= self._max_indexed:
-      start_ts = max((0, 0), (self._index[self._max_indexed][0],
-                              self._index[self._max_indexed][1] - 1))
-      idx = self._max_indexed
+      record_ids: (timestamp, suffix) pairs of records which were written to
+        the collection, defaults to the pending records. Records which are
+        indexed already are skipped.
+
+      token: The database access token to write with.
+
+      index_existing_records: If the collection has no index yet, index the
+        records which are in the collection already first.
+
+    Returns:
+      The number of records added to the index.
+
+    Raises:
+      DBSubjectLockError: If the index could not be locked. The pending
+        records stay pending.
+    """
+    collection_id = rdfvalue.RDFURN(collection_id)
+    count, pending, needs_update = cls._ReadIndexState(
+        collection_id, token=token)
+    if record_ids is None:
+      if not pending:
+        return 0
+      first_new_id = pending[0]
+    elif record_ids:
+      first_new_id = min(tuple(r) for r in record_ids)
+    else:
+      return 0
+
+    # Existing records are scanned before locking the index, so the lock is
+    # only held for a bounded number of reads and writes. Records without a
+    # marker which are newer than the first new record are still being
+    # written, their markers follow.
+    existing_ids = None
+    if count is None and index_existing_records and not needs_update:
+      existing_ids = cls._ScanExistingRecords(
+          collection_id, first_new_id, token=token)
+      if existing_ids is None:
+        # Remember this, so later updates don't scan the collection again.
+        logging.warning("%s has no index, it needs to be created with "
+                        "UpdateIndex.", collection_id)
+        data_store.DB.Set(
+            collection_id, cls.INDEX_NEEDS_UPDATE_ATTRIBUTE, "1", token=token)
+        return 0
+
+    with data_store.DB.LockRetryWrapper(
+        collection_id,
+        retrywrap_timeout=cls.INDEX_LOCK_RETRY_INTERVAL,
+        retrywrap_max_timeout=cls.INDEX_LOCK_TIMEOUT,
+        lease_time=cls.INDEX_LOCK_LEASE,
+        token=token):
+      count, pending, needs_update = cls._ReadIndexState(
+          collection_id, token=token)
+      if record_ids is None:
+        record_ids = pending
+      record_ids = [tuple(r) for r in record_ids]
+      to_delete = [
+          cls.INDEX_PENDING_TEMPLATE % r
+          for r in set(pending).intersection(record_ids)
+      ]
+
+      if count is None:
+        count = 0
+        if index_existing_records:
+          if needs_update or existing_ids is None:
+            # Another writer found the collection too large to index, or
+            # removed the index, while this one was not holding the lock.
+            return 0
+          record_ids = existing_ids + record_ids
+        elif needs_update:
+          to_delete.append(cls.INDEX_NEEDS_UPDATE_ATTRIBUTE)
+      record_ids = list(collections.OrderedDict.fromkeys(record_ids))
+
+      records_urn = cls.IndexedRecordsURN(collection_id)
+      indexed = set(
+          attribute
+          for attribute, _, _ in data_store.DB.ResolveMulti(
+              records_urn, [cls.INDEX_RECORD_TEMPLATE % r for r in record_ids],
+              token=token))
+
+      block = count // cls.INDEX_BLOCK_SIZE
+      block_data = ""
+      if count % cls.INDEX_BLOCK_SIZE:
+        block_data, _ = data_store.DB.Resolve(
+            collection_id, cls.INDEX_BLOCK_TEMPLATE % block, token=token)
+        block_data = block_data[:(count % cls.INDEX_BLOCK_SIZE) *
+                                cls.INDEX_KEY_SIZE]
+
+      values = {}
+      record_numbers = {}
+      added = 0
+      for record_id in record_ids:
+        attribute = cls.INDEX_RECORD_TEMPLATE % record_id
+        if attribute in indexed:
+          continue
+        record_numbers[attribute] = ["%x" % count]
+        block_data += struct.pack(cls.INDEX_KEY_FORMAT, *record_id)
+        count += 1
+        added += 1
+        if count % cls.INDEX_BLOCK_SIZE == 0:
+          values[cls.INDEX_BLOCK_TEMPLATE % block] = [block_data]
+          block += 1
+          block_data = ""
+
+      if not added:
+        if to_delete:
+          data_store.DB.DeleteAttributes(
+              collection_id, to_delete, token=token)
+        return 0
+
+      if block_data:
+        values[cls.INDEX_BLOCK_TEMPLATE % block] = [block_data]
+      values[cls.INDEX_COUNT_ATTRIBUTE] = ["%x" % count]
+      # Readers see the records either as pending or as indexed, never both.
+      data_store.DB.MultiSet(
+          collection_id, values, to_delete=to_delete, token=token)
+      # Record numbers are written last: if this fails the records may be
+      # indexed twice by a later update, but they are never skipped.
+      data_store.DB.MultiSet(records_urn, record_numbers, token=token)
+
+    return added
+
+  @classmethod
+  def FlushPendingRecords(cls, collection_urn, token=None):
+    """Appends the pending records to the index, leaving them on failure."""
+    try:
+      cls.AppendToIndex(collection_urn, token=token)
+    except data_store.DBSubjectLockError:
+      # Readers find the pending records without the index, the next writer
+      # of the collection indexes them.
+      logging.warning("Unable to lock the index of %s, leaving the records "
+                      "pending.", collection_urn)
+
+  def _ReadRecords(self, record_ids):
+    """Yields the values of the records, in the same order.
+
+    Args:
+      record_ids: (timestamp, suffix) pairs of indexed or pending records.
+
+    Yields:
+      The values of the records.
+
+    Raises:
+      MissingRecordError: When reaching a record which does not exist.
+        Skipping it would shift the numbers of all the following records.
+    """
+    # Records are usually indexed in the order they are stored in, in which
+    # case they are read with a single scan.
+    timestamp, suffix = record_ids[0]
+    if suffix:
+      after_timestamp = (timestamp, suffix - 1)
     else:
-      try:
-        possible_idx = i - i % self.INDEX_SPACING
-        start_ts = (max(0, self._index[possible_idx][0]),
-                    self._index[possible_idx][1] - 1)
-        idx = possible_idx
-      except KeyError:
-        pass
-
-    if max_records is not None:
-      max_records += i - idx
-
-    with data_store.DB.GetMutationPool(token=self.token) as mutation_pool:
-      for (ts, value) in self.Scan(
-          after_timestamp=start_ts,
-          max_records=max_records,
-          include_suffix=True):
-        self._MaybeWriteIndex(idx, ts, mutation_pool)
-        if idx >= i:
-          yield (idx, ts, value)
-        idx += 1
+      after_timestamp = (timestamp - 1, self.MAX_SUFFIX)
+    for batch in self.ScanBatches(
+        batch_size=len(record_ids),
+        after_timestamp=after_timestamp,
+        include_suffix=True,
+        max_records=len(record_ids),
+        decode=False):
+      if [record_id for record_id, _ in batch] == record_ids:
+        for record_id, value in batch:
+          yield self._DecodeValue(value, record_id[0])
+        return
+      break
+
+    subjects = [
+        utils.SmartStr(self._MakeURN(self.collection_id, *record_id))
+        for record_id in record_ids
+    ]
+    values = {}
+    for subject, results in data_store.DB.MultiResolvePrefix(
+        subjects, self.ATTRIBUTE, token=self.token):
+      _, value, timestamp = results[0]
+      values[utils.SmartStr(subject)] = self._DecodeValue(value, timestamp)
+
+    for subject in subjects:
+      if subject not in values:
+        raise MissingRecordError("Record %s of %s is missing." %
+                                 (subject, self.collection_id))
+      yield values[subject]
+
+  def _ReadCountAndPending(self):
+    """Returns the number of indexed records and the pending record ids.
+
+    The number is None if the collection has records which were written before
+    it had an index, which can only be found by scanning it.
+    """
+    count, pending, _ = self._ReadIndexState(
+        self.collection_id, token=self.token)
+    if count is None and pending:
+      # New collections have no records before their first pending one.
+      for batch in self.ScanBatches(
+          include_suffix=True, max_records=1, decode=False):
+        if batch[0][0] == pending[0]:
+          count = 0
+    return count, pending
+
+  def _IndexedRecordIds(self, count, offset):
+    """Yields the ids of the indexed records from record number offset on."""
+    while offset < count:
+      block, start = divmod(offset, self.INDEX_BLOCK_SIZE)
+      record_ids = self._ReadIndexBlock(
+          self.collection_id, block, token=self.token)
+      record_ids = record_ids[start:count - block * self.INDEX_BLOCK_SIZE]
+      if not record_ids:
+        return
+
+      for record_id in record_ids:
+        yield record_id
+      offset += len(record_ids)
 
   def GenerateItems(self, offset=0):
-    for (_, _, value) in self._IndexedScan(offset):
-      yield value
+    """Yields the records from record number offset onwards."""
+    count, pending = self._ReadCountAndPending()
+    if count is None:
+      for _, value in itertools.islice(self.Scan(), offset, None):
+        yield value
+      return
+
+    record_ids = itertools.chain(
+        self._IndexedRecordIds(count, offset), pending[max(offset - count, 0):])
+    read_size = 32
+    while True:
+      batch = list(itertools.islice(record_ids, read_size))
+      if not batch:
+        return
+
+      for value in self._ReadRecords(batch):
+        yield value
+      read_size = min(read_size * 2, self.MAX_READ_BATCH_SIZE)
 
   def __getitem__(self, index):
     if index >= 0:
-      for (_, _, value) in self._IndexedScan(index, max_records=1):
+      for value in itertools.islice(self.GenerateItems(offset=index), 1):
         return value
       raise IndexError("collection index out of range")
     else:
       raise RuntimeError("Index must be >= 0")
 
   def CalculateLength(self):
-    self._ReadIndex()
-    highest_index = None
-    for (i, _, _) in self._IndexedScan(self._max_indexed):
-      highest_index = i
-    if highest_index is None:
-      return 0
-    return highest_index + 1
+    count, pending = self._ReadCountAndPending()
+    if count is not None:
+      return count + len(pending)
+
+    count = 0
+    for batch in self.ScanBatches(decode=False):
+      count += len(batch)
+    return count
 
   def __len__(self):
     return self.CalculateLength()
 
   def UpdateIndex(self):
-    self._ReadIndex()
-    for _ in self._IndexedScan(self._max_indexed):
-      pass
+    """Adds the records which are not indexed yet to the index.
+
+    This creates the index of collections written before it existed. It is
+    safe to run while the collection is written to.
+
+    Returns:
+      The number of records added to the index.
+    """
+    added = 0
+    for batch in self.ScanBatches(
+        batch_size=self.INDEX_EXISTING_RECORDS_LIMIT,
+        include_suffix=True,
+        decode=False):
+      added += self.AppendToIndex(
+          self.collection_id, [record_id for record_id, _ in batch],
+          token=self.token,
+          index_existing_records=False)
+    # Records which were added while the collection was scanned.
+    added += self.AppendToIndex(self.collection_id, token=self.token)
+
+    legacy_attributes = [
+        attribute
+        for attribute, _, _ in data_store.DB.ResolvePrefix(
+            self.collection_id,
+            self.LEGACY_INDEX_ATTRIBUTE_PREFIX,
+            token=self.token)
+    ]
+    if legacy_attributes:
+      data_store.DB.DeleteAttributes(
+          self.collection_id, legacy_attributes, token=self.token)
+
+    return added
+
+  def Delete(self):
+    super(IndexedSequentialCollection, self).Delete()
+    data_store.DB.DeleteSubject(
+        self.IndexedRecordsURN(self.collection_id), token=self.token)
+
+    # The blocks are deleted without reading them.
+    count, pending, _ = self._ReadIndexState(
+        self.collection_id, token=self.token)
+    blocks = ((count or 0) + self.INDEX_BLOCK_SIZE - 1) // self.INDEX_BLOCK_SIZE
+    attributes = [self.INDEX_BLOCK_TEMPLATE % block for block in xrange(blocks)]
+    attributes.extend(self.INDEX_PENDING_TEMPLATE % r for r in pending)
+    attributes.extend(
+        attribute
+        for attribute, _, _ in data_store.DB.ResolvePrefix(
+            self.collection_id,
+            self.LEGACY_INDEX_ATTRIBUTE_PREFIX,
+            token=self.token))
+    attributes.extend(
+        [self.INDEX_COUNT_ATTRIBUTE, self.INDEX_NEEDS_UPDATE_ATTRIBUTE])
+    data_store.DB.DeleteAttributes(
+        self.collection_id, attributes, token=self.token)
 
   @classmethod
   def StaticAdd(cls,
@@ -433,11 +771,29 @@ class IndexedSequentialCollection(SequentialCollection):
                 rdf_value,
                 timestamp=None,
                 suffix=None,
+                mutation_pool=None,
                 **kwargs):
     r = super(IndexedSequentialCollection, cls).StaticAdd(
-        collection_urn, token, rdf_value, timestamp, suffix, **kwargs)
-    if random.randint(0, cls.INDEX_SPACING) == 0:
-      BACKGROUND_INDEX_UPDATER.AddIndexToUpdate(cls, collection_urn)
+        collection_urn,
+        token,
+        rdf_value,
+        timestamp,
+        suffix,
+        mutation_pool=mutation_pool,
+        **kwargs)
+
+    # The marker is written after the record, so readers never find markers
+    # of records which don't exist.
+    if mutation_pool:
+      mutation_pool.CollectionAddToIndex(cls, collection_urn, r)
+    else:
+      data_store.DB.Set(
+          collection_urn,
+          cls.INDEX_PENDING_TEMPLATE % r,
+          "1",
+          token=token,
+          **kwargs)
+      cls.FlushPendingRecords(collection_urn, token=token)
     return r
 
 
@@ -456,10 +812,9 @@ class GeneralIndexedCollection(IndexedSequentialCollection):
         rdf_protodict.EmbeddedRDFValue(payload=rdf_value),
         **kwargs)
 
-  def Scan(self, **kwargs):
-    for (timestamp, rdf_value) in super(GeneralIndexedCollection, self).Scan(
-        **kwargs):
-      yield (timestamp, rdf_value.payload)
+  def _DecodeValue(self, value, timestamp):
+    return super(GeneralIndexedCollection, self)._DecodeValue(
+        value, timestamp).payload
 
 
 class GrrMessageCollection(IndexedSequentialCollection):
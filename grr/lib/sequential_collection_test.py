@@ -1,8 +1,7 @@
 #!/usr/bin/env python
 """Tests for SequentialCollection and related subclasses."""
 
-import threading
-
+from grr.lib import data_store
 from grr.lib import flags
 from grr.lib import rdfvalue
 from grr.lib import sequential_collection
@@ -41,6 +40,31 @@ class SequentialCollectionTest(test_lib.AFF4ObjectTest):
 
     self.assertEqual(i, 200)
 
+  def testScanBatches(self):
+    collection = self._TestCollection(
+        "aff4:/sequential_collection/testScanBatches")
+    for i in range(25):
+      collection.Add(rdfvalue.RDFInteger(i), timestamp=1000 + i, suffix=1)
+
+    batches = list(collection.ScanBatches(batch_size=10))
+    self.assertEqual([len(b) for b in batches], [10, 10, 5])
+    self.assertEqual([v for b in batches for _, v in b], range(25))
+    self.assertEqual([ts for b in batches for ts, _ in b], range(1000, 1025))
+    self.assertEqual(batches[0][3][1].age, 1003)
+
+    batches = list(
+        collection.ScanBatches(
+            batch_size=4,
+            after_timestamp=(1009, 1),
+            include_suffix=True,
+            max_records=6,
+            decode=False))
+    self.assertEqual([len(b) for b in batches], [4, 2])
+    self.assertEqual(batches[0][0][0], (1010, 1))
+    self.assertEqual(
+        [rdfvalue.RDFInteger.FromSerializedString(v) for b in batches
+         for _, v in b], range(10, 16))
+
   def testDuplicateTimestamps(self):
     collection = self._TestCollection(
         "aff4:/sequential_collection/testDuplicateTimestamps")
@@ -89,21 +113,14 @@ class IndexedSequentialCollectionTest(test_lib.AFF4ObjectTest):
     return TestIndexedSequentialCollection(
         rdfvalue.RDFURN(collection_id), token=self.token)
 
-  def setUp(self):
-    super(IndexedSequentialCollectionTest, self).setUp()
-    # Create a new background thread for each test. In the default
-    # configuration, this thread can sleep for quite a long time and
-    # might therefore be unavailable in further tests so we just
-    # create a new one for each test we run.
-    biu = sequential_collection.BackgroundIndexUpdater()
-    try:
-      sequential_collection.BACKGROUND_INDEX_UPDATER.ExitNow()
-    except AttributeError:
-      pass
-    sequential_collection.BACKGROUND_INDEX_UPDATER = biu
-    t = threading.Thread(None, biu.UpdateLoop)
-    t.daemon = True
-    t.start()
+  def _AddPending(self, collection, value, **kwargs):
+    """Adds a record while the index is locked, leaving it pending."""
+
+    def LockRetryWrapper(*unused_args, **unused_kwargs):
+      raise data_store.DBSubjectLockError("Locked")
+
+    with utils.Stubber(data_store.DB, "LockRetryWrapper", LockRetryWrapper):
+      return collection.Add(rdfvalue.RDFInteger(value), **kwargs)
 
   def testAddGet(self):
     collection = self._TestCollection("aff4:/sequential_collection/testAddGet")
@@ -133,36 +150,251 @@ class IndexedSequentialCollectionTest(test_lib.AFF4ObjectTest):
   def testIndexCreate(self):
     collection = self._TestCollection(
         "aff4:/sequential_collection/testIndexCreate")
-    for i in range(10 * 1024):
-      collection.Add(rdfvalue.RDFInteger(i))
+    pool = data_store.DB.GetMutationPool(token=self.token)
+    with pool:
+      for i in range(3 * 1024 + 10):
+        collection.StaticAdd(
+            collection.collection_id,
+            self.token,
+            rdfvalue.RDFInteger(i),
+            timestamp=1000 + i,
+            suffix=1,
+            mutation_pool=pool)
+
+    # The records are indexed when the pool is flushed.
+    self.assertEqual(
+        collection._ReadIndexState(collection.collection_id, token=self.token),
+        (3 * 1024 + 10, [], False))
+    self.assertEqual(
+        collection._ReadIndexBlock(
+            collection.collection_id, 3, token=self.token),
+        [(1000 + 3 * 1024 + i, 1) for i in range(10)])
 
-    # It is too soon to build an index, check that we don't.
-    self.assertEqual(collection._index, None)
-    self.assertEqual(collection.CalculateLength(), 10 * 1024)
-    self.assertEqual(sorted(collection._index.keys()), [0])
+    # Lengths and reads at an offset don't scan the collection.
+    with test_lib.Instrument(sequential_collection.SequentialCollection,
+                             "ScanBatches") as scan:
+      self.assertEqual(len(collection), 3 * 1024 + 10)
+      self.assertEqual(scan.call_count, 0)
+
+    self.assertEqual(collection[2049], 2049)
+    self.assertEqual(
+        list(collection.GenerateItems(offset=3 * 1024 + 5)),
+        range(3 * 1024 + 5, 3 * 1024 + 10))
+
+  def testPooledAddsLockTheIndexOncePerCollection(self):
+    collections = [
+        self._TestCollection("aff4:/sequential_collection/testPooledAdds%d" % i)
+        for i in range(2)
+    ]
+    with test_lib.Instrument(data_store.DB, "LockRetryWrapper") as lock:
+      with data_store.DB.GetMutationPool(token=self.token) as pool:
+        for i in range(10):
+          for collection in collections:
+            collection.StaticAdd(
+                collection.collection_id,
+                self.token,
+                rdfvalue.RDFInteger(i),
+                mutation_pool=pool)
+      self.assertEqual(lock.call_count, 2)
+
+    for collection in collections:
+      self.assertEqual(
+          collection._ReadIndexState(collection.collection_id,
+                                     token=self.token), (10, [], False))
+      self.assertEqual(list(collection.GenerateItems()), range(10))
 
-    # Push the clock forward 10m, and we should build an index on access.
-    with test_lib.FakeTime(rdfvalue.RDFDatetime.Now() +
-                           rdfvalue.Duration("10m")):
-      # Read from start doesn't rebuild index (lazy rebuild)
-      _ = collection[0]
-      self.assertEqual(sorted(collection._index.keys()), [0])
+  def testPendingRecordsAreReadAfterTheIndexedOnes(self):
+    collection = self._TestCollection(
+        "aff4:/sequential_collection/testPendingRecords")
+    for i in range(5):
+      collection.Add(rdfvalue.RDFInteger(i), timestamp=2000 + i, suffix=1)
+
+    # Pending records come after the indexed ones, in timestamp order.
+    for i in range(5, 10):
+      self._AddPending(collection, i, timestamp=2000 - i, suffix=1)
 
-      self.assertEqual(collection.CalculateLength(), 10 * 1024)
+    self.assertEqual(
+        collection._ReadIndexState(collection.collection_id, token=self.token),
+        (5, [(2000 - i, 1) for i in range(9, 4, -1)], False))
+    self.assertEqual(len(collection), 10)
+    self.assertEqual([collection[i] for i in range(10)],
+                     [0, 1, 2, 3, 4, 9, 8, 7, 6, 5])
+    self.assertEqual(list(collection.GenerateItems(offset=4)), [4, 9, 8, 7, 6, 5])
+
+    # Indexing them keeps their record numbers.
+    TestIndexedSequentialCollection.AppendToIndex(
+        collection.collection_id, token=self.token)
+    self.assertEqual(
+        collection._ReadIndexState(collection.collection_id, token=self.token),
+        (10, [], False))
+    self.assertEqual(
+        list(collection.GenerateItems()), [0, 1, 2, 3, 4, 9, 8, 7, 6, 5])
+
+  def testIndexLockTimeoutsDoNotHideRecords(self):
+    collection = self._TestCollection(
+        "aff4:/sequential_collection/testIndexLockTimeouts")
+    for i in range(5):
+      collection.Add(rdfvalue.RDFInteger(i), timestamp=1000 + i, suffix=1)
+    for i in range(5, 10):
+      self._AddPending(collection, i, timestamp=1000 + i, suffix=1)
+
+    self.assertEqual(len(collection), 10)
+    self.assertEqual(list(collection.GenerateItems()), range(10))
+
+    # The next writer indexes the records which were left pending.
+    collection.Add(rdfvalue.RDFInteger(10), timestamp=1010, suffix=1)
+    self.assertEqual(
+        collection._ReadIndexState(collection.collection_id, token=self.token),
+        (11, [], False))
+    self.assertEqual(list(collection.GenerateItems()), range(11))
+
+  def testMissingRecordsAreReported(self):
+    collection = self._TestCollection(
+        "aff4:/sequential_collection/testMissingRecords")
+    record_ids = [
+        collection.Add(rdfvalue.RDFInteger(i), timestamp=1000 + i, suffix=1)
+        for i in range(10)
+    ]
+    data_store.DB.DeleteSubject(
+        collection._MakeURN(collection.collection_id, *record_ids[5]),
+        token=self.token)
+
+    self.assertEqual(collection[4], 4)
+    with self.assertRaises(sequential_collection.MissingRecordError):
+      _ = collection[5]
+    with self.assertRaises(sequential_collection.MissingRecordError):
+      list(collection.GenerateItems(offset=2))
+
+  def testIndexIsIdempotent(self):
+    collection = self._TestCollection(
+        "aff4:/sequential_collection/testIndexIsIdempotent")
+    record_ids = [
+        self._AddPending(collection, i, timestamp=1000 + i, suffix=1)
+        for i in range(10)
+    ]
+    self.assertEqual(
+        TestIndexedSequentialCollection.AppendToIndex(
+            collection.collection_id, token=self.token), 10)
+    self.assertEqual(
+        TestIndexedSequentialCollection.AppendToIndex(
+            collection.collection_id, record_ids, token=self.token), 0)
+    self.assertEqual(len(collection), 10)
+    self.assertEqual(list(collection.GenerateItems()), range(10))
+
+  def testUpdateIndex(self):
+    collection = self._TestCollection(
+        "aff4:/sequential_collection/testUpdateIndex")
+    # Records written by a collection without an index.
+    unindexed = TestSequentialCollection(
+        collection.collection_id, token=self.token)
+    for i in range(100):
+      unindexed.Add(rdfvalue.RDFInteger(i), timestamp=1000 + i, suffix=1)
+    data_store.DB.Set(
+        collection.collection_id,
+        "index:sc_00000400",
+        "legacy",
+        token=self.token)
+
+    # Collections without an index are read by scanning them.
+    self.assertEqual(
+        collection._ReadIndexState(collection.collection_id, token=self.token),
+        (None, [], False))
+    self.assertEqual(len(collection), 100)
+    self.assertEqual(collection[42], 42)
+    self.assertEqual(list(collection.GenerateItems(offset=98)), [98, 99])
+
+    self.assertEqual(collection.UpdateIndex(), 100)
+    self.assertEqual(collection.UpdateIndex(), 0)
+    self.assertEqual(
+        collection._ReadIndexState(collection.collection_id, token=self.token),
+        (100, [], False))
+    self.assertEqual(list(collection.GenerateItems(offset=50)), range(50, 100))
+    self.assertEqual(
+        data_store.DB.ResolvePrefix(
+            collection.collection_id, "index:sc_", token=self.token), [])
+
+  def testExistingRecordsAreIndexed(self):
+    collection = self._TestCollection(
+        "aff4:/sequential_collection/testExistingRecordsAreIndexed")
+    # Records written by a collection without an index.
+    unindexed = TestSequentialCollection(
+        collection.collection_id, token=self.token)
+    for i in range(10):
+      unindexed.Add(rdfvalue.RDFInteger(i), timestamp=1000 + i, suffix=1)
+
+    # The records are scanned before the index is locked.
+    lock_retry_wrapper = data_store.DB.LockRetryWrapper
+    scans_when_locking = []
+    with test_lib.Instrument(sequential_collection.SequentialCollection,
+                             "ScanBatches") as scan:
+
+      def LockRetryWrapper(*args, **kwargs):
+        scans_when_locking.append(scan.call_count)
+        return lock_retry_wrapper(*args, **kwargs)
+
+      with utils.Stubber(data_store.DB, "LockRetryWrapper", LockRetryWrapper):
+        collection.Add(rdfvalue.RDFInteger(10), timestamp=1010, suffix=1)
+      self.assertEqual(scans_when_locking, [scan.call_count])
+      self.assertGreater(scan.call_count, 0)
+
+    self.assertEqual(
+        collection._ReadIndexState(collection.collection_id, token=self.token),
+        (11, [], False))
+    self.assertEqual(list(collection.GenerateItems()), range(11))
+
+  def testLargeCollectionsAreLeftToUpdateIndex(self):
+    collection = self._TestCollection(
+        "aff4:/sequential_collection/testLargeCollectionsAreLeftToUpdateIndex")
+    # Records written by a collection without an index.
+    unindexed = TestSequentialCollection(
+        collection.collection_id, token=self.token)
+    with utils.Stubber(TestIndexedSequentialCollection,
+                       "INDEX_EXISTING_RECORDS_LIMIT", 5):
+      for i in range(10):
+        unindexed.Add(rdfvalue.RDFInteger(i), timestamp=1000 + i, suffix=1)
+
+      collection.Add(rdfvalue.RDFInteger(10), timestamp=1010, suffix=1)
       self.assertEqual(
-          sorted(collection._index.keys()),
-          [0, 1024, 2048, 3072, 4096, 5120, 6144, 7168, 8192, 9216])
+          collection._ReadIndexState(collection.collection_id, token=self.token),
+          (None, [(1010, 1)], True))
+      self.assertEqual(len(collection), 11)
+
+      # Later updates remember that the collection is too large.
+      with test_lib.Instrument(sequential_collection.SequentialCollection,
+                               "ScanBatches") as scan:
+        collection.Add(rdfvalue.RDFInteger(11), timestamp=1011, suffix=1)
+        self.assertEqual(scan.call_count, 0)
 
-    # Now check that the index was persisted to aff4 by re-opening and checking
-    # that a read from head does load full index (optimistic load):
+      self.assertEqual(collection.UpdateIndex(), 12)
+      self.assertEqual(
+          collection._ReadIndexState(collection.collection_id, token=self.token),
+          (12, [], False))
+      self.assertEqual(list(collection.GenerateItems(offset=8)), [8, 9, 10, 11])
 
+  def testDeleteRemovesIndex(self):
     collection = self._TestCollection(
-        "aff4:/sequential_collection/testIndexCreate")
-    self.assertEqual(collection._index, None)
-    _ = collection[0]
+        "aff4:/sequential_collection/testDeleteRemovesIndex")
+    with utils.Stubber(TestIndexedSequentialCollection, "INDEX_BLOCK_SIZE", 4):
+      for i in range(10):
+        collection.Add(rdfvalue.RDFInteger(i))
+      self._AddPending(collection, 10)
+
+      with test_lib.Instrument(data_store.DB, "Resolve") as resolve:
+        collection.Delete()
+        # Deleting the index does not read it.
+        self.assertEqual(resolve.call_count, 0)
+
+    self.assertEqual(
+        data_store.DB.ResolvePrefix(
+            collection.collection_id, "index:", token=self.token), [])
     self.assertEqual(
-        sorted(collection._index.keys()),
-        [0, 1024, 2048, 3072, 4096, 5120, 6144, 7168, 8192, 9216])
+        data_store.DB.ResolvePrefix(
+            collection.IndexedRecordsURN(collection.collection_id),
+            "index:",
+            token=self.token), [])
+    self.assertEqual(len(collection), 0)
+    collection.Add(rdfvalue.RDFInteger(42))
+    self.assertEqual(list(collection.GenerateItems()), [42])
 
   def testIndexedReads(self):
     collection = self._TestCollection(
@@ -170,15 +402,15 @@ class IndexedSequentialCollectionTest(test_lib.AFF4ObjectTest):
     data_size = 4 * 1024
     for i in range(data_size):
       collection.Add(rdfvalue.RDFInteger(i))
-    with test_lib.FakeTime(rdfvalue.RDFDatetime.Now() +
-                           rdfvalue.Duration("10m")):
-      for i in range(data_size - 1, data_size - 20, -1):
-        self.assertEqual(collection[i], i)
-      self.assertEqual(collection[1023], 1023)
-      self.assertEqual(collection[1024], 1024)
-      self.assertEqual(collection[1025], 1025)
-      for i in range(data_size - 1020, data_size - 1040, -1):
-        self.assertEqual(collection[i], i)
+    for i in range(data_size - 1, data_size - 20, -1):
+      self.assertEqual(collection[i], i)
+    self.assertEqual(collection[1023], 1023)
+    self.assertEqual(collection[1024], 1024)
+    self.assertEqual(collection[1025], 1025)
+    for i in range(data_size - 1020, data_size - 1040, -1):
+      self.assertEqual(collection[i], i)
+    with self.assertRaises(IndexError):
+      _ = collection[data_size]
 
   def testListing(self):
     test_urn = "aff4:/sequential_collection/testIndexedListing"
@@ -190,37 +422,9 @@ class IndexedSequentialCollectionTest(test_lib.AFF4ObjectTest):
     with test_lib.Instrument(sequential_collection.SequentialCollection,
                              "Scan") as scan:
       self.assertEqual(len(list(collection)), 100)
-      # Listing should be done using a single scan but there is another one
-      # for calculating the length.
-      self.assertEqual(scan.call_count, 2)
-
-  def testAutoIndexing(self):
-
-    indexing_done = threading.Event()
-
-    def UpdateIndex(self):
-      self.UpdateIndex.old_target(self)
-      indexing_done.set()
-
-    # To reduce the time for the test to run, reduce the delays, so that
-    # indexing should instantaneously.
-    isq = sequential_collection.IndexedSequentialCollection
-    biu = sequential_collection.BACKGROUND_INDEX_UPDATER
-    with utils.MultiStubber((biu, "INDEX_DELAY", 0), (isq, "INDEX_WRITE_DELAY",
-                                                      rdfvalue.Duration("0s")),
-                            (isq, "INDEX_SPACING", 8), (isq, "UpdateIndex",
-                                                        UpdateIndex)):
-      collection = self._TestCollection(
-          "aff4:/sequential_collection/testAutoIndexing")
-      for i in range(2048):
-        collection.Add(rdfvalue.RDFInteger(i))
-
-      # Wait for the updater thread to finish the indexing.
-      if not indexing_done.wait(timeout=10):
-        self.fail("Indexing did not finish in time.")
-
-      _ = collection[0]
-      self.assertGreater(len(collection._index), 16)
+      # Listing should be done using a single scan, the length is read from
+      # the index.
+      self.assertEqual(scan.call_count, 1)
 
 
 class GeneralIndexedCollectionTest(test_lib.AFF4ObjectTest):
@@ -36,12 +36,14 @@ if platform.system() == "Linux":
   # Trying to import this module on non-Linux platforms won't work.
   from grr.lib import fuse_mount_test
 
+from grr.lib import hash_index_test
 from grr.lib import hunt_test
 from grr.lib import instant_output_plugin_test
 from grr.lib import ipv6_utils_test
 from grr.lib import lexer_test
 from grr.lib import log_test
 from grr.lib import multi_type_collection_test
+from grr.lib import nsrl_index_test
 from grr.lib import objectfilter_test
 from grr.lib import output_plugin_test
 from grr.lib import parsers_test
@@ -56,6 +58,7 @@ from grr.lib import threadpool_test
 from grr.lib import throttle_test
 from grr.lib import type_info_test
 from grr.lib import uploads_test
+from grr.lib import utils_benchmark_test
 from grr.lib import utils_test
 
 from grr.lib.aff4_objects import tests
@@ -69,5 +72,6 @@ from grr.lib.local import tests
 from grr.lib.output_plugins import tests
 from grr.lib.rdfvalues import tests
 
+from grr.tools import frontend_benchmark_test
 from grr.tools import frontend_test
 # pylint: enable=unused-import,g-import-not-at-top
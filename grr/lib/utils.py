@@ -7,6 +7,7 @@ import cStringIO
 import errno
 import functools
 import getpass
+import itertools
 import os
 import pipes
 import Queue
@@ -200,10 +201,22 @@ class LinkedList(object):
       p = p.next
 
 
+# Field offsets of the links making up the FastStore LRU list.
+_PREV, _NEXT, _KEY, _DATA = 0, 1, 2, 3
+
+
 class FastStore(object):
   """This is a cache which expires objects in oldest first manner.
 
-  This implementation first appeared in PyFlag.
+  The cache keeps a dict mapping each key to a [prev, next, key, data] list
+  which is also a link in a circular doubly linked list ordered from least to
+  most recently used. This is the layout used by collections.OrderedDict, but
+  manipulated inline which avoids allocating an object per entry and keeps all
+  operations O(1).
+
+  The links are guarded by a private non reentrant lock which is never held
+  while calling out of the class. The reentrant self.lock is left for
+  subclasses which need to make several calls atomically (see Synchronized).
   """
 
   def __init__(self, max_size=10):
@@ -212,14 +225,19 @@ class FastStore(object):
     Args:
        max_size: The maximum number of objects held in cache.
     """
-    # This class implements a LRU cache which needs fast updates of the LRU
-    # order for random elements. This is usually implemented by using a
-    # dict for fast lookups and a linked list for quick deletions / insertions.
-    self._age = LinkedList()
     self._hash = {}
+    # The root of the LRU list, root[_NEXT] is the oldest entry.
+    self._root = []
+    self._root[:] = [self._root, self._root, None, None]
     self._limit = max_size
+    self._lock = threading.Lock()
     self.lock = threading.RLock()
 
+    # Usage counters.
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
   def KillObject(self, obj):
     """Perform cleanup on objects when they expire.
 
@@ -228,72 +246,93 @@ class FastStore(object):
       obj: The object which was stored in the cache and is now expired.
     """
 
-  @Synchronized
+  def _Unlink(self, link):
+    """Removes the link from the LRU list and the hash, needs self._lock."""
+    link_prev, link_next = link[_PREV], link[_NEXT]
+    link_prev[_NEXT] = link_next
+    link_next[_PREV] = link_prev
+    del self._hash[link[_KEY]]
+
+  def _PopOldest(self):
+    """Unlinks and returns the objects over the size limit."""
+    expired = []
+    with self._lock:
+      while len(self._hash) > self._limit:
+        link = self._root[_NEXT]
+        self._Unlink(link)
+        self.evictions += 1
+        expired.append(link[_DATA])
+
+    return expired
+
   def __iter__(self):
-    return iter([(key, n.data) for key, n in self._hash.iteritems()])
+    with self._lock:
+      return iter([(key, link[_DATA]) for key, link in self._hash.iteritems()])
 
-  @Synchronized
   def Expire(self):
     """Expires old cache entries."""
-    while len(self._age) > self._limit:
-      node = self._age.PopLeft()
-      self._hash.pop(node.key, None)
-      self.KillObject(node.data)
+    for obj in self._PopOldest():
+      self.KillObject(obj)
 
-  @Synchronized
   def Put(self, key, obj):
     """Add the object to the cache."""
-    # Remove the old entry if it is there.
-    node = self._hash.pop(key, None)
-    if node:
-      self._age.Unlink(node)
+    with self._lock:
+      # Remove the old entry if it is there.
+      link = self._hash.get(key)
+      if link is not None:
+        self._Unlink(link)
 
-    # Make a new node and insert it.
-    node = Node(key=key, data=obj)
-    self._hash[key] = node
-    self._age.AppendNode(node)
+      # Add a new link at the most recently used end.
+      root = self._root
+      last = root[_PREV]
+      link = [last, root, key, obj]
+      last[_NEXT] = root[_PREV] = self._hash[key] = link
 
-    self.Expire()
+      full = len(self._hash) > self._limit
+
+    if full:
+      self.Expire()
 
     return key
 
-  @Synchronized
   def ExpireObject(self, key):
     """Expire a specific object from cache."""
-    node = self._hash.pop(key, None)
-    if node:
-      self._age.Unlink(node)
-      self.KillObject(node.data)
+    with self._lock:
+      link = self._hash.get(key)
+      if link is None:
+        return
+      self._Unlink(link)
 
-      return node.data
+    self.KillObject(link[_DATA])
+    return link[_DATA]
 
-  @Synchronized
   def ExpireRegEx(self, regex):
     """Expire all the objects with the key matching the regex."""
     reg = re.compile(regex)
-    for key in list(self._hash):
-      if reg.match(key):
-        self.ExpireObject(key)
+    with self._lock:
+      keys = [key for key in self._hash if reg.match(key)]
+
+    for key in keys:
+      self.ExpireObject(key)
 
-  @Synchronized
   def ExpirePrefix(self, prefix):
     """Expire all the objects with the key having a given prefix."""
-    for key in list(self._hash):
-      if key.startswith(prefix):
-        self.ExpireObject(key)
+    with self._lock:
+      keys = [key for key in self._hash if key.startswith(prefix)]
+
+    for key in keys:
+      self.ExpireObject(key)
 
-  @Synchronized
   def Pop(self, key):
     """Remove the object from the cache completely."""
-    node = self._hash.get(key)
-
-    if node:
-      del self._hash[key]
-      self._age.Unlink(node)
+    with self._lock:
+      link = self._hash.get(key)
+      if link is None:
+        return
+      self._Unlink(link)
 
-      return node.data
+    return link[_DATA]
 
-  @Synchronized
   def Get(self, key):
     """Fetch the object from cache.
 
@@ -309,36 +348,147 @@ class FastStore(object):
     Raises:
       KeyError: If the object is not present in the cache.
     """
-    if key not in self._hash:
-      raise KeyError(key)
+    with self._lock:
+      link = self._hash.get(key)
+      if link is None:
+        self.misses += 1
+        raise KeyError(key)
+
+      self.hits += 1
+
+      # Move the link to the most recently used end.
+      root = self._root
+      link_prev, link_next = link[_PREV], link[_NEXT]
+      link_prev[_NEXT] = link_next
+      link_next[_PREV] = link_prev
+      last = root[_PREV]
+      last[_NEXT] = root[_PREV] = link
+      link[_PREV] = last
+      link[_NEXT] = root
+
+      return link[_DATA]
 
-    node = self._hash[key]
-
-    self._age.Unlink(node)
-    self._age.AppendNode(node)
-
-    return node.data
-
-  @Synchronized
   def __contains__(self, obj):
     return obj in self._hash
 
-  @Synchronized
   def __getitem__(self, key):
     return self.Get(key)
 
-  @Synchronized
   def Flush(self):
     """Flush all items from cache."""
-    while self._age:
-      node = self._age.PopLeft()
-      self.KillObject(node.data)
+    with self._lock:
+      root = self._root
+      link = root[_NEXT]
+      self._hash = dict()
+      root[:] = [root, root, None, None]
 
-    self._hash = dict()
+    while link is not root:
+      self.KillObject(link[_DATA])
+      link = link[_NEXT]
 
   def __len__(self):
     return len(self._hash)
 
+  def HitRate(self):
+    """Returns the fraction of Get() calls which found the object."""
+    total = self.hits + self.misses
+    if not total:
+      return 0.0
+    return float(self.hits) / total
+
+
+class ShardedFastStore(object):
+  """A FastStore split into independently locked shards.
+
+  Keys are distributed over the shards by hash, so threads working on
+  different keys rarely contend on the same lock. Each shard holds up to
+  max_size / shards objects and expires them in oldest first manner.
+  """
+
+  store_cls = FastStore
+
+  def __init__(self, max_size=10, shards=16, **kwargs):
+    """Constructor.
+
+    Args:
+      max_size: The maximum number of objects held in cache.
+      shards: The number of independently locked shards.
+      **kwargs: Passed to the store_cls constructor of every shard.
+    """
+    shard_size = max(1, (max_size + shards - 1) // shards)
+    self._shards = [
+        self._MakeShard(shard_size, **kwargs) for _ in xrange(shards)
+    ]
+
+  def _MakeShard(self, shard_size, **kwargs):
+    shard = self.store_cls(max_size=shard_size, **kwargs)
+    # Expired objects are reported through this object's KillObject.
+    shard.KillObject = self.KillObject
+    return shard
+
+  def _Shard(self, key):
+    shards = self._shards
+    return shards[hash(key) % len(shards)]
+
+  def KillObject(self, obj):
+    """Perform cleanup on objects when they expire."""
+
+  def Put(self, key, obj):
+    return self._Shard(key).Put(key, obj)
+
+  def Get(self, key):
+    return self._Shard(key).Get(key)
+
+  def Pop(self, key):
+    return self._Shard(key).Pop(key)
+
+  def ExpireObject(self, key):
+    return self._Shard(key).ExpireObject(key)
+
+  def ExpireRegEx(self, regex):
+    for shard in self._shards:
+      shard.ExpireRegEx(regex)
+
+  def ExpirePrefix(self, prefix):
+    for shard in self._shards:
+      shard.ExpirePrefix(prefix)
+
+  def Flush(self):
+    for shard in self._shards:
+      shard.Flush()
+
+  def __contains__(self, key):
+    return key in self._Shard(key)
+
+  def __getitem__(self, key):
+    return self.Get(key)
+
+  def __iter__(self):
+    return itertools.chain.from_iterable(iter(shard) for shard in self._shards)
+
+  def __len__(self):
+    return sum(len(shard) for shard in self._shards)
+
+  @property
+  def hits(self):
+    return sum(shard.hits for shard in self._shards)
+
+  @property
+  def misses(self):
+    return sum(shard.misses for shard in self._shards)
+
+  @property
+  def evictions(self):
+    return sum(shard.evictions for shard in self._shards)
+
+  def HitRate(self):
+    """Returns the fraction of Get() calls which found the object."""
+    hits = self.hits
+    total = hits + self.misses
+    if not total:
+      return 0.0
+    return float(hits) / total
+
 
 class TimeBasedCache(FastStore):
   """A Cache which expires based on time."""
@@ -372,19 +522,22 @@ class TimeBasedCache(FastStore):
         # Only expunge while holding the lock on the data store.
         with cache.lock:
           # pylint: disable=protected-access
-          # We need to take a copy of the value list because we are changing
-          # this dict during the iteration.
-          for node in cache._hash.values():
-            timestamp, obj = node.data
-
-            # Expire the object if it is too old.
-            if timestamp + cache.max_age < now:
-              cache.KillObject(obj)
-
-              cache._age.Unlink(node)
-              cache._hash.pop(node.key, None)
+          expired = []
+          with cache._lock:
+            # We need to take a copy of the value list because we are changing
+            # this dict during the iteration.
+            for link in cache._hash.values():
+              timestamp, obj = link[_DATA]
+
+              # Expire the object if it is too old.
+              if timestamp + cache.max_age < now:
+                cache._Unlink(link)
+                expired.append(obj)
           # pylint: enable=protected-access
 
+          for obj in expired:
+            cache.KillObject(obj)
+
     if not TimeBasedCache.house_keeper_thread:
       TimeBasedCache.active_caches = weakref.WeakSet()
       # This thread is designed to never finish.
@@ -514,6 +667,12 @@ class AgeBasedCache(TimeBasedCache):
     return stored[1]
 
 
+class ShardedAgeBasedCache(ShardedFastStore):
+  """An AgeBasedCache split into independently locked shards."""
+
+  store_cls = AgeBasedCache
+
+
 class Struct(object):
   """A baseclass for parsing binary Structs."""
 
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""Benchmarks for the caches in the utils module."""
+
+
+import sys
+import threading
+import time
+
+
+from grr.lib import flags
+from grr.lib import test_lib
+from grr.lib import utils
+
+
+class LinkedListStore(object):
+  """The Node based LRU cache FastStore was originally implemented as."""
+
+  def __init__(self, max_size=10):
+    self._hash = {}
+    self._age = utils.LinkedList()
+    self._limit = max_size
+    self.lock = threading.RLock()
+
+  @utils.Synchronized
+  def Put(self, key, obj):
+    node = self._hash.pop(key, None)
+    if node:
+      self._age.Unlink(node)
+
+    node = utils.Node(key=key, data=obj)
+    self._hash[key] = node
+    self._age.AppendNode(node)
+
+    while len(self._age) > self._limit:
+      node = self._age.PopLeft()
+      self._hash.pop(node.key, None)
+
+  @utils.Synchronized
+  def Get(self, key):
+    if key not in self._hash:
+      raise KeyError(key)
+
+    node = self._hash[key]
+    self._age.Unlink(node)
+    self._age.AppendNode(node)
+    return node.data
+
+
+def EntrySize(store):
+  """Returns the bytes the store uses per entry, excluding keys and values."""
+  # pylint: disable=protected-access
+  total = sys.getsizeof(store._hash)
+  for entry in store._hash.itervalues():
+    total += sys.getsizeof(entry)
+    if hasattr(entry, "__dict__"):
+      total += sys.getsizeof(entry.__dict__)
+
+  return total / len(store._hash)
+
+
+class FastStoreBenchmark(test_lib.MicroBenchmarks):
+  """Compares the FastStore to the Node based cache it replaced."""
+
+  labels = ["benchmark"]
+  units = "us"
+
+  REPEATS = 100000
+  SIZE = 50000
+  THREADS = 4
+
+  def setUp(self):
+    super(FastStoreBenchmark, self).setUp(["Value"], ["<20"])
+
+  def _FillStore(self, store):
+    for i in xrange(self.SIZE):
+      store.Put("key%d" % i, i)
+    return store
+
+  def testGet(self):
+    """Per-Get overhead and memory per entry of the store implementations."""
+    stores = [("LinkedListStore", LinkedListStore),
+              ("FastStore", utils.FastStore)]
+
+    for name, store_cls in stores:
+      store = self._FillStore(store_cls(max_size=self.SIZE))
+      keys = ["key%d" % (i % self.SIZE) for i in xrange(self.REPEATS)]
+
+      start = time.time()
+      for key in keys:
+        store.Get(key)
+      time_taken = (time.time() - start) / self.REPEATS
+
+      self.AddResult("%s Get (bytes/entry)" % name, time_taken,
+                     self.REPEATS, EntrySize(store))
+
+  def testContendedGet(self):
+    """Gets from several threads on a plain and a sharded store."""
+    stores = [("FastStore", utils.FastStore),
+              ("ShardedFastStore", utils.ShardedFastStore)]
+
+    for name, store_cls in stores:
+      # Leave room for the uneven distribution of keys over the shards.
+      store = self._FillStore(store_cls(max_size=2 * self.SIZE))
+      repeats = self.REPEATS // self.THREADS
+
+      def Worker(store=store, repeats=repeats):
+        for i in xrange(repeats):
+          store.Get("key%d" % (i % self.SIZE))
+
+      threads = [threading.Thread(target=Worker) for _ in range(self.THREADS)]
+
+      start = time.time()
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+      time_taken = (time.time() - start) / (repeats * self.THREADS)
+
+      self.AddResult("%s %d threads (hit rate)" % (name, self.THREADS),
+                     time_taken, repeats * self.THREADS, store.HitRate())
+
+
+def main(argv):
+  test_lib.GrrTestProgram(argv=argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -119,6 +119,106 @@ class StoreTests(test_lib.GRRBaseTest):
     # Make sure it's actually gone.
     self.assertLess(len(utils.TimeBasedCache.active_caches), l)
 
+  def testStoreOrder(self):
+    """Tests that the least recently used objects are expired first."""
+    s = utils.FastStore(max_size=3)
+    for i in range(3):
+      s.Put(i, i)
+
+    # Touch 0 and replace 1 which makes 2 the oldest object.
+    s.Get(0)
+    s.Put(1, "one")
+    s.Put(3, 3)
+
+    self.assertNotIn(2, s)
+    self.assertEqual(sorted(s), [(0, 0), (1, "one"), (3, 3)])
+    self.assertEqual(len(s), 3)
+
+  def testStorePopAndFlush(self):
+    results = []
+
+    class TestStore(utils.FastStore):
+
+      def KillObject(self, obj):
+        results.append(obj)
+
+    s = TestStore(max_size=10)
+    for i in range(5):
+      s.Put(i, i)
+
+    # Popping does not kill the object.
+    self.assertEqual(s.Pop(2), 2)
+    self.assertIsNone(s.Pop(2))
+    self.assertEqual(results, [])
+
+    s.Flush()
+    self.assertEqual(results, [0, 1, 3, 4])
+    self.assertEqual(len(s), 0)
+
+    # The store is still usable after a flush.
+    s.Put("a", 1)
+    self.assertEqual(s["a"], 1)
+
+  def testStoreHitRate(self):
+    s = utils.FastStore(max_size=2)
+    self.assertEqual(s.HitRate(), 0)
+
+    for i in range(3):
+      s.Put(i, i)
+
+    s.Get(2)
+    s.Get(2)
+    s.Get(1)
+    self.assertRaises(KeyError, s.Get, 0)
+
+    self.assertEqual(s.hits, 3)
+    self.assertEqual(s.misses, 1)
+    self.assertEqual(s.evictions, 1)
+    self.assertEqual(s.HitRate(), 0.75)
+
+  def testShardedStore(self):
+    results = []
+
+    class TestStore(utils.ShardedFastStore):
+
+      def KillObject(self, obj):
+        results.append(obj)
+
+    s = TestStore(max_size=400, shards=4)
+    for i in range(40):
+      s.Put("key%d" % i, i)
+
+    self.assertEqual(len(s), 40)
+    self.assertIn("key10", s)
+    self.assertEqual(s.Get("key10"), 10)
+    self.assertEqual(s["key11"], 11)
+    self.assertRaises(KeyError, s.Get, "nokey")
+    self.assertEqual(s.hits, 2)
+    self.assertEqual(s.misses, 1)
+
+    self.assertEqual(s.ExpireObject("key12"), 12)
+    self.assertEqual(s.Pop("key13"), 13)
+    self.assertEqual(results, [12])
+
+    s.ExpirePrefix("key2")
+    self.assertEqual(len(s), 27)
+    self.assertEqual(sorted(results), [2, 12] + range(20, 30))
+
+    s.Flush()
+    self.assertEqual(len(s), 0)
+    self.assertEqual(sorted(results), range(13) + range(14, 40))
+
+  def testShardedStoreExpiration(self):
+    s = utils.ShardedFastStore(max_size=40, shards=4)
+    for i in range(1000):
+      s.Put(i, i)
+
+    # Every shard holds at most its share of the objects.
+    self.assertEqual(len(s), 40)
+    self.assertEqual(s.evictions, 960)
+    self.assertEqual(s.Get(999), 999)
+    self.assertRaises(KeyError, s.Get, 0)
+
 
 class UtilsTest(test_lib.GRRBaseTest):
   """Utilities tests."""
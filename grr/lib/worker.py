@@ -16,6 +16,7 @@ from grr.lib import flow
 from grr.lib import master
 from grr.lib import queue_manager as queue_manager_lib
 from grr.lib import queues as queues_config
+from grr.lib import rdfvalue
 from grr.lib import registry
 # pylint: disable=unused-import
 from grr.lib import server_stubs
@@ -97,39 +98,105 @@ class GRRWorker(object):
     # Well known flows are just instantiated.
     self.well_known_flows = flow.WellKnownFlow.GetAllWellKnownFlows(token=token)
 
+    # We get woken up when notifications are written to any of our shards so
+    # we only need to poll for notifications written by remote processes.
+    self.queue_by_shard = {}
+    manager = queue_manager_lib.QueueManager(token=token)
+    for queue in queues:
+      for queue_shard in manager.GetAllNotificationShards(queue):
+        self.queue_by_shard[utils.SmartStr(queue_shard)] = queue
+
+    self.notified_shards = set()
+    self.last_poll = 0
+    self.notification_waiter = queue_manager_lib.NOTIFIER.Register(
+        self.queue_by_shard)
+    queue_manager_lib.NOTIFIER.Listen()
+
+    # When shards are leased we only look at notifications in our own shards.
+    self.shard_leases = None
+    self.next_rebalance = 0
+    if config.CONFIG["Worker.lease_queue_shards"]:
+      self.shard_leases = queue_manager_lib.QueueShardLeases(
+          queues,
+          lease_time=config.CONFIG["Worker.queue_shard_lease_time"],
+          token=token)
+
+  def RebalanceShards(self):
+    """Renews our shard leases and adapts them to the number of workers."""
+    if self.shard_leases is None or time.time() < self.next_rebalance:
+      return
+
+    self.shard_leases.Rebalance()
+    self.next_rebalance = time.time() + self.shard_leases.lease_time / 3.0
+
+  def _GetPollingInterval(self):
+    if time.time() - self.last_active > self.SHORT_POLL_TIME:
+      return self.POLLING_INTERVAL
+    return self.SHORT_POLLING_INTERVAL
+
   def Run(self):
     """Event loop."""
     try:
       while 1:
+        processed = 0
         if master.MASTER_WATCHER.IsMaster():
-          processed = self.RunOnce()
-        else:
-          processed = 0
+          self.RebalanceShards()
+          processed += self.RunNotifiedShards()
+
+          if time.time() - self.last_poll >= self._GetPollingInterval():
+            self.last_poll = time.time()
+            processed += self.RunOnce()
 
         if processed == 0:
           logger = logging.getLogger()
           for h in logger.handlers:
             h.flush()
 
-          if time.time() - self.last_active > self.SHORT_POLL_TIME:
-            interval = self.POLLING_INTERVAL
-          else:
-            interval = self.SHORT_POLLING_INTERVAL
-
-          time.sleep(interval)
+          # Wait until we get notified or the next poll is due.
+          self.notification_waiter.Wait(
+              max(0, self.last_poll + self._GetPollingInterval() -
+                  time.time()))
         else:
           self.last_active = time.time()
 
     except KeyboardInterrupt:
       logging.info("Caught interrupt, exiting.")
       self.__class__.thread_pool.Join()
+      if self.shard_leases is not None:
+        self.shard_leases.Release()
 
-  def RunOnce(self):
+  def RunNotifiedShards(self):
+    """Processes the notification shards we were notified about.
+
+    Shards stay in self.notified_shards until a scan finds no notifications
+    in them, so work which did not fit into one run is picked up by the next.
+
+    Returns:
+        Total number of messages processed by this call.
+    """
+    self.notified_shards.update(self.notification_waiter.PopShards())
+    if self.shard_leases is not None:
+      self.notified_shards = set(
+          shard for shard in self.notified_shards
+          if self.shard_leases.Holds(shard))
+
+    if not self.notified_shards:
+      return 0
+
+    return self.RunOnce(queue_shards=self.notified_shards)
+
+  def RunOnce(self, queue_shards=None):
     """Processes one set of messages from Task Scheduler.
 
     The worker processes new jobs from the task master. For each job
     we retrieve the session from the Task Scheduler.
 
+    Args:
+        queue_shards: If given, a set of notification shard urns to scan
+                      instead of the next shard of each queue (or all our
+                      leased shards). Shards without any notifications are
+                      removed from this set.
+
     Returns:
         Total number of messages processed by this call.
     """
@@ -138,13 +205,33 @@ class GRRWorker(object):
 
     queue_manager = queue_manager_lib.QueueManager(token=self.token)
     for queue in self.queues:
+      shards = None
+      if queue_shards is not None:
+        shards = [
+            shard for shard in queue_shards
+            if self.queue_by_shard.get(shard) == queue
+        ]
+      elif self.shard_leases is not None:
+        shards = self.shard_leases.GetShards(queue)
+
+      if shards is not None and not shards:
+        continue
+
       # Freezeing the timestamp used by queue manager to query/delete
       # notifications to avoid possible race conditions.
       queue_manager.FreezeTimestamp()
 
       fetch_messages_start = time.time()
-      notifications_by_priority = queue_manager.GetNotificationsByPriority(
-          queue)
+      if shards is None:
+        notifications_by_priority = queue_manager.GetNotificationsByPriority(
+            queue)
+      else:
+        notifications_by_priority = (
+            queue_manager.GetNotificationsByPriorityForShards(
+                queue, [rdfvalue.RDFURN(shard) for shard in shards]))
+        if not notifications_by_priority and queue_shards is not None:
+          queue_shards.difference_update(shards)
+
       stats.STATS.RecordEvent("worker_time_to_retrieve_notifications",
                               time.time() - fetch_messages_start)
 
@@ -236,6 +323,9 @@ class GRRWorker(object):
 
         processed += 1
         self.queued_flows.Put(notification.session_id, 1)
+        if notification.timestamp:
+          stats.STATS.RecordEvent("worker_notification_pickup_latency",
+                                  _SecondsSince(notification.timestamp))
         self.__class__.thread_pool.AddTask(
             target=self._ProcessMessages,
             args=(notification, queue_manager.Copy()),
@@ -320,9 +410,17 @@ class GRRWorker(object):
       stats.STATS.RecordEvent(
           "worker_flow_processing_time", elapsed, fields=[flow_obj.Name()])
 
+      if notification.first_queued:
+        stats.STATS.RecordEvent("worker_notification_latency",
+                                _SecondsSince(notification.first_queued))
+
       # Everything went well -> session can be run again.
       self.queued_flows.ExpireObject(session_id)
 
+      # Notifications for this flow which arrived while we were processing it
+      # were skipped, make sure Run() rescans the notified shards.
+      self.notification_waiter.Wake()
+
     except aff4.LockError:
       # Another worker is dealing with this flow right now, we just skip it.
       # We expect lots of these when there are few messages (the system isn't
@@ -347,6 +445,12 @@ class GRRWorker(object):
       queue_manager.DeleteNotification(session_id)
 
 
+def _SecondsSince(timestamp):
+  now = rdfvalue.RDFDatetime.Now()
+  return max(0, now.AsMicroSecondsFromEpoch() -
+             timestamp.AsMicroSecondsFromEpoch()) / 1e6
+
+
 class WorkerInit(registry.InitHook):
   """Registers worker stats variables."""
 
@@ -365,3 +469,12 @@ class WorkerInit(registry.InitHook):
     stats.STATS.RegisterEventMetric(
         "worker_flow_processing_time", fields=[("flow", str)])
     stats.STATS.RegisterEventMetric("worker_time_to_retrieve_notifications")
+    stats.STATS.RegisterEventMetric(
+        "worker_notification_pickup_latency",
+        docstring=("Seconds from a notification being written until the "
+                   "worker starts processing it."))
+    stats.STATS.RegisterEventMetric(
+        "worker_notification_latency",
+        docstring=("Seconds from the first notification of a flow (e.g. when "
+                   "the frontend received client responses) until the flow "
+                   "finished processing them."))
@@ -213,6 +213,12 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
           status=rdf_data_store.DataStoreResponse.Status.AUTHORIZATION_DENIED)
       response = resp.SerializeToString()
 
+    if cmd.request_id:
+      # Serialized fields appended to a serialized protobuf are merged into
+      # it, which saves parsing the response again.
+      response += rdf_data_store.DataStoreResponse(
+          request_id=cmd.request_id).SerializeToString()
+
     return sutils.SIZE_PACKER.pack(len(response)) + response
 
   def HandleRegister(self):
@@ -3,8 +3,12 @@
 """RDFValue instances related to the foreman implementation."""
 
 
+import bisect
 import itertools
+import operator
 
+
+import logging
 from grr.lib import aff4
 from grr.lib import rdfvalue
 from grr.lib import utils
@@ -14,6 +18,64 @@ from grr.lib.rdfvalues import structs as rdf_structs
 from grr.proto import jobs_pb2
 
 
+class ForemanClientValues(object):
+  """The values of a client which foreman client rules are evaluated against.
+
+  Each value is read from the opened aff4 objects once, however many rules
+  look at it.
+  """
+
+  # Returned for values which can't be read.
+  MISSING = object()
+
+  def __init__(self, objects, client_id):
+    """Constructor.
+
+    Args:
+      objects: A dict that maps fd.urn to fd for all file descriptors fd
+          corresponding to the aff4 paths returned by the GetPathsToCheck
+          methods of the rules.
+      client_id: An aff4 client id object.
+    """
+    self.objects = objects
+    self.client_id = client_id
+    self._values = {}
+
+  def Get(self, path, attribute_name):
+    """Returns the value of an attribute of the object at path."""
+    key = (path, attribute_name)
+    try:
+      return self._values[key]
+    except KeyError:
+      pass
+
+    try:
+      fd = self.objects[self.client_id.Add(path)]
+      attribute = aff4.Attribute.NAMES[attribute_name]
+    except KeyError:
+      value = self.MISSING
+    else:
+      value = fd.Get(attribute)
+
+    self._values[key] = value
+    return value
+
+  def GetLabelsNames(self):
+    """Returns the set of label names of the client, or None."""
+    try:
+      return self._values[None]
+    except KeyError:
+      pass
+
+    try:
+      labels = set(self.objects[self.client_id].GetLabelsNames())
+    except KeyError:
+      labels = None
+
+    self._values[None] = labels
+    return labels
+
+
 class ForemanClientRuleBase(rdf_structs.RDFProtoStruct):
   """Abstract base class of foreman client rules."""
 
@@ -40,6 +102,15 @@ class ForemanClientRuleBase(rdf_structs.RDFProtoStruct):
     Returns:
       A bool value of the evaluation.
     """
+    return self.Compile()(ForemanClientValues(objects, client_id))
+
+  def Compile(self):
+    """Compiles the rule represented by this object.
+
+    Returns:
+      A function which takes a ForemanClientValues object and returns the bool
+      value of the evaluation.
+    """
     raise NotImplementedError
 
   def Validate(self):
@@ -50,18 +121,21 @@ class ForemanOsClientRule(ForemanClientRuleBase):
   """This rule will fire if the client OS is marked as true in the proto."""
   protobuf = jobs_pb2.ForemanOsClientRule
 
-  def Evaluate(self, objects, client_id):
-    try:
-      fd = objects[client_id]
-      attribute = aff4.Attribute.NAMES["System"]
-    except KeyError:
-      return False
+  def Compile(self):
+    prefixes = tuple(prefix
+                     for selected, prefix in ((self.os_windows, "Windows"),
+                                              (self.os_linux, "Linux"),
+                                              (self.os_darwin, "Darwin"))
+                     if selected)
+
+    def Evaluate(values):
+      value = values.Get("/", "System")
+      if value is values.MISSING:
+        return False
 
-    value = utils.SmartStr(fd.Get(attribute))
+      return utils.SmartStr(value).startswith(prefixes)
 
-    return ((self.os_windows and value.startswith("Windows")) or
-            (self.os_linux and value.startswith("Linux")) or
-            (self.os_darwin and value.startswith("Darwin")))
+    return Evaluate
 
   def Validate(self):
     pass
@@ -71,12 +145,7 @@ class ForemanLabelClientRule(ForemanClientRuleBase):
   """This rule will fire if the client has the selected label."""
   protobuf = jobs_pb2.ForemanLabelClientRule
 
-  def Evaluate(self, objects, client_id):
-    try:
-      fd = objects[client_id]
-    except KeyError:
-      return False
-
+  def Compile(self):
     if self.match_mode == ForemanLabelClientRule.MatchMode.MATCH_ALL:
       quantifier = all
     elif self.match_mode == ForemanLabelClientRule.MatchMode.MATCH_ANY:
@@ -88,9 +157,16 @@ class ForemanLabelClientRule(ForemanClientRuleBase):
     else:
       raise ValueError("Unexpected match mode value: %s" % self.match_mode)
 
-    client_label_names = set(fd.GetLabelsNames())
+    label_names = list(self.label_names)
+
+    def Evaluate(values):
+      client_label_names = values.GetLabelsNames()
+      if client_label_names is None:
+        return False
 
-    return quantifier((name in client_label_names) for name in self.label_names)
+      return quantifier((name in client_label_names) for name in label_names)
+
+    return Evaluate
 
   def Validate(self):
     pass
@@ -107,17 +183,19 @@ class ForemanRegexClientRule(ForemanClientRuleBase):
   def GetPathsToCheck(self):
     return [self.path]
 
-  def Evaluate(self, objects, client_id):
-    path = client_id.Add(self.path)
-    try:
-      fd = objects[path]
-      attribute = aff4.Attribute.NAMES[self.attribute_name]
-    except KeyError:
-      return False
+  def Compile(self):
+    path = utils.SmartStr(self.path)
+    attribute_name = utils.SmartStr(self.attribute_name)
+    regex = self.attribute_regex
+
+    def Evaluate(values):
+      value = values.Get(path, attribute_name)
+      if value is values.MISSING:
+        return False
 
-    value = utils.SmartStr(fd.Get(attribute))
+      return bool(regex.Search(utils.SmartStr(value)))
 
-    return self.attribute_regex.Search(value)
+    return Evaluate
 
   def Validate(self):
     if not self.attribute_name:
@@ -138,30 +216,36 @@ class ForemanIntegerClientRule(ForemanClientRuleBase):
   def GetPathsToCheck(self):
     return [self.path]
 
-  def Evaluate(self, objects, client_id):
-    path = client_id.Add(self.path)
-    try:
-      fd = objects[path]
-      attribute = aff4.Attribute.NAMES[self.attribute_name]
-    except KeyError:
-      return False
-
-    try:
-      value = int(fd.Get(attribute))
-    except (ValueError, TypeError):
-      # Not an integer attribute.
-      return False
+  def Compile(self):
+    path = utils.SmartStr(self.path)
+    attribute_name = utils.SmartStr(self.attribute_name)
+    reference = int(self.value)
 
     op = self.operator
     if op == ForemanIntegerClientRule.Operator.LESS_THAN:
-      return value < self.value
+      compare = operator.lt
     elif op == ForemanIntegerClientRule.Operator.GREATER_THAN:
-      return value > self.value
+      compare = operator.gt
     elif op == ForemanIntegerClientRule.Operator.EQUAL:
-      return value == self.value
+      compare = operator.eq
     else:
       # Unknown operator.
-      return False
+      return lambda values: False
+
+    def Evaluate(values):
+      value = values.Get(path, attribute_name)
+      if value is values.MISSING:
+        return False
+
+      try:
+        value = int(value)
+      except (ValueError, TypeError):
+        # Not an integer attribute.
+        return False
+
+      return compare(value, reference)
+
+    return Evaluate
 
   def Validate(self):
     if not self.attribute_name:
@@ -192,8 +276,8 @@ class ForemanClientRule(ForemanClientRuleBase):
   def GetPathsToCheck(self):
     return self.UnionCast().GetPathsToCheck()
 
-  def Evaluate(self, objects, client_id):
-    return self.UnionCast().Evaluate(objects, client_id)
+  def Compile(self):
+    return self.UnionCast().Compile()
 
   def Validate(self):
     self.UnionCast().Validate()
@@ -227,15 +311,19 @@ class ForemanClientRuleSet(rdf_structs.RDFProtoStruct):
     Raises:
       ValueError: The match mode is of unknown value.
     """
+    rules = [rule.Compile() for rule in self.rules]
+    values = ForemanClientValues(objects, client_id)
+    return self.GetQuantifier()(rule(values) for rule in rules)
+
+  def GetQuantifier(self):
+    """Returns the function which combines the results of the rules."""
     if self.match_mode == ForemanClientRuleSet.MatchMode.MATCH_ALL:
-      quantifier = all
+      return all
     elif self.match_mode == ForemanClientRuleSet.MatchMode.MATCH_ANY:
-      quantifier = any
+      return any
     else:
       raise ValueError("Unexpected match mode value: %s" % self.match_mode)
 
-    return quantifier(rule.Evaluate(objects, client_id) for rule in self.rules)
-
   def Validate(self):
     for rule in self.rules:
       rule.Validate()
@@ -264,3 +352,168 @@ class ForemanRule(rdf_structs.RDFProtoStruct):
 class ForemanRules(rdf_protodict.RDFValueArray):
   """A list of rules that the foreman will apply."""
   rdf_type = ForemanRule
+
+
+class CompiledForemanRules(object):
+  """Foreman rules prepared for evaluating them against many clients.
+
+  Compiling the rules once saves decoding and interpreting the rule protos on
+  every foreman check. Client rules which are used by several foreman rules are
+  evaluated once per client, and the rules are kept in creation order so that
+  the rules a client has not seen yet are found with a binary search.
+
+  Rules which require an OS or a label are also indexed by that OS prefix or
+  label name, so a client is only evaluated against the rules which can match
+  its OS and labels, plus the rules which can't be indexed.
+  """
+
+  OS_PREFIXES = ("Windows", "Linux", "Darwin")
+
+  def __init__(self, rules):
+    self.rules = sorted(rules, key=lambda rule: int(rule.created))
+    self._created = [int(rule.created) for rule in self.rules]
+    self.earliest_expiry = min([int(rule.expires) for rule in self.rules] or
+                               [None])
+
+    self._client_rules = []
+    client_rule_ids = {}
+    # For each rule, the quantifier and the ids of its client rules.
+    self._rule_sets = []
+    # For each rule, the paths to open.
+    self._paths = []
+    # Indexes of the rules which require one of these OS prefixes or labels.
+    self._os_index = {}
+    self._label_index = {}
+    # Indexes of the rules which are not in any of the indexes above. Invalid
+    # rules never match and are in none of the indexes.
+    self._unindexed = set()
+
+    for index, rule in enumerate(self.rules):
+      rule_set = rule.client_rule_set
+      ids = []
+      try:
+        quantifier = rule_set.GetQuantifier()
+        for client_rule in rule_set.rules:
+          key = client_rule.SerializeToString()
+          if key not in client_rule_ids:
+            client_rule_ids[key] = len(self._client_rules)
+            self._client_rules.append(client_rule.Compile())
+          ids.append(client_rule_ids[key])
+        self._IndexRule(index, rule_set)
+      except ValueError as e:
+        logging.error("Foreman rule %s is invalid: %s", rule.description, e)
+        quantifier = lambda unused_results: False
+        ids = []
+
+      self._rule_sets.append((quantifier, ids))
+      self._paths.append(rule_set.GetPathsToCheck())
+
+  def _IndexRule(self, index, rule_set):
+    """Adds the rule to the index of one of the client rules it requires."""
+    # Every client rule of a MATCH_ALL rule set has to match, a MATCH_ANY rule
+    # set only requires its client rule if it has just one.
+    if (rule_set.match_mode == ForemanClientRuleSet.MatchMode.MATCH_ALL or
+        len(rule_set.rules) == 1):
+      required = [client_rule.UnionCast() for client_rule in rule_set.rules]
+    else:
+      required = []
+
+    for client_rule in required:
+      if isinstance(client_rule, ForemanOsClientRule):
+        for selected, prefix in zip((client_rule.os_windows,
+                                     client_rule.os_linux,
+                                     client_rule.os_darwin), self.OS_PREFIXES):
+          if selected:
+            self._os_index.setdefault(prefix, set()).add(index)
+        # A rule without any selected OS never matches and isn't indexed.
+        return
+
+    label_match_modes = (ForemanLabelClientRule.MatchMode.MATCH_ALL,
+                         ForemanLabelClientRule.MatchMode.MATCH_ANY)
+    for client_rule in required:
+      if (isinstance(client_rule, ForemanLabelClientRule) and
+          client_rule.match_mode in label_match_modes and
+          client_rule.label_names):
+        if client_rule.match_mode == ForemanLabelClientRule.MatchMode.MATCH_ALL:
+          # Any one of the labels is required.
+          label_names = list(client_rule.label_names)[:1]
+        else:
+          label_names = client_rule.label_names
+        for label_name in label_names:
+          self._label_index.setdefault(utils.SmartStr(label_name),
+                                       set()).add(index)
+        return
+
+    self._unindexed.add(index)
+
+  def __len__(self):
+    return len(self.rules)
+
+  @property
+  def latest_rule_time(self):
+    """The creation time of the newest rule, 0 if there are no rules."""
+    return self._created[-1] if self._created else 0
+
+  def GetRulesCreatedAfter(self, timestamp):
+    """Returns the indexes of the rules created after timestamp."""
+    return xrange(bisect.bisect_right(self._created, timestamp), len(self.rules))
+
+  def GetPathsToCheck(self, rule_indexes):
+    """Returns the aff4 paths which the rules need opened."""
+    paths = set()
+    for index in rule_indexes:
+      paths.update(self._paths[index])
+    return paths
+
+  def _GetCandidateRules(self, values):
+    """Returns the indexes of the rules which can match the client."""
+    candidates = set(self._unindexed)
+
+    if self._os_index:
+      system = values.Get("/", "System")
+      if system is not values.MISSING:
+        system = utils.SmartStr(system)
+        for prefix, indexes in self._os_index.iteritems():
+          if system.startswith(prefix):
+            candidates.update(indexes)
+
+    if self._label_index:
+      for label_name in values.GetLabelsNames() or []:
+        candidates.update(
+            self._label_index.get(utils.SmartStr(label_name), ()))
+
+    return candidates
+
+  def GetMatchingRules(self, rule_indexes, objects, client_id):
+    """Returns the rules which match the client.
+
+    Args:
+      rule_indexes: The indexes of the rules to evaluate.
+      objects: A dict that maps fd.urn to fd for all file descriptors fd
+          corresponding to the aff4 paths returned by GetPathsToCheck.
+      client_id: An aff4 client id object.
+
+    Returns:
+      A list of ForemanRule objects, in creation order.
+    """
+    values = ForemanClientValues(objects, client_id)
+    results = {}
+
+    def Result(client_rule_id):
+      try:
+        return results[client_rule_id]
+      except KeyError:
+        result = results[client_rule_id] = self._client_rules[client_rule_id](
+            values)
+        return result
+
+    candidates = self._GetCandidateRules(values)
+    matching = []
+    for index in rule_indexes:
+      if index not in candidates:
+        continue
+
+      quantifier, ids = self._rule_sets[index]
+      if quantifier(Result(client_rule_id) for client_rule_id in ids):
+        matching.append(self.rules[index])
+    return matching
@@ -271,6 +271,28 @@ parser_list_components = subparsers.add_parser(
     parents=[],
     help="Lists all available client components.")
 
+parser_update_collection_indexes = subparsers.add_parser(
+    "update_collection_indexes",
+    parents=[],
+    help="Creates the indexes of collections written by older GRR versions.")
+
+parser_update_collection_indexes.add_argument(
+    "--collection",
+    default=[],
+    action="append",
+    help="The urn of a collection to index. May be given multiple times.")
+
+parser_update_collection_indexes.add_argument(
+    "--all_hunts",
+    default=False,
+    action="store_true",
+    help="Index the collections of all hunts.")
+
+parser_update_hunt_summary_index = subparsers.add_parser(
+    "update_hunt_summary_index",
+    parents=[],
+    help="Adds hunts created by older GRR versions to the hunts list.")
+
 
 def ImportConfig(filename, config):
   """Reads an old config file and imports keys and user accounts."""
@@ -912,6 +934,15 @@ def main(unused_argv):
     s = rekall_profile_server.GRRRekallProfileServer()
     s.GetMissingProfiles()
 
+  elif flags.FLAGS.subparser_name == "update_collection_indexes":
+    maintenance_utils.UpdateCollectionIndexes(
+        collection_urns=flags.FLAGS.collection,
+        all_hunts=flags.FLAGS.all_hunts,
+        token=token)
+
+  elif flags.FLAGS.subparser_name == "update_hunt_summary_index":
+    maintenance_utils.UpdateHuntSummaryIndex(token=token)
+
 
 if __name__ == "__main__":
   flags.StartMain(main)
@@ -3,9 +3,15 @@
 
 
 
+import asynchat
+import asyncore
 import BaseHTTPServer
 import cgi
+import collections
 import cStringIO
+import errno
+import mimetools
+import os
 import pdb
 import socket
 import SocketServer
@@ -32,6 +38,7 @@ from grr.lib import master
 from grr.lib import rdfvalue
 from grr.lib import server_startup
 from grr.lib import stats
+from grr.lib import threadpool
 from grr.lib import utils
 from grr.lib.rdfvalues import flows as rdf_flows
 
@@ -300,6 +307,24 @@ class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             "frontend_active_count", self.active_counter, fields=["http"])
 
 
+def _CreateFrontEnd():
+  """Creates the FrontEndServer from the config."""
+  return front_end.FrontEndServer(
+      certificate=config.CONFIG["Frontend.certificate"],
+      private_key=config.CONFIG["PrivateKeys.server_key"],
+      max_queue_size=config.CONFIG["Frontend.max_queue_size"],
+      message_expiry_time=config.CONFIG["Frontend.message_expiry_time"],
+      max_retransmission_time=config.CONFIG["Frontend.max_retransmission_time"])
+
+
+def _AddressFamily(server_address):
+  """Returns the socket address family to listen on server_address."""
+  (address, _) = server_address
+  if ipaddr.IPAddress(address).version == 4:
+    return socket.AF_INET
+  return socket.AF_INET6
+
+
 class GRRHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
   """The GRR HTTP frontend server."""
 
@@ -312,40 +337,341 @@ class GRRHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
     stats.STATS.SetGaugeValue("frontend_max_active_count",
                               self.request_queue_size)
 
-    if frontend:
-      self.frontend = frontend
-    else:
-      self.frontend = front_end.FrontEndServer(
-          certificate=config.CONFIG["Frontend.certificate"],
-          private_key=config.CONFIG["PrivateKeys.server_key"],
-          max_queue_size=config.CONFIG["Frontend.max_queue_size"],
-          message_expiry_time=config.CONFIG["Frontend.message_expiry_time"],
-          max_retransmission_time=config.CONFIG[
-              "Frontend.max_retransmission_time"])
+    self.frontend = frontend or _CreateFrontEnd()
     self.server_cert = config.CONFIG["Frontend.certificate"]
-
-    (address, _) = server_address
-    version = ipaddr.IPAddress(address).version
-    if version == 4:
-      self.address_family = socket.AF_INET
-    elif version == 6:
-      self.address_family = socket.AF_INET6
+    self.address_family = _AddressFamily(server_address)
 
     logging.info("Will attempt to listen on %s", server_address)
     BaseHTTPServer.HTTPServer.__init__(self, server_address, handler, *args,
                                        **kwargs)
 
 
+class _BufferedRequest(object):
+  """Stands in for the socket of a request read by the AsyncGRRHTTPServer.
+
+  This allows the GRRHTTPServerHandler to process a complete request from a
+  buffer and collect its response without touching the client connection.
+  """
+
+  closed = False
+
+  def __init__(self, data):
+    self.rfile = cStringIO.StringIO(data)
+    self.response = []
+
+  def makefile(self, mode, unused_bufsize=-1):
+    if "r" in mode:
+      return self.rfile
+    return self
+
+  def write(self, data):
+    self.response.append(data)
+
+  def flush(self):
+    pass
+
+  def close(self):
+    pass
+
+
+class _AsyncConnection(asynchat.async_chat):
+  """Reads a single HTTP request from a client without blocking.
+
+  Once the request, including a content-length or chunked body, is complete it
+  is handed to the server's worker pool and the connection stops reading until
+  the response is sent. Requests larger than the server's max_request_size are
+  answered with 413 and the connection is closed.
+  """
+
+  REQUEST_TOO_LARGE_RESPONSE = ("HTTP/1.0 413 Request Entity Too Large\r\n"
+                                "Server: GRR Server\r\n"
+                                "Content-Length: 0\r\n"
+                                "\r\n")
+
+  def __init__(self, sock, client_address, server):
+    asynchat.async_chat.__init__(self, sock=sock, map=server.socket_map)
+    self.client_address = client_address
+    self.server = server
+    self._request = []
+    self._data = []
+    self._size = 0
+    self._ReadUntil("\r\n\r\n", self._HeadersDone)
+
+  def _ReadUntil(self, terminator, state):
+    self.set_terminator(terminator)
+    self._state = state
+
+  def readable(self):
+    # While the server's backlog is full, requests stay in the socket buffers.
+    return (self._state is not None and not self.server.BacklogFull() and
+            asynchat.async_chat.readable(self))
+
+  def _CheckSize(self, size):
+    """Counts size more bytes, returns False if the request is too large."""
+    self._size += size
+    if self._size <= self.server.max_request_size:
+      return True
+
+    logging.warning("Request from %s is larger than %d bytes.",
+                    self.client_address[0], self.server.max_request_size)
+    self._state = None
+    self.set_terminator(None)
+    self._request = []
+    self._data = []
+    self.SendResponse(self.REQUEST_TOO_LARGE_RESPONSE)
+    return False
+
+  def collect_incoming_data(self, data):
+    # Anything sent after the request is dropped.
+    if self._state is not None and self._CheckSize(len(data)):
+      self._data.append(data)
+
+  def found_terminator(self):
+    data = "".join(self._data)
+    self._data = []
+
+    # String terminators are not passed to collect_incoming_data.
+    if isinstance(self.terminator, str):
+      data += self.terminator
+      if not self._CheckSize(len(self.terminator)):
+        return
+
+    self._request.append(data)
+    self._state(data)
+
+  def _HeadersDone(self, data):
+    headers = mimetools.Message(cStringIO.StringIO(data.split("\r\n", 1)[-1]))
+
+    if "chunked" in headers.get("transfer-encoding", ""):
+      self._ReadUntil("\r\n", self._ChunkSizeDone)
+      return
+
+    try:
+      length = int(headers.get("content-length", 0))
+    except ValueError:
+      length = 0
+
+    if length > self.server.max_request_size - self._size:
+      self._CheckSize(length)
+    elif length > 0:
+      self._ReadUntil(length, self._RequestDone)
+    else:
+      self._RequestDone()
+
+  def _ChunkSizeDone(self, data):
+    # We do not support chunked extensions, just ignore them.
+    try:
+      chunk_size = int(data.split(";")[0], 16)
+    except ValueError:
+      self._RequestDone()
+      return
+
+    if chunk_size > self.server.max_request_size - self._size:
+      self._CheckSize(chunk_size)
+    elif chunk_size:
+      # The chunk is followed by \r\n.
+      self._ReadUntil(chunk_size + 2, self._ChunkDone)
+    else:
+      self._ReadUntil("\r\n", self._RequestDone)
+
+  def _ChunkDone(self, unused_data):
+    self._ReadUntil("\r\n", self._ChunkSizeDone)
+
+  def _RequestDone(self, unused_data=None):
+    self._state = None
+    self.set_terminator(None)
+    self.server.QueueRequest(self, "".join(self._request))
+    self._request = []
+
+  def SendResponse(self, data):
+    if self.connected:
+      self.push(data)
+      self.close_when_done()
+
+  def handle_error(self):
+    logging.exception("Error on connection from %s.", self.client_address[0])
+    self.close()
+
+
+class _Waker(asyncore.file_dispatcher):
+  """Wakes the event loop up from other threads."""
+
+  def __init__(self, socket_map):
+    self._read_fd, self._write_fd = os.pipe()
+    asyncore.file_dispatcher.__init__(self, self._read_fd, map=socket_map)
+    self.callbacks = collections.deque()
+
+  def writable(self):
+    return False
+
+  def Wake(self, callback):
+    """Runs the callback in the event loop thread."""
+    self.callbacks.append(callback)
+    try:
+      os.write(self._write_fd, "x")
+    except OSError as e:
+      # The pipe is full so the loop is going to wake up anyway.
+      if e.errno != errno.EAGAIN:
+        raise
+
+  def handle_read(self):
+    try:
+      self.recv(4096)
+    except OSError as e:
+      if e.errno != errno.EAGAIN:
+        raise
+
+    while self.callbacks:
+      self.callbacks.popleft()()
+
+  def close(self):
+    asyncore.file_dispatcher.close(self)
+    os.close(self._write_fd)
+
+
+class AsyncGRRHTTPServer(asyncore.dispatcher):
+  """A GRR HTTP frontend server based on an event loop.
+
+  Unlike GRRHTTPServer this does not tie up a thread for every connected
+  client. All connections are multiplexed on a single event loop which only
+  reads requests and writes responses. Complete requests are processed by the
+  request handler in a pool of Frontend.async_worker_threads threads.
+
+  At most Frontend.async_max_backlog requests wait for a worker thread, no new
+  connections are accepted and no requests are read while the backlog is full.
+  """
+
+  request_queue_size = 500
+
+  def __init__(self, server_address, handler, frontend=None,
+               worker_threads=None):
+    stats.STATS.SetGaugeValue("frontend_max_active_count",
+                              self.request_queue_size)
+
+    self.frontend = frontend or _CreateFrontEnd()
+    self.server_cert = config.CONFIG["Frontend.certificate"]
+    self.handler = handler
+
+    # Each server runs its own loop so we do not share the global socket map.
+    self.socket_map = {}
+    asyncore.dispatcher.__init__(self, map=self.socket_map)
+
+    logging.info("Will attempt to listen on %s", server_address)
+    self.create_socket(_AddressFamily(server_address), socket.SOCK_STREAM)
+    try:
+      self.set_reuse_addr()
+      self.bind(server_address)
+      self.listen(self.request_queue_size)
+    except socket.error:
+      self.close()
+      raise
+
+    self.server_address = self.socket.getsockname()
+
+    self._waker = _Waker(self.socket_map)
+
+    if worker_threads is None:
+      worker_threads = config.CONFIG["Frontend.async_worker_threads"]
+    self.worker_pool = threadpool.ThreadPool.Factory(
+        "grr_frontend_workers", worker_threads, max_threads=worker_threads)
+    self.worker_pool.Start()
+
+    self.max_request_size = config.CONFIG["Frontend.async_max_request_size"]
+    self.max_backlog = config.CONFIG["Frontend.async_max_backlog"]
+    # Requests waiting for a free worker thread.
+    self._backlog = collections.deque()
+    self._is_shut_down = threading.Event()
+    self._shutdown_request = False
+
+  def BacklogFull(self):
+    return len(self._backlog) >= self.max_backlog
+
+  def readable(self):
+    return not self.BacklogFull()
+
+  def handle_accept(self):
+    pair = self.accept()
+    if pair is not None:
+      sock, client_address = pair
+      _AsyncConnection(sock, client_address, self)
+
+  def handle_error(self):
+    logging.exception("Error in the frontend event loop.")
+
+  def QueueRequest(self, connection, data):
+    """Queues a complete request for processing in the worker pool."""
+    self._backlog.append((connection, data))
+    self._ScheduleRequests()
+
+  def _ScheduleRequests(self):
+    while self._backlog:
+      try:
+        self.worker_pool.AddTask(
+            self._ProcessRequest,
+            self._backlog[0],
+            name="frontend request",
+            blocking=False,
+            inline=False)
+      except threadpool.Full:
+        # We try again when a worker is done.
+        return
+
+      self._backlog.popleft()
+
+  def _ProcessRequest(self, connection, data):
+    """Runs the request handler on a buffered request in a worker thread."""
+    request = _BufferedRequest(data)
+    try:
+      self.handler(request, connection.client_address, self)
+    except Exception:  # pylint: disable=broad-except
+      logging.exception("Unable to handle request from %s.",
+                        connection.client_address[0])
+
+    response = "".join(request.response)
+
+    def SendResponse():
+      connection.SendResponse(response)
+      self._ScheduleRequests()
+
+    self._waker.Wake(SendResponse)
+
+  def serve_forever(self, poll_interval=0.5):
+    """Runs the event loop until shutdown() is called."""
+    self._is_shut_down.clear()
+    try:
+      while not self._shutdown_request:
+        asyncore.loop(
+            timeout=poll_interval, use_poll=True, map=self.socket_map, count=1)
+    finally:
+      self._shutdown_request = False
+      self._is_shut_down.set()
+
+  def shutdown(self):
+    """Stops serve_forever() and closes all connections."""
+    self._shutdown_request = True
+    self._waker.Wake(lambda: None)
+    self._is_shut_down.wait()
+
+    # Requests still being processed need the waker.
+    self.worker_pool.Stop()
+    asyncore.close_all(map=self.socket_map)
+
+
 def CreateServer(frontend=None):
   """Start frontend http server."""
   max_port = config.CONFIG.Get("Frontend.port_max",
                                config.CONFIG["Frontend.bind_port"])
 
+  if config.CONFIG["Frontend.server_mode"] == "async":
+    server_cls = AsyncGRRHTTPServer
+  else:
+    server_cls = GRRHTTPServer
+
   for port in range(config.CONFIG["Frontend.bind_port"], max_port + 1):
 
     server_address = (config.CONFIG["Frontend.bind_address"], port)
     try:
-      httpd = GRRHTTPServer(
+      httpd = server_cls(
           server_address, GRRHTTPServerHandler, frontend=frontend)
       break
     except socket.error as e:
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""A load generator for the frontend http servers."""
+
+
+import socket
+import threading
+import time
+
+
+import portpicker
+import requests
+
+from grr import config
+from grr.client import comms
+from grr.lib import aff4
+from grr.lib import flags
+from grr.lib import front_end
+from grr.lib import rdfvalue
+from grr.lib import test_lib
+from grr.lib import utils
+from grr.lib.aff4_objects import aff4_grr
+from grr.lib.rdfvalues import crypto as rdf_crypto
+from grr.lib.rdfvalues import flows as rdf_flows
+from grr.tools import frontend
+
+
+class SimulatedClient(object):
+  """A client which encodes its messages with the real ClientCommunicator."""
+
+  def __init__(self, private_key):
+    self.communicator = comms.ClientCommunicator(private_key=private_key)
+    self.communicator.LoadServerCertificate(
+        server_certificate=config.CONFIG["Frontend.certificate"],
+        ca_certificate=config.CONFIG["CA.certificate"])
+
+  def EncodeRequest(self):
+    message_list = rdf_flows.MessageList()
+    message_list.job.Append(
+        session_id=rdfvalue.SessionID(flow_name="Stats"),
+        name="GetClientStats")
+
+    result = rdf_flows.ClientCommunication()
+    self.communicator.EncodeMessages(message_list, result)
+    return result.SerializeToString()
+
+
+class FrontendBenchmark(test_lib.MicroBenchmarks):
+  """Compares the threaded and the event loop based frontend servers.
+
+  Simulated clients poll the server from CONNECTIONS threads while
+  IDLE_CONNECTIONS more clients keep connections open without completing a
+  request, which is what long polling clients behind slow links look like to
+  the server.
+  """
+
+  labels = ["benchmark"]
+  units = "ms"
+
+  CLIENTS = 20
+  CONNECTIONS = 10
+  IDLE_CONNECTIONS = 200
+  REQUESTS = 500
+
+  def setUp(self):
+    super(FrontendBenchmark, self).setUp(["Requests/s", "p99 (ms)"],
+                                         ["<20", "<20"])
+    # Frontend must be initialized to register all the stats counters.
+    front_end.FrontendInit().RunOnce()
+
+    # Loading the server certificate changes the config so we preserve state.
+    self.config_stubber = test_lib.PreserveConfig()
+    self.config_stubber.Start()
+
+    self.clients = []
+    for _ in range(self.CLIENTS):
+      private_key = rdf_crypto.RSAPrivateKey.GenerateKey(bits=1024)
+      self._EnrolClient(private_key)
+      self.clients.append(SimulatedClient(private_key))
+
+  def tearDown(self):
+    super(FrontendBenchmark, self).tearDown()
+    self.config_stubber.Stop()
+
+  def _EnrolClient(self, private_key):
+    client_cert = self.ClientCertFromPrivateKey(private_key)
+    with aff4.FACTORY.Create(
+        client_cert.GetCN(), aff4_grr.VFSGRRClient,
+        token=self.token) as client:
+      client.Set(client.Schema.CERT, client_cert)
+
+  def _StartServer(self, server_cls):
+    port = portpicker.PickUnusedPort()
+    ip = utils.ResolveHostnameToIP("localhost", port)
+    httpd = server_cls((ip, port), frontend.GRRHTTPServerHandler)
+
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    if ":" in ip:
+      return httpd, "http://[%s]:%d/" % (ip, port)
+    return httpd, "http://%s:%d/" % (ip, port)
+
+  def _OpenIdleConnections(self, httpd):
+    connections = []
+    address = httpd.server_address[:2]
+    for _ in range(self.IDLE_CONNECTIONS):
+      sock = socket.socket(
+          socket.AF_INET6 if ":" in address[0] else socket.AF_INET,
+          socket.SOCK_STREAM)
+      sock.connect(address)
+      sock.sendall("POST /control HTTP/1.0\r\n")
+      connections.append(sock)
+    return connections
+
+  def _Poll(self, url, clients, latencies, errors):
+    session = requests.Session()
+    for i in range(self.REQUESTS // self.CONNECTIONS):
+      data = clients[i % len(clients)].EncodeRequest()
+
+      start = time.time()
+      response = session.post(url, data=data)
+      latencies.append(time.time() - start)
+
+      if response.status_code != 200:
+        errors.append(response.status_code)
+
+  def _RunLoad(self, name, server_cls):
+    httpd, base_url = self._StartServer(server_cls)
+    idle_connections = self._OpenIdleConnections(httpd)
+    url = base_url + "control?api=%s" % config.CONFIG["Network.api"]
+
+    latencies = []
+    errors = []
+    threads = [
+        threading.Thread(
+            target=self._Poll,
+            args=(url, self.clients[i::self.CONNECTIONS], latencies, errors))
+        for i in range(self.CONNECTIONS)
+    ]
+
+    try:
+      start = time.time()
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+      time_taken = time.time() - start
+    finally:
+      for sock in idle_connections:
+        sock.close()
+      httpd.shutdown()
+
+    self.assertEqual(errors, [])
+
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    self.AddResult(name, time_taken / len(latencies), len(latencies),
+                   "%.1f" % (len(latencies) / time_taken),
+                   "%.2f" % (p99 * 1000))
+
+  def testFrontendServers(self):
+    """Polling clients against both frontend server modes."""
+    self._RunLoad("Threaded server", frontend.GRRHTTPServer)
+    self._RunLoad("Event loop server", frontend.AsyncGRRHTTPServer)
+
+
+def main(argv):
+  test_lib.GrrTestProgram(argv=argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
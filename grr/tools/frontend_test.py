@@ -41,6 +41,8 @@ from grr.tools import frontend
 class GRRHTTPServerTest(test_lib.GRRBaseTest):
   """Test the http server."""
 
+  server_cls = frontend.GRRHTTPServer
+
   @classmethod
   def setUpClass(cls):
     super(GRRHTTPServerTest, cls).setUpClass()
@@ -50,14 +52,13 @@ class GRRHTTPServerTest(test_lib.GRRBaseTest):
     # Bring up a local server for testing.
     port = portpicker.PickUnusedPort()
     ip = utils.ResolveHostnameToIP("localhost", port)
-    cls.httpd = frontend.GRRHTTPServer((ip, port),
-                                       frontend.GRRHTTPServerHandler)
+    cls.httpd = cls.server_cls((ip, port), frontend.GRRHTTPServerHandler)
 
     if ipaddr.IPAddress(ip).version == 6:
       cls.address_family = socket.AF_INET6
       cls.base_url = "http://[%s]:%d/" % (ip, port)
     else:
-      cls.address_family = socket.AF_INET4
+      cls.address_family = socket.AF_INET
       cls.base_url = "http://%s:%d/" % (ip, port)
 
     cls.httpd_thread = threading.Thread(target=cls.httpd.serve_forever)
@@ -389,6 +390,87 @@ class GRRHTTPServerTest(test_lib.GRRBaseTest):
     self.assertEqual(profile.data[:2], "\x1f\x8b")
 
 
+class AsyncGRRHTTPServerTest(GRRHTTPServerTest):
+  """Runs the http server tests against the event loop based server."""
+
+  server_cls = frontend.AsyncGRRHTTPServer
+
+  def testManyConnections(self):
+    """Idle connections do not block requests from other clients."""
+    idle_connections = []
+    for _ in range(50):
+      sock = socket.socket(self.address_family, socket.SOCK_STREAM)
+      sock.connect(self.httpd.server_address[:2])
+      sock.sendall("POST /control HTTP/1.0\r\n")
+      idle_connections.append(sock)
+
+    try:
+      for _ in range(3):
+        req = requests.get(self.base_url + "server.pem")
+        self.assertEqual(req.status_code, 200)
+        self.assertTrue("BEGIN CERTIFICATE" in req.content)
+    finally:
+      for sock in idle_connections:
+        sock.close()
+
+  def _Connect(self):
+    sock = socket.socket(self.address_family, socket.SOCK_STREAM)
+    sock.settimeout(10)
+    sock.connect(self.httpd.server_address[:2])
+    return sock
+
+  def _ReadResponse(self, sock):
+    response = ""
+    while True:
+      data = sock.recv(4096)
+      if not data:
+        return response
+      response += data
+
+  def testLargeRequestsAreRejected(self):
+    with utils.Stubber(self.httpd, "max_request_size", 1000):
+      sock = self._Connect()
+      try:
+        sock.sendall("POST /control HTTP/1.0\r\nContent-Length: 1001\r\n\r\n")
+        self.assertTrue(self._ReadResponse(sock).startswith("HTTP/1.0 413"))
+      finally:
+        sock.close()
+
+      sock = self._Connect()
+      try:
+        sock.sendall("POST /control HTTP/1.1\r\n"
+                     "Transfer-Encoding: chunked\r\n\r\n")
+        for _ in range(5):
+          sock.sendall("100\r\n" + "x" * 0x100 + "\r\n")
+        self.assertTrue(self._ReadResponse(sock).startswith("HTTP/1.0 413"))
+      finally:
+        sock.close()
+
+      sock = self._Connect()
+      try:
+        sock.sendall("GET /server.pem HTTP/1.0\r\nX-Padding: %s\r\n\r\n" %
+                     ("x" * 1000))
+        self.assertTrue(self._ReadResponse(sock).startswith("HTTP/1.0 413"))
+      finally:
+        sock.close()
+
+    req = requests.get(self.base_url + "server.pem")
+    self.assertEqual(req.status_code, 200)
+
+  def testRequestsAreNotReadWhileTheBacklogIsFull(self):
+    sock = self._Connect()
+    try:
+      with utils.Stubber(self.httpd, "max_backlog", 0):
+        sock.settimeout(1)
+        sock.sendall("GET /server.pem HTTP/1.0\r\n\r\n")
+        self.assertRaises(socket.timeout, sock.recv, 4096)
+
+      sock.settimeout(10)
+      self.assertIn("BEGIN CERTIFICATE", self._ReadResponse(sock))
+    finally:
+      sock.close()
+
+
 def main(args):
   test_lib.main(args)
 
@@ -12,6 +12,7 @@ from grr.lib import server_plugins
 from grr.lib import aff4
 from grr.lib import data_store
 from grr.lib import flags
+from grr.lib import nsrl_index
 from grr.lib import server_startup
 from grr.lib import utils
 
@@ -19,6 +20,10 @@ from grr.lib.aff4_objects import filestore
 
 flags.DEFINE_string("filename", "", "File with hashes.")
 flags.DEFINE_integer("start", None, "Start row in the file.")
+flags.DEFINE_string("nsrl_index", "",
+                    "Stream the hashes into this NSRL index file instead of "
+                    "the data store. Point FileStore.nsrl_index_path at it "
+                    "to use it.")
 
 
 def _ImportRow(store, row, product_code_list, op_system_code_list):
@@ -33,7 +38,16 @@ def _ImportRow(store, row, product_code_list, op_system_code_list):
 
 
 def ImportFile(store, filename, start):
-  """Import hashes from 'filename' into 'store'."""
+  """Import hashes from 'filename' into 'store'.
+
+  Args:
+    store: An NSRLFileStore or an nsrl_index.NSRLIndexWriter.
+    filename: The NSRLFile.txt of the reference data set.
+    start: The row to start importing at.
+
+  Returns:
+    The number of rows read.
+  """
   with open(filename, "rb") as fp:
     reader = csv.reader(fp, delimiter=",", quotechar="\"")
     i = 0
@@ -87,6 +101,12 @@ def main(unused_argv):
     print "File %s does not exist" % filename
     return
 
+  if flags.FLAGS.nsrl_index:
+    writer = nsrl_index.NSRLIndexWriter(flags.FLAGS.nsrl_index)
+    ImportFile(writer, filename, flags.FLAGS.start)
+    print "Wrote %d hashes to %s" % (writer.Close(), flags.FLAGS.nsrl_index)
+    return
+
   with aff4.FACTORY.Create(
       filestore.NSRLFileStore.PATH,
       filestore.NSRLFileStore,
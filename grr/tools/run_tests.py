@@ -28,6 +28,7 @@ from grr.lib import utils
 from grr.parsers import tests
 from grr.path_detection import tests
 from grr.server import tests
+from grr.worker import worker_benchmark_test
 from grr.worker import worker_test
 # pylint: enable=unused-import,g-bad-import-order
 
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+"""Benchmarks several worker processes sharing an SQLite data store."""
+
+
+import multiprocessing
+import os
+import time
+
+
+from grr.lib import access_control
+from grr.lib import aff4
+from grr.lib import data_store
+from grr.lib import flags
+from grr.lib import flow
+from grr.lib import queue_manager
+from grr.lib import queues
+from grr.lib import stats
+from grr.lib import test_lib
+from grr.lib import utils
+from grr.lib import worker
+from grr.lib.data_stores import sqlite_data_store
+
+
+class WorkerBenchmarkFlow(flow.GRRFlow):
+  """A flow with a single state to run in the worker."""
+
+  PROCESSING_TIME = 0.02
+
+  @flow.StateHandler()
+  def Start(self):
+    self.CallState(next_state="Process")
+
+  @flow.StateHandler()
+  def Process(self, unused_responses=None):
+    time.sleep(self.PROCESSING_TIME)
+
+
+def RunWorkerProcess(start_event, stop_event, results):
+  """Runs a worker on a fresh data store connection until stop_event is set."""
+  # SQLite connections and thread pools can't be used across a fork.
+  data_store.DB = sqlite_data_store.SqliteDataStore()
+  aff4.FACTORY.Flush()
+  worker.GRRWorker.thread_pool = None
+
+  token = access_control.ACLToken(username="test", reason="benchmark")
+  worker_obj = worker.GRRWorker(
+      queues=[queues.FLOWS],
+      threadpool_prefix="benchmark_worker_%d" % os.getpid(),
+      threadpool_size=2,
+      token=token)
+
+  def GetCounts():
+    return (stats.STATS.GetMetricValue(
+        "worker_flow_processing_time", fields=["WorkerBenchmarkFlow"]).count,
+            stats.STATS.GetMetricValue("worker_flow_lock_error"))
+
+  # Counters are inherited from the parent process.
+  processed, lock_errors = GetCounts()
+
+  # Let all the workers settle on their shards before starting.
+  while not start_event.is_set():
+    worker_obj.next_rebalance = 0
+    worker_obj.RebalanceShards()
+    start_event.wait(0.2)
+
+  while not stop_event.is_set():
+    worker_obj.RebalanceShards()
+    if not worker_obj.RunOnce():
+      time.sleep(0.05)
+
+  worker_obj.thread_pool.Join()
+  if worker_obj.shard_leases is not None:
+    worker_obj.shard_leases.Release()
+
+  counts = GetCounts()
+  results.put((counts[0] - processed, counts[1] - lock_errors))
+
+
+class WorkerShardLeaseBenchmark(test_lib.MicroBenchmarks):
+  """Worker processes competing for shards vs. leasing their own shards."""
+
+  labels = ["benchmark"]
+  units = "ms"
+
+  FLOWS = 200
+  WORKERS = [1, 2, 4]
+  QUEUE_SHARDS = 8
+  TIMEOUT = 300
+
+  def setUp(self):
+    super(WorkerShardLeaseBenchmark, self).setUp(
+        ["Flows/s", "Lock errors", "Redundant runs"], ["<20", "<20", "<20"])
+    self.db_stubber = utils.Stubber(data_store, "DB", data_store.DB)
+    self.db_stubber.Start()
+
+  def tearDown(self):
+    super(WorkerShardLeaseBenchmark, self).tearDown()
+    self.db_stubber.Stop()
+
+  def _RunWorkers(self, num_workers, lease_queue_shards):
+    # Every run gets a fresh data store in the temp dir.
+    root_path = os.path.join(self.temp_dir, "sqlite_%d_%s" %
+                             (num_workers, lease_queue_shards))
+
+    with test_lib.ConfigOverrider({
+        "Datastore.location": root_path,
+        "Worker.queue_shards": self.QUEUE_SHARDS,
+        "Worker.lease_queue_shards": lease_queue_shards,
+        "Worker.queue_shard_lease_time": 3
+    }):
+      data_store.DB = sqlite_data_store.SqliteDataStore()
+      for _ in range(self.FLOWS):
+        flow.GRRFlow.StartFlow(
+            flow_name="WorkerBenchmarkFlow", queue=queues.FLOWS,
+            token=self.token)
+
+      # The workers open their own connections.
+      data_store.DB.cache.Flush()
+
+      start_event = multiprocessing.Event()
+      stop_event = multiprocessing.Event()
+      results = multiprocessing.Queue()
+      processes = [
+          multiprocessing.Process(
+              target=RunWorkerProcess,
+              args=(start_event, stop_event, results))
+          for _ in range(num_workers)
+      ]
+      for process in processes:
+        process.start()
+
+      try:
+        time.sleep(2)
+        manager = queue_manager.QueueManager(token=self.token)
+
+        start = time.time()
+        start_event.set()
+        while manager.GetNotificationsForAllShards(queues.FLOWS):
+          if time.time() - start > self.TIMEOUT:
+            self.fail("Workers did not process all the flows.")
+          time.sleep(0.05)
+        time_taken = time.time() - start
+
+      finally:
+        stop_event.set()
+        worker_results = [results.get() for _ in processes]
+        for process in processes:
+          process.join()
+
+    # Workers acting on outdated notifications process flows which have
+    # nothing left to do.
+    processed = sum(result[0] for result in worker_results)
+    lock_errors = sum(result[1] for result in worker_results)
+    self.assertGreaterEqual(processed, self.FLOWS)
+
+    self.AddResult("%d workers (%s)" % (num_workers, "leased shards"
+                                        if lease_queue_shards else
+                                        "all shards"),
+                   time_taken / self.FLOWS, self.FLOWS,
+                   "%.1f" % (self.FLOWS / time_taken), lock_errors,
+                   processed - self.FLOWS)
+
+  def testSharedShards(self):
+    """Workers polling all the notification shards."""
+    for num_workers in self.WORKERS:
+      self._RunWorkers(num_workers, False)
+
+  def testLeasedShards(self):
+    """Workers only processing their leased notification shards."""
+    for num_workers in self.WORKERS:
+      self._RunWorkers(num_workers, True)
+
+
+def main(argv):
+  test_lib.GrrTestProgram(argv=argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
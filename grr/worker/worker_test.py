@@ -18,6 +18,7 @@ from grr.lib import queue_manager
 from grr.lib import queues
 from grr.lib import rdfvalue
 from grr.lib import server_stubs
+from grr.lib import stats
 from grr.lib import test_lib
 from grr.lib import utils
 from grr.lib import worker
@@ -389,6 +390,62 @@ class GrrWorkerTest(test_lib.FlowTestsBaseclass):
         flow_obj.context.state == rdf_flows.FlowContext.State.TERMINATED)
     self.assertEqual(flow_obj.context.current_state, "End")
 
+  def testProcessMessagesInNotifiedShards(self):
+    """Notified shards are processed without polling all the shards."""
+    flow_obj = self.FlowSetup("WorkerSendingTestFlow")
+    session_id = flow_obj.session_id
+    flow_obj.Close()
+
+    worker_obj = worker.GRRWorker(token=self.token)
+    self.assertEqual(worker_obj.RunNotifiedShards(), 0)
+
+    latency_count = stats.STATS.GetMetricValue(
+        "worker_notification_latency").count
+
+    self.SendResponse(session_id, "Hello1")
+    self.assertTrue(worker_obj.notification_waiter.Wait(0))
+
+    self.assertEqual(worker_obj.RunNotifiedShards(), 1)
+    worker_obj.thread_pool.Join()
+    self.assertEqual(RESULTS, ["Hello1"])
+    self.assertEqual(
+        stats.STATS.GetMetricValue("worker_notification_latency").count,
+        latency_count + 1)
+
+    # The shard is dropped once it has no more notifications.
+    self.assertTrue(worker_obj.notified_shards)
+    self.assertEqual(worker_obj.RunNotifiedShards(), 0)
+    self.assertFalse(worker_obj.notified_shards)
+
+  def testWorkerOnlyProcessesLeasedShards(self):
+    flow_obj = self.FlowSetup("WorkerSendingTestFlow")
+    session_id = flow_obj.session_id
+    flow_obj.Close()
+
+    with test_lib.ConfigOverrider({"Worker.lease_queue_shards": True}):
+      # Another worker holds all the shards.
+      other_leases = queue_manager.QueueShardLeases(
+          [queues.FLOWS], token=self.token)
+      other_leases.Rebalance()
+
+      worker_obj = worker.GRRWorker(token=self.token)
+      worker_obj.RebalanceShards()
+      self.assertEqual(worker_obj.shard_leases.GetShards(queues.FLOWS), [])
+
+      self.SendResponse(session_id, "Hello1")
+      self.assertEqual(worker_obj.RunOnce(), 0)
+      self.assertEqual(worker_obj.RunNotifiedShards(), 0)
+
+      # Once the other worker is gone we take over its shards.
+      other_leases.Release()
+      worker_obj.next_rebalance = 0
+      worker_obj.RebalanceShards()
+      self.assertTrue(worker_obj.RunOnce())
+      worker_obj.thread_pool.Join()
+      self.assertEqual(RESULTS, ["Hello1"])
+
+      worker_obj.shard_leases.Release()
+
   def testNoNotificationRescheduling(self):
     """Test that no notifications are rescheduled when a flow raises."""
 